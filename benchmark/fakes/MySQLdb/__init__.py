@@ -0,0 +1,138 @@
+# A stand in for the MySQLdb driver.  Only the statements
+# issued by the backup tool are understood.  Put the
+# benchmark/fakes directory first on sys.path to use it.
+
+import binascii
+import datetime
+import random
+from benchmark.fakes import fake_server_state
+
+
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = ()
+
+    def execute(self, query, args=None):
+        statement = ' '.join(query.strip().rstrip(';').split()).upper()
+
+        if statement == 'SHOW DATABASES':
+            self.result = tuple({'Database': db} for db in fake_server_state.read_state()['databases'])
+
+        elif statement == 'SHOW SLAVE STATUS':
+            self.result = (dict(fake_server_state.get_slave(fake_server_state.read_state(), self.connection.host)),)
+
+        elif statement in ('START SLAVE', 'STOP SLAVE'):
+            running = 'Yes' if statement == 'START SLAVE' else 'No'
+
+            def set_slave(state):
+                slave = fake_server_state.get_slave(state, self.connection.host)
+                # A started slave catches up with what the master wrote meanwhile
+                if running == 'Yes' and slave['Slave_SQL_Running'] != 'Yes':
+                    slave['Exec_Master_Log_Pos'] += state.get('applied_per_start', 0)
+                slave['Slave_IO_Running'] = running
+                slave['Slave_SQL_Running'] = running
+            fake_server_state.update_state(set_slave)
+            self.result = ()
+
+        elif statement.startswith('START SLAVE UNTIL MASTER_LOG_FILE'):
+            log_file, position = args
+
+            def start_until(state):
+                # Applies up to the position and the sql thread stops there
+                slave = fake_server_state.get_slave(state, self.connection.host)
+                if slave['Relay_Master_Log_File'] == log_file:
+                    slave['Exec_Master_Log_Pos'] = max(slave['Exec_Master_Log_Pos'], position)
+                slave['Slave_IO_Running'] = 'Yes'
+                slave['Slave_SQL_Running'] = 'No'
+            fake_server_state.update_state(start_until)
+            self.result = ()
+
+        elif statement == 'SHOW MASTER STATUS':
+            binlog = fake_server_state.read_state().get('binlog')
+            self.result = ()
+            if binlog and binlog['files']:
+                last = sorted(binlog['files'])[-1]
+                events = binlog['files'][last]
+                self.result = ({'File': last, 'Position': events[-1]['End_log_pos'] if events else 4},)
+
+        elif statement == 'SHOW BINARY LOGS':
+            binlog = fake_server_state.read_state().get('binlog') or {'files': {}}
+            self.result = tuple({'Log_name': name} for name in sorted(binlog['files']))
+
+        elif statement.startswith('SHOW BINLOG EVENTS IN'):
+            log_name, position, limit = args
+            binlog = fake_server_state.read_state().get('binlog') or {'files': {}}
+            events = [event for event in binlog['files'].get(log_name, []) if event['Pos'] >= position]
+            self.result = tuple(dict(event, Log_name=log_name) for event in events[:limit])
+
+        elif statement.startswith('SELECT TABLE_NAME, TABLE_TYPE, UPDATE_TIME, TABLE_ROWS FROM INFORMATION_SCHEMA.TABLES'):
+            database = args[0]
+
+            def bump_tables(state):
+                # Each table may have been written since the last time it was asked about
+                rows = list()
+                for table in fake_server_state.get_tables(state, database):
+                    key = '%s.%s' % (database, table)
+                    generation = state['table_generations'].get(key, 0)
+                    if random.random() < state['dump']['change_probability']:
+                        generation += 1
+                        state['table_generations'][key] = generation
+                    rows.append({'TABLE_NAME': table, 'TABLE_TYPE': 'BASE TABLE',
+                                 'UPDATE_TIME': datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=generation),
+                                 'TABLE_ROWS': 1000})
+                return rows
+            self.result = tuple(fake_server_state.update_state(bump_tables))
+
+        elif statement.startswith('CHECKSUM TABLE'):
+            state = fake_server_state.read_state()
+            database = self.connection.db
+            tables = [table.strip().strip('`') for table in query.strip().rstrip(';')[len('CHECKSUM TABLE'):].split(',')]
+            self.result = tuple({'Table': '%s.%s' % (database, table),
+                                 'Checksum': binascii.crc32('%s.%s:%d' % (database, table, state['table_generations'].get(
+                                     '%s.%s' % (database, table), 0))) & 0xffffffff}
+                                for table in tables)
+
+        else:
+            raise OperationalError("The fake server does not understand: %s" % query)
+
+        return len(self.result)
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, host, user, passwd, db, cursorclass=None):
+        self.host = host
+        self.user = user
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect(host=None, user=None, passwd=None, db=None, **kwargs):
+    return FakeConnection(host, user, passwd, db, kwargs.get('cursorclass'))
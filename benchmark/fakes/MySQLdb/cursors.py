@@ -0,0 +1,5 @@
+# The fake driver always returns rows as dictionaries.
+
+
+class DictCursor(object):
+    pass
@@ -0,0 +1,36 @@
+# A stand in for lvcreate, lvdisplay and lvremove.  Snapshots
+# are symlinks in a fake device directory, which is all
+# LvSnapshot looks at.  The command is chosen by argv[1].
+
+import os
+import sys
+
+
+def lvcreate(argv):
+    name = argv[argv.index('--name') + 1]
+    origin = argv[-1]
+    snapshot = os.path.join(os.path.dirname(origin), name)
+    if not os.path.isdir(os.path.dirname(origin)):
+        os.makedirs(os.path.dirname(origin))
+    os.symlink(origin, snapshot)
+
+
+def lvdisplay(argv):
+    # lvdisplay -c: the sixth colon separated field is the open count
+    path = argv[-1]
+    if not os.path.islink(path):
+        sys.exit(5)
+    sys.stdout.write("  %s:vg:3:1:1:0:2097152:32:-1:0:-1:253:1\n" % path)
+
+
+def lvremove(argv):
+    os.unlink(argv[-1])
+
+
+def main():
+    commands = {'lvcreate': lvcreate, 'lvdisplay': lvdisplay, 'lvremove': lvremove}
+    commands[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# A stand in for /usr/bin/mysqldump.  Writes a deterministic
+# dump for a database at a configurable size and speed.  A
+# database's content only changes when its generation is
+# bumped, which happens at the change_probability configured
+# in the fake server state.
+
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from benchmark.fakes import fake_server_state
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def parse_arguments(argv):
+    """Return: (database, result_file or None, tables, options, host or None)"""
+    database = None
+    result_file = None
+    host = None
+    tables = list()
+    options = set()
+    skip_next = False
+    for i, arg in enumerate(argv):
+        if skip_next:
+            skip_next = False
+        elif arg in ('-u', '-h', '-P', '--result-file'):
+            if arg == '--result-file':
+                result_file = argv[i + 1]
+            elif arg == '-h':
+                host = argv[i + 1]
+            skip_next = True
+        elif arg.startswith('--result-file='):
+            result_file = arg.split('=', 1)[1]
+        elif arg.startswith('-'):
+            options.add(arg)
+        elif database is None:
+            database = arg
+        else:
+            tables.append(arg)
+    return database, result_file, tables, options, host
+
+
+def get_generation(database):
+    def bump(state):
+        generation = state['generations'].get(database, 0)
+        if random.random() < state['dump']['change_probability']:
+            generation += 1
+            state['generations'][database] = generation
+        return generation, state
+    return fake_server_state.update_state(bump)
+
+
+def count_dump(host):
+    def count(state):
+        dumps = state.setdefault('dumps_by_host', dict())
+        dumps[host or 'localhost'] = dumps.get(host or 'localhost', 0) + 1
+    fake_server_state.update_state(count)
+
+
+def get_chunk(database, generation):
+    """Return: a chunk of sql looking text unique to this database and generation"""
+    seed = hashlib.sha1('%s:%d' % (database, generation)).hexdigest()
+    line = "INSERT INTO `t` VALUES ('%s');\n" % seed
+    return (line * (CHUNK_SIZE // len(line) + 1))[:CHUNK_SIZE]
+
+
+def main():
+    database, result_file, tables, options, host = parse_arguments(sys.argv[1:])
+    count_dump(host)
+    if tables or '--no-data' in options:
+        # One table or the routines, see table_level_incremental
+        state = fake_server_state.read_state()
+        generation = 0
+    else:
+        generation, state = get_generation(database)
+
+    if database not in state['databases']:
+        sys.stderr.write("mysqldump: Got error: 1049: Unknown database '%s'\n" % database)
+        sys.exit(2)
+
+    total_bytes = state['database_sizes'].get(database, state['dump']['bytes'])
+    bytes_per_second = state['dump']['bytes_per_second']
+    if tables:
+        table_names = fake_server_state.get_tables(state, database)
+        generation = sum(state['table_generations'].get('%s.%s' % (database, table), 0) for table in tables)
+        chunk = get_chunk('%s.%s' % (database, ','.join(tables)), generation)
+        total_bytes = total_bytes * len(tables) // max(1, len(table_names))
+    elif '--no-data' in options:
+        chunk = get_chunk(database + '-routines', 0)
+        total_bytes = min(total_bytes, 1024)
+    else:
+        chunk = get_chunk(database, generation)
+
+    output = open(result_file, 'wb') if result_file else sys.stdout
+    header = "-- Fake dump of %s\n" % database
+    output.write(header)
+    written = len(header)
+    start = time.time()
+    while written < total_bytes:
+        piece = chunk[:total_bytes - written]
+        output.write(piece)
+        written += len(piece)
+        if bytes_per_second:
+            ahead = written / float(bytes_per_second) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    output.flush()
+    if result_file:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Fake server state
+# The fake MySQLdb module and the fake mysqldump binary
+# share one json state file, named by the FAKE_MYSQL_STATE
+# environment variable, so forked workers and child
+# processes all see the same server.
+
+import fcntl
+import json
+import os
+
+STATE_ENV = 'FAKE_MYSQL_STATE'
+
+
+def default_state(databases):
+    return {
+        'databases': ['information_schema', 'mysql', 'performance_schema'] + list(databases),
+        'slave': {
+            'Slave_IO_Running': 'Yes',
+            'Slave_SQL_Running': 'Yes',
+            'Seconds_Behind_Master': 0,
+            'Executed_Gtid_Set': '',
+            'Relay_Master_Log_File': 'master-bin.000001',
+            'Exec_Master_Log_Pos': 4,
+        },
+        # host -> slave status of further replicas, 'slave' is that of
+        # any other host
+        'replicas': dict(),
+        # bytes of master binlog applied each time the slave starts
+        'applied_per_start': 1000,
+        # the slave's own binlog: {'files': {name: [events]}}, events
+        # as SHOW BINLOG EVENTS returns them.  None = binary logging off.
+        'binlog': None,
+        'dump': {
+            # bytes written per dump unless overridden in database_sizes
+            'bytes': 1024 * 1024,
+            # 0 = as fast as possible
+            'bytes_per_second': 0,
+            # chance a database changed since its last dump
+            'change_probability': 0.5,
+            # tables per database, each changes at change_probability
+            # between two fingerprint queries (table_level_incremental)
+            'tables': 1,
+        },
+        'database_sizes': dict(),
+        'generations': dict(),
+        # 'database.table' -> generation
+        'table_generations': dict(),
+        # host -> dumps taken from it
+        'dumps_by_host': dict(),
+    }
+
+
+def add_replicas(state, hosts, behind=0):
+    """Add replicas of the same master, each behind bytes further behind"""
+    for i, host in enumerate(hosts):
+        slave = dict(state['slave'])
+        slave['Exec_Master_Log_Pos'] = max(4, slave['Exec_Master_Log_Pos'] - behind * (i + 1))
+        state['replicas'][host] = slave
+
+
+def get_state_file():
+    state_file = os.environ.get(STATE_ENV)
+    if not state_file:
+        raise RuntimeError("%s must name the fake server state file." % STATE_ENV)
+    return state_file
+
+
+def write_state(state, state_file=None):
+    state_file = state_file or get_state_file()
+    with open(state_file, 'w') as state_pointer:
+        json.dump(state, state_pointer, indent=2, sort_keys=True)
+
+
+def read_state():
+    with open(get_state_file()) as state_pointer:
+        fcntl.flock(state_pointer, fcntl.LOCK_SH)
+        return json.load(state_pointer)
+
+
+def update_state(update_function):
+    """Apply update_function(state) under an exclusive lock.
+    Return: whatever update_function returns"""
+    with open(get_state_file(), 'r+') as state_pointer:
+        fcntl.flock(state_pointer, fcntl.LOCK_EX)
+        state = json.load(state_pointer)
+        result = update_function(state)
+        state_pointer.seek(0)
+        state_pointer.truncate()
+        json.dump(state, state_pointer, indent=2, sort_keys=True)
+        return result
+
+
+def get_slave(state, host):
+    """Return: the slave status of host, changed in place by updates"""
+    return state.get('replicas', {}).get(host, state['slave'])
+
+
+def get_tables(state, database):
+    """Return: the names of the tables of database"""
+    return ['t%03d' % i for i in range(state['dump'].get('tables', 1))]
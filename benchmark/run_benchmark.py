@@ -0,0 +1,594 @@
+#!/usr/bin/python
+
+# Benchmark the hot paths of a backup run against a fake
+# MySQL server, fake lvm binaries and a synthetic backup
+# tree.  Results are appended to a history file and
+# compared with earlier comparable runs so regressions
+# are caught.  Importing the package is held to a time
+# budget and must not load the modules only a run needs.
+#
+# ex: python -m benchmark.run_benchmark --databases 50 --instances 200
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES_DIR = os.path.join(REPO_DIR, 'benchmark', 'fakes')
+
+# The fake MySQLdb must win over any installed driver
+sys.path.insert(0, FAKES_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from benchmark import synthetic_tree
+from benchmark.fakes import fake_server_state
+
+SETTINGS_TEMPLATE = """
+[MySQL]
+username = bench
+password =
+host = %(hosts)s
+dump_options = --triggers --routines --events
+mysqldump_command = %(bin_dir)s/mysqldump
+
+[Logging]
+logfile = %(workspace)s/backup.log
+loglevel = %(loglevel)s
+
+[Backup]
+compression_enabled = True
+compress_command = %(compress_command)s
+decompress_command = %(decompress_command)s
+compressed_file_extension = %(compressed_file_extension)s
+max_parallel = %(max_parallel)s
+cleanup_delay_days = 30
+running_cache_file = %(workspace)s/running_cache
+cache_lock_wait = 300
+cache_successful_run_purge_days = 30
+incremental_path = %(workspace)s/incrementals
+incremental_min_backup_frequency_seconds
+incremental_max_lifespan_seconds
+incremental_max_copies = %(incremental_max_copies)s
+incremental_cleanup_delay_days = 30
+long_term_backup_path = %(workspace)s/long_term
+long_term_backup_min_frequency_seconds = 86400
+long_term_max_lifespan_seconds
+long_term_backup_max_copies = %(long_term_backup_max_copies)s
+
+[Snapshot]
+name = bench_snap
+vg = benchvg
+lv = benchlv
+size_gb = 1
+lvm_bin_dir = %(bin_dir)s
+dev_dir = %(workspace)s/dev
+
+[Limits]
+exclude_databases = information_schema, performance_schema, mysql
+include_only_databases
+
+[Metrics]
+report_file = %(workspace)s/run_report.json
+"""
+
+COMPRESSORS = (
+    ('pbzip2', 'bz2'),
+    ('bzip2', 'bz2'),
+    ('gzip', 'gz'),
+)
+
+
+def find_compressor():
+    """Return: (compress_command, decompress_command, extension)"""
+    for binary, extension in COMPRESSORS:
+        for directory in os.environ.get('PATH', '/bin:/usr/bin').split(os.pathsep):
+            full_path = os.path.join(directory, binary)
+            if os.access(full_path, os.X_OK):
+                return full_path + ' -k -f', full_path + ' -d -k -f', extension
+    raise RuntimeError("No compressor (pbzip2, bzip2 or gzip) was found on the PATH.")
+
+
+def get_peak_rss_kb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_rss_kb():
+    """Return: current resident set size or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_deep_size(obj, seen=None):
+    """Approximate bytes held by obj, following containers, __dict__
+    and __slots__ but never class level or shared objects twice."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(get_deep_size(k, seen) + get_deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_deep_size(item, seen) for item in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += get_deep_size(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    size += get_deep_size(getattr(obj, slot), seen)
+    return size
+
+
+# Filled in by phases that measure memory, reported with the timings
+MEMORY_RESULTS = dict()
+
+# Filled in by phase_import, checked against --import-budget-ms
+IMPORT_RESULTS = dict()
+
+# Filled in by the page cache phases, phase -> residency after the run
+CACHE_RESULTS = dict()
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Workspace(object):
+    """A scratch directory with a settings file, fake binaries,
+    fake server state and a synthetic backup tree."""
+
+    def __init__(self, options):
+        self.options = options
+        self.workspace = tempfile.mkdtemp(prefix='mysql_backup_bench_', dir=options.work_dir)
+        self.bin_dir = os.path.join(self.workspace, 'bin')
+        self.incremental_path = os.path.join(self.workspace, 'incrementals')
+        self.long_term_path = os.path.join(self.workspace, 'long_term')
+        self.settings_file = os.path.join(self.workspace, 'settings.ini')
+        self.state_file = os.path.join(self.workspace, 'fake_server.json')
+        self.compress_command, self.decompress_command, self.compressed_file_extension = find_compressor()
+
+        os.makedirs(self.bin_dir)
+        os.makedirs(os.path.join(self.workspace, 'dev', 'benchvg'))
+        self.write_fake_binaries()
+        self.write_settings()
+        self.write_fake_server_state()
+
+    def write_fake_binaries(self):
+        wrappers = {
+            'mysqldump': '%s %s/fake_mysqldump.py "$@"',
+            'lvcreate': '%s %s/fake_lvm.py lvcreate "$@"',
+            'lvdisplay': '%s %s/fake_lvm.py lvdisplay "$@"',
+            'lvremove': '%s %s/fake_lvm.py lvremove "$@"',
+        }
+        for name, command in wrappers.items():
+            wrapper = os.path.join(self.bin_dir, name)
+            with open(wrapper, 'w') as wrapper_file:
+                wrapper_file.write('#!/bin/sh\nexec ' + command % (sys.executable, FAKES_DIR) + '\n')
+            os.chmod(wrapper, 0o755)
+
+    def write_settings(self):
+        with open(self.settings_file, 'w') as settings:
+            settings.write(SETTINGS_TEMPLATE % {
+                'workspace': self.workspace,
+                'bin_dir': self.bin_dir,
+                'loglevel': self.options.loglevel,
+                'compress_command': self.compress_command,
+                'decompress_command': self.decompress_command,
+                'compressed_file_extension': self.compressed_file_extension,
+                'max_parallel': self.options.max_parallel,
+                'hosts': ', '.join(['localhost'] + self.get_replica_hosts()),
+                'incremental_max_copies': max(1, self.options.instances // 2),
+                'long_term_backup_max_copies': max(1, self.options.instances // 48),
+            })
+
+    def get_replica_hosts(self):
+        """Return: the replicas besides localhost"""
+        return ['replica%d' % i for i in range(1, self.options.replicas)]
+
+    def write_fake_server_state(self):
+        state = fake_server_state.default_state(synthetic_tree.get_database_names(self.options.databases))
+        # Each further replica a little behind the one before, so they catch up
+        state['slave']['Exec_Master_Log_Pos'] += 100 * len(self.get_replica_hosts())
+        fake_server_state.add_replicas(state, self.get_replica_hosts(), behind=100)
+        state['dump']['bytes'] = self.options.dump_bytes
+        state['dump']['bytes_per_second'] = self.options.dump_bytes_per_second
+        state['dump']['change_probability'] = self.options.change_probability
+        fake_server_state.write_state(state, self.state_file)
+        os.environ[fake_server_state.STATE_ENV] = self.state_file
+
+    def reset_tree(self):
+        """Throw away the backup tree and build a fresh one"""
+        for path in (self.incremental_path, self.long_term_path):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        return synthetic_tree.build_tree(self.incremental_path, self.long_term_path,
+                                         database_count=self.options.databases,
+                                         instances_per_database=self.options.instances,
+                                         junk_files=self.options.junk_files,
+                                         compressed_file_extension=self.compressed_file_extension)
+
+    def remove(self):
+        shutil.rmtree(self.workspace)
+
+
+def time_call(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def phase_startup_scan(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup
+    workspace.reset_tree()
+    backup = MysqlBackup(workspace.settings_file)
+    db_instances = list()
+    rss_before = get_rss_kb()
+    seconds = time_call(lambda: db_instances.extend(backup.get_db_backup_instances_from_files()))
+    rss_after = get_rss_kb()
+
+    file_count = sum(len(bkinst.bkup_file_objs) for db_instance in db_instances
+                     for bkinst in db_instance.mysql_backup_instances)
+    catalog_bytes = get_deep_size(db_instances)
+    MEMORY_RESULTS['startup_scan'] = {
+        'files': file_count,
+        'catalog_bytes': catalog_bytes,
+        'bytes_per_file': catalog_bytes // file_count if file_count else 0,
+        'rss_growth_kb': rss_after - rss_before if None not in (rss_before, rss_after) else None,
+    }
+    return seconds
+
+
+def phase_set_correct_state(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup
+    workspace.reset_tree()
+    backup = MysqlBackup(workspace.settings_file)
+    db_instances = backup.get_db_backup_instances_from_files()
+
+    def set_correct_state():
+        for db_instance in db_instances:
+            db_instance.set_correct_state()
+    return time_call(set_correct_state)
+
+
+def phase_reconcile(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup
+    workspace.reset_tree()
+    backup = MysqlBackup(workspace.settings_file)
+    backup.mysql_db_backup_instances = backup.get_db_backup_instances_from_files()
+    return time_call(backup.reconcile_instances)
+
+
+def phase_cleanup(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup
+    workspace.reset_tree()
+    backup = MysqlBackup(workspace.settings_file)
+    backup.mysql_db_backup_instances = backup.get_db_backup_instances_from_files()
+    return time_call(backup.clean_non_backup_files)
+
+
+def phase_compression(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup, MysqlBackupFileFactory
+    workspace.reset_tree()
+    config = MysqlBackup(workspace.settings_file).config
+    dumps = synthetic_tree.build_uncompressed_dumps(workspace.incremental_path,
+                                                    min(workspace.options.databases, 8),
+                                                    workspace.options.dump_bytes)
+
+    def compress():
+        for dump in dumps:
+            ucpf = MysqlBackupFileFactory.get_file_object(config, dump)
+            MysqlBackupFileFactory.create_file_object(config, ucpf.db_name, ucpf=ucpf)
+    return time_call(compress)
+
+
+def phase_execute(workspace):
+    from mysql_backup.mysql_backup import MysqlBackup
+    workspace.reset_tree()
+    backup = MysqlBackup(workspace.settings_file)
+    return time_call(backup.execute)
+
+
+def phase_catalog_refresh(workspace):
+    """The next run of a daemon after a few backup files appeared:
+    the watched listing takes the changes and the catalog is rebuilt"""
+    from mysql_backup.mysql_backup import MysqlBackup
+    from mysql_backup.mysql_backup_directory_snapshot import BackupDirectorySnapshot
+    workspace.reset_tree()
+    BackupDirectorySnapshot.persistent = True
+    try:
+        backup = MysqlBackup(workspace.settings_file)
+        backup.load_catalog()
+        synthetic_tree.build_uncompressed_dumps(workspace.incremental_path, min(workspace.options.databases, 8), 1024)
+
+        def refresh():
+            BackupDirectorySnapshot.refresh()
+            backup.load_catalog()
+        return time_call(refresh)
+    finally:
+        BackupDirectorySnapshot.persistent = False
+        BackupDirectorySnapshot.reset()
+
+
+# Must not be loaded by importing the package, only by a run that needs them
+DEFERRED_MODULES = ('MySQLdb', 'joblib', 'numpy', 'psutil', 'cProfile', 'boto3', 'ctypes')
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import mysql_backup.mysql_backup
+print(json.dumps({'seconds': time.time() - start,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def phase_import(workspace):
+    """Import the package in a fresh interpreter, as cron would"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([FAKES_DIR, REPO_DIR])
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % (DEFERRED_MODULES,)],
+                                     cwd=REPO_DIR, env=env)
+    measured = json.loads(output.strip().splitlines()[-1])
+    IMPORT_RESULTS.setdefault('loaded', set()).update(measured['loaded'])
+    return measured['seconds']
+
+
+def phase_nothing_due(workspace):
+    """A whole run.py invocation that finds nothing due"""
+    workspace.reset_tree()
+    settings_file = os.path.join(workspace.workspace, 'settings_nothing_due.ini')
+    with open(workspace.settings_file) as settings, open(settings_file, 'w') as nothing_due:
+        nothing_due.write(settings.read().replace('\nincremental_min_backup_frequency_seconds\n',
+                                                  '\nincremental_min_backup_frequency_seconds = 315360000\n'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = FAKES_DIR
+    command = [sys.executable, os.path.join(REPO_DIR, 'run.py'), '-s', settings_file]
+    # The first run records a successful run for the second to rely on
+    subprocess.check_call(command, env=env)
+    return time_call(lambda: subprocess.check_call(command, env=env))
+
+
+def time_logged_state(workspace, loglevel):
+    """The startup scan and set_correct_state logging at loglevel,
+    until the records are in the log file"""
+    from mysql_backup.mysql_backup import MysqlBackup
+    from mysql_backup.mysql_backup_logging import RunLog
+    workspace.reset_tree()
+    settings_file = os.path.join(workspace.workspace, 'settings_%s.ini' % loglevel.lower())
+    with open(workspace.settings_file) as settings, open(settings_file, 'w') as variant:
+        variant.write(settings.read().replace('\nloglevel = %s\n' % workspace.options.loglevel,
+                                              '\nloglevel = %s\n' % loglevel))
+    backup = MysqlBackup(settings_file)
+
+    def logged_state():
+        for db_instance in backup.get_db_backup_instances_from_files():
+            db_instance.set_correct_state()
+        RunLog.flush(backup.config)
+    return time_call(logged_state)
+
+
+def get_tree_files(workspace):
+    files = list()
+    for path in (workspace.incremental_path, workspace.long_term_path):
+        for directory, _, file_names in os.walk(path):
+            files.extend(os.path.join(directory, file_name) for file_name in file_names)
+    return files
+
+
+def get_tree_residency(workspace):
+    """Return: (bytes of the backup tree in the page cache, bytes of the tree)"""
+    from mysql_backup.mysql_backup_page_cache import PageCache
+    resident_total, size_total = 0, 0
+    for file_name in get_tree_files(workspace):
+        resident, size = PageCache.get_resident_bytes(file_name)
+        resident_total += resident or 0
+        size_total += size
+    return resident_total, size_total
+
+
+def time_cached_execute(workspace, name, page_cache_drop):
+    """A whole run, starting with none of the backup tree in the page
+    cache.  Records how much of the tree the run left in it."""
+    from mysql_backup.mysql_backup import MysqlBackup
+    from mysql_backup.mysql_backup_page_cache import PageCache
+    workspace.reset_tree()
+    settings_file = os.path.join(workspace.workspace, 'settings_%s.ini' % name)
+    with open(workspace.settings_file) as settings, open(settings_file, 'w') as variant:
+        variant.write(settings.read() + '\n[Throttle]\npage_cache_drop = %s\n' % page_cache_drop)
+    for file_name in get_tree_files(workspace):
+        with open(file_name) as file_pointer:
+            os.fsync(file_pointer.fileno())
+            PageCache.fadvise_dontneed(file_pointer.fileno(), 0, 0)
+    before = get_tree_residency(workspace)[0]
+    seconds = time_call(MysqlBackup(settings_file).execute)
+    resident, size = get_tree_residency(workspace)
+    CACHE_RESULTS[name] = {'resident_before': before, 'resident_after': resident, 'tree_bytes': size}
+    return seconds
+
+
+def phase_page_cache_kept(workspace):
+    return time_cached_execute(workspace, 'page_cache_kept', False)
+
+
+def phase_page_cache_dropped(workspace):
+    """Compared with page_cache_kept, what the run leaves in the page cache"""
+    return time_cached_execute(workspace, 'page_cache_dropped', True)
+
+
+def phase_logging_info(workspace):
+    return time_logged_state(workspace, 'INFO')
+
+
+def phase_logging_debug(workspace):
+    """Compared with logging_info, what DEBUG records cost"""
+    return time_logged_state(workspace, 'DEBUG')
+
+
+PHASES = (
+    ('import', phase_import),
+    ('nothing_due', phase_nothing_due),
+    ('startup_scan', phase_startup_scan),
+    ('catalog_refresh', phase_catalog_refresh),
+    ('set_correct_state', phase_set_correct_state),
+    ('reconcile', phase_reconcile),
+    ('logging_info', phase_logging_info),
+    ('logging_debug', phase_logging_debug),
+    ('cleanup', phase_cleanup),
+    ('compression', phase_compression),
+    ('execute', phase_execute),
+    ('page_cache_kept', phase_page_cache_kept),
+    ('page_cache_dropped', phase_page_cache_dropped),
+)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def load_history(history_file):
+    history = list()
+    if os.path.isfile(history_file):
+        with open(history_file) as history_pointer:
+            for line in history_pointer:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+
+def find_regressions(result, history, window, threshold):
+    """Compare each phase with the median of the last window comparable runs.
+    return: list of (phase, baseline seconds, current seconds)"""
+    comparable = [h for h in history if h.get('parameters') == result['parameters']][-window:]
+    regressions = list()
+    for phase, seconds in result['phases'].items():
+        previous = [h['phases'][phase] for h in comparable if phase in h.get('phases', {})]
+        if previous:
+            baseline = median(previous)
+            if seconds > baseline * (1 + threshold):
+                regressions.append((phase, baseline, seconds))
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--databases", type="int", default=20, help="Databases in the synthetic tree.")
+    parser.add_option("--instances", type="int", default=100, help="Backup instances per database.")
+    parser.add_option("--junk-files", type="int", default=100, help="Non backup files to clean up.")
+    parser.add_option("--dump-bytes", type="int", default=4 * 1024 * 1024, help="Size of each fake dump.")
+    parser.add_option("--dump-bytes-per-second", type="int", default=0,
+                      help="Throttle the fake mysqldump (0 = unthrottled).")
+    parser.add_option("--change-probability", type="float", default=0.5,
+                      help="Chance a database changed between dumps.")
+    parser.add_option("--max-parallel", type="int", default=0, help="max_parallel for the backup run.")
+    parser.add_option("--replicas", type="int", default=1,
+                      help="Equivalent replicas the fake server has, the databases are dumped from all of them.")
+    parser.add_option("--repeat", type="int", default=3, help="Runs per phase, the median is kept.")
+    parser.add_option("--phases", default=','.join(p[0] for p in PHASES), help="Comma separated phases to run.")
+    parser.add_option("--loglevel", default="INFO", help="Log level of the backup run.")
+    parser.add_option("--work-dir", default=None, help="Where to build scratch trees.")
+    parser.add_option("--keep-workspace", action="store_true", default=False,
+                      help="Leave the scratch tree, logs and reports behind for inspection.")
+    parser.add_option("--history-file", default=os.path.join(REPO_DIR, 'benchmark', 'results', 'history.jsonl'),
+                      help="Where results are appended.")
+    parser.add_option("--history-window", type="int", default=5, help="Earlier runs to compare against.")
+    parser.add_option("--threshold", type="float", default=0.2,
+                      help="Fractional slow down that counts as a regression.")
+    parser.add_option("--fail-on-regression", action="store_true", default=False,
+                      help="Exit non zero when a regression is found.")
+    parser.add_option("--import-budget-ms", type="float", default=100,
+                      help="Exit non zero when importing the package takes longer or loads a deferred module.")
+    (options, args) = parser.parse_args()
+
+    requested_phases = [p.strip() for p in options.phases.split(',')]
+    workspace = Workspace(options)
+    phase_results = dict()
+    try:
+        for name, phase in PHASES:
+            if name in requested_phases:
+                timings = [phase(workspace) for _ in range(options.repeat)]
+                phase_results[name] = median(timings)
+                print "%-20s %10.4fs  (runs: %s)" % (name, phase_results[name],
+                                                     ', '.join('%.4f' % t for t in timings))
+    finally:
+        if options.keep_workspace:
+            print "workspace kept at %s" % workspace.workspace
+        else:
+            workspace.remove()
+
+    result = {
+        'timestamp': int(time.time()),
+        'git_commit': get_git_commit(),
+        'python': sys.version.split()[0],
+        'parameters': {
+            'databases': options.databases,
+            'instances': options.instances,
+            'junk_files': options.junk_files,
+            'dump_bytes': options.dump_bytes,
+            'dump_bytes_per_second': options.dump_bytes_per_second,
+            'change_probability': options.change_probability,
+            'max_parallel': options.max_parallel,
+            'replicas': options.replicas,
+            'loglevel': options.loglevel,
+        },
+        'phases': phase_results,
+        'peak_rss_kb': get_peak_rss_kb(),
+        'memory': MEMORY_RESULTS,
+        'page_cache': CACHE_RESULTS,
+    }
+    if phase_results.get('logging_info') and 'logging_debug' in phase_results:
+        result['debug_logging_overhead'] = phase_results['logging_debug'] / phase_results['logging_info'] - 1
+
+    history = load_history(options.history_file)
+    regressions = find_regressions(result, history, options.history_window, options.threshold)
+
+    if not os.path.isdir(os.path.dirname(options.history_file)):
+        os.makedirs(os.path.dirname(options.history_file))
+    with open(options.history_file, 'a') as history_pointer:
+        history_pointer.write(json.dumps(result, sort_keys=True) + '\n')
+
+    print "peak rss: %d kB" % result['peak_rss_kb']
+    for phase, memory in sorted(MEMORY_RESULTS.items()):
+        print "%s memory: %s" % (phase, ', '.join('%s=%s' % item for item in sorted(memory.items())))
+    if 'debug_logging_overhead' in result:
+        print "DEBUG logging overhead: %.1f%% over INFO" % (result['debug_logging_overhead'] * 100)
+    for phase, residency in sorted(CACHE_RESULTS.items()):
+        print "%s residency: %d kB of the %d kB tree in the page cache after the run (%d kB before)" % (
+            phase, residency['resident_after'] // 1024, residency['tree_bytes'] // 1024,
+            residency['resident_before'] // 1024)
+    for phase, baseline, seconds in regressions:
+        print "REGRESSION %s: %.4fs, baseline %.4fs" % (phase, seconds, baseline)
+
+    budget_exceeded = False
+    if 'import' in phase_results:
+        if phase_results['import'] * 1000 > options.import_budget_ms:
+            print "IMPORT BUDGET EXCEEDED: %.1fms, budget %.1fms" % (phase_results['import'] * 1000,
+                                                                  options.import_budget_ms)
+            budget_exceeded = True
+        if IMPORT_RESULTS.get('loaded'):
+            print "IMPORT BUDGET EXCEEDED: importing the package loaded %s" % ', '.join(sorted(IMPORT_RESULTS['loaded']))
+            budget_exceeded = True
+
+    if budget_exceeded or (regressions and options.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
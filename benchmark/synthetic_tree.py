@@ -0,0 +1,80 @@
+# Synthetic backup trees
+# Builds incremental_path and long_term_backup_path
+# directories that look like years of backup history
+# without running a single dump.
+
+import hashlib
+import os
+import time
+
+
+def get_database_names(database_count):
+    return ['benchdb%04d' % i for i in range(database_count)]
+
+
+def build_tree(incremental_path, long_term_backup_path, database_count, instances_per_database,
+               interval_seconds=3600, long_term_every=24, junk_files=0, compressed_file_extension='bz2',
+               data_file_bytes=256):
+    """Create database_count * instances_per_database backup instances.
+    Every long_term_every'th instance also gets a long term copy.
+    junk_files non backup files, old enough to be cleaned up, are
+    spread across both paths.
+
+    return: dict with counts of what was created"""
+    for path in (incremental_path, long_term_backup_path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    now = int(time.time())
+    payload = 'x' * data_file_bytes
+    created = {'instances': 0, 'files': 0, 'long_term_copies': 0, 'junk_files': 0}
+
+    for db_name in get_database_names(database_count):
+        for i in range(instances_per_database):
+            ts = now - (i + 1) * interval_seconds
+            file_name_no_ext = db_name + '__' + time.strftime("%Y%m%d-%H%M%S", time.localtime(ts))
+            data_file_name = file_name_no_ext + '.sql.' + compressed_file_extension
+
+            with open(os.path.join(incremental_path, data_file_name), 'w') as data_file:
+                data_file.write(payload)
+            with open(os.path.join(incremental_path, file_name_no_ext + '.md5'), 'w') as checksum_file:
+                checksum_file.write(hashlib.md5(file_name_no_ext).hexdigest())
+            created['instances'] += 1
+            created['files'] += 2
+
+            if long_term_every and i % long_term_every == 0:
+                with open(os.path.join(long_term_backup_path, data_file_name), 'w') as data_file:
+                    data_file.write(payload)
+                created['long_term_copies'] += 1
+
+    old = now - 365 * 86400
+    for i in range(junk_files):
+        path = (incremental_path, long_term_backup_path)[i % 2]
+        junk_file_name = os.path.join(path, 'not_a_backup_%06d.txt' % i)
+        with open(junk_file_name, 'w') as junk_file:
+            junk_file.write(payload)
+        os.utime(junk_file_name, (old, old))
+        created['junk_files'] += 1
+
+    return created
+
+
+def build_uncompressed_dumps(incremental_path, database_count, dump_bytes):
+    """Create one uncompressed dump per database for compression timing.
+    return: list of full paths"""
+    if not os.path.isdir(incremental_path):
+        os.makedirs(incremental_path)
+    date_string = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+    line = "INSERT INTO `t` VALUES (1,'benchmark row'),(2,'another benchmark row');\n"
+    block = line * (1024 * 1024 // len(line))
+    dumps = list()
+    for db_name in get_database_names(database_count):
+        dump_file_name = os.path.join(incremental_path, db_name + '__' + date_string + '.sql')
+        with open(dump_file_name, 'w') as dump_file:
+            written = 0
+            while written < dump_bytes:
+                piece = block[:dump_bytes - written]
+                dump_file.write(piece)
+                written += len(piece)
+        dumps.append(dump_file_name)
+    return dumps
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# Restore single tables from a backup compressed as frames
+# (compression_format = frames).  Only the frames holding
+# the tables are read and decompressed, several at a time.
+#
+# ex: python extract.py -f /incrementals/shop__20240101-000000.sql.bz2 -t orders -t customers > part.sql
+
+import os
+import sys
+
+from optparse import OptionParser
+
+def main():
+
+    parser = OptionParser(usage="usage: %prog [options]",
+                          version="%prog 1.0")
+    parser.add_option("-f", "--file",
+                      action="store",
+                      dest="file_name",
+                      default=False,
+                      help="The compressed backup file.  Its index must be next to it.")
+    parser.add_option("-t", "--table",
+                      action="append",
+                      dest="tables",
+                      default=[],
+                      help="A table to extract, may be given more than once.")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      dest="output",
+                      default=None,
+                      help="Where to write the sql.  Defaults to stdout.")
+    parser.add_option("-j", "--threads",
+                      action="store",
+                      type="int",
+                      dest="threads",
+                      default=4,
+                      help="Frames decompressed at a time.")
+    parser.add_option("-l", "--list",
+                      action="store_true",
+                      dest="list_sections",
+                      default=False,
+                      help="List the sections of the backup instead.")
+
+    (options, args) = parser.parse_args()
+
+    if not options.file_name:
+        print "File argument is required.  Run with -h to see more information."
+        sys.exit(-1)
+
+    if not options.tables and not options.list_sections:
+        print "At least one table or --list is required.  Run with -h to see more information."
+        sys.exit(-1)
+
+    file_name = os.path.abspath(options.file_name)
+    output_name = os.path.abspath(options.output) if options.output else None
+
+    # Always run local to the extract.py so user modules import properly.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    from mysql_backup.mysql_backup_frames import DumpFrames
+
+    index_name = DumpFrames.get_index_name(file_name)
+    if not os.path.isfile(index_name):
+        print "%s has no index.  It was not compressed as frames; decompress all of it instead." % file_name
+        sys.exit(-1)
+    index = DumpFrames.read_index(index_name)
+
+    if options.list_sections:
+        for kind, table, first, end in DumpFrames.get_sections(index):
+            print "%-10s %-40s frames %d-%d" % (kind, table or '', first, end - 1)
+        return
+
+    missing = set(options.tables) - set(table for _, table, _, _ in DumpFrames.get_sections(index))
+    if missing:
+        print "Not in the backup: %s" % ', '.join(sorted(missing))
+        sys.exit(-1)
+
+    if output_name:
+        with open(output_name, 'wb') as output:
+            DumpFrames.extract(file_name, index, options.tables, output, options.threads)
+    else:
+        DumpFrames.extract(file_name, index, options.tables, sys.stdout, options.threads)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 from os.path import islink
 import subprocess
-import mysql_backup.mysql_backup
+from run_metrics.run_metrics import RunMetrics
 
 
 class LvSnapshot:
@@ -8,14 +8,18 @@ class LvSnapshot:
 
     backup_logger = None
 
-    def __init__(self, vg, lv, snapshot_name, size_gb):
-        """provide vg,lv, snapshot_name, and size_mb (snapshot allocation size) to this constructor"""
+    def __init__(self, config):
+        """provide the run's config, its snapshot_vg, snapshot_lv, snapshot_name and snapshot_size_gb
+        (snapshot allocation size) describe the snapshot.  snapshot_lvm_bin_dir and snapshot_dev_dir
+        only need changing for non standard installs or test harnesses."""
 
-        self.vg = vg
-        self.lv = lv
-        self.snapshot_name = snapshot_name
-        self.size_gb = size_gb
-        LvSnapshot.backup_logger = mysql_backup.mysql_backup.MysqlBackup.backup_logger
+        self.vg = config.snapshot_vg
+        self.lv = config.snapshot_lv
+        self.snapshot_name = config.snapshot_name
+        self.size_gb = config.snapshot_size_gb
+        self.lvm_bin_dir = config.snapshot_lvm_bin_dir.rstrip('/')
+        self.dev_dir = config.snapshot_dev_dir.rstrip('/')
+        LvSnapshot.backup_logger = config.get_logger('snapshot')
 
     def __str__(self):
         return "/" + self.vg + "/" + self.lv + "/" + self.snapshot_name + " snapshot instance"
@@ -25,9 +29,9 @@ class LvSnapshot:
         Whether or not a snapshot already exists.  If is_mounted is True
         will return True only when the snapshot exists and is mounted."""
         if not is_mounted:
-            return islink('/dev/'+self.vg+'/'+self.snapshot_name)
-        elif islink('/dev/'+self.vg+'/'+self.snapshot_name):
-            cmd = ['/sbin/lvdisplay', '-c', '/dev/'+self.vg+'/'+self.snapshot_name,]
+            return islink(self.dev_dir+'/'+self.vg+'/'+self.snapshot_name)
+        elif islink(self.dev_dir+'/'+self.vg+'/'+self.snapshot_name):
+            cmd = [self.lvm_bin_dir+'/lvdisplay', '-c', self.dev_dir+'/'+self.vg+'/'+self.snapshot_name,]
             output = int(subprocess.check_output(cmd, close_fds=True).split(':')[5])
             if output:
                 return True
@@ -42,8 +46,8 @@ class LvSnapshot:
 
         if not self.get_snapshot_status():
 
-            cmd = ['/sbin/lvcreate', '--snapshot', '-L', str(self.size_gb)+'G', '--name', self.snapshot_name,
-                   '/dev/'+self.vg+'/'+self.lv]
+            cmd = [self.lvm_bin_dir+'/lvcreate', '--snapshot', '-L', str(self.size_gb)+'G', '--name',
+                   self.snapshot_name, self.dev_dir+'/'+self.vg+'/'+self.lv]
 
             LvSnapshot.backup_logger.info("Snapshot does not exist.  Attempting the following command:\n " + " ".join(cmd),
                          extra={'object': self})
@@ -52,8 +56,8 @@ class LvSnapshot:
             lv_snap.wait()
 
             if not self.get_snapshot_status():
-                raise IOError("Failed to create snapshot named %s at /dev/%s/%s of size %d" %
-                              (self.snapshot_name, self.vg, self.lv, self.size_gb))
+                raise IOError("Failed to create snapshot named %s at %s/%s/%s of size %d" %
+                              (self.snapshot_name, self.dev_dir, self.vg, self.lv, self.size_gb))
 
     def delete_snapshot(self):
         """Remove a snapshot.  Will raise IOError on failure."""
@@ -63,7 +67,7 @@ class LvSnapshot:
 
         if self.get_snapshot_status():
 
-            cmd = ['/sbin/lvremove', '-f', '/dev/'+self.vg+'/'+self.snapshot_name]
+            cmd = [self.lvm_bin_dir+'/lvremove', '-f', self.dev_dir+'/'+self.vg+'/'+self.snapshot_name]
 
             LvSnapshot.backup_logger.info("Removing snapshot with the following command: \n" + ' '.join(cmd), extra={'object': self})
 
@@ -82,8 +86,13 @@ class LvSnapshot:
 
     def safe_refresh_snapshot(self):
         """If the snapshot is not mounted, delete it and recreate it"""
+        with RunMetrics.timer('snapshot_refresh_seconds'):
+            self.refresh_snapshot_if_not_mounted()
 
-        LvSnapshot.backup_logger.info("Begin refreshing snapshot at /dev/%s/%s" % (self.vg, self.snapshot_name),
+    def refresh_snapshot_if_not_mounted(self):
+        """Use safe_refresh_snapshot, which also records how long this took"""
+
+        LvSnapshot.backup_logger.info("Begin refreshing snapshot at %s/%s/%s", self.dev_dir, self.vg, self.snapshot_name,
                                       extra={'object': self})
 
         if not self.get_snapshot_status(is_mounted=True):
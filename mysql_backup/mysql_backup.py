@@ -1,24 +1,108 @@
-import MySQLdb
-import MySQLdb.cursors
 from time import sleep
 import datetime
 from .mysql_backup_file import *
 from .mysql_backup_instance import MysqlBackupInstance
 from .mysql_db_instance import MysqlDbInstance
+from .mysql_backup_checksum import MysqlBackupChecksum
+from .mysql_retention_planner import RetentionColumns
+from .mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from .mysql_backup_deletion_pool import DeletionPool
+from .mysql_backup_job_retry import JobRetry
+from .mysql_backup_long_term_copier import LongTermCopier
+from .mysql_backup_long_term_storage import LongTermStorage
+from .mysql_backup_throttle import MysqlBackupThrottle
+from .mysql_backup_page_cache import PageCache
+from .mysql_backup_open_files import OpenFiles
+from .mysql_backup_schedule import BackupSchedule
+from .mysql_backup_replication import ReplicationPosition
+from .mysql_backup_replicas import BackupReplicas, Replica
+from .mysql_backup_config import BackupConfig
+from .mysql_backup_logging import RunLog
 import ConfigParser
 from lv_snapshot.lv_snapshot import LvSnapshot
-import os, time
-from joblib import Parallel, delayed
+import logging
+import os, sys, time
+from functools import partial
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter, methodcaller
 from run_cache.run_cache_manager import RunningCacheManager
-import logging
-import uuid
-import psutil
-
-
-def fork_db(db_instance_obj):
-    """Helper function to allow forking"""
-    db_instance_obj.execute()
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
+import binascii
+
+# MySQLdb, joblib, psutil and cProfile are imported where they are
+# used.  A run with nothing to do never needs them and a cron
+# invocation is mostly import time otherwise.
+
+
+def execute_db(db_instance_obj, run_started):
+    """(void)
+    One attempt at the job of db_instance_obj, profiled when asked.
+    Setting the worker up is part of it, and fails it the same way."""
+    config = db_instance_obj.config
+    MysqlBackup.configure_process(config)
+    if run_started != MysqlBackup.run_started:
+        # A worker kept from an earlier run of the daemon
+        BackupDirectorySnapshot.refresh()
+        MysqlBackup.run_started = run_started
+
+    with RunTrace.span('fork_db', db=db_instance_obj.db_name), BackupReplicas.using(db_instance_obj.replica):
+        if config.profile_database == db_instance_obj.db_name and config.profile_stats_file:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                db_instance_obj.execute()
+            finally:
+                profiler.disable()
+                profiler.dump_stats(config.profile_stats_file)
+        else:
+            db_instance_obj.execute()
+
+
+def fork_db(db_instance_obj, run_started=None):
+    """Helper function to allow forking.  Everything the job needs
+    comes with db_instance_obj and its config, so the worker may be
+    forked, spawned or left over from an earlier job.  A failing job
+    is retried or reported, see mysql_backup_job_retry, and what is
+    done after it only logged when it fails: fork_db does not raise,
+    so one job can not take the run down.
+    run_started: when the run the job belongs to started
+    return: dict of the metrics and trace events collected by this job
+    and its failure, None when it succeeded"""
+    config = db_instance_obj.config
+    job = JobRetry(config, db_instance_obj.db_name)
+
+    # joblib runs jobs in the calling process when only one worker
+    # is used.  Put the caller's collection back when done so the
+    # returned values are not counted twice or lost.  The caller's
+    # long term copier threads go on adding meanwhile: what they add
+    # during the job is returned with the job's and merged once.
+    caller_metrics = RunMetrics.take_snapshot()
+    caller_events = RunTrace.take_events()
+    RunTrace.name_process("mysql_backup worker %d" % os.getpid())
+
+    try:
+        failure = job.run(partial(execute_db, db_instance_obj, run_started))
+    finally:
+        if db_instance_obj.replica is not None:
+            # Left stopped, the run starts it again when it ends
+            job.after("handing back replica %s" % db_instance_obj.replica, BackupReplicas.release, config,
+                      db_instance_obj.replica, db_instance_obj.db_name)
+        metrics = RunMetrics.take_snapshot()
+        events = RunTrace.take_events()
+        RunMetrics.merge(caller_metrics)
+        RunTrace.merge(caller_events)
+        # A spawned worker writes its own records, have them in the
+        # log before the run goes on
+        job.after("flushing the log", RunLog.flush, config)
+
+    return {
+        'metrics': metrics,
+        'trace': events,
+        'failure': failure,
+    }
 
 
 class MysqlBackup:
@@ -28,27 +112,10 @@ class MysqlBackup:
     the backup process. Must be done using
     a slave server."""
 
-    mysql_username = None
-    mysql_password = None
-    mysql_dump_options = None
-    mysql_host = None
-    compression_enabled = None
-    compress_command = None
-    decompress_command = None
-    compressed_file_extension = None
-    max_parallel = None
-    cleanup_delay_days = None
-    incremental_path = None
-    incremental_min_backup_frequency_seconds = None
-    incremental_max_lifespan_seconds = None
-    incremental_max_copies = None
-    long_term_backup_path = None
-    long_term_backup_min_frequency_seconds = None
-    long_term_backup_max_copies = None
-    long_term_max_lifespan_seconds = None
-    limits_exclude_databases = None
-    limits_include_only_databases = None
-    verbose = True
+    # The process wide helpers are set up for this config
+    process_config = None
+    # and the directory snapshot for the run started then
+    run_started = None
     backup_logger = None
 
     def __init__(self, settings_file):
@@ -62,135 +129,470 @@ class MysqlBackup:
         raw_config = ConfigParser.RawConfigParser(allow_no_value=True)
         raw_config.read(settings_file)
 
-        MysqlBackup.mysql_username = Config.get("MySQL", "username")
-        MysqlBackup.mysql_password = raw_config.get("MySQL", "password")
-        MysqlBackup.mysql_dump_options = Config.get("MySQL", "dump_options")
-        MysqlBackup.mysql_host = Config.get("MySQL", "host")
-
-        MysqlBackup.compression_enabled = Config.getboolean("Backup", "compression_enabled")
-        MysqlBackup.compress_command = Config.get("Backup", "compress_command")
-        MysqlBackup.decompress_command = Config.get("Backup", "decompress_command")
-        MysqlBackup.compressed_file_extension = Config.get("Backup", "compressed_file_extension")
-
-        MysqlBackup.max_parallel = self.int_or_none(Config.get("Backup", "max_parallel"))
-
-        MysqlBackup.cleanup_delay_days = self.int_or_none(Config.get("Backup", "cleanup_delay_days"))
-
-        MysqlBackup.incremental_path = Config.get("Backup", "incremental_path")
-        MysqlBackup.incremental_min_backup_frequency_seconds = \
+        settings = dict()
+        settings['settings_file'] = settings_file
+        settings['backup_id'] = binascii.hexlify(os.urandom(3)).upper()
+        settings['logfile'] = Config.get("Logging", "logfile")
+        settings['loglevel'] = Config.get("Logging", "loglevel")
+        settings['log_levels'] = RunLog.parse_levels(self.get_optional(Config, "Logging", "levels"))
+
+        settings['mysql_username'] = Config.get("MySQL", "username")
+        settings['mysql_password'] = raw_config.get("MySQL", "password")
+        settings['mysql_dump_options'] = Config.get("MySQL", "dump_options")
+        # Equivalent replicas, the first is the run's own server, see mysql_backup_replicas
+        settings['mysql_hosts'] = tuple(host.strip() for host in (Config.get("MySQL", "host") or '').split(',')
+                                        if host.strip()) or (None,)
+        settings['mysql_host'] = settings['mysql_hosts'][0]
+        settings['replica_max_lag_seconds'] = self.int_or_none(self.get_optional(Config, "MySQL",
+                                                                                 "replica_max_lag_seconds", 300))
+        settings['replica_catch_up_seconds'] = self.int_or_none(self.get_optional(Config, "MySQL",
+                                                                                  "replica_catch_up_seconds", 600))
+        settings['mysqldump_command'] = self.get_optional(Config, "MySQL", "mysqldump_command", "/usr/bin/mysqldump")
+
+        settings['compression_enabled'] = Config.getboolean("Backup", "compression_enabled")
+        settings['compress_command'] = Config.get("Backup", "compress_command")
+        settings['decompress_command'] = Config.get("Backup", "decompress_command")
+        settings['compressed_file_extension'] = Config.get("Backup", "compressed_file_extension")
+        settings['compression_format'] = self.get_optional(Config, "Backup", "compression_format", "command")
+        if settings['compression_format'] not in ('command', 'frames'):
+            raise ValueError("compression_format must be command or frames, not %s" % settings['compression_format'])
+        if settings['compression_format'] == 'frames' and settings['compressed_file_extension'] != 'bz2':
+            raise ValueError("compression_format frames writes bz2, compressed_file_extension must be bz2")
+        settings['compression_frame_size'] = \
+            (self.int_or_none(self.get_optional(Config, "Backup", "compression_frame_size_mb")) or 4) * 1024 * 1024
+        settings['compression_threads'] = self.int_or_none(self.get_optional(Config, "Backup",
+                                                                             "compression_threads", 2))
+        settings['table_level_incremental'] = self.get_optional(Config, "Backup", "table_level_incremental",
+                                                                "false").lower() in ('1', 'true', 'yes', 'on')
+        settings['table_checksum'] = self.get_optional(Config, "Backup", "table_checksum",
+                                                       "true").lower() in ('1', 'true', 'yes', 'on')
+
+        settings['max_parallel'] = self.int_or_none(Config.get("Backup", "max_parallel"))
+        settings['worker_backend'] = self.get_optional(Config, "Backup", "worker_backend", "multiprocessing")
+        if settings['worker_backend'] not in ('multiprocessing', 'loky'):
+            raise ValueError("worker_backend must be multiprocessing or loky, not %s" % settings['worker_backend'])
+
+        settings['cleanup_delay_days'] = self.int_or_none(Config.get("Backup", "cleanup_delay_days"))
+
+        settings['incremental_path'] = Config.get("Backup", "incremental_path")
+        settings['incremental_min_backup_frequency_seconds'] = \
             self.int_or_none(Config.get("Backup", "incremental_min_backup_frequency_seconds"))
-        MysqlBackup.incremental_max_lifespan_seconds = self.int_or_none(Config.get("Backup",
+        settings['incremental_max_lifespan_seconds'] = self.int_or_none(Config.get("Backup",
                                                                                    "incremental_max_lifespan_seconds"))
-        MysqlBackup.incremental_max_copies = self.int_or_none(Config.get("Backup", "incremental_max_copies"))
-        MysqlBackup.long_term_backup_path = Config.get("Backup", "long_term_backup_path")
-        MysqlBackup.long_term_backup_min_frequency_seconds = \
+        settings['incremental_max_copies'] = self.int_or_none(Config.get("Backup", "incremental_max_copies"))
+        settings['long_term_backup_path'] = Config.get("Backup", "long_term_backup_path")
+        settings['long_term_backup_min_frequency_seconds'] = \
             self.int_or_none(Config.get("Backup", "long_term_backup_min_frequency_seconds"))
-        MysqlBackup.long_term_max_lifespan_seconds = self.int_or_none(Config.get("Backup",
+        settings['long_term_max_lifespan_seconds'] = self.int_or_none(Config.get("Backup",
                                                                                  "long_term_max_lifespan_seconds"))
-        MysqlBackup.long_term_backup_max_copies = self.int_or_none(Config.get("Backup", "long_term_backup_max_copies"))
-
-        # Set up logging
-        # This can be changed without consequences.
-        # Every other object uses getLogger(settings_file).
-        # As long as that continues to be true, the logger
-        # can be made to do whatever.
-
-        logfile = Config.get("Logging", "logfile")
-        loglevel = Config.get("Logging", "loglevel")
-        MysqlBackup.settings_file = settings_file
-
-        rand_backup_id = str(uuid.uuid4().get_hex().upper()[0:6])
-        MysqlBackup.backup_logger = logging.getLogger("Backup ID:" + rand_backup_id)
-        hdlr = logging.FileHandler(logfile)
-        formatter = logging.Formatter('[%(name)s][TIME:%(asctime)s][OBJ:%(object)s][LOGLEVEL:%(levelname)s]'
-                                      '[METHOD:%(funcName)s][LINE:%(lineno)d]'
-                                      '[MSG:%(message)s]')
+        settings['long_term_backup_max_copies'] = self.int_or_none(Config.get("Backup", "long_term_backup_max_copies"))
+
+        settings['checksum_algorithm'] = self.get_optional(Config, "Backup", "checksum_algorithm",
+                                                           MysqlBackupChecksum.legacy_algorithm)
+        if settings['checksum_algorithm'] not in MysqlBackupChecksum.get_supported_algorithms():
+            raise ValueError("checksum_algorithm %s is not available. Choose one of %s"
+                             % (settings['checksum_algorithm'],
+                                ', '.join(MysqlBackupChecksum.get_supported_algorithms())))
+        settings['checksum_buffer_size'] = \
+            (self.int_or_none(self.get_optional(Config, "Backup", "checksum_buffer_size_mb")) or 8) * 1024 * 1024
+
+        settings['retention_dry_run'] = self.get_optional(Config, "Backup", "retention_dry_run", "False") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['retention_io_threads'] = self.int_or_none(self.get_optional(Config, "Backup",
+                                                                              "retention_io_threads", 4))
+        settings['deletion_retries'] = self.int_or_none(self.get_optional(Config, "Backup", "deletion_retries", 3))
+        settings['reconcile_threads'] = self.int_or_none(self.get_optional(Config, "Backup", "reconcile_threads", 4))
+        settings['job_retries'] = self.int_or_none(self.get_optional(Config, "Backup", "job_retries", 2))
+        settings['job_retry_delay_seconds'] = self.int_or_none(self.get_optional(Config, "Backup",
+                                                                                 "job_retry_delay_seconds", 15))
+        settings['long_term_copy_streams'] = self.int_or_none(self.get_optional(Config, "Backup",
+                                                                                "long_term_copy_streams", 2))
+        settings['long_term_copy_verify'] = self.get_optional(Config, "Backup", "long_term_copy_verify", "True") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['long_term_storage'] = self.get_optional(Config, "Backup", "long_term_storage", "filesystem")
+        settings['skip_when_nothing_due'] = self.get_optional(Config, "Backup", "skip_when_nothing_due", "True") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['skip_when_replication_idle'] = self.get_optional(Config, "Backup", "skip_when_replication_idle",
+                                                                   "True").lower() in ('1', 'true', 'yes', 'on')
+        settings['replication_idle_max_skip_seconds'] = self.int_or_none(self.get_optional(
+            Config, "Backup", "replication_idle_max_skip_seconds", 86400))
+        settings['binlog_change_detection'] = self.get_optional(Config, "Backup", "binlog_change_detection",
+                                                                "False").lower() in ('1', 'true', 'yes', 'on')
+        settings['binlog_scan_max_events'] = self.int_or_none(self.get_optional(Config, "Backup",
+                                                                                "binlog_scan_max_events", 1000000))
+
+        # per database frequency learned from how often dumps change
+        settings['adaptive_frequency'] = self.get_optional(Config, "Backup", "adaptive_frequency", "False") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['adaptive_min_backup_frequency_seconds'] = \
+            self.int_or_none(self.get_optional(Config, "Backup", "adaptive_min_backup_frequency_seconds"))
+        settings['adaptive_max_backup_frequency_seconds'] = \
+            self.int_or_none(self.get_optional(Config, "Backup", "adaptive_max_backup_frequency_seconds"))
+        settings['adaptive_max_dump_bytes_per_day'] = \
+            self.int_or_none(self.get_optional(Config, "Backup", "adaptive_max_dump_bytes_per_day"))
+
+        # keeping listings of the backup directories between runs
+        settings['directory_watch'] = self.get_optional(Config, "Backup", "directory_watch", "True") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['directory_cursor_file'] = None
+        if self.get_optional(Config, "Backup", "directory_cursor", "True").lower() in ('1', 'true', 'yes', 'on'):
+            settings['directory_cursor_file'] = Config.get("Backup", "running_cache_file") + '.listing'
 
-        hdlr.setFormatter(formatter)
-        MysqlBackup.backup_logger.addHandler(hdlr)
-        MysqlBackup.backup_logger.setLevel(loglevel)
-        # Done setting up logging
-
-
-        MysqlBackup.limits_exclude_databases = None
+        # instance locking
+        settings['running_cache_file'] = Config.get("Backup", "running_cache_file")
+        settings['cache_lock_wait'] = self.int_or_none(Config.get("Backup", "cache_lock_wait"))
+        settings['cache_successful_run_purge_days'] = \
+            self.int_or_none(Config.get("Backup", "cache_successful_run_purge_days"))
+
+        # where long term copies live when long_term_storage is s3
+        settings['s3_bucket'] = self.get_optional(Config, "S3", "bucket")
+        settings['s3_prefix'] = self.get_optional(Config, "S3", "prefix", '')
+        settings['s3_endpoint_url'] = self.get_optional(Config, "S3", "endpoint_url")
+        settings['s3_region'] = self.get_optional(Config, "S3", "region")
+        settings['s3_access_key_id'] = self.get_optional(raw_config, "S3", "access_key_id")
+        settings['s3_secret_access_key'] = self.get_optional(raw_config, "S3", "secret_access_key")
+        settings['s3_part_size'] = self.int_or_none(self.get_optional(Config, "S3", "part_size_mb", 8)) * 1024 * 1024
+        settings['s3_upload_threads'] = self.int_or_none(self.get_optional(Config, "S3", "upload_threads", 4))
+        settings['s3_storage_class'] = self.get_optional(Config, "S3", "storage_class")
+
+        # bandwidth and priority of the backup processes
+        settings['throttle_rates'] = tuple(
+            (stage, self.int_or_none(self.get_optional(Config, "Throttle", stage + "_bytes_per_second")))
+            for stage in ('dump', 'compress', 'copy'))
+        settings['throttle_nice'] = self.int_or_none(self.get_optional(Config, "Throttle", "nice"))
+        settings['throttle_ionice'] = self.get_optional(Config, "Throttle", "ionice")
+        settings['throttle_cpu_affinity'] = self.get_optional(Config, "Throttle", "cpu_affinity")
+        settings['throttle_adaptive'] = self.get_optional(Config, "Throttle", "adaptive", "False").lower() in \
+            ('1', 'true', 'yes', 'on')
+        settings['throttle_adaptive_max_lag_seconds'] = self.int_or_none(self.get_optional(
+            Config, "Throttle", "adaptive_max_lag_seconds", 60))
+        settings['throttle_adaptive_min_fraction'] = float(self.get_optional(Config, "Throttle",
+                                                                             "adaptive_min_fraction", 0.1))
+        settings['throttle_adaptive_check_interval_seconds'] = self.int_or_none(self.get_optional(
+            Config, "Throttle", "adaptive_check_interval_seconds", 10))
+        settings['throttle_page_cache_drop'] = self.get_optional(Config, "Throttle", "page_cache_drop", "True") \
+            .lower() in ('1', 'true', 'yes', 'on')
+        settings['throttle_page_cache_window'] = \
+            (self.int_or_none(self.get_optional(Config, "Throttle", "page_cache_window_mb")) or 64) * 1024 * 1024
+        settings['throttle_preallocate'] = self.get_optional(Config, "Throttle", "preallocate", "True").lower() in \
+            ('1', 'true', 'yes', 'on')
+        settings['throttle_copy_direct_io'] = self.get_optional(Config, "Throttle", "copy_direct_io", "False") \
+            .lower() in ('1', 'true', 'yes', 'on')
+
+        settings['limits_exclude_databases'] = None
         if Config.get("Limits", "exclude_databases"):
-            MysqlBackup.limits_exclude_databases = [x.strip() for x in
-                                                    Config.get("Limits", "exclude_databases").split(',')]
+            settings['limits_exclude_databases'] = tuple(x.strip() for x in
+                                                         Config.get("Limits", "exclude_databases").split(','))
 
-        MysqlBackup.limits_include_only_databases = None
+        settings['limits_include_only_databases'] = None
         if Config.get("Limits", "include_only_databases"):
-            MysqlBackup.limits_include_only_databases = [x.strip() for x in
-                                             Config.get("Limits", "include_only_databases").split(',')]
+            settings['limits_include_only_databases'] = tuple(x.strip() for x in
+                                                              Config.get("Limits", "include_only_databases").split(','))
+
+        # snapshot settings
+        settings['snapshot_name'] = Config.get("Snapshot", "name")
+        settings['snapshot_vg'] = Config.get("Snapshot", "vg")
+        settings['snapshot_lv'] = Config.get("Snapshot", "lv")
+        settings['snapshot_size_gb'] = self.int_or_none(Config.get("Snapshot", "size_gb"))
+        settings['snapshot_lvm_bin_dir'] = self.get_optional(Config, "Snapshot", "lvm_bin_dir", "/sbin")
+        settings['snapshot_dev_dir'] = self.get_optional(Config, "Snapshot", "dev_dir", "/dev")
+
+        # metrics output (empty allowed)
+        settings['metrics_textfile'] = self.get_optional(Config, "Metrics", "textfile")
+        settings['metrics_report_file'] = self.get_optional(Config, "Metrics", "report_file")
+        settings['trace_file'] = self.get_optional(Config, "Metrics", "trace_file")
+
+        settings['profile_database'] = self.get_optional(Config, "Metrics", "profile_database")
+        settings['profile_stats_file'] = None
+        if settings['profile_database'] is not None:
+            # Saved next to the run report, or the trace when there is no report
+            report_file = settings['metrics_report_file'] or settings['trace_file']
+            if report_file:
+                settings['profile_stats_file'] = os.path.join(os.path.dirname(report_file),
+                                                              "%s.%s.pstats" % (os.path.basename(report_file),
+                                                                                settings['profile_database']))
+        settings['verbose'] = True
+
+        # Everything the run and its workers need to know
+        self.config = BackupConfig(**settings)
+        MysqlBackup.configure_process(self.config)
 
         # database connection
         self.db_connection = None
         self.cursor = None
         self.cur_database = None
 
-        # instance locking
-        self.running_cache_file = Config.get("Backup", "running_cache_file")
-        self.cache_lock_wait = self.int_or_none(Config.get("Backup", "cache_lock_wait"))
-        self.cache_successful_run_purge_days = self.int_or_none(Config.get("Backup", "cache_successful_run_purge_days"))
+        # replication positions of the last successful run and this one
+        self.replication_state = None
+        self.slave_position = None
+        self.binlog_position = None
+        # in scope databases replication has not touched since their last backup
+        self.unchanged_databases = set()
+        self.databases_in_scope = list()
 
-        # snapshot settings
-        self.snapshot_name = Config.get("Snapshot", "name")
-        self.snapshot_vg = Config.get("Snapshot", "vg")
-        self.snapshot_lv = Config.get("Snapshot", "lv")
-        self.snapshot_size_gb = self.int_or_none(Config.get("Snapshot", "size_gb"))
+        self.slave_stopped_time = None
+        # replicas other than the first stopped for this run's dumps
+        self.replicas_in_use = list()
 
-        # all of the db backup instances
+        # all of the db backup instances, and the version of the
+        # incremental path's listing they were found in
         self.mysql_db_backup_instances = None
+        self.catalog_version = None
+        # database -> backup files, of databases other settings files manage
+        self.out_of_scope_files = dict()
 
         # running time
         self.starting_time = None
-        self.run_cache_manager = RunningCacheManager(settings_file, self.cache_lock_wait, self.running_cache_file,
-                                                     self.cache_successful_run_purge_days)
+        self.run_cache_manager = RunningCacheManager(self.config)
+
+    @staticmethod
+    def configure_process(config):
+        """(void)
+        Set up the process wide logger, schedule, long term storage,
+        throttle, page cache, replicas and directory snapshot for config.  Every worker
+        does this for the config shipped with its job; a worker
+        forked from the run, or one that already ran a job of this
+        run, is set up already and keeps what it inherited."""
+        if MysqlBackup.process_config == config:
+            return
+        MysqlBackup.backup_logger = config.get_logger()
+        # Set by their constructors, which do not run for objects shipped to a worker
+        MysqlDbInstance.backup_logger = config.get_logger('database')
+        MysqlBackupInstance.backup_logger = config.get_logger('instance')
+        MysqlBackupFileFactory.backup_logger = config.get_logger('file')
+        BackupDirectorySnapshot.configure(config)
+        BackupSchedule.configure(config)
+        LongTermStorage.configure(config)
+        MysqlBackupThrottle.configure(config)
+        PageCache.configure(config)
+        BackupReplicas.configure(config)
+        RunTrace.enabled = config.trace_file is not None
+        MysqlBackup.process_config = config
 
     def __str__(self):
         return "mysql_backup.py"
 
-    def execute(self):
+    def execute(self, force=False):
         """Attempt to run new backups, rotate, and age according to configuration.  This is the only method
-        That needs called after initialization."""
+        That needs called after initialization.  May be called again, as the daemon does.
+        force: go ahead even when replication is idle or nothing is due"""
         # Prep
+        # Another settings file may have run in this process since
+        MysqlBackup.configure_process(self.config)
         self.log_running_time(logtype='begin')
+        RunMetrics.reset()
+        RunTrace.reset()
+        RunTrace.name_process("mysql_backup %s" % self.config.settings_file)
+        BackupDirectorySnapshot.refresh()
+        LongTermStorage.get().reset()
 
         if self.run_cache_manager.have_already_run_while_others_are_still_running():
             MysqlBackup.backup_logger.info("A backup using this settings file has already run while another is still running. "
                              "Because no changes would be expected while that is true, there is no reason to proceed.",
                              extra={'object': self})
+            RunMetrics.set('run_skipped', 1)
         else:
+            RunMetrics.set('run_skipped', 0)
 
             # Let other instances know this backup has started
             self.run_cache_manager.add_current_backup_to_running_cache()
+            BackupSchedule.load(self.run_cache_manager.get_database_schedules())
+            self.replication_state = self.run_cache_manager.get_replication_state()
 
             # A little pre-cleanup possible here
-            self.mysql_db_backup_instances = self.get_db_backup_instances_from_files()
+            self.load_catalog()
 
+            # Decided from the run cache and the schedule first, the
+            # server and its driver are only needed once something is due
+            skip_reason = None
+            if not force and self.config.skip_when_nothing_due and not self.is_anything_due():
+                skip_reason = "No database is due for a backup yet."
+            else:
+                self.check_connection()
+                if not force and self.config.skip_when_replication_idle and self.is_replication_idle():
+                    skip_reason = "Replication has applied nothing since the last run."
+
+            if skip_reason is not None:
+                MysqlBackup.backup_logger.info("%s  Leaving the slave alone.", skip_reason, extra={'object': self})
+                RunMetrics.set('run_skipped', 1)
+                self.run_cache_manager.remove_current_backup_from_running_cache()
+            else:
+                self.run()
+
+        self.log_running_time(logtype='end')
+        try:
+            BackupDirectorySnapshot.save_cursor()
+        except (IOError, OSError) as e:
+            MysqlBackup.backup_logger.warning("Could not save the directory listings for the next run: %s", e,
+                                              extra={'object': self})
+        self.write_metrics()
+        RunLog.flush(self.config)
+
+    def run(self):
+        """(void)
+        The part of execute that needs the database server"""
+        # While replication still runs
+        self.reconcile_instances()
+
+        if self.config.retention_dry_run:
+            self.log_retention_plan()
+
+        try:
             # More prep
             self.slave_should_be_running(False)
+            self.record_replication_position()
 
             # Do work
             self.clean_non_backup_files()
             self.process_databases()
+            self.save_database_schedules()
+            self.save_replication_state()
+        except Exception:
+            # Replication is not left stopped by a run that failed outright
+            exc_info = sys.exc_info()
+            try:
+                self.resume_replication()
+            except Exception as e:
+                MysqlBackup.backup_logger.error("Could not restart replication after the run failed. %s", e,
+                                                extra={'object': self})
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-            # Cleanup
-            if self.run_cache_manager.get_current_running_count() == 1:
-                MysqlBackup.backup_logger.info("This is the only backup running.  Starting the mysql slave back up and refreshing the"
-                                 " snapshot if possible.", extra={'object': self})
-                # this backup is still in the run queue.  Unless this
-                # is the only backup, the slave should not be started
-                # nore should the snapshot be refreshed.
-                self.slave_should_be_running(True)
-                self.ensure_snapshot_exists_and_refresh_if_possible()
-            else:
-                MysqlBackup.backup_logger.info("This does not appear to be the only running backup. To be safe the slave will not be "
-                                 "started nor will the snapshot be refreshed at this time.", extra={'object': self})
+        self.resume_replication()
 
-            self.run_cache_manager.update_last_successful_runtime()
-            self.run_cache_manager.remove_current_backup_from_running_cache()
+        self.run_cache_manager.update_last_successful_runtime(int(time.mktime(self.starting_time.timetuple())))
+        self.run_cache_manager.remove_current_backup_from_running_cache()
 
-        self.log_running_time(logtype='end')
+    def resume_replication(self):
+        """(void)
+        Start the slaves again and refresh the snapshot, unless
+        another backup is still running"""
+        if self.run_cache_manager.get_current_running_count() == 1:
+            MysqlBackup.backup_logger.info("This is the only backup running.  Starting the mysql slave back up and refreshing the"
+                             " snapshot if possible.", extra={'object': self})
+            # this backup is still in the run queue.  Unless this
+            # is the only backup, the slave should not be started
+            # nore should the snapshot be refreshed.
+            self.slave_should_be_running(True)
+            # Those whose last database failed, the others were started by their workers
+            for host in self.replicas_in_use:
+                self.start_replica(host)
+            self.ensure_snapshot_exists_and_refresh_if_possible()
+        else:
+            MysqlBackup.backup_logger.info("This does not appear to be the only running backup. To be safe the slave will not be "
+                             "started nor will the snapshot be refreshed at this time.", extra={'object': self})
+
+    def is_replication_idle(self):
+        """Has replication applied nothing since the last successful run,
+        which left every database backed up at the position it recorded.
+        At least every replication_idle_max_skip_seconds a run goes ahead
+        anyway so retention and cleanup happen on an idle server.
+        return: bool"""
+        state = self.replication_state
+        if not state or state.get('dirty') is None or state['dirty']:
+            return False
+        if self.config.replication_idle_max_skip_seconds is not None and \
+                time.time() - state['timestamp'] > self.config.replication_idle_max_skip_seconds:
+            return False
+        return self.get_slave_position() == state['slave_position']
+
+    def get_slave_status(self):
+        self.connect_if_not_connected("mysql")
+        self.cursor.execute("SHOW SLAVE STATUS;")
+        return self.cursor.fetchall()[0]
+
+    def get_slave_position(self):
+        return ReplicationPosition.get_slave_position(self.get_slave_status())
+
+    def record_replication_position(self):
+        """(void)
+        With the slave stopped, note what it has executed.  Every dump
+        of this run reflects this position."""
+        self.slave_position = self.get_slave_position()
+        self.binlog_position = None
+        if self.config.binlog_change_detection:
+            self.binlog_position = ReplicationPosition.get_binlog_position(self.cursor)
+            if self.binlog_position is None:
+                MysqlBackup.backup_logger.warning("binlog_change_detection is enabled but the slave does not write a "
+                                                  "binlog.", extra={'object': self})
+        self.unchanged_databases = self.get_unchanged_databases()
+
+    def get_unchanged_databases(self):
+        """Return: set of the databases with backups that the slave's
+        binlog shows untouched since the last successful run, which
+        left them backed up"""
+        state = self.replication_state
+        if self.binlog_position is None or not state or state.get('binlog_position') is None:
+            return set()
+
+        with RunMetrics.timer('binlog_scan_seconds'):
+            touched = ReplicationPosition.get_touched_databases(self.cursor, state['binlog_position'],
+                                                                self.binlog_position,
+                                                                self.config.binlog_scan_max_events)
+        if touched is None:
+            MysqlBackup.backup_logger.info("The binlog since the last run does not tell which databases changed, "
+                                           "every database is considered changed.", extra={'object': self})
+            return set()
+
+        backed_up = set(dbobj.db_name for dbobj in self.mysql_db_backup_instances)
+        unchanged = backed_up.intersection(state.get('databases', ())) - touched - set(state['dirty'])
+        RunMetrics.set('replication_unchanged_databases', len(unchanged))
+        MysqlBackup.backup_logger.info("%d databases were not touched since the last run.", len(unchanged),
+                                       extra={'object': self})
+        return unchanged
+
+    def save_replication_state(self):
+        """(void)
+        Record this run's position for the next run.  Databases in scope
+        that were neither dumped nor known unchanged are carried forward
+        as dirty, they may hold changes their youngest backup lacks.
+        So are those whose job failed, whether or not it got to dump."""
+        attempted = set(db_name for db_name, values in RunMetrics.database_values.items()
+                        if values.get('dump_attempts') and not values.get('job_failures'))
+        dirty = set(self.databases_in_scope) - attempted - self.unchanged_databases
+        self.run_cache_manager.save_replication_state({
+            'slave_position': self.slave_position,
+            'binlog_position': self.binlog_position,
+            'databases': sorted(self.databases_in_scope),
+            'dirty': sorted(dirty),
+            'timestamp': int(time.time()),
+        })
+
+    def is_anything_due(self):
+        """Can this run do anything, decided without the database server.
+        Nothing is due while every database with backups is within its
+        backup frequency and the last successful run, which would have
+        found new databases, is more recent than the smallest frequency.
+        Retention and cleanup wait for the next run that is due.
+        return: bool"""
+        min_frequency = BackupSchedule.get_min_frequency_seconds()
+        if not min_frequency:
+            return True
+
+        last_successful_ts = self.run_cache_manager.get_last_successful_runtime()
+        if last_successful_ts is None or time.time() - last_successful_ts > min_frequency:
+            return True
+
+        for dbobj in self.mysql_db_backup_instances:
+            if dbobj.is_criteria_for_an_attempt_met():
+                return True
+        return False
+
+    def get_next_attempt_times(self):
+        """When will a run have something to do, worked out as
+        is_anything_due decides it.
+        return: (unix time the next run is due or None for now,
+        dict of database -> unix time its next attempt is due or None)"""
+        MysqlBackup.configure_process(self.config)
+        BackupDirectorySnapshot.refresh()
+        BackupSchedule.load(self.run_cache_manager.get_database_schedules())
+        attempts = dict((dbobj.db_name, dbobj.get_next_attempt_time()) for dbobj in self.load_catalog())
+
+        min_frequency = BackupSchedule.get_min_frequency_seconds()
+        last_successful_ts = self.run_cache_manager.get_last_successful_runtime()
+        if not min_frequency or last_successful_ts is None:
+            return None, attempts
+        due = [last_successful_ts + min_frequency] + attempts.values()
+        return (None if None in due else min(due)), attempts
 
     def process_databases(self):
         """(void)
@@ -201,38 +603,256 @@ class MysqlBackup:
         self.set_valid_database_flags()
 
         dbs_to_process_per_configuration = self.get_databases_to_attempt_backups()
+        self.databases_in_scope = dbs_to_process_per_configuration
 
         db_object_processing_queue = list()
 
-        for db in self.get_databases():
+        db_names = self.get_databases()
+        for db in db_names:
 
             dbobj = self.get_db_instance_by_name(db)
 
-            if db in dbs_to_process_per_configuration or (dbobj is not None and not dbobj.is_valid()):
-                MysqlBackup.backup_logger.debug("Executing %s per configuration or because marked as an invalid database instance"
-                                  % db, extra={'object': self})
+            if db in dbs_to_process_per_configuration:
+                MysqlBackup.backup_logger.debug("Executing %s per configuration", db, extra={'object': self})
 
                 if dbobj is None:
-                    MysqlBackup.backup_logger.debug("No existing backups found for %s. Initializing before execution." % db,
+                    MysqlBackup.backup_logger.debug("No existing backups found for %s. Initializing before execution.", db,
                                       extra={'object': self})
-                    dbobj = MysqlDbInstance(db_name=db, valid=True)
+                    dbobj = MysqlDbInstance(self.config, db_name=db, valid=True)
 
-                    MysqlBackup.backup_logger.info("Adding to the processing queue %s.." % dbobj, extra={'object': self})
+                    MysqlBackup.backup_logger.info("Adding to the processing queue %s..", dbobj, extra={'object': self})
 
+                dbobj.unchanged = db in self.unchanged_databases
+                dbobj.replica = None
                 db_object_processing_queue.append(dbobj)
 
             else:
-                MysqlBackup.backup_logger.debug("Not executing %s per configuration" % db, extra={'object': self})
+                MysqlBackup.backup_logger.debug("Not executing %s per configuration", db, extra={'object': self})
 
-        proc_count = cpu_count()
+        # Backups of databases no longer on the server wait cleanup_delay_days
+        for dbobj in [dbobj for dbobj in self.mysql_db_backup_instances if not dbobj.is_valid()] + \
+                self.get_out_of_scope_leftovers(set(db_names)):
+            MysqlBackup.backup_logger.debug("Executing %s because marked as an invalid database instance", dbobj,
+                                            extra={'object': self})
+            dbobj.unchanged = False
+            dbobj.replica = None
+            db_object_processing_queue.append(dbobj)
 
-        if mysql_backup.MysqlBackup.max_parallel not in (None, 0):
-            proc_count = mysql_backup.MysqlBackup.max_parallel
+        from joblib import Parallel, delayed
 
-            MysqlBackup.backup_logger.info("Start multiprocessing backups.  Max parallel set to %s"
-                         % str(mysql_backup.MysqlBackup.max_parallel), extra={'object': self})
+        proc_count = cpu_count()
 
-        Parallel(n_jobs=proc_count)(map(delayed(fork_db), db_object_processing_queue))
+        if self.config.max_parallel not in (None, 0):
+            proc_count = self.config.max_parallel
+
+            MysqlBackup.backup_logger.info("Start multiprocessing backups.  Max parallel set to %s",
+                         str(self.config.max_parallel), extra={'object': self})
+
+        RunMetrics.set('databases_processed', len(db_object_processing_queue))
+
+        if BackupReplicas.is_fanned_out():
+            db_object_processing_queue = self.place_on_replicas(db_object_processing_queue)
+
+        # Inherited by the workers, forked or spawned, and everything they start
+        MysqlBackupThrottle.apply_process_priority()
+
+        # Forked workers start from this process' directory snapshot
+        MysqlBackup.run_started = self.starting_time
+
+        # Long term copies drain on this process while the workers
+        # go on dumping, and must all land before the snapshot refresh.
+        if self.config.long_term_copy_streams:
+            LongTermCopier.start(self.config)
+        failures = list()
+        try:
+            # Each job carries the config.  multiprocessing forks workers for
+            # this call only; loky keeps its spawned workers for later calls,
+            # which copy long term backups and throttle on their own.
+            for job_result in Parallel(n_jobs=proc_count, backend=self.config.worker_backend)(
+                    delayed(fork_db)(dbobj, self.starting_time) for dbobj in db_object_processing_queue):
+                RunMetrics.merge(job_result['metrics'])
+                RunTrace.merge(job_result['trace'])
+                if job_result['failure'] is not None:
+                    failures.append(job_result['failure'])
+            self.log_job_summary(len(db_object_processing_queue), failures)
+        finally:
+            LongTermCopier.drain()
+            if BackupReplicas.is_fanned_out():
+                BackupReplicas.remove_remaining()
+
+    def log_job_summary(self, job_count, failures):
+        """(void)
+        Report the databases whose job failed, together, after every
+        job of the run is done"""
+        retried = [values['job_retries'] for values in RunMetrics.database_values.values() if values.get('job_retries')]
+        RunMetrics.set('job_retries', sum(retried))
+        RunMetrics.set('databases_failed', len(failures))
+        if not failures:
+            if retried:
+                MysqlBackup.backup_logger.info("All %d databases processed, %d of them after %d retries.", job_count,
+                                               len(retried), sum(retried), extra={'object': self})
+            return
+        MysqlBackup.backup_logger.error("%d of %d databases failed and are left for the next run: %s", len(failures),
+                                        job_count, '; '.join("%s after %d attempt(s), %s" % (
+                                            failure['db_name'], failure['attempts'], failure['error'])
+                                            for failure in sorted(failures, key=lambda f: f['db_name'])),
+                                        extra={'object': self})
+
+    @RunTrace.traced('place_on_replicas')
+    def place_on_replicas(self, db_object_processing_queue):
+        """Spread the databases about to be dumped over the replicas, see
+        mysql_backup_replicas.  Each replica but the first that is given
+        any is stopped at or past the first's position, which the first's
+        stopped slave is at.
+        return: the queue, the largest dumps first"""
+        import MySQLdb
+
+        hosts = self.config.mysql_hosts
+        primary = hosts[0]
+
+        candidates = [primary]
+        for host in hosts[1:]:
+            try:
+                status = Replica(self.config, host).get_status()
+            except MySQLdb.Error as e:
+                MysqlBackup.backup_logger.warning("Not using replica %s, its slave status could not be read. %s",
+                                                  host, e, extra={'object': self})
+                continue
+            lag = MysqlBackup.get_seconds_behind_master(status)
+            if not Replica.is_running(status) or lag is None or \
+                    (self.config.replica_max_lag_seconds is not None and lag > self.config.replica_max_lag_seconds):
+                MysqlBackup.backup_logger.warning("Not using replica %s, it is not replicating or %s seconds behind "
+                                                  "its master.", host, lag, extra={'object': self})
+                continue
+            candidates.append(host)
+
+        sizes = dict()
+        for dbobj in db_object_processing_queue:
+            if dbobj.is_dump_expected():
+                youngest = dbobj.get_youngest_instance()
+                sizes[dbobj.db_name] = BackupSchedule.get_dump_size(dbobj.db_name) or \
+                    (youngest.get_size_bytes() if youngest is not None else 0)
+        # Databases never dumped weigh as much as the average one
+        known = [size for size in sizes.values() if size]
+        default_size = sum(known) // len(known) if known else 1
+        weights = dict((dbobj.db_name, (sizes.get(dbobj.db_name) or default_size) if dbobj.db_name in sizes else 0)
+                       for dbobj in db_object_processing_queue)
+
+        position = ReplicationPosition.get_master_position(self.get_slave_status())
+        stopped = set()
+        while True:
+            placement = BackupReplicas.place(weights, candidates)
+            failed = list()
+            for host in candidates[1:]:
+                if not placement[host] or host in stopped:
+                    continue
+                replica = Replica(self.config, host)
+                start = time.time()
+                try:
+                    caught_up = replica.catch_up(position, self.config.replica_catch_up_seconds or 0)
+                except (MySQLdb.Error, SystemError) as e:
+                    MysqlBackup.backup_logger.warning("Could not stop replica %s. %s", host, e, extra={'object': self})
+                    caught_up = False
+                RunMetrics.add('replica_catch_up_seconds', time.time() - start)
+                stopped.add(host)
+                if not caught_up:
+                    failed.append(host)
+            if not failed:
+                break
+            MysqlBackup.backup_logger.warning("Replicas %s did not get to %s:%d, placing their databases on the "
+                                              "others.", ', '.join(failed), position[0], position[1],
+                                              extra={'object': self})
+            candidates = [host for host in candidates if host not in failed]
+
+        # Stopped by this run and placed nothing after all
+        for host in sorted(stopped):
+            if host not in candidates or not placement[host]:
+                self.start_replica(host)
+        self.replicas_in_use = [host for host in candidates[1:] if placement[host]]
+        BackupReplicas.write_remaining(placement)
+
+        for host in candidates:
+            MysqlBackup.backup_logger.info("Replica %s dumps %d databases, about %d bytes: %s", host,
+                                           len([db for db in placement[host] if weights[db]]),
+                                           sum(weights[db] for db in placement[host]),
+                                           ', '.join(placement[host]), extra={'object': self})
+        RunMetrics.set('replicas_used', 1 + len(self.replicas_in_use))
+
+        host_of = dict((db_name, host) for host, db_names in placement.items() for db_name in db_names)
+        for dbobj in db_object_processing_queue:
+            dbobj.replica = host_of[dbobj.db_name]
+        # Largest first keeps every replica busy until the end
+        return sorted(db_object_processing_queue, key=lambda dbobj: (-weights[dbobj.db_name], dbobj.db_name))
+
+    def start_replica(self, host):
+        """(void)
+        Start the slave of a replica this run stopped, logging rather than raising"""
+        import MySQLdb
+        try:
+            Replica(self.config, host).set_running(True)
+        except (MySQLdb.Error, SystemError) as e:
+            MysqlBackup.backup_logger.error("Could not start the slave of replica %s. %s", host, e,
+                                            extra={'object': self})
+
+    def save_database_schedules(self):
+        """(void)
+        Learn from this run's dump attempts and keep the result
+        for the next run and the run report"""
+        BackupSchedule.record_run(RunMetrics.database_values)
+        if self.config.cache_successful_run_purge_days is not None:
+            BackupSchedule.prune(self.config.cache_successful_run_purge_days * 86400)
+        BackupSchedule.export_metrics()
+        self.run_cache_manager.save_database_schedules(BackupSchedule.get_stats())
+
+    @RunTrace.traced('reconcile_instances')
+    def reconcile_instances(self):
+        """(void)
+        Validate the existing backup instances needing attention
+        before any database is processed, each database on its own
+        thread of a reconcile_threads pool, and report the ones no
+        longer managed together.  The workers find them validated.
+        With reconcile_threads 0 each database's worker does it."""
+        if not self.config.reconcile_threads:
+            return
+
+        self.set_valid_database_flags()
+        dbobjs = sorted((dbobj for dbobj in self.mysql_db_backup_instances if dbobj.is_valid()),
+                        key=attrgetter('db_name'))
+        if not dbobjs:
+            return
+
+        # Compression changes are made here, at the backup's priority.
+        # Replication still runs, they back off while it falls behind.
+        MysqlBackupThrottle.apply_process_priority()
+        MysqlBackupThrottle.start_adaptive(self.get_seconds_behind_master_on_new_connection)
+        start = time.time()
+        try:
+            # One open file scan for every database
+            with OpenFiles.shared():
+                if self.config.reconcile_threads == 1 or len(dbobjs) == 1:
+                    results = [dbobj.reconcile() for dbobj in dbobjs]
+                else:
+                    pool = ThreadPool(min(self.config.reconcile_threads, len(dbobjs)))
+                    try:
+                        results = pool.map(methodcaller('reconcile'), dbobjs)
+                    finally:
+                        pool.close()
+                        pool.join()
+        finally:
+            MysqlBackupThrottle.stop_adaptive()
+        elapsed = time.time() - start
+        RunMetrics.add('reconcile_seconds', elapsed)
+
+        # In database order whatever thread finished first
+        for dbobj, result in zip(dbobjs, results):
+            dbobj.log_reconciliation(result)
+        being_written = sum(len(result['being_written']) for result in results)
+        self_destructed = sum(len(result['self_destructed']) for result in results)
+        MysqlBackup.backup_logger.log(logging.WARNING if being_written or self_destructed else logging.INFO,
+                                      "Reconciled the backups of %d databases in %.2fs: %d validated, %d still "
+                                      "being written, %d self destructed.", len(dbobjs), elapsed,
+                                      sum(result['validated'] for result in results), being_written,
+                                      self_destructed, extra={'object': self})
 
     def set_valid_database_flags(self):
         """(void)
@@ -240,104 +860,108 @@ class MysqlBackup:
         db_names = self.get_databases()
         for dbobj in self.mysql_db_backup_instances:
             if dbobj.db_name in db_names:
-                MysqlBackup.backup_logger.debug("Setting %s as a valid database" % dbobj.db_name,
+                MysqlBackup.backup_logger.debug("Setting %s as a valid database", dbobj.db_name,
                                                 extra={'object': self})
                 dbobj.set_valid(valid=True)
             else:
-                MysqlBackup.backup_logger.debug("Setting %s as a invalid database" % dbobj.db_name,
+                MysqlBackup.backup_logger.debug("Setting %s as a invalid database", dbobj.db_name,
                                                 extra={'object': self})
                 dbobj.set_valid(valid=False)
 
+    @RunTrace.traced('get_db_backup_instances_from_files')
     def get_db_backup_instances_from_files(self):
         """Scan through the incremental path and attempt
         to initialize each file as a mysql backup file, passing
         each to the MysqlBackupFileFactory and throwing and
         catching any exceptions.
 
+        Databases outside of exclude_databases/include_only_databases
+        are skipped; their files are only remembered so they are not
+        mistaken for non backup files, and looked at once the database
+        is gone, see get_out_of_scope_leftovers.  Backup instances are
+        lightweight handles, validated when first touched.
+
         return: list of db instance objects"""
-        db_instance_file_objects = list()
+        self.out_of_scope_files = dict()
+        in_scope_files = list()
         for myfile in self.get_files_in_incremental_path():
+            db_name = MysqlBackup.get_db_name_from_file_name(myfile)
+            if db_name is not None and not self.config.is_database_in_scope(db_name):
+                self.out_of_scope_files.setdefault(db_name, list()).append(myfile)
+            else:
+                in_scope_files.append(myfile)
+        return self.get_db_instances_of_files(in_scope_files)
+
+    def get_db_instances_of_files(self, files):
+        """Return: list of db instance objects of the backup files among files"""
+        # (db name, date string) -> backup file objects
+        instance_files = dict()
+        for myfile in files:
             try:
-                db_obj = MysqlBackupFileFactory.get_file_object(myfile)
-                db_instance_file_objects.append(db_obj)
+                fo = MysqlBackupFileFactory.get_file_object(self.config, myfile)
             except AssertionError as e:
-                MysqlBackup.backup_logger.debug("%s is not a valid mysql backup file" % myfile, extra={'object': self})
-                MysqlBackup.backup_logger.debug("Excpetion was %s" % e, extra={'object': self})
-            else:
-                MysqlBackup.backup_logger.debug("%s is a valid mysql backup file" % myfile, extra={'object': self})
-
-        db_backup_instance_dict = dict()
-        for fo in db_instance_file_objects:
-            if fo.db_name not in db_backup_instance_dict:
-                # initialize a dictionary holding dates and later a db instance object
-                db_backup_instance_dict[fo.db_name] = {
-                    'date_strings':dict(),
-                    'db backup instance': None
-                }
-            if fo.date_string not in db_backup_instance_dict[fo.db_name]['date_strings']:
-                # initialize the date dictionary with a holder for a instances files
-                # and later backup instances
-                db_backup_instance_dict[fo.db_name]['date_strings'][fo.date_string]={
-                    'db backup file objects': [fo, ],
-                    'backup instance': None
-                }
-            else:
-                db_backup_instance_dict[fo.db_name]['date_strings'][fo.date_string]['db backup file objects'].append(fo)
-
-        # loop and build the backup instances
-        for db in db_backup_instance_dict:
-            failed_instances = set()
-            for date_string in db_backup_instance_dict[db]['date_strings']:
-                try:
-                    db_backup_instance_dict[db]['date_strings'][date_string]['backup instance'] = \
-                        MysqlBackupInstance(db_name=db, date_string=date_string, bkup_file_objs=
-                                            tuple(db_backup_instance_dict[db]['date_strings'][date_string]
-                                                  ['db backup file objects']))
-
-                    MysqlBackup.backup_logger.debug("%s initialized" %
-                                      db_backup_instance_dict[db]['date_strings'][date_string]['backup instance'],
-                                      extra={'object': self})
-
-                except RuntimeError as e:
-                    MysqlBackup.backup_logger.warning("Caught failure when initializing backup instance. Cleaning up "
-                                                      "db: %s and backup instance date: %s" % (db, date_string),
-                                                      extra={'object': self})
-                    failed_instances.add(date_string)
-                else:
-                    MysqlBackup.backup_logger.debug("%s %s is a valid backup instance" % (db, date_string),
-                                                    extra={'object': self})
-
-            # Cleanup failed initializations
-            for failed_instance in failed_instances:
-                del db_backup_instance_dict[db]['date_strings'][failed_instance]
-
-        # Cleanup initialized database entries that only had failed initializations
-        empty_databases = set()
-        for d in db_backup_instance_dict:
-            if len(db_backup_instance_dict[d]['date_strings']) == 0:
-                empty_databases.add(d)
-                MysqlBackup.backup_logger.debug("%s only had failed or impartial instance, removing from the backup "
-                                                "candidates to initialize." % (d,), extra={'object': self})
-        for d in empty_databases:
-            del db_backup_instance_dict[d]
-
-        # build the db instances
-        for db in db_backup_instance_dict:
-            backup_instances = list()
-            for date_string in db_backup_instance_dict[db]['date_strings']:
-                backup_instances.append(db_backup_instance_dict[db]['date_strings'][date_string]['backup instance'])
-            db_backup_instance_dict[db]['db backup instance'] = \
-                MysqlDbInstance(db_name=db, mysql_backup_instances=tuple(backup_instances))
-
-        # and finally, throw most of the hard work away.
-        # all this method really does is return a list of
-        # of db instances, so do that now
-        db_backup_instances = list()
-        for db in db_backup_instance_dict:
-            db_backup_instances.append(db_backup_instance_dict[db]['db backup instance'])
-
-        return db_backup_instances
-
+                MysqlBackup.backup_logger.debug("%s is not a valid mysql backup file", myfile, extra={'object': self})
+                MysqlBackup.backup_logger.debug("Excpetion was %s", e, extra={'object': self})
+                continue
+
+            MysqlBackup.backup_logger.debug("%s is a valid mysql backup file", myfile, extra={'object': self})
+            instance_files.setdefault((fo.db_name, fo.date_string), list()).append(fo)
+
+        # build the db instances from lightweight backup instances
+        backup_instances = dict()
+        for (db, date_string), file_objs in instance_files.iteritems():
+            backup_instances.setdefault(db, list()).append(
+                MysqlBackupInstance(self.config, db_name=db, date_string=date_string, bkup_file_objs=file_objs))
+
+        return [MysqlDbInstance(self.config, db_name=db, mysql_backup_instances=tuple(instances))
+                for db, instances in backup_instances.iteritems()]
+
+    def get_out_of_scope_leftovers(self, db_names):
+        """Databases other settings files manage are not looked at while
+        they exist.  Once one is gone from the server its backups are
+        left over, and go the way of any invalid database's.
+        db_names: the databases on the server
+        return: list of invalid db instance objects"""
+        leftovers = self.get_db_instances_of_files(
+            [myfile for db_name, files in sorted(self.out_of_scope_files.items()) if db_name not in db_names
+             for myfile in files])
+        for dbobj in leftovers:
+            dbobj.set_valid(valid=False)
+        return leftovers
+
+    def load_catalog(self):
+        """Return: the db instances of the backup files.  A process
+        running more than once keeps them while the listing of the
+        incremental path is unchanged."""
+        version = BackupDirectorySnapshot.get_version(self.config.incremental_path)
+        if self.mysql_db_backup_instances is None or version != self.catalog_version:
+            self.mysql_db_backup_instances = self.get_db_backup_instances_from_files()
+            self.catalog_version = version
+        else:
+            MysqlBackup.backup_logger.debug("The incremental path is unchanged, keeping the backup instances found "
+                                            "before.", extra={'object': self})
+            for dbobj in self.mysql_db_backup_instances:
+                # Learned by the last run
+                dbobj.backup_interval = BackupSchedule.get_interval(dbobj.db_name)
+                dbobj.unchanged = False
+        return self.mysql_db_backup_instances
+
+    def log_retention_plan(self):
+        """(void)
+        Plan retention for every database with existing backups
+        in one pass and log what would change."""
+        columns = RetentionColumns()
+        for dbobj in self.mysql_db_backup_instances:
+            dbobj.add_to_retention_columns(columns)
+        plan = MysqlDbInstance.get_retention_planner(self.config).plan(columns, int(time.time()))
+        diff = plan.get_diff()
+        MysqlBackup.backup_logger.info("Retention dry run over %d instances: %d changes, %d bytes would be freed "
+                                       "before this run's new backups are considered.",
+                                       len(columns), len(diff), plan.get_bytes_freed(), extra={'object': self})
+        for change in diff:
+            MysqlBackup.backup_logger.info("Retention dry run: %s", change, extra={'object': self})
+
+    @RunTrace.traced('clean_non_backup_files')
     def clean_non_backup_files(self):
         """(void)
         If a file exists in a backup managed path
@@ -345,43 +969,49 @@ class MysqlBackup:
         business being there, but wait cleanup_delay_days
         before removing it."""
         non_backup_files = set(self.get_all_files()) - set(self.get_all_db_files())
+        files_to_remove = list()
+        with OpenFiles.shared():
+            open_files = set(myfile for myfile in non_backup_files if MysqlBackup.is_file_open(myfile))
         for myfile in non_backup_files:
-            if not MysqlBackup.is_file_open(myfile):
-                MysqlBackup.backup_logger.info("%s does not appear to be a backup file"
-                                                % myfile, extra={'object': self})
-
-                file_age_days = int((time.time() - os.stat(myfile).st_mtime) / 86400.0)
-                if file_age_days > MysqlBackup.cleanup_delay_days:
-                    MysqlBackup.backup_logger.info("%s is older, %d days, than cleanup_delay_days, %d, removing."
-                                                   % (myfile, file_age_days, MysqlBackup.cleanup_delay_days),
+            if myfile not in open_files:
+                MysqlBackup.backup_logger.info("%s does not appear to be a backup file",
+                                                myfile, extra={'object': self})
+
+                file_age_days = int((time.time() - LongTermStorage.storage_for(myfile).get_mtime(myfile)) / 86400.0)
+                if file_age_days > self.config.cleanup_delay_days:
+                    MysqlBackup.backup_logger.info("%s is older, %d days, than cleanup_delay_days, %d, removing.",
+                                                   myfile, file_age_days, self.config.cleanup_delay_days,
                                                    extra={'object': self})
-                    os.remove(myfile)
+                    files_to_remove.append(myfile)
                 else:
                     MysqlBackup.backup_logger.info("%s is not older, %d days, than cleanup_delay_days, %d, not "
-                                                   "removing." % (myfile, file_age_days,
-                                                                  MysqlBackup.cleanup_delay_days),
+                                                   "removing.", myfile, file_age_days, self.config.cleanup_delay_days,
                                                    extra={'object': self})
             else:
-                MysqlBackup.backup_logger.debug("%s is open.  Not removing it." % myfile, extra={'object': self})
+                MysqlBackup.backup_logger.debug("%s is open.  Not removing it.", myfile, extra={'object': self})
+
+        failed = DeletionPool(self.config).delete(files_to_remove)
+        RunMetrics.add('files_pruned', len(files_to_remove) - len(failed))
 
     def get_all_db_files(self):
-        filelist = list()
+        filelist = [myfile for files in self.out_of_scope_files.values() for myfile in files]
         for dbinst in self.mysql_db_backup_instances:
             filelist += dbinst.get_all_files()
+        # long term copies of databases managed by other settings files
+        for myfile in self.get_files_in_long_term_path():
+            db_name = MysqlBackup.get_db_name_from_file_name(myfile)
+            if db_name is not None and not self.config.is_database_in_scope(db_name):
+                filelist.append(myfile)
         return filelist
 
     def get_all_files(self):
         return self.get_files_in_incremental_path() + self.get_files_in_long_term_path()
 
     def get_files_in_incremental_path(self):
-        incremental_files = [mysql_backup.MysqlBackup.incremental_path.rstrip('/') + '/' + f for f in os.listdir(mysql_backup.MysqlBackup.incremental_path)
-                             if os.path.isfile(os.path.join(mysql_backup.MysqlBackup.incremental_path, f))]
-        return incremental_files
+        return BackupDirectorySnapshot.list_files(self.config.incremental_path)
 
     def get_files_in_long_term_path(self):
-        incremental_files = [mysql_backup.MysqlBackup.long_term_backup_path.rstrip('/') + '/' + f for f in os.listdir(mysql_backup.MysqlBackup.long_term_backup_path)
-                             if os.path.isfile(os.path.join(mysql_backup.MysqlBackup.long_term_backup_path, f))]
-        return incremental_files
+        return LongTermStorage.get().list_files()
 
     def get_db_instance_by_name(self, name):
         for db in self.mysql_db_backup_instances:
@@ -389,11 +1019,20 @@ class MysqlBackup:
                 return db
         return None
 
+    @staticmethod
+    def get_db_name_from_file_name(file_name):
+        """Return: the database a backup file name belongs to or None
+        when the name does not follow the db__date.ext convention."""
+        file_name = os.path.basename(file_name)
+        if file_name.count('__') != 1 or '.' not in file_name:
+            return None
+        return file_name.split('__')[0]
+
     @staticmethod
     def get_file_age(age_format, file_name):
         """format: [days|seconds]"""
         cur_ts = int(time.time())
-        epoc_mod_time = int(os.stat(file_name).st_mtime)
+        epoc_mod_time = int(BackupDirectorySnapshot.get_mtime(file_name))
 
         age_in_secs = cur_ts - epoc_mod_time
 
@@ -424,14 +1063,20 @@ class MysqlBackup:
 
     @staticmethod
     def is_file_open(file_name):
+        return OpenFiles.is_open(file_name)
 
-        open_files = set()
-        for p in psutil.process_iter():
-            process = psutil.Process(p.pid)
-            for f in process.open_files():
-                open_files.add(f.path)
-
-        return file_name in open_files
+    @staticmethod
+    def connect(config, database, host=None):
+        """Return: a new connection returning rows as dicts, to host or
+        else the replica the running job dumps from"""
+        import MySQLdb
+        import MySQLdb.cursors
+        host, port = BackupReplicas.split_host(host or BackupReplicas.get_host(config))
+        if port is not None:
+            return MySQLdb.connect(host, config.mysql_username, config.mysql_password, database, port=port,
+                                   cursorclass=MySQLdb.cursors.DictCursor)
+        return MySQLdb.connect(host, config.mysql_username, config.mysql_password,
+                               database, cursorclass=MySQLdb.cursors.DictCursor)
 
     def connect_if_not_connected(self, database):
         """
@@ -445,12 +1090,34 @@ class MysqlBackup:
             if self.cursor is not None:
                 self.cursor.close()
 
-            self.db_connection = MySQLdb.connect(MysqlBackup.mysql_host, MysqlBackup.mysql_username,
-                                                 MysqlBackup.mysql_password, database,
-                                                 cursorclass=MySQLdb.cursors.DictCursor)
+            self.db_connection = MysqlBackup.connect(self.config, database)
             self.cursor = self.db_connection.cursor()
             self.cur_database = database
 
+    def check_connection(self):
+        """A connection kept from an earlier run may have been closed
+        by the server meanwhile, connect again when it is used"""
+        if self.db_connection is None:
+            return
+        import MySQLdb
+        try:
+            self.db_connection.ping()
+        except MySQLdb.Error as e:
+            MysqlBackup.backup_logger.info("The connection kept from the last run is gone (%s), reconnecting.", e,
+                                           extra={'object': self})
+            self.close_connection()
+
+    def close_connection(self):
+        for handle in (self.cursor, self.db_connection):
+            if handle is not None:
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+        self.cursor = None
+        self.db_connection = None
+        self.cur_database = None
+
     def get_databases(self):
         '''
         return a list of databases names
@@ -473,20 +1140,11 @@ class MysqlBackup:
         backup would be saved.  Only when a backup completes and
         matches an md5 are we really sure it should be saved or not."""
 
-        db_config_filtered = list()
-        for db in self.get_databases():
-            if MysqlBackup.limits_include_only_databases:
-                if db in MysqlBackup.limits_include_only_databases:
-                    db_config_filtered.append(db)
-            elif MysqlBackup.limits_exclude_databases:
-                if db not in MysqlBackup.limits_exclude_databases:
-                    db_config_filtered.append(db)
-            else:
-                db_config_filtered.append(db)
+        db_config_filtered = [db for db in self.get_databases() if self.config.is_database_in_scope(db)]
 
-        if MysqlBackup.verbose:
+        if self.config.verbose:
             MysqlBackup.backup_logger.info("Based on the exclude_databases and include_only_databases directives, the potential "
-                             "database backup candidates so far are as follows:\n%s" % (','.join(db_config_filtered)),
+                             "database backup candidates so far are as follows:\n%s", ','.join(db_config_filtered),
                              extra={'object': self})
 
         return db_config_filtered
@@ -502,6 +1160,24 @@ class MysqlBackup:
         else:
             return False
 
+    @staticmethod
+    def get_seconds_behind_master(slave_status):
+        """Return: int or None when unknown, as when the slave is stopped"""
+        lag = slave_status.get("Seconds_Behind_Master")
+        if lag in (None, '', 'NULL'):
+            return None
+        return int(lag)
+
+    def get_seconds_behind_master_on_new_connection(self):
+        """For threads that can not share the run's connection"""
+        db_connection = MysqlBackup.connect(self.config, "mysql")
+        try:
+            cursor = db_connection.cursor()
+            cursor.execute("SHOW SLAVE STATUS;")
+            return MysqlBackup.get_seconds_behind_master(cursor.fetchall()[0])
+        finally:
+            db_connection.close()
+
     def slave_should_be_running(self, running_state):
         """
         param: running_state (bool)
@@ -509,6 +1185,12 @@ class MysqlBackup:
         False = set the slave to stopped if not already stopped
         """
 
+        with RunTrace.span('slave_should_be_running', running_state=running_state):
+            self.set_slave_running_state(running_state)
+
+    def set_slave_running_state(self, running_state):
+        """Use slave_should_be_running, which also traces this"""
+
         # wait for the slave to catch up before failing
         seconds_between_tries = 5
         retries = 20
@@ -518,6 +1200,7 @@ class MysqlBackup:
             self.connect_if_not_connected("mysql")
             MysqlBackup.backup_logger.info("Starting mysql slave.", extra={'object': self})
             self.cursor.execute("START SLAVE;")
+            self.record_slave_stopped_time()
 
             while i < retries and not self.is_slave_running():
                 i += 1
@@ -543,6 +1226,15 @@ class MysqlBackup:
                 MysqlBackup.backup_logger.error(msg, extra={'object': self})
                 raise SystemError(msg)
 
+            self.slave_stopped_time = time.time()
+
+    def record_slave_stopped_time(self):
+        """(void)
+        Add the time since this run stopped the slave to the metrics"""
+        if self.slave_stopped_time is not None:
+            RunMetrics.add('slave_stopped_seconds', time.time() - self.slave_stopped_time)
+            self.slave_stopped_time = None
+
     def get_database_file_objects(self):
         """Iterate over the backup file directories
         and attempt to return backup file objects.
@@ -557,35 +1249,35 @@ class MysqlBackup:
         However, backup files are only removed if they meet
         the age criteria."""
 
-        for path in (MysqlBackup.incremental_path, MysqlBackup.long_term_backup_path):
-            file_full_paths = [os.path.join(path, fn) for fn in next(os.walk(path))[2]]
+        for path in (self.config.incremental_path, self.config.long_term_backup_path):
+            file_full_paths = BackupDirectorySnapshot.list_files(path)
             for file_full_path in file_full_paths:
                 try:
-                    db_file_obj = MysqlBackupFileFactory.get_file_object(file_full_path)
+                    db_file_obj = MysqlBackupFileFactory.get_file_object(self.config, file_full_path)
                     yield db_file_obj
                 except AssertionError as e:
 
                     MysqlBackup.backup_logger.debug("%s failed to initialized as a backup file. Only backup files "
                                                     "should exist in backup directories. Based on preservation time, "
-                                                    "considering deletion."
-                                                    % (file_full_path,), extra={'object': self})
+                                                    "considering deletion.",
+                                                    file_full_path, extra={'object': self})
 
-                    MysqlBackup.backup_logger.debug("Assertion was %s" % e)
+                    MysqlBackup.backup_logger.debug("Assertion was %s", e)
 
-                    if path == MysqlBackup.incremental_path and \
+                    if path == self.config.incremental_path and \
                             MysqlBackup.get_file_age(file_name=file_full_path, age_format='days') > \
-                            MysqlBackup.cleanup_delay_days:
+                            self.config.cleanup_delay_days:
                             MysqlBackup.backup_logger.debug("Criteria met.  Deleting.", extra={'object': self})
 
-                            os.remove(file_full_path)
+                            BackupDirectorySnapshot.remove(file_full_path)
 
-                    elif path == MysqlBackup.long_term_backup_path and \
+                    elif path == self.config.long_term_backup_path and \
                             MysqlBackup.get_file_age(file_name=file_full_path, age_format='days') > \
-                            MysqlBackup.cleanup_delay_days:
+                            self.config.cleanup_delay_days:
 
                             MysqlBackup.backup_logger.debug("Criteria met.  Deleting.")
 
-                            os.remove(file_full_path)
+                            BackupDirectorySnapshot.remove(file_full_path)
                     else:
                         MysqlBackup.backup_logger.debug("Criteria not met.  Leaving along for now.", extra={'object': self})
 
@@ -599,18 +1291,51 @@ class MysqlBackup:
         else:
             return int(config_value)
 
+    def get_optional(self, config, section, option, default=None):
+        """Options added after a settings file was first written
+        may be missing or empty.  Return the default in that case
+        so older settings files keep working."""
+        if config.has_option(section, option) and config.get(section, option) not in (None, ''):
+            return config.get(section, option)
+        return default
+
+    @RunTrace.traced('ensure_snapshot_exists_and_refresh_if_possible')
     def ensure_snapshot_exists_and_refresh_if_possible(self):
-        snapshot_obj = LvSnapshot(vg=self.snapshot_vg, lv=self.snapshot_lv, snapshot_name=self.snapshot_name,
-                                  size_gb=self.snapshot_size_gb)
+        snapshot_obj = LvSnapshot(self.config)
         snapshot_obj.safe_refresh_snapshot()
 
+    def write_metrics(self):
+        """(void)
+        Write the node_exporter textfile and json run report
+        when configured."""
+        # A slave left stopped for other running backups still counts
+        self.record_slave_stopped_time()
+        RunMetrics.set('run_timestamp_seconds', int(time.time()))
+
+        if self.config.metrics_textfile:
+            MysqlBackup.backup_logger.debug("Writing metrics to %s", self.config.metrics_textfile,
+                                            extra={'object': self})
+            RunMetrics.write_textfile(self.config.metrics_textfile,
+                                      labels={'settings_file': self.config.settings_file})
+
+        if self.config.metrics_report_file:
+            MysqlBackup.backup_logger.debug("Writing run report to %s", self.config.metrics_report_file,
+                                            extra={'object': self})
+            RunMetrics.write_json_report(self.config.metrics_report_file, settings_file=self.config.settings_file,
+                                         backup_id=self.config.backup_id,
+                                         profile_stats_file=self.config.profile_stats_file)
+
+        if self.config.trace_file:
+            MysqlBackup.backup_logger.debug("Writing trace to %s", self.config.trace_file, extra={'object': self})
+            RunTrace.write_chrome_trace(self.config.trace_file)
+
     def log_running_time(self, logtype):
         """Input: logtype=[begin|end]
         If verbosity is enabled, print start, end, and running times"""
 
         if logtype == 'begin':
             self.starting_time = datetime.datetime.now()
-            MysqlBackup.backup_logger.info("Backup start time: %s" % (self.starting_time,), extra={'object': self})
+            MysqlBackup.backup_logger.info("Backup start time: %s", self.starting_time, extra={'object': self})
 
         elif logtype == 'end':
             if self.starting_time is None:
@@ -618,9 +1343,10 @@ class MysqlBackup:
                 MysqlBackup.backup_logger.error(msg, extra={'object': self})
                 raise ValueError(msg)
             end = datetime.datetime.now()
-            MysqlBackup.backup_logger.info("Backup end time: %s" % (end,), extra={'object': self})
+            MysqlBackup.backup_logger.info("Backup end time: %s", end, extra={'object': self})
             tdelta = end - self.starting_time
-            MysqlBackup.backup_logger.info("Backup runtime: %s" % (tdelta,), extra={'object': self})
+            MysqlBackup.backup_logger.info("Backup runtime: %s", tdelta, extra={'object': self})
+            RunMetrics.set('run_duration_seconds', tdelta.total_seconds())
 
         else:
             msg = "logtype must be either begin or end"
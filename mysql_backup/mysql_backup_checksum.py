@@ -0,0 +1,93 @@
+# Checksum
+# In process hashing of backup files.  Backup files
+# are read once through a large reusable buffer
+# rather than forking /bin/md5sum.  The algorithm
+# used is recorded in the checksum file so older,
+# md5 only, checksum files continue to compare.
+
+import hashlib
+
+# Optional, faster, non cryptographic and cryptographic
+# hash implementations.  Only required when configured.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+class MysqlBackupChecksum(object):
+
+    # Checksum files written before the algorithm was recorded
+    # only ever contained an md5 hex digest.
+    legacy_algorithm = 'md5'
+    default_buffer_size = 8 * 1024 * 1024
+    separator = ':'
+
+    @staticmethod
+    def get_supported_algorithms():
+        """Return: list of algorithm names usable on this system"""
+        supported = ['md5', 'sha1', 'sha256', 'sha512']
+        if 'blake2b' in getattr(hashlib, 'algorithms_available', ()):
+            supported.append('blake2b')
+        if xxhash is not None:
+            supported.append('xxh64')
+            if hasattr(xxhash, 'xxh3_64'):
+                supported += ['xxh3_64', 'xxh3_128']
+        if blake3 is not None:
+            supported.append('blake3')
+        return supported
+
+    @staticmethod
+    def new_hash(algorithm):
+        """Return: a hash object with update and hexdigest methods"""
+        if algorithm not in MysqlBackupChecksum.get_supported_algorithms():
+            raise ValueError("Checksum algorithm %s is not supported on this system. Supported algorithms are %s"
+                             % (algorithm, ', '.join(MysqlBackupChecksum.get_supported_algorithms())))
+        if algorithm.startswith('xxh'):
+            return getattr(xxhash, algorithm)()
+        elif algorithm == 'blake3':
+            return blake3.blake3()
+        else:
+            return hashlib.new(algorithm)
+
+    @staticmethod
+    def get_digest_from_file(file_name, algorithm, buffer_size=None):
+        """Return: hex digest of the file contents.
+        The file is read sequentially into a single reusable
+        buffer so large dumps do not churn memory."""
+        if not buffer_size:
+            buffer_size = MysqlBackupChecksum.default_buffer_size
+
+        hash_obj = MysqlBackupChecksum.new_hash(algorithm)
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        with open(file_name, 'rb', 0) as file_pointer:
+            while True:
+                bytes_read = file_pointer.readinto(buf)
+                if not bytes_read:
+                    break
+                hash_obj.update(view[:bytes_read])
+        return hash_obj.hexdigest()
+
+    @staticmethod
+    def format_checksum(algorithm, digest):
+        """Return: the string stored in a checksum file.
+        md5 is written as a bare digest to stay identical
+        to checksum files written by md5sum."""
+        if algorithm == MysqlBackupChecksum.legacy_algorithm:
+            return digest
+        return algorithm + MysqlBackupChecksum.separator + digest
+
+    @staticmethod
+    def parse_checksum(checksum_str):
+        """Return: tuple (algorithm, digest) from the content of a checksum file"""
+        checksum_str = checksum_str.strip()
+        if MysqlBackupChecksum.separator in checksum_str:
+            algorithm, digest = checksum_str.split(MysqlBackupChecksum.separator, 1)
+            return algorithm, digest.lower()
+        return MysqlBackupChecksum.legacy_algorithm, checksum_str.lower()
@@ -0,0 +1,77 @@
+# Config
+# The settings of a run as one frozen, picklable value.
+# MysqlBackup reads the settings file into a BackupConfig
+# and hands it to everything doing the work.  A worker
+# needs nothing but the config shipped with its job, so
+# it makes no difference whether the worker was forked
+# from the run, spawned, or kept from an earlier run.
+
+from collections import namedtuple
+from mysql_backup_logging import RunLog
+
+FIELDS = (
+    # Logging
+    # log_levels is a tuple of (subsystem, level name)
+    'backup_id', 'settings_file', 'logfile', 'loglevel', 'log_levels',
+    # MySQL
+    'mysql_username', 'mysql_password', 'mysql_dump_options', 'mysql_host', 'mysqldump_command',
+    'mysql_hosts', 'replica_max_lag_seconds', 'replica_catch_up_seconds',
+    # Backup
+    'compression_enabled', 'compress_command', 'decompress_command', 'compressed_file_extension',
+    'compression_format', 'compression_frame_size', 'compression_threads',
+    'table_level_incremental', 'table_checksum',
+    'max_parallel', 'worker_backend', 'cleanup_delay_days',
+    'incremental_path', 'incremental_min_backup_frequency_seconds', 'incremental_max_lifespan_seconds',
+    'incremental_max_copies',
+    'long_term_backup_path', 'long_term_backup_min_frequency_seconds', 'long_term_backup_max_copies',
+    'long_term_max_lifespan_seconds',
+    'checksum_algorithm', 'checksum_buffer_size', 'directory_watch', 'directory_cursor_file',
+    'retention_dry_run', 'retention_io_threads', 'deletion_retries', 'reconcile_threads',
+    'job_retries', 'job_retry_delay_seconds',
+    'long_term_copy_streams', 'long_term_copy_verify', 'long_term_storage',
+    'skip_when_nothing_due', 'skip_when_replication_idle', 'replication_idle_max_skip_seconds',
+    'binlog_change_detection', 'binlog_scan_max_events',
+    'adaptive_frequency', 'adaptive_min_backup_frequency_seconds', 'adaptive_max_backup_frequency_seconds',
+    'adaptive_max_dump_bytes_per_day',
+    'running_cache_file', 'cache_lock_wait', 'cache_successful_run_purge_days',
+    # S3
+    's3_bucket', 's3_prefix', 's3_endpoint_url', 's3_region', 's3_access_key_id', 's3_secret_access_key',
+    's3_part_size', 's3_upload_threads', 's3_storage_class',
+    # Throttle, throttle_rates is a tuple of (stage, bytes per second)
+    'throttle_rates', 'throttle_nice', 'throttle_ionice', 'throttle_cpu_affinity', 'throttle_adaptive',
+    'throttle_adaptive_max_lag_seconds', 'throttle_adaptive_min_fraction',
+    'throttle_adaptive_check_interval_seconds',
+    'throttle_page_cache_drop', 'throttle_page_cache_window', 'throttle_preallocate', 'throttle_copy_direct_io',
+    # Limits, tuples or None
+    'limits_exclude_databases', 'limits_include_only_databases',
+    # Snapshot
+    'snapshot_name', 'snapshot_vg', 'snapshot_lv', 'snapshot_size_gb', 'snapshot_lvm_bin_dir', 'snapshot_dev_dir',
+    # Metrics
+    'metrics_textfile', 'metrics_report_file', 'trace_file', 'profile_database', 'profile_stats_file',
+    'verbose',
+)
+
+
+class BackupConfig(namedtuple('BackupConfig', FIELDS)):
+    """Immutable.  Settings are attributes, build one with
+    BackupConfig(**settings) naming every field."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "config of %s" % self.settings_file
+
+    def get_logger(self, subsystem=None):
+        """Return: the run's logger, or its child for one of
+        mysql_backup_logging.SUBSYSTEMS.  Forked workers inherit
+        the handler, spawned ones open the log file themselves."""
+        return RunLog.get_logger(self, subsystem)
+
+    def is_database_in_scope(self, db_name):
+        """Per the exclude_databases and include_only_databases directives,
+        is this database managed by this settings file"""
+        if self.limits_include_only_databases:
+            return db_name in self.limits_include_only_databases
+        elif self.limits_exclude_databases:
+            return db_name not in self.limits_exclude_databases
+        return True
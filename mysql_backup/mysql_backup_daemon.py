@@ -0,0 +1,412 @@
+# Daemon
+# Runs the backups of one or more settings files from one
+# long running process instead of one cron invocation per
+# run.  Modules are imported, settings files read and the
+# running cache sanitized once; the database connection,
+# the directory listings, watched for changes, and the
+# backup instances found in them are kept between runs.
+#
+# Each database's next attempt follows from its youngest
+# backup, its last attempt and its backup frequency, and a
+# run is due at the earliest of them or once the smallest
+# frequency passed since the last successful run, as
+# is_anything_due decides.  The daemon sleeps until then,
+# no longer than max_idle_seconds, and never runs a settings
+# file again within min_idle_seconds of its last run.
+#
+# SIGHUP reads the settings files again, SIGUSR1 runs every
+# settings file now and SIGTERM or SIGINT stop the daemon
+# once the current run is over.  The control socket, a UNIX
+# socket only its owner may use, takes one command per
+# connection and answers with one line of json:
+#   status                  the daemon and every settings file
+#   run [settings file]     run now, even when nothing is due
+#   reload
+#   stop
+
+import errno
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from mysql_backup import MysqlBackup
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup_logging import RunLog
+from run_metrics.run_metrics import RunMetrics
+
+COMMANDS = ('status', 'run', 'reload', 'stop')
+
+
+class ScheduledBackup(object):
+    """A settings file the daemon runs, and how its runs went"""
+
+    def __init__(self, settings_file):
+        self.settings_file = settings_file
+        self.backup = MysqlBackup(settings_file)
+        # idle, running or failed
+        self.state = 'idle'
+        self.runs = 0
+        self.failures = 0
+        self.last_run_started = None
+        self.last_run_finished = None
+        # ok, skipped or failed
+        self.last_result = None
+        self.last_error = None
+        # unix times, None for now
+        self.next_attempt = None
+        self.database_attempts = dict()
+        # Run at the next wake up, nothing due or not
+        self.forced = False
+
+    def __str__(self):
+        return "daemon schedule of %s" % self.settings_file
+
+    def take_over(self, previous):
+        """Go on from how the runs with the previous settings went"""
+        for name in ('runs', 'failures', 'last_run_started', 'last_run_finished', 'last_result', 'last_error',
+                     'forced'):
+            setattr(self, name, getattr(previous, name))
+
+    def get_status(self):
+        return {
+            'settings_file': self.settings_file,
+            'state': self.state,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run_started': self.last_run_started,
+            'last_run_finished': self.last_run_finished,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+            'next_attempt': self.next_attempt,
+            'forced': self.forced,
+            'databases': self.database_attempts,
+        }
+
+
+class BackupDaemon(object):
+
+    backup_logger = None
+
+    def __init__(self, settings_files, control_socket=None, max_idle_seconds=3600, min_idle_seconds=60,
+                 retry_seconds=300):
+        self.settings_files = [os.path.abspath(settings_file) for settings_file in settings_files]
+        self.control_socket = control_socket and os.path.abspath(control_socket)
+        self.max_idle_seconds = max_idle_seconds
+        self.min_idle_seconds = min_idle_seconds
+        self.retry_seconds = retry_seconds
+
+        self.pid = os.getpid()
+        self.started = None
+        self.scheduled = list()
+        # Guards the schedules and the flags below, which the control
+        # thread and signal handlers change
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.reload_requested = False
+        self.server = None
+        self.server_thread = None
+
+    def __str__(self):
+        return "backup daemon %d" % self.pid
+
+    # Loading
+
+    def load(self):
+        """Read every settings file.  On a reload a settings file that
+        can not be read keeps its previous settings."""
+        previous = dict((scheduled.settings_file, scheduled) for scheduled in self.scheduled)
+        scheduled_list = list()
+        for settings_file in self.settings_files:
+            try:
+                scheduled = ScheduledBackup(settings_file)
+            except Exception:
+                if settings_file not in previous:
+                    raise
+                BackupDaemon.backup_logger.exception("%s could not be read, keeping its previous settings.",
+                                                     settings_file, extra={'object': self})
+                scheduled_list.append(previous.pop(settings_file))
+                continue
+            if settings_file in previous:
+                scheduled.take_over(previous[settings_file])
+            scheduled_list.append(scheduled)
+
+        with self.lock:
+            self.scheduled = scheduled_list
+        BackupDaemon.backup_logger = self.scheduled[0].backup.config.get_logger()
+        # What was replaced
+        for scheduled in previous.values():
+            if scheduled not in scheduled_list:
+                scheduled.backup.close_connection()
+                RunLog.stop(scheduled.backup.config)
+        for scheduled in self.scheduled:
+            self.schedule(scheduled)
+
+    def reload(self):
+        BackupDaemon.backup_logger.info("Reading the settings files again.", extra={'object': self})
+        with self.lock:
+            self.reload_requested = False
+        self.load()
+
+    # Scheduling
+
+    def schedule(self, scheduled, failed=False):
+        """Work out when scheduled is due next"""
+        now = time.time()
+        try:
+            next_attempt, database_attempts = scheduled.backup.get_next_attempt_times()
+        except Exception:
+            BackupDaemon.backup_logger.exception("Could not work out when %s is due, trying again in %d seconds.",
+                                                 scheduled.settings_file, self.retry_seconds,
+                                                 extra={'object': self})
+            next_attempt, database_attempts = now + self.retry_seconds, dict()
+
+        if scheduled.last_run_finished is not None:
+            wait = self.retry_seconds if failed else self.min_idle_seconds
+            next_attempt = max(next_attempt or now, scheduled.last_run_finished + wait)
+        if next_attempt is not None:
+            next_attempt = min(next_attempt, now + self.max_idle_seconds)
+
+        with self.lock:
+            scheduled.next_attempt = next_attempt
+            scheduled.database_attempts = database_attempts
+        BackupDaemon.backup_logger.info("%s is due %s.", scheduled.settings_file,
+                                        time.ctime(next_attempt) if next_attempt is not None else 'now',
+                                        extra={'object': self})
+
+    def get_due(self):
+        """Return: the settings files to run now, in the order given"""
+        now = time.time()
+        with self.lock:
+            return [scheduled for scheduled in self.scheduled
+                    if scheduled.forced or scheduled.next_attempt is None or scheduled.next_attempt <= now]
+
+    def get_wait_seconds(self):
+        """Return: how long to sleep until the next settings file is due"""
+        now = time.time()
+        with self.lock:
+            next_attempts = [scheduled.next_attempt for scheduled in self.scheduled]
+        if None in next_attempts:
+            return 0
+        return max(0, min([self.max_idle_seconds] + [next_attempt - now for next_attempt in next_attempts]))
+
+    # Running
+
+    def run_scheduled(self, scheduled):
+        with self.lock:
+            forced = scheduled.forced
+            scheduled.forced = False
+            scheduled.state = 'running'
+            scheduled.last_run_started = time.time()
+        BackupDaemon.backup_logger.info("Running %s%s.", scheduled.settings_file, " on demand" if forced else "",
+                                        extra={'object': self})
+
+        backup = scheduled.backup
+        failed = False
+        try:
+            # Cron started each run with this, a backup process may have died since
+            backup.run_cache_manager.sanitize_cache()
+            backup.execute(force=forced)
+        except Exception as e:
+            failed = True
+            BackupDaemon.backup_logger.exception("The run of %s failed, trying again in %d seconds.",
+                                                 scheduled.settings_file, self.retry_seconds, extra={'object': self})
+            # This process lives on, sanitize_cache would not remove it
+            try:
+                backup.run_cache_manager.remove_current_backup_from_running_cache()
+            except Exception:
+                BackupDaemon.backup_logger.exception("Could not remove the failed run from the running cache.",
+                                                     extra={'object': self})
+            # The connection may be what failed
+            backup.close_connection()
+            result, error = 'failed', str(e)
+        else:
+            result = 'skipped' if RunMetrics.get_values().get('run_skipped') else 'ok'
+            error = None
+
+        with self.lock:
+            scheduled.state = 'failed' if failed else 'idle'
+            scheduled.runs += 1
+            scheduled.failures += failed
+            scheduled.last_run_finished = time.time()
+            scheduled.last_result = result
+            scheduled.last_error = error
+        self.schedule(scheduled, failed)
+
+    def serve(self):
+        """Run the settings files as they become due until stopped"""
+        self.started = time.time()
+        # Listings are watched and kept from run to run
+        BackupDirectorySnapshot.persistent = True
+        self.load()
+        self.install_signal_handlers()
+        if self.control_socket:
+            self.start_control_server()
+        BackupDaemon.backup_logger.info("Backup daemon started for %s.", ', '.join(self.settings_files),
+                                        extra={'object': self})
+        try:
+            while not self.stopping:
+                # Anything asking for a wake up from here on is seen by wait
+                self.wake.clear()
+                if self.reload_requested:
+                    self.reload()
+                for scheduled in self.get_due():
+                    if self.stopping or self.reload_requested:
+                        break
+                    self.run_scheduled(scheduled)
+                if not self.stopping:
+                    self.wake.wait(self.get_wait_seconds())
+        finally:
+            BackupDaemon.backup_logger.info("Backup daemon stopping.", extra={'object': self})
+            self.stop_control_server()
+            for scheduled in self.scheduled:
+                scheduled.backup.close_connection()
+
+    # Requests, from signals and the control socket
+
+    def request_run(self, settings_file=None):
+        """Return: the settings files that will run at the next wake up"""
+        with self.lock:
+            requested = [scheduled for scheduled in self.scheduled
+                         if settings_file is None or scheduled.settings_file == os.path.abspath(settings_file)]
+            for scheduled in requested:
+                scheduled.forced = True
+        self.wake.set()
+        return [scheduled.settings_file for scheduled in requested]
+
+    def request_reload(self):
+        with self.lock:
+            self.reload_requested = True
+        self.wake.set()
+
+    def request_stop(self):
+        with self.lock:
+            self.stopping = True
+        self.wake.set()
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'started': self.started,
+                'state': 'stopping' if self.stopping else 'running',
+                'settings_files': [scheduled.get_status() for scheduled in self.scheduled],
+            }
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+            # Restart system calls of a run the signal arrives during
+            signal.siginterrupt(signum, False)
+
+    def handle_signal(self, signum, frame):
+        if os.getpid() != self.pid:
+            # A worker forked during a run inherited the handler, it
+            # goes the way it would have gone without the daemon
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        if signum == signal.SIGHUP:
+            self.request_reload()
+        elif signum == signal.SIGUSR1:
+            self.request_run()
+        else:
+            self.request_stop()
+
+    def handle_command(self, line):
+        """Return: the answer to one control socket command, a dict"""
+        words = line.split(None, 1)
+        command = words[0].lower() if words else ''
+        if command == 'status':
+            return self.get_status()
+        elif command == 'run':
+            requested = self.request_run(words[1].strip() if len(words) > 1 else None)
+            if not requested:
+                return {'error': "%s is not run by this daemon" % words[1].strip()}
+            return {'requested': requested}
+        elif command == 'reload':
+            self.request_reload()
+            return {'requested': 'reload'}
+        elif command == 'stop':
+            self.request_stop()
+            return {'requested': 'stop'}
+        return {'error': "Unknown command %r, expected one of %s" % (command, ', '.join(COMMANDS))}
+
+    # The control socket
+
+    def start_control_server(self):
+        """Listen on the control socket.  A socket file left by a daemon
+        that is gone is replaced, a daemon still listening on it is not."""
+        if os.path.exists(self.control_socket):
+            try:
+                BackupDaemon.send_command(self.control_socket, 'status')
+            except socket.error as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    raise
+                os.unlink(self.control_socket)
+            else:
+                raise RuntimeError("Another daemon is listening on %s" % self.control_socket)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands start backups, only the owner may connect
+        umask = os.umask(0077)
+        try:
+            self.server.bind(self.control_socket)
+        finally:
+            os.umask(umask)
+        self.server.listen(5)
+        # accept wakes up now and then to see whether the daemon stopped
+        self.server.settimeout(1.0)
+        self.server_thread = threading.Thread(target=self.serve_control, name="control socket")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def stop_control_server(self):
+        if self.server is None:
+            return
+        self.server_thread.join(5)
+        self.server.close()
+        self.server = None
+        try:
+            os.unlink(self.control_socket)
+        except OSError:
+            pass
+
+    def serve_control(self):
+        while not self.stopping:
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                connection.settimeout(5.0)
+                line = connection.makefile('rb').readline(4096).strip()
+                try:
+                    answer = self.handle_command(line)
+                except Exception as e:
+                    BackupDaemon.backup_logger.exception("Control command %r failed.", line, extra={'object': self})
+                    answer = {'error': str(e)}
+                connection.sendall(json.dumps(answer, sort_keys=True) + '\n')
+            except socket.error:
+                BackupDaemon.backup_logger.warning("Lost a control socket connection.", exc_info=True,
+                                                   extra={'object': self})
+            finally:
+                connection.close()
+
+    @staticmethod
+    def send_command(control_socket, command, timeout=10.0):
+        """Return: the daemon's answer to command, a dict"""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(timeout)
+            client.connect(control_socket)
+            client.sendall(command.strip() + '\n')
+            return json.loads(client.makefile('rb').readline())
+        finally:
+            client.close()
@@ -0,0 +1,121 @@
+# Deletion Pool
+# Removes large numbers of backup files on a bounded
+# thread pool.  Removals are batched per directory,
+# transient errors (common on NFS) are retried with a
+# growing delay and throughput is logged and exported.
+# Long term copies are always removed before the
+# incremental they were copied from, through the long
+# term storage they live in.
+
+import errno
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from mysql_backup_long_term_storage import LongTermStorage
+from run_metrics.run_metrics import RunMetrics
+
+# Worth another attempt, anything else is reported straight away
+TRANSIENT_ERRNOS = (errno.EINTR, errno.EAGAIN, errno.EBUSY, errno.EIO, errno.ETIMEDOUT, errno.ESTALE)
+
+
+class DeletionPool(object):
+
+    backup_logger = None
+
+    # Files removed by one thread before it moves to the next batch
+    batch_size = 256
+
+    def __init__(self, config, threads=None, retry_delay=0.5):
+        """threads defaults to config's retention_io_threads"""
+        DeletionPool.backup_logger = config.get_logger('retention')
+        self.config = config
+        self.threads = max(1, threads or config.retention_io_threads or 1)
+        self.retries = max(0, config.deletion_retries or 0)
+        self.retry_delay = retry_delay
+
+    def __str__(self):
+        return "deletion pool"
+
+    def remove_file(self, file_name):
+        """Return: True when the file is gone"""
+        attempt = 0
+        while True:
+            try:
+                LongTermStorage.storage_for(file_name).remove(file_name)
+                return True
+            except OSError as e:
+                if e.errno in TRANSIENT_ERRNOS and attempt < self.retries:
+                    attempt += 1
+                    RunMetrics.add('deletion_retries', 1)
+                    DeletionPool.backup_logger.debug("Removing %s failed, attempt %d of %d. %s",
+                                                     file_name, attempt, self.retries + 1, e,
+                                                     extra={'object': self})
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                else:
+                    DeletionPool.backup_logger.warning("Could not remove %s. %s", file_name, e,
+                                                       extra={'object': self})
+                    return False
+
+    def remove_batch(self, file_names):
+        """Return: the files of the batch that could not be removed"""
+        return [file_name for file_name in file_names if not self.remove_file(file_name)]
+
+    def get_batches(self, file_names):
+        """Return: lists of at most batch_size files, each from a single directory"""
+        by_directory = dict()
+        for file_name in file_names:
+            by_directory.setdefault(os.path.dirname(file_name), list()).append(file_name)
+        batches = list()
+        for directory in sorted(by_directory):
+            files = sorted(by_directory[directory])
+            for start in range(0, len(files), DeletionPool.batch_size):
+                batches.append(files[start:start + DeletionPool.batch_size])
+        return batches
+
+    def delete(self, file_names):
+        """Return: list of the files that could not be removed"""
+        file_names = list(set(file_names))
+        if not file_names:
+            return []
+
+        size = sum(LongTermStorage.storage_for(file_name).get_size(file_name) for file_name in file_names)
+        start = time.time()
+        batches = self.get_batches(file_names)
+        if self.threads == 1 or len(batches) == 1:
+            results = [self.remove_batch(batch) for batch in batches]
+        else:
+            pool = ThreadPool(min(self.threads, len(batches)))
+            try:
+                results = pool.map(self.remove_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+
+        failed = [file_name for batch_failed in results for file_name in batch_failed]
+        removed = len(file_names) - len(failed)
+        RunMetrics.add('deletion_seconds', elapsed)
+        RunMetrics.add('files_deleted', removed)
+        RunMetrics.add('bytes_deleted', size - sum(LongTermStorage.storage_for(f).get_size(f) for f in failed))
+        DeletionPool.backup_logger.info("Removed %d of %d files in %d batches in %.2fs (%.1f files/s).",
+                                        removed, len(file_names), len(batches), elapsed,
+                                        removed / elapsed if elapsed else float(removed),
+                                        extra={'object': self})
+        return failed
+
+    def delete_instances(self, instances):
+        """Remove every file of the backup instances.  All long term
+        copies go first and an instance keeps its incremental files
+        until its long term copies are gone.
+        return: the instances whose files were all removed"""
+        stages = dict((id(instance), instance.get_removal_stages()) for instance in instances)
+
+        failed = set(self.delete([file_name for instance in instances for file_name in stages[id(instance)][0]]))
+        lt_removed = [instance for instance in instances if not failed.intersection(stages[id(instance)][0])]
+        for instance in instances:
+            if failed.intersection(stages[id(instance)][0]):
+                DeletionPool.backup_logger.warning("%s: Keeping the incremental, its long term copy could not be "
+                                                   "removed.", instance, extra={'object': self})
+
+        failed = set(self.delete([file_name for instance in lt_removed for file_name in stages[id(instance)][1]]))
+        return [instance for instance in lt_removed if not failed.intersection(stages[id(instance)][1])]
@@ -0,0 +1,349 @@
+# Directory Snapshot
+# One listing of each backup directory per run.  Every
+# question about what exists, how big it is or how old it
+# is is answered from this listing instead of going back
+# to the filesystem.  The run keeps it current as files
+# are created and removed.
+#
+# Backup files are created, renamed and removed, never
+# rewritten in place, so a directory whose mtime has not
+# changed since it was listed still holds what was listed.
+# Such a listing is kept for the next run, in the process
+# (the daemon) and in the cursor file, which a short lived
+# run starts from.  A change within the second a directory
+# was listed may not show in its mtime, such listings are
+# not kept.  A process running more than once watches the
+# directories it listed, see DirectoryWatcher, and applies
+# what changed instead of listing a changed directory again.
+
+import cPickle
+import errno
+import os
+import stat
+import threading
+import time
+from mysql_backup_directory_watcher import DirectoryWatcher
+from run_metrics.run_metrics import RunMetrics
+
+CURSOR_VERSION = 1
+
+# os.scandir arrived in python 3.5, the scandir module
+# backports it.  Without either, fall back to listdir + stat.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class BackupDirectorySnapshot:
+    """Run scoped listing of the backup directories.
+    directories maps a directory to {file name: (size, mtime)}.
+    Directories are scanned the first time they are asked about."""
+
+    directories = dict()
+    lock = threading.RLock()
+    # directory -> ((st_dev, st_ino, st_mtime) before it was listed, when)
+    stamps = dict()
+    # directory -> a number that changes whenever its listing does
+    versions = dict()
+    version = 0
+
+    # Set by configure
+    watch = False
+    cursor_file = None
+    # Set by a process that runs more than once
+    persistent = False
+    watcher = None
+    # directory -> (stamp, when, entries) read from cursor_file
+    cursor = None
+
+    @staticmethod
+    def configure(config):
+        """Listings belong to directories, not configs, those still
+        current are kept"""
+        BackupDirectorySnapshot.watch = config.directory_watch
+        if not BackupDirectorySnapshot.watch:
+            BackupDirectorySnapshot.close_watcher()
+        if config.directory_cursor_file != BackupDirectorySnapshot.cursor_file:
+            BackupDirectorySnapshot.cursor_file = config.directory_cursor_file
+            BackupDirectorySnapshot.cursor = None
+        BackupDirectorySnapshot.refresh()
+
+    @staticmethod
+    def reset():
+        """Forget everything, the next question rescans"""
+        with BackupDirectorySnapshot.lock:
+            BackupDirectorySnapshot.directories = dict()
+            BackupDirectorySnapshot.stamps = dict()
+            if BackupDirectorySnapshot.watcher is not None:
+                BackupDirectorySnapshot.close_watcher()
+
+    @staticmethod
+    def refresh():
+        """Bring the listings up to date for a new run.  Changes the
+        watcher saw are applied, other listings are kept while their
+        directory is unchanged and the rest are forgotten."""
+        with BackupDirectorySnapshot.lock:
+            watcher = BackupDirectorySnapshot.watcher
+            if watcher is not None and watcher.pid != os.getpid():
+                # Inherited by a forked worker, the events are not its to take
+                watcher = None
+            if watcher is not None:
+                BackupDirectorySnapshot.apply_events(watcher)
+            for directory in BackupDirectorySnapshot.directories.keys():
+                if not (watcher is not None and watcher.is_watched(directory)) and \
+                        not BackupDirectorySnapshot.is_unchanged(directory, *BackupDirectorySnapshot.stamps[directory]):
+                    BackupDirectorySnapshot.forget(directory)
+
+    @staticmethod
+    def apply_events(watcher):
+        # Stamped before the events are read: any change after the
+        # stamp is in the events or shows in the next stamp
+        for directory in BackupDirectorySnapshot.directories:
+            if watcher.is_watched(directory):
+                BackupDirectorySnapshot.stamps[directory] = (BackupDirectorySnapshot.get_stamp(directory), time.time())
+        changed, lost, overflowed = watcher.read_events()
+        if overflowed:
+            RunMetrics.add('directory_watch_overflows', 1)
+            lost.update(directory for directory in BackupDirectorySnapshot.directories if watcher.is_watched(directory))
+        for directory in lost:
+            watcher.unwatch(directory)
+            BackupDirectorySnapshot.forget(directory)
+        for directory, file_names in changed.items():
+            if directory not in BackupDirectorySnapshot.directories:
+                continue
+            RunMetrics.add('directory_watch_changes', len(file_names))
+            for file_name in file_names:
+                BackupDirectorySnapshot.add(os.path.join(directory, file_name))
+
+    @staticmethod
+    def forget(directory):
+        BackupDirectorySnapshot.directories.pop(directory, None)
+        BackupDirectorySnapshot.stamps.pop(directory, None)
+
+    @staticmethod
+    def get_watcher():
+        """Return: the process' watcher, None when not watching"""
+        if BackupDirectorySnapshot.watcher is None and BackupDirectorySnapshot.watch and \
+                BackupDirectorySnapshot.persistent:
+            try:
+                BackupDirectorySnapshot.watcher = DirectoryWatcher()
+            except OSError:
+                # Listed again every run instead
+                BackupDirectorySnapshot.watch = False
+        return BackupDirectorySnapshot.watcher
+
+    @staticmethod
+    def close_watcher():
+        with BackupDirectorySnapshot.lock:
+            if BackupDirectorySnapshot.watcher is not None:
+                BackupDirectorySnapshot.watcher.close()
+                BackupDirectorySnapshot.watcher = None
+
+    @staticmethod
+    def get_stamp(directory):
+        """Return: what tells whether directory changed, None when it is missing"""
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return None
+        return st.st_dev, st.st_ino, st.st_mtime
+
+    @staticmethod
+    def is_unchanged(directory, stamp, when):
+        """Is directory as it was at when, the time stamp was taken"""
+        return stamp is not None and stamp[2] < when - 1 and BackupDirectorySnapshot.get_stamp(directory) == stamp
+
+    @staticmethod
+    def bump(directory):
+        BackupDirectorySnapshot.version += 1
+        BackupDirectorySnapshot.versions[directory] = BackupDirectorySnapshot.version
+
+    # The cursor
+
+    @staticmethod
+    def read_cursor():
+        """Return: the listings of the cursor file, empty when it is missing or unreadable"""
+        if BackupDirectorySnapshot.cursor_file is not None:
+            try:
+                with open(BackupDirectorySnapshot.cursor_file, 'rb') as cursor_pointer:
+                    cursor = cPickle.load(cursor_pointer)
+                if cursor.get('version') == CURSOR_VERSION:
+                    return cursor['directories']
+            except (IOError, EOFError, ValueError, TypeError, AttributeError, KeyError, cPickle.UnpicklingError):
+                pass
+        return dict()
+
+    @staticmethod
+    def get_cursor():
+        """Return: the listings of the cursor file, read once per process"""
+        if BackupDirectorySnapshot.cursor is None:
+            BackupDirectorySnapshot.cursor = BackupDirectorySnapshot.read_cursor()
+        return BackupDirectorySnapshot.cursor
+
+    @staticmethod
+    def save_cursor():
+        """Write the listings known unchanged to the cursor file for
+        the next run, merged with the other settings files' listings"""
+        if BackupDirectorySnapshot.cursor_file is None:
+            return
+        with BackupDirectorySnapshot.lock:
+            # What other runs saved since this one read it is kept
+            cursor = BackupDirectorySnapshot.read_cursor()
+            for directory, entries in BackupDirectorySnapshot.directories.items():
+                stamp, when = BackupDirectorySnapshot.stamps[directory]
+                if BackupDirectorySnapshot.is_unchanged(directory, stamp, when):
+                    cursor[directory] = (stamp, when, entries)
+                else:
+                    cursor.pop(directory, None)
+            temporary = "%s.%d.tmp" % (BackupDirectorySnapshot.cursor_file, os.getpid())
+            try:
+                with open(temporary, 'wb') as cursor_pointer:
+                    cPickle.dump({'version': CURSOR_VERSION, 'directories': cursor}, cursor_pointer,
+                                 cPickle.HIGHEST_PROTOCOL)
+                os.rename(temporary, BackupDirectorySnapshot.cursor_file)
+            except (IOError, OSError):
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+                raise
+            BackupDirectorySnapshot.cursor = cursor
+
+    @staticmethod
+    def split(file_name_full_path):
+        directory, file_name = os.path.split(file_name_full_path)
+        return directory.rstrip('/') or '/', file_name
+
+    @staticmethod
+    def scan(directory):
+        """Return: {file name: (size, mtime)} of the regular files in directory"""
+        entries = dict()
+        with RunMetrics.timer('directory_scan_seconds'):
+            if scandir is not None:
+                for entry in scandir(directory):
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries[entry.name] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        # removed between listing and stat
+                        pass
+            else:
+                for file_name in os.listdir(directory):
+                    try:
+                        st = os.stat(os.path.join(directory, file_name))
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        entries[file_name] = (st.st_size, st.st_mtime)
+        RunMetrics.add('directory_scans', 1)
+        return entries
+
+    @staticmethod
+    def load(directory):
+        """List directory, from the cursor when it is unchanged since"""
+        watcher = BackupDirectorySnapshot.get_watcher()
+        if watcher is not None:
+            # Before the listing, nothing may happen unseen after it
+            watcher.watch(directory)
+        cursor_entry = BackupDirectorySnapshot.get_cursor().get(directory)
+        if cursor_entry is not None and BackupDirectorySnapshot.is_unchanged(directory, *cursor_entry[:2]):
+            stamp, when, entries = cursor_entry[0], cursor_entry[1], dict(cursor_entry[2])
+            RunMetrics.add('directory_cursor_hits', 1)
+        else:
+            stamp, when = BackupDirectorySnapshot.get_stamp(directory), time.time()
+            entries = BackupDirectorySnapshot.scan(directory)
+        BackupDirectorySnapshot.directories[directory] = entries
+        BackupDirectorySnapshot.stamps[directory] = (stamp, when)
+        BackupDirectorySnapshot.bump(directory)
+
+    @staticmethod
+    def get_entries(directory):
+        directory = directory.rstrip('/') or '/'
+        with BackupDirectorySnapshot.lock:
+            if directory not in BackupDirectorySnapshot.directories:
+                BackupDirectorySnapshot.load(directory)
+            return BackupDirectorySnapshot.directories[directory]
+
+    @staticmethod
+    def get_version(directory):
+        """Return: a number that changes whenever the listing of directory does"""
+        directory = directory.rstrip('/') or '/'
+        with BackupDirectorySnapshot.lock:
+            BackupDirectorySnapshot.get_entries(directory)
+            return BackupDirectorySnapshot.versions[directory]
+
+    @staticmethod
+    def get_entry(file_name_full_path):
+        """Return: (size, mtime) or None when the file does not exist"""
+        directory, file_name = BackupDirectorySnapshot.split(file_name_full_path)
+        return BackupDirectorySnapshot.get_entries(directory).get(file_name)
+
+    # Questions
+
+    @staticmethod
+    def list_files(directory):
+        """Return: full paths of the regular files in directory"""
+        prefix = directory.rstrip('/') + '/'
+        with BackupDirectorySnapshot.lock:
+            return [prefix + file_name for file_name in BackupDirectorySnapshot.get_entries(directory)]
+
+    @staticmethod
+    def exists(file_name_full_path):
+        return BackupDirectorySnapshot.get_entry(file_name_full_path) is not None
+
+    @staticmethod
+    def get_size(file_name_full_path):
+        """Return: size in bytes, 0 when the file does not exist"""
+        entry = BackupDirectorySnapshot.get_entry(file_name_full_path)
+        return entry[0] if entry is not None else 0
+
+    @staticmethod
+    def get_mtime(file_name_full_path):
+        """Return: modification time or None when the file does not exist"""
+        entry = BackupDirectorySnapshot.get_entry(file_name_full_path)
+        return entry[1] if entry is not None else None
+
+    # Keeping it current
+
+    @staticmethod
+    def add(file_name_full_path):
+        """Record a file this run created or changed.  Directories
+        not yet scanned are left to be scanned when first asked about."""
+        directory, file_name = BackupDirectorySnapshot.split(file_name_full_path)
+        with BackupDirectorySnapshot.lock:
+            if directory not in BackupDirectorySnapshot.directories:
+                return
+            try:
+                st = os.stat(file_name_full_path)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                BackupDirectorySnapshot.directories[directory][file_name] = (st.st_size, st.st_mtime)
+            else:
+                BackupDirectorySnapshot.directories[directory].pop(file_name, None)
+            BackupDirectorySnapshot.bump(directory)
+
+    @staticmethod
+    def discard(file_name_full_path):
+        """Record a file this run removed"""
+        directory, file_name = BackupDirectorySnapshot.split(file_name_full_path)
+        with BackupDirectorySnapshot.lock:
+            if directory in BackupDirectorySnapshot.directories:
+                BackupDirectorySnapshot.directories[directory].pop(file_name, None)
+                BackupDirectorySnapshot.bump(directory)
+
+    @staticmethod
+    def remove(file_name_full_path):
+        """Remove the file and forget it.  A file someone else
+        already removed is not an error."""
+        try:
+            os.remove(file_name_full_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        BackupDirectorySnapshot.discard(file_name_full_path)
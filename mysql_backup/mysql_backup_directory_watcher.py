@@ -0,0 +1,144 @@
+# Directory Watcher
+# Keeps the directory snapshot of a process that runs more
+# than once, the daemon, current between its runs.  Each
+# directory the snapshot lists is watched with inotify from
+# before it is listed.  At the start of the next run the
+# files created, removed, moved or written since are stat'ed
+# again and the rest of the listing is kept, so the cost
+# follows the changes rather than the number of files.
+#
+# Where the kernel's event queue overflowed what changed can
+# not be told, and the watched directories are listed again.
+# So is a watched directory that was itself removed or moved.
+#
+# inotify is used through Libc.  Where it is not available
+# nothing is watched.
+
+import errno
+import os
+import struct
+from mysql_backup_libc import Libc
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+# Everything that changes a file's presence, size or mtime.
+# IN_MODIFY would report every write of a dump, the file is
+# looked at once it is closed.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event without its name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class DirectoryWatcher(object):
+    """An inotify instance watching the directories of one process.
+    Raises OSError when inotify is not available."""
+
+    def __init__(self):
+        inotify_init1 = Libc.get_function('inotify_init1')
+        if inotify_init1 is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise Libc.get_error("inotify_init1")
+        # Forked workers inherit the instance, only this process reads it
+        self.pid = os.getpid()
+        # watch descriptor -> directory and back
+        self.watches = dict()
+        self.directories = dict()
+
+    def __str__(self):
+        return "directory watcher"
+
+    def is_watched(self, directory):
+        return directory in self.directories
+
+    def watch(self, directory):
+        """Start watching directory.
+        return: True when it is watched, False when it can not be,
+        as when it is missing or the limit of watches is reached"""
+        if directory in self.directories:
+            return True
+        if os.getpid() != self.pid:
+            return False
+        wd = Libc.get_function('inotify_add_watch')(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            return False
+        self.watches[wd] = directory
+        self.directories[directory] = wd
+        return True
+
+    def forget(self, wd):
+        directory = self.watches.pop(wd, None)
+        if directory is not None:
+            self.directories.pop(directory, None)
+        return directory
+
+    def read_events(self):
+        """Take the events queued since the last call.
+        return: (dict of directory -> set of the names that changed,
+        set of the directories no longer watched, True when events
+        were lost to an overflow)"""
+        data = list()
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+            data.append(chunk)
+        data = ''.join(data)
+
+        changed = dict()
+        lost = set()
+        overflowed = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                directory = self.watches.get(wd)
+                if directory is not None:
+                    lost.add(directory)
+                if mask & IN_IGNORED:
+                    self.forget(wd)
+                else:
+                    self.unwatch(directory)
+            elif name and wd in self.watches:
+                changed.setdefault(self.watches[wd], set()).add(name)
+        return changed, lost, overflowed
+
+    def unwatch(self, directory):
+        wd = self.directories.get(directory)
+        if wd is None:
+            return
+        self.forget(wd)
+        Libc.get_function('inotify_rm_watch')(self.fd, wd)
+
+    def close(self):
+        if self.fd is not None and os.getpid() == self.pid:
+            os.close(self.fd)
+        self.fd = None
+        self.watches = dict()
+        self.directories = dict()
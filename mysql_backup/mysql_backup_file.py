@@ -8,77 +8,115 @@ import mysql_backup
 import re
 import time
 import subprocess
+import sys
+import tempfile
 from abc import abstractmethod
-from shutil import copyfile
+from mysql_backup_checksum import MysqlBackupChecksum
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup_frames import DumpFrames, INDEX_EXTENSION
+from mysql_backup_job_retry import DumpFailedError
+from mysql_backup_segments import MANIFEST_EXTENSION, MANIFEST_VERSION, TableSegments
+from mysql_backup_long_term_copier import LongTermCopier
+from mysql_backup_long_term_storage import LongTermStorage
+from mysql_backup_page_cache import PageCache
+from mysql_backup_replicas import BackupReplicas
+from mysql_backup_schedule import BackupSchedule
+from mysql_backup_throttle import MysqlBackupThrottle
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
 # import traceback
 # import psutil
 
 
 class MysqlBackupFileFactory(object):
+    """A backup file is only its name, database and date, and
+    a reference to the run's config.  Everything else, paths
+    included, is derived on demand so hundreds of thousands
+    of these stay small."""
+
+    __slots__ = ('config', 'file_name', 'db_name', 'date_string')
 
     backup_logger = None
 
-    def __init__(self, file_name_full_path, path, file_name, file_name_no_ext, file_ext, db_name, date_string):
+    def __init__(self, config, file_name, db_name, date_string):
 
-        MysqlBackupFileFactory.backup_logger = mysql_backup.mysql_backup.MysqlBackup.backup_logger
+        MysqlBackupFileFactory.backup_logger = config.get_logger('file')
 
-        self.file_name_full_path = file_name_full_path
-        self.path = path
+        self.config = config
         self.file_name = file_name
-        self.file_name_no_ext = file_name_no_ext
-        self.file_ext = file_ext
-        self.db_name = db_name
-        self.date_string = date_string
-
-        # database connection
-        # letting the file objects have their own database connection
-        # will allow for parallel backups
-        self.db_connection = None
-        self.cursor = None
-        self.cur_database = None
+        # Every file of a database and instance shares one copy of these
+        self.db_name = intern(db_name)
+        self.date_string = intern(date_string)
 
     def __str__(self):
         return self.file_name_full_path
 
+    @property
+    def path(self):
+        return self.config.incremental_path
+
+    @property
+    def file_name_full_path(self):
+        return self.config.incremental_path.rstrip('/') + '/' + self.file_name
+
+    @property
+    def file_name_no_ext(self):
+        return self.db_name + '__' + self.date_string
+
+    @property
+    def file_ext(self):
+        return self.file_name.split('.')[-1]
+
     def get_age_secs(self):
         mysql_backup.MysqlBackup.get_file_age(age_format='seconds', file_name=self.file_name_full_path)
 
     def self_destruct(self):
-        """Delete the backup file associated with this object."""
-        if os.path.isfile(self.file_name_full_path):
+        """Delete the backup file associated with this object.
+        The long term copy goes first so it is never left behind
+        without its incremental."""
+        MysqlBackupFileFactory.backup_logger.debug("Requesting removal of the long term copy.", extra={'object': self})
+        self.remove_long_term_version()
+
+        if self.exists():
             MysqlBackupFileFactory.backup_logger.debug("File exists and removal requested.  Removing.",
                                                        extra={'object': self})
-            os.remove(self.file_name_full_path)
+            BackupDirectorySnapshot.remove(self.file_name_full_path)
         else:
             MysqlBackupFileFactory.backup_logger.debug("File does not exist and removal requested.  Whatever.",
                                                        extra={'object': self})
 
-        MysqlBackupFileFactory.backup_logger.debug("Requesting removal of the long term copy.", extra={'object': self})
-        self.remove_long_term_version()
-
     def exists(self):
         """Does the file described by this file object exist
         Return: bool"""
-        MysqlBackupFileFactory.backup_logger.debug("Determining if file exists.", extra={'object': self})
-        return os.path.isfile(self.file_name_full_path)
+        return BackupDirectorySnapshot.exists(self.file_name_full_path)
 
     def get_long_term_backup_full_name(self):
-        return mysql_backup.MysqlBackup.long_term_backup_path.rstrip('/') + '/' + self.file_name
+        return LongTermStorage.get().get_full_name(self.file_name)
 
     def is_a_long_term_version(self):
-        """This file is in long term version path"""
-        return os.path.isfile(self.get_long_term_backup_full_name())
+        """This file is in the long term storage"""
+        return LongTermStorage.get().exists(self.get_long_term_backup_full_name())
+
+    def get_long_term_source(self):
+        """Return: (file the long term copy is made from, whether it
+        is temporary and to be removed once copied)"""
+        return self.file_name_full_path, False
 
+    @RunTrace.traced('copy_to_long_term_backup')
     def copy_to_long_term_backup(self):
-        src = self.file_name_full_path
+        src, temporary = self.get_long_term_source()
         dst = self.get_long_term_backup_full_name()
-        MysqlBackupFileFactory.backup_logger.info("copying %s to %s" % (src, dst), extra={'object': self})
-        copyfile(src, dst)
+        MysqlBackupFileFactory.backup_logger.info("copying %s to %s", src, dst, extra={'object': self})
+        try:
+            LongTermCopier.copy(src, dst, verify=self.config.long_term_copy_verify)
+        finally:
+            if temporary:
+                BackupDirectorySnapshot.remove(src)
 
     def remove_long_term_version(self):
         if self.is_a_long_term_version():
             MysqlBackupFileFactory.backup_logger.debug("Long term version exists.  Removing.", extra={'object': self})
-            os.remove(self.get_long_term_backup_full_name())
+            LongTermStorage.get().remove(self.get_long_term_backup_full_name())
         else:
             MysqlBackupFileFactory.backup_logger.debug("Long term version does not exist.  Nothing to do.",
                                                        extra={'object': self})
@@ -92,13 +130,16 @@ class MysqlBackupFileFactory(object):
         raise NotImplemented("Not implemented on this object class.")
 
     @staticmethod
-    def get_file_object(file_name_full_path):
+    def get_file_object(config, file_name_full_path):
         """Static factory method to return the proper file type object"""
 
+        # May be called before any file object has been initialized
+        MysqlBackupFileFactory.backup_logger = config.get_logger('file')
+
         path = os.path.dirname(file_name_full_path)
         file_name = os.path.basename(file_name_full_path)
 
-        if path != mysql_backup.MysqlBackup.incremental_path:
+        if path != config.incremental_path:
             msg = "File not in a backup path"
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': file_name_full_path})
             raise AssertionError(msg)
@@ -108,7 +149,11 @@ class MysqlBackupFileFactory(object):
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': file_name_full_path})
             raise AssertionError(msg)
 
-        if file_name.endswith(mysql_backup.MysqlBackup.compressed_file_extension):
+        if file_name.endswith('.' + INDEX_EXTENSION):
+            file_name_no_ext = '.'.join(file_name.split('.')[0:-3])
+        elif file_name.endswith('.' + MANIFEST_EXTENSION):
+            file_name_no_ext = '.'.join(file_name.split('.')[0:-1])
+        elif file_name.endswith(config.compressed_file_extension):
             file_name_no_ext = '.'.join(file_name.split('.')[0:-2])
         else:
             file_name_no_ext = '.'.join(file_name.split('.')[0:-1])
@@ -116,7 +161,7 @@ class MysqlBackupFileFactory(object):
         db_name = file_name_no_ext.split('__')[0]
         date_string = file_name_no_ext.split('__')[1]
 
-        if file_ext not in ('md5', 'sql',mysql_backup.MysqlBackup.compressed_file_extension):
+        if file_ext not in ('md5', 'sql', INDEX_EXTENSION, MANIFEST_EXTENSION, config.compressed_file_extension):
             msg = "File extension does not appear to be valid.  Extenion was %s" % file_ext
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': file_name_full_path})
             raise AssertionError(msg)
@@ -127,22 +172,20 @@ class MysqlBackupFileFactory(object):
             raise AssertionError(msg)
 
         if file_ext == 'sql':
-            return UncompressedFile(file_name_full_path=file_name_full_path, path=path, file_name=file_name,
-                                    file_name_no_ext=file_name_no_ext, file_ext=file_ext, db_name=db_name,
-                                    date_string=date_string)
-        elif file_ext == mysql_backup.MysqlBackup.compressed_file_extension:
-            return CompressedFile(file_name_full_path=file_name_full_path, path=path, file_name=file_name,
-                                  file_name_no_ext=file_name_no_ext, file_ext=file_ext, db_name=db_name,
-                                  date_string=date_string)
+            return UncompressedFile(config, file_name=file_name, db_name=db_name, date_string=date_string)
+        elif file_ext == config.compressed_file_extension:
+            return CompressedFile(config, file_name=file_name, db_name=db_name, date_string=date_string)
         elif file_ext == 'md5':
-            return CheckSumFile(file_name_full_path=file_name_full_path, path=path, file_name=file_name,
-                                file_name_no_ext=file_name_no_ext, file_ext=file_ext, db_name=db_name,
-                                date_string=date_string)
+            return CheckSumFile(config, file_name=file_name, db_name=db_name, date_string=date_string)
+        elif file_ext == INDEX_EXTENSION:
+            return IndexFile(config, file_name=file_name, db_name=db_name, date_string=date_string)
+        elif file_ext == MANIFEST_EXTENSION:
+            return ManifestFile(config, file_name=file_name, db_name=db_name, date_string=date_string)
 
     @staticmethod
-    def create_file_object(db_name, **kwargs):
+    def create_file_object(config, db_name, **kwargs):
         """
-        db_name is required.  Additionally,
+        config and db_name are required.  Additionally,
 
         1: Passing nothing runs a backup and returns a dictionary with an uncompressed file object
            and a checksum file object
@@ -157,64 +200,64 @@ class MysqlBackupFileFactory(object):
 
             return: CompressedFile
 
+        3: With table_level_incremental, passing nothing or the previous backup's ManifestFile
+           as previous returns a dictionary with a manifest file object and a checksum file object
+           return:
+           dict {
+                'checksum file object' = CheckSumFile,
+                'manifest file object' = ManifestFile
+           }
+
         """
         if 'ucpf' in kwargs:
             # initialize an instance of an uncompressed backup object
             ucpf = kwargs['ucpf']
-            date_string = ucpf.date_string
-            file_ext = mysql_backup.MysqlBackup.compressed_file_extension
-            file_name_no_ext = ucpf.file_name_no_ext + '.sql'
-            file_name = file_name_no_ext + '.' + file_ext
-            file_name_full_path = mysql_backup.MysqlBackup.incremental_path.rstrip('/') + '/' + file_name
-
-            cmpf = CompressedFile(file_name_full_path=file_name_full_path,
-                                  path=mysql_backup.MysqlBackup.incremental_path,
-                                  file_name=file_name,
-                                  file_name_no_ext=file_name_no_ext,
-                                  file_ext=file_ext,
-                                  db_name=db_name,
-                                  date_string=date_string)
+            file_name = ucpf.file_name + '.' + config.compressed_file_extension
+
+            cmpf = CompressedFile(config, file_name=file_name, db_name=db_name, date_string=ucpf.date_string)
 
             MysqlBackupFileFactory.backup_logger.debug("Requesting conversion of an uncompressed file object to"
                                                        " become a compressed file object.", extra={'object': db_name})
             cmpf.birth(ucpf=kwargs.get('ucpf'))
             return cmpf
 
+        elif config.table_level_incremental:
+            date_string = mysql_backup.MysqlBackup.human_readable_date_from_tt(time.localtime())
+            file_name_no_ext = db_name + '__' + date_string
+
+            manifest = ManifestFile(config, file_name=file_name_no_ext + '.' + MANIFEST_EXTENSION, db_name=db_name,
+                                    date_string=date_string)
+
+            MysqlBackupFileFactory.backup_logger.debug("Requesting creation of a manifest file object.",
+                                                       extra={'object': db_name})
+            checksum = manifest.birth(previous=kwargs.get('previous'))
+
+            chksmf = CheckSumFile(config, file_name=file_name_no_ext + '.md5', db_name=db_name, date_string=date_string)
+            chksmf.birth(ucpf=manifest, checksum=checksum)
+
+            return {
+                'checksum file object': chksmf,
+                'manifest file object': manifest,
+            }
+
         else:
             # initialize an instance of an uncompressed backup object
             date_string = mysql_backup.MysqlBackup.human_readable_date_from_tt(time.localtime())
-            file_ext = 'sql'
             file_name_no_ext = db_name + '__' + date_string
-            file_name = file_name_no_ext + '.' + file_ext
-            file_name_full_path = mysql_backup.MysqlBackup.incremental_path.rstrip('/') + '/' + file_name
-
-            ucpf = UncompressedFile(file_name_full_path=file_name_full_path,
-                                    path=mysql_backup.MysqlBackup.incremental_path,
-                                    file_name=file_name,
-                                    file_name_no_ext=file_name_no_ext,
-                                    file_ext=file_ext,
-                                    db_name=db_name,
-                                    date_string=date_string)
+
+            ucpf = UncompressedFile(config, file_name=file_name_no_ext + '.sql', db_name=db_name, date_string=date_string)
 
             MysqlBackupFileFactory.backup_logger.debug("Requesting creation of an uncompressed file object.",
                                                        extra={'object': db_name})
-            ucpf.birth()
+            checksum = ucpf.birth()
 
             # initialize an instance of a CheckSumFile object
 
-            file_ext = 'md5'
-            file_name_full_path = '.'.join(file_name_full_path.split('.')[0:-1]) + '.' + file_ext
-            chksmf = CheckSumFile(file_name_full_path=file_name_full_path,
-                                  path=mysql_backup.MysqlBackup.incremental_path,
-                                  file_name=file_name_no_ext + '.' + file_ext,
-                                  file_name_no_ext=file_name_no_ext,
-                                  file_ext=file_ext,
-                                  db_name=db_name,
-                                  date_string=date_string)
+            chksmf = CheckSumFile(config, file_name=file_name_no_ext + '.md5', db_name=db_name, date_string=date_string)
 
             MysqlBackupFileFactory.backup_logger.debug("Requesting creation of a checksum file object.",
                                                        extra={'object': db_name})
-            chksmf.birth(ucpf=ucpf)
+            chksmf.birth(ucpf=ucpf, checksum=checksum)
 
             return {
                 'checksum file object': chksmf,
@@ -222,21 +265,27 @@ class MysqlBackupFileFactory(object):
             }
 
     @staticmethod
-    def get_checksum_from_file(file_name):
-        return subprocess.check_output(["/bin/md5sum", file_name, ], close_fds=True).split()[0]
+    def get_checksum_from_file(config, file_name):
+        """Return: checksum string, prefixed with the algorithm when not md5"""
+        algorithm = config.checksum_algorithm
+        digest = MysqlBackupChecksum.get_digest_from_file(file_name, algorithm, config.checksum_buffer_size)
+        return MysqlBackupChecksum.format_checksum(algorithm, digest)
 
 
 class CheckSumFile(MysqlBackupFileFactory):
 
+    __slots__ = ()
+
     def birth(self, **kwargs):
-        """Required (key word arg): ucpf (type=UncompressedFile)"""
+        """Required (key word arg): ucpf (type=UncompressedFile)
+        Optional (key word arg): checksum, when already computed while dumping"""
         if 'ucpf' not in kwargs:
             msg = "ucpf (UncompressedFile object is required when creating a CheckSumFile object)"
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': self})
             raise ValueError(msg)
 
         ucpf = kwargs.get('ucpf')
-        self.write_checksum(ucpf)
+        self.write_checksum(ucpf, checksum=kwargs.get('checksum'))
 
     def get_checksum(self, ucpf=None):
         """Pass a UncompressFile object when the file itself needs a checksum calculated,
@@ -246,82 +295,184 @@ class CheckSumFile(MysqlBackupFileFactory):
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': self})
             raise ValueError(msg)
         elif ucpf is not None:
-            return MysqlBackupFileFactory.get_checksum_from_file(ucpf.file_name_full_path)
+            with RunMetrics.timer('hash_duration_seconds', db_name=self.db_name), RunTrace.span('checksum'):
+                return MysqlBackupFileFactory.get_checksum_from_file(self.config, ucpf.file_name_full_path)
         else:
             with open(self.file_name_full_path, 'r') as checksum_file_pointer:
                 checksum_str = checksum_file_pointer.readline()
                 checksum_file_pointer.close()
                 return checksum_str
 
-    def write_checksum(self,ucpf):
-        if mysql_backup.MysqlBackup.verbose:
-            MysqlBackupFileFactory.backup_logger.debug("Getting checksum from file at %s" % ucpf.file_name_full_path,
-                                                       extra={'object': self})
-        checksum = self.get_checksum(ucpf)
+    def write_checksum(self, ucpf, checksum=None):
+        if checksum is None:
+            if self.config.verbose:
+                MysqlBackupFileFactory.backup_logger.debug("Getting checksum from file at %s",
+                                                           ucpf.file_name_full_path, extra={'object': self})
+            checksum = self.get_checksum(ucpf)
         with open(self.file_name_full_path, 'w') as checksum_file_pointer:
-            if mysql_backup.MysqlBackup.verbose:
-                MysqlBackupFileFactory.backup_logger.info("writing new checksum file at %s" % self.file_name_full_path,
+            if self.config.verbose:
+                MysqlBackupFileFactory.backup_logger.info("writing new checksum file at %s", self.file_name_full_path,
                                                           extra={'object': self})
             checksum_file_pointer.write(checksum)
         checksum_file_pointer.close()
+        BackupDirectorySnapshot.add(self.file_name_full_path)
 
 
 class UncompressedFile(MysqlBackupFileFactory):
 
+    __slots__ = ()
+
+    @RunTrace.traced('UncompressedFile.birth')
     def birth(self):
-        """void
-        creates a mysql backup"""
-        os.environ['MYSQL_PWD'] = mysql_backup.MysqlBackup.mysql_password
-        # command = '/usr/bin/mysqldump -u ' + mysql_backup.MysqlBackup.mysql_username + ' ' + self.db_name + ' ' + \
-        #          mysql_backup.MysqlBackup.mysql_dump_options + ' --result-file ' + self.file_name_full_path
+        """return: checksum string of the dump
+        creates a mysql backup.  The dump streams through this process,
+        throttled as the dump stage and hashed on the way."""
+        os.environ['MYSQL_PWD'] = self.config.mysql_password
+        # command = '/usr/bin/mysqldump -u ' + self.config.mysql_username + ' ' + self.db_name + ' ' + \
+        #          self.config.mysql_dump_options + ' --result-file ' + self.file_name_full_path
 
-        command = ['/usr/bin/mysqldump', '-u', mysql_backup.MysqlBackup.mysql_username, self.db_name] + \
-                  mysql_backup.MysqlBackup.mysql_dump_options.split() + ['--result-file', self.file_name_full_path]
+        command = [self.config.mysqldump_command, '-u', self.config.mysql_username] + \
+            BackupReplicas.get_dump_options() + [self.db_name] + self.config.mysql_dump_options.split()
 
-        MysqlBackupFileFactory.backup_logger.info("running %s" % (' '.join(command),), extra={'object': self})
+        MysqlBackupFileFactory.backup_logger.info("running %s > %s", ' '.join(command), self.file_name_full_path,
+                                                  extra={'object': self})
 
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+        algorithm = self.config.checksum_algorithm
+        hash_obj = MysqlBackupChecksum.new_hash(algorithm)
+        stderr_pointer = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_pointer, close_fds=True)
+        try:
+            # Sized after the smoothed size of this database's earlier dumps
+            with PageCache.open_output(self.file_name_full_path, BackupSchedule.get_dump_size(self.db_name)) as \
+                    dump_pointer:
+                MysqlBackupThrottle.stream('dump', process.stdout, dump_pointer,
+                                           self.config.checksum_buffer_size, hash_obj)
+        except Exception:
+            # Out of space or a failed write: mysqldump is not left behind
+            # blocked on its pipe, nor the partial dump on disk
+            exc_info = sys.exc_info()
+            process.kill()
+            process.wait()
+            BackupDirectorySnapshot.remove(self.file_name_full_path)
+            stderr_pointer.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
         process.wait()
+        with stderr_pointer:
+            stderr = DumpFailedError.read_stderr(stderr_pointer)
         if process.returncode != 0:
-            msg = "Something went wrong while trying to backup %s" % self.db_name
-            MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': self})
-            raise RuntimeError(msg)
+            # Not left behind for a retry of the job to trip over
+            BackupDirectorySnapshot.remove(self.file_name_full_path)
+            error = DumpFailedError("Something went wrong while trying to backup %s" % self.db_name,
+                                    process.returncode, stderr)
+            MysqlBackupFileFactory.backup_logger.error("%s", error, extra={'object': self})
+            raise error
         else:
+            if stderr.strip():
+                MysqlBackupFileFactory.backup_logger.info("mysqldump: %s", stderr.strip(), extra={'object': self})
+            BackupDirectorySnapshot.add(self.file_name_full_path)
             MysqlBackupFileFactory.backup_logger.debug("command completed successfully.", extra={'object': self})
 
+        return MysqlBackupChecksum.format_checksum(algorithm, hash_obj.hexdigest())
+
 
 class CompressedFile(MysqlBackupFileFactory):
 
+    __slots__ = ()
+
     def birth(self, ucpf):
         """void
         create an compressed file"""
-        self.compress_ucpf(ucpf=ucpf)
+        if self.config.compression_format == 'frames':
+            self.compress_ucpf_to_frames(ucpf=ucpf)
+        else:
+            self.compress_ucpf(ucpf=ucpf)
 
+    def self_destruct(self):
+        """The index of a compressed file goes with it"""
+        MysqlBackupFileFactory.self_destruct(self)
+        index_file = self.get_index_file_object()
+        if index_file.exists():
+            index_file.self_destruct()
+
+    def get_index_file_object(self):
+        """Return: the IndexFile of this file, which exists when it was
+        compressed as frames"""
+        return IndexFile(self.config, file_name=DumpFrames.get_index_name(self.file_name), db_name=self.db_name,
+                         date_string=self.date_string)
+
+    @RunTrace.traced('CompressedFile.compress_ucpf_to_frames')
+    def compress_ucpf_to_frames(self, ucpf):
+        """Compresses an UncompressedFile as frames with their index
+        and requests the UncompressedFile to self destruct"""
+        MysqlBackupFileFactory.backup_logger.info("compressing %s as frames", ucpf.file_name_full_path,
+                                                  extra={'object': self})
+        try:
+            index = DumpFrames.compress(ucpf.file_name_full_path, self.file_name_full_path,
+                                        self.config.compression_frame_size, self.config.compression_threads)
+            BackupDirectorySnapshot.add(self.file_name_full_path)
+            self.get_index_file_object().birth(index=index)
+        except (IOError, OSError) as e:
+            msg = "Something went wrong while trying to compress %s. %s" % (ucpf.file_name_full_path, e)
+            MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': self})
+            raise RuntimeError(msg)
+        RunMetrics.add('compression_frames', len(index['frames']), db_name=self.db_name)
+
+        ucpf.self_destruct()
+
+    @RunTrace.traced('CompressedFile.compress_ucpf')
     def compress_ucpf(self, ucpf):
         """Compresses a CompressedFile object
         and requested an UncompressedFile to self destruct"""
-        cmd = mysql_backup.MysqlBackup.compress_command.split()
-        cmd.append(ucpf.file_name_full_path)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        MysqlBackupFileFactory.backup_logger.info("compressing %s" % (ucpf.file_name_full_path,),
+        cmd = self.config.compress_command.split()
+        MysqlBackupFileFactory.backup_logger.info("compressing %s", ucpf.file_name_full_path,
                                                   extra={'object': self})
+        stderr_pointer = tempfile.TemporaryFile()
+        if MysqlBackupThrottle.is_throttled('compress') or PageCache.drop:
+            # Have the compressor write to stdout so its output can be throttled and kept out of the page cache
+            process = subprocess.Popen(cmd + ['-c', ucpf.file_name_full_path], stdout=subprocess.PIPE,
+                                       stderr=stderr_pointer)
+            try:
+                with PageCache.open_output(self.file_name_full_path) as compressed_pointer:
+                    MysqlBackupThrottle.stream('compress', process.stdout, compressed_pointer,
+                                               self.config.checksum_buffer_size)
+            except Exception:
+                # Out of space or a failed write: the compressor is not left
+                # behind blocked on its pipe, nor the partial file on disk
+                exc_info = sys.exc_info()
+                process.kill()
+                process.wait()
+                BackupDirectorySnapshot.remove(self.file_name_full_path)
+                with stderr_pointer:
+                    stderr = DumpFailedError.read_stderr(stderr_pointer).strip()
+                if stderr:
+                    MysqlBackupFileFactory.backup_logger.error("%s: %s", cmd[0], stderr, extra={'object': self})
+                raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            cmd.append(ucpf.file_name_full_path)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_pointer)
         process.wait()
+        with stderr_pointer:
+            stderr = DumpFailedError.read_stderr(stderr_pointer).strip()
         if process.returncode != 0:
+            BackupDirectorySnapshot.remove(self.file_name_full_path)
             msg = "Something went wrong while trying to compress %s" % ucpf.file_name_full_path
+            if stderr:
+                msg = "%s. %s" % (msg, stderr)
             MysqlBackupFileFactory.backup_logger.error(msg, extra={'object': self})
             raise RuntimeError(msg)
         else:
             MysqlBackupFileFactory.backup_logger.debug("command completed successfully.", extra={'object': self})
 
+        BackupDirectorySnapshot.add(self.file_name_full_path)
         ucpf.self_destruct()
 
     def decompress(self):
         """Decompress self, self destruct
         return: UncompressedFile object"""
-        cmd = mysql_backup.MysqlBackup.decompress_command.split()
+        cmd = self.config.decompress_command.split()
         cmd.append(self.file_name_full_path)
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        MysqlBackupFileFactory.backup_logger.info("decompressing %s" % (self.file_name_full_path,),
+        MysqlBackupFileFactory.backup_logger.info("decompressing %s", self.file_name_full_path,
                                                   extra={'object': self})
         process.wait()
         if process.returncode:
@@ -331,15 +482,90 @@ class CompressedFile(MysqlBackupFileFactory):
         else:
             MysqlBackupFileFactory.backup_logger.debug("command completed successfully.", extra={'object': self})
 
-        ucpf = UncompressedFile(
-            file_name_full_path='.'.join(self.file_name_full_path.split('.')[0:-1]),
-            path=self.path,
-            file_name=self.file_name_no_ext + '.sql',
-            file_name_no_ext=self.file_name_no_ext,
-            file_ext='sql',
-            db_name=self.db_name,
-            date_string=self.date_string
-        )
+        ucpf = UncompressedFile(self.config, file_name=self.file_name_no_ext + '.sql', db_name=self.db_name,
+                                date_string=self.date_string)
+        BackupDirectorySnapshot.add(ucpf.file_name_full_path)
         MysqlBackupFileFactory.backup_logger.debug("Removing the compressed file object.", extra={'object': self})
         self.self_destruct()
         return ucpf
+
+
+class IndexFile(MysqlBackupFileFactory):
+    """The frames and sections of a CompressedFile written as
+    frames, see mysql_backup_frames"""
+
+    __slots__ = ()
+
+    def birth(self, index):
+        """void
+        write index"""
+        DumpFrames.write_index(index, self.file_name_full_path)
+        BackupDirectorySnapshot.add(self.file_name_full_path)
+
+
+class ManifestFile(MysqlBackupFileFactory):
+    """A full backup made of table segments, see mysql_backup_segments"""
+
+    __slots__ = ()
+
+    @RunTrace.traced('ManifestFile.birth')
+    def birth(self, previous=None):
+        """Dump the tables whose fingerprint changed since previous, the
+        ManifestFile of the last backup, and refer to its segments for
+        the others.
+        return: checksum string of the backup"""
+        fingerprints = TableSegments.get_fingerprints(self.config, self.db_name)
+        reusable = dict()
+        if previous is not None:
+            for segment in previous.read()['segments']:
+                if segment['table'] is not None and segment['fingerprint'] is not None and \
+                        BackupDirectorySnapshot.exists(TableSegments.get_path(self.config, self.db_name,
+                                                                              segment['file'])):
+                    reusable[segment['table']] = segment
+
+        segments = list()
+        reused = 0
+        for table, fingerprint in fingerprints.items():
+            segment = reusable.get(table)
+            if fingerprint is not None and segment is not None and segment['fingerprint'] == fingerprint:
+                segments.append(segment)
+                reused += 1
+            else:
+                segments.append(TableSegments.dump(self.config, self.db_name, self.date_string, table, fingerprint))
+        # Routines and events have no fingerprint, they are always dumped
+        segments.append(TableSegments.dump(self.config, self.db_name, self.date_string, None, None))
+        RunMetrics.add('segments_reused', reused, db_name=self.db_name)
+        MysqlBackupFileFactory.backup_logger.info("%d of %d tables dumped", len(fingerprints) - reused,
+                                                  len(fingerprints), extra={'object': self})
+
+        TableSegments.write_manifest({
+            'version': MANIFEST_VERSION,
+            'db_name': self.db_name,
+            'date_string': self.date_string,
+            'segments': segments,
+        }, self.file_name_full_path)
+        BackupDirectorySnapshot.add(self.file_name_full_path)
+        return TableSegments.get_instance_checksum(self.config, segments)
+
+    def read(self):
+        return TableSegments.read_manifest(self.file_name_full_path)
+
+    def get_segment_files(self):
+        """Return: the file names of the segments this backup is made of"""
+        return [segment['file'] for segment in self.read()['segments']]
+
+    def get_long_term_backup_full_name(self):
+        """The long term copy is the assembled dump, named as a whole
+        backup of this date would be"""
+        file_name = self.file_name_no_ext + '.sql'
+        if self.config.compression_enabled:
+            file_name += '.' + self.config.compressed_file_extension
+        return LongTermStorage.get().get_full_name(file_name)
+
+    def get_long_term_source(self):
+        """Assemble the segments next to them, removed once copied"""
+        src = os.path.join(TableSegments.get_directory(self.config, self.db_name),
+                           self.file_name_no_ext + '.assembling')
+        TableSegments.assemble(self.config, self.db_name, self.read()['segments'], src)
+        return src, True
+
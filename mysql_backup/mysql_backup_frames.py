@@ -0,0 +1,227 @@
+# Frames
+# A compressed dump made of independently compressed bz2
+# streams, frames, with a sidecar index of the frames and
+# of the sections of the dump: the header, each table's
+# structure and data, routines, events and the footer.
+# Concatenated bz2 streams are a valid bz2 file, so bzip2
+# and pbzip2 still decompress the whole of it, while
+# extract decompresses only the frames of the tables asked
+# for, several at a time.
+#
+# A frame ends after frame_size bytes of the dump or where
+# the next section starts, so every section is a run of
+# whole frames.  The index is built as the dump streams
+# through the compressor.
+
+import bz2
+import json
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from mysql_backup_page_cache import PageCache
+from mysql_backup_throttle import MysqlBackupThrottle
+
+INDEX_EXTENSION = 'idx'
+INDEX_VERSION = 1
+
+# The comments mysqldump opens sections with, (pattern, kind).
+# The name a pattern captures is the section's table.
+SECTION_MARKERS = (
+    (re.compile(r'^-- Table structure for table `(.+)`\n$'), 'structure'),
+    (re.compile(r'^-- (?:Temporary table|Temporary view|Final view) structure for view `(.+)`\n$'), 'structure'),
+    (re.compile(r'^-- Dumping data for table `(.+)`\n$'), 'data'),
+    (re.compile(r'^-- Dumping routines for database'), 'routines'),
+    (re.compile(r'^-- Dumping events for database'), 'events'),
+    (re.compile(r'^/\*!40103 SET TIME_ZONE=@OLD_TIME_ZONE \*/;'), 'footer'),
+)
+
+# Sections every extract needs for the statements to apply
+SESSION_KINDS = ('header', 'footer')
+
+
+class DumpFrames:
+
+    @staticmethod
+    def get_section(line):
+        """Return: (kind, table or None) when line opens a section, else None"""
+        for pattern, kind in SECTION_MARKERS:
+            match = pattern.match(line)
+            if match:
+                return kind, match.group(1) if match.groups() else None
+        return None
+
+    @staticmethod
+    def read_frames(src_pointer, frame_size):
+        """Yield (section or None, data) per frame of the dump.  section
+        is given with the first frame of each section.  The comment line
+        mysqldump puts before a section marker goes with the marker."""
+        section = ('header', None)
+        section_is_new = True
+        frame, frame_bytes = list(), 0
+        held = None
+        at_line_start = True
+        any_yielded = False
+        while True:
+            # Long lines are read in pieces, only a line start may open a section
+            line = src_pointer.readline(frame_size)
+            starts_line = at_line_start
+            at_line_start = line.endswith('\n')
+
+            opened = DumpFrames.get_section(line) if line and starts_line else None
+            if opened is not None:
+                if frame:
+                    yield (section if section_is_new else None), ''.join(frame)
+                    any_yielded = True
+                section, section_is_new = opened, True
+                frame, frame_bytes = list(), 0
+            if held is not None:
+                frame.append(held)
+                frame_bytes += len(held)
+                held = None
+            if not line:
+                break
+            if line == '--\n' and starts_line:
+                held = line
+                continue
+
+            frame.append(line)
+            frame_bytes += len(line)
+            if frame_bytes >= frame_size:
+                yield (section if section_is_new else None), ''.join(frame)
+                any_yielded = True
+                section_is_new = False
+                frame, frame_bytes = list(), 0
+
+        if frame or not any_yielded:
+            # An empty dump is still one (empty) frame
+            yield (section if section_is_new else None), ''.join(frame)
+
+    @staticmethod
+    def ordered_map(func, items, threads):
+        """Yield func(item) for each of items in order, computed on
+        threads threads.  bz2 lets go of the GIL while it works.  No
+        more than twice threads results are held at any time."""
+        pool = ThreadPool(max(1, threads))
+        slots = threading.Semaphore(max(1, threads) * 2)
+        stopped = threading.Event()
+
+        def bounded():
+            for item in items:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield item
+
+        try:
+            for result in pool.imap(func, bounded()):
+                slots.release()
+                yield result
+        finally:
+            # Let the pool's feeding thread go when stopped early
+            stopped.set()
+            slots.release()
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def compress(src, dst, frame_size, threads=1, level=9):
+        """Compress the dump src to dst as frames, throttled as the
+        compress stage.
+        return: the index"""
+        frames = list()
+        sections = list()
+        offset = 0
+
+        def compress_frame(item):
+            section, data = item
+            return section, bz2.compress(data, level), len(data)
+
+        with open(src, 'rb') as src_pointer, PageCache.open_output(dst) as dst_pointer:
+            for section, data, size in DumpFrames.ordered_map(compress_frame,
+                                                              DumpFrames.read_frames(src_pointer, frame_size),
+                                                              threads):
+                if section is not None:
+                    sections.append([section[0], section[1], len(frames)])
+                frames.append([offset, len(data), size])
+                MysqlBackupThrottle.throttle('compress', len(data))
+                dst_pointer.write(data)
+                offset += len(data)
+
+        return {
+            'version': INDEX_VERSION,
+            'frame_size': frame_size,
+            'compressed_bytes': offset,
+            # [offset in the compressed file, compressed bytes, dump bytes]
+            'frames': frames,
+            # [kind, table or None, first frame], in the order of the dump
+            'sections': sections,
+        }
+
+    # The index
+
+    @staticmethod
+    def get_index_name(file_name):
+        return file_name + '.' + INDEX_EXTENSION
+
+    @staticmethod
+    def write_index(index, index_name):
+        """Write index so it is either whole or missing"""
+        with open(index_name + '.tmp', 'w') as index_pointer:
+            json.dump(index, index_pointer, separators=(',', ':'))
+        os.rename(index_name + '.tmp', index_name)
+
+    @staticmethod
+    def read_index(index_name):
+        """return: the index, raises ValueError when it can not be used"""
+        with open(index_name) as index_pointer:
+            index = json.load(index_pointer)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError("%s is an index of version %s, expected %s"
+                             % (index_name, index.get('version'), INDEX_VERSION))
+        return index
+
+    @staticmethod
+    def get_sections(index):
+        """return: list of (kind, table, first frame, frame after the last)"""
+        sections = index['sections']
+        ends = [section[2] for section in sections[1:]] + [len(index['frames'])]
+        return [(kind, table, first, end) for (kind, table, first), end in zip(sections, ends)]
+
+    # Extracting
+
+    @staticmethod
+    def get_frames_for_tables(index, tables):
+        """return: the frame numbers to extract for tables, in order,
+        with the header and footer every restore needs"""
+        frame_numbers = list()
+        for kind, table, first, end in DumpFrames.get_sections(index):
+            if kind in SESSION_KINDS or table in tables:
+                frame_numbers.extend(range(first, end))
+        return frame_numbers
+
+    @staticmethod
+    def extract(src, index, tables, dst_pointer, threads=1):
+        """Write the sections of tables in src to dst_pointer,
+        decompressing only their frames.
+        return: dump bytes written"""
+        frames = index['frames']
+        if os.path.getsize(src) != index['compressed_bytes']:
+            raise ValueError("%s does not match its index" % src)
+
+        def decompress_frame(frame_number):
+            offset, length, size = frames[frame_number]
+            with open(src, 'rb') as src_pointer:
+                src_pointer.seek(offset)
+                data = bz2.decompress(src_pointer.read(length))
+            if len(data) != size:
+                raise ValueError("Frame %d of %s decompressed to %d bytes, expected %d"
+                                 % (frame_number, src, len(data), size))
+            return data
+
+        written = 0
+        for data in DumpFrames.ordered_map(decompress_frame, DumpFrames.get_frames_for_tables(index, tables),
+                                           threads):
+            dst_pointer.write(data)
+            written += len(data)
+        return written
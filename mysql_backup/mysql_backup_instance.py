@@ -5,23 +5,38 @@
 # the creation of new backups.
 
 import mysql_backup
+from mysql_backup_checksum import MysqlBackupChecksum
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
 import time
+from run_metrics.run_metrics import RunMetrics
 
 
-class MysqlBackupInstance:
+class FilesBeingWrittenError(RuntimeError):
+    """A backup that was never validated is still being written,
+    it is left alone rather than self destructed"""
+    pass
+
+
+class MysqlBackupInstance(object):
+
+    __slots__ = ('config', 'db_name', 'date_string', 'timestamp', 'bkup_file_objs', 'checksum',
+                 'incremental_backup_file_obj', 'set_proper_instance_state_called_at_least_once', 'hydrated')
 
     backup_logger = None
 
-    def __init__(self, db_name, date_string=None, bkup_file_objs=()):
-        """There are two methods to initialize.
+    def __init__(self, config, db_name, date_string=None, bkup_file_objs=(), previous=None):
+        """config is the run's BackupConfig.  There are two methods to initialize.
         1: Pass only db_name = trigger a new backup to be created and become an instance.
-        (Still verify the crap out of the new instance)
-        2: Pass a tuple of backup file objects to bkup_file_objs = initialize an instance
-        of an existing backup, making every effort to make sure things are valid or
-        self destructing (removing all files) with a RuntimeError"""
+        (Still verify the crap out of the new instance)  With table_level_incremental,
+        previous is the last backup instance, whose unchanged tables are not dumped again.
+        2: Pass a tuple of backup file objects to bkup_file_objs = a lightweight handle on
+        an existing backup.  Nothing is read or validated until the instance is touched,
+        at which point hydrate makes every effort to make sure things are valid or
+        self destructs (removing all files) with a RuntimeError"""
 
-        MysqlBackupInstance.backup_logger = mysql_backup.mysql_backup.MysqlBackup.backup_logger
+        MysqlBackupInstance.backup_logger = config.get_logger('instance')
 
+        self.config = config
         self.db_name = db_name
         self.date_string = date_string
 
@@ -37,33 +52,54 @@ class MysqlBackupInstance:
         # at least once, which should almost always be sufficient
         self.set_proper_instance_state_called_at_least_once = False
 
+        # Existing backups are validated on first touch, see hydrate
+        self.hydrated = False
+
         if bkup_file_objs and date_string is not None:
-            if self.any_files_being_written():
-                msg = "Files are being written.  Can not instantiate %s" % self
-                # MysqlBackupInstance.backup_logger(msg, extra={'object': self})
-                raise RuntimeError(msg)
-            else:
-                self.set_proper_instance_state()
+            # Existing backup, validated on first touch
+            pass
 
         elif not bkup_file_objs and date_string is None:
             # Create a new backup
-            results = mysql_backup.MysqlBackupFileFactory.create_file_object(self.db_name)
+            with RunMetrics.timer('dump_duration_seconds', db_name=self.db_name):
+                if self.config.table_level_incremental:
+                    results = mysql_backup.MysqlBackupFileFactory.create_file_object(
+                        self.config, self.db_name, previous=previous.get_manifest_file_obj() if previous else None)
+                else:
+                    results = mysql_backup.MysqlBackupFileFactory.create_file_object(self.config, self.db_name)
+            if 'uncompressed file object' in results:
+                # Segments count their own dump bytes
+                RunMetrics.add('dump_bytes', BackupDirectorySnapshot.get_size(
+                    results['uncompressed file object'].file_name_full_path), db_name=self.db_name)
             self.bkup_file_objs = results.values()
             self.date_string = results.values()[0].date_string
             validated_instance_file_objects = self.clean_bad_files_return_good_file_objects_or_fail()
             self.checksum = validated_instance_file_objects.get("checksumfileobj").get_checksum()
+            self.hydrated = True
 
         else:
             msg = "Improper combination of arguments."
             # MysqlBackupInstance.backup_logger(msg, extra={'object': self})
             raise ValueError(msg)
 
+        # seconds since the epoch, parsed once from the file naming
+        self.timestamp = mysql_backup.MysqlBackup.ts_from_human_readable_date(self.date_string)
+
     def __eq__(self, other):
         """If the checksums of two instances are equal
         the backups are equal."""
         if not isinstance(other, MysqlBackupInstance):
             AssertionError("Invalid comparison attempted.")
-        return self.checksum == other.checksum
+        self.hydrate()
+        other.hydrate()
+        if self.checksum is None or other.checksum is None:
+            return self.checksum == other.checksum
+
+        # Checksum files without an algorithm recorded are md5.
+        # Digests made with different algorithms never match,
+        # which errs on the side of keeping the new backup.
+        return MysqlBackupChecksum.parse_checksum(self.checksum) == \
+            MysqlBackupChecksum.parse_checksum(other.checksum)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -71,16 +107,45 @@ class MysqlBackupInstance:
     def __str__(self):
         return self.db_name + " " + self.date_string
 
+    def hydrate(self):
+        """void (but throws RuntimeError)
+        Validate an existing backup the first time it is needed.
+        Files still being written are left alone, anything else
+        that is not a proper backup self destructs."""
+        if self.hydrated:
+            return
+
+        if self.any_files_being_written():
+            msg = "Files are being written.  Can not hydrate %s" % self
+            raise FilesBeingWrittenError(msg)
+
+        self.set_proper_instance_state()
+        self.hydrated = True
+        MysqlBackupInstance.backup_logger.debug("%s hydrated", self, extra={'object': self})
+
+    def needs_hydration(self):
+        """Return: True when the file names alone show this backup
+        is incomplete or not in the configured compression state,
+        the cases validating every backup at startup used to fix."""
+        if self.hydrated:
+            return False
+        checksum_files = [bkobj for bkobj in self.bkup_file_objs if isinstance(bkobj, mysql_backup.CheckSumFile)]
+        data_files = self.get_data_file_objs()
+        if len(checksum_files) != 1 or len(data_files) != 1:
+            return True
+        if isinstance(data_files[0], mysql_backup.ManifestFile):
+            # The state of a manifest's segments is its own, not compression's
+            return False
+        return isinstance(data_files[0], mysql_backup.CompressedFile) != \
+            bool(self.config.compression_enabled)
+
     # Get stuff
 
     def get_age_secs(self):
         # current time stamp
         now = int(time.time())
 
-        #time stamp based on the backup files naming
-        backup_time = mysql_backup.MysqlBackup.ts_from_human_readable_date(self.date_string)
-
-        age_in_secs = now - backup_time
+        age_in_secs = now - self.timestamp
 
         return age_in_secs
 
@@ -91,14 +156,48 @@ class MysqlBackupInstance:
         for obj in self.bkup_file_objs:
             return_list.append(obj.file_name_full_path)
 
-        if self.is_a_long_term_version():
-            return_list.append(self.incremental_backup_file_obj.get_long_term_backup_full_name())
+        for bkobj in self.get_data_file_objs():
+            if bkobj.is_a_long_term_version():
+                return_list.append(bkobj.get_long_term_backup_full_name())
         return return_list
 
+    def get_data_file_objs(self):
+        """Return: the backup file objects that are not checksums or indexes.
+        Once hydrated this is only ever the incremental_backup_file_obj."""
+        if self.incremental_backup_file_obj is not None:
+            return [self.incremental_backup_file_obj]
+        return [bkobj for bkobj in self.bkup_file_objs
+                if not isinstance(bkobj, (mysql_backup.CheckSumFile, mysql_backup.IndexFile))]
+
+    def get_manifest_file_obj(self):
+        """Return: the ManifestFile of a table level backup, else None"""
+        for bkobj in self.get_data_file_objs():
+            if isinstance(bkobj, mysql_backup.ManifestFile):
+                return bkobj
+        return None
+
+    def get_segment_files(self):
+        """Return: the segments a table level backup is made of, an
+        empty list for any other backup or an unreadable manifest"""
+        manifest = self.get_manifest_file_obj()
+        if manifest is None:
+            return []
+        try:
+            return manifest.get_segment_files()
+        except (IOError, ValueError):
+            return []
+
+    def get_size_bytes(self):
+        """Size of the backup file itself, compressed or not"""
+        return sum(BackupDirectorySnapshot.get_size(bkobj.file_name_full_path) for bkobj in self.get_data_file_objs())
+
     def is_a_long_term_version(self):
         """Does this backup instance exist in the long
         term backup path"""
-        return self.incremental_backup_file_obj.is_a_long_term_version()
+        for bkobj in self.get_data_file_objs():
+            if bkobj.is_a_long_term_version():
+                return True
+        return False
 
     # Validate or (do stuff (with a RuntimeError) and die trying)
 
@@ -119,8 +218,28 @@ class MysqlBackupInstance:
 
         self.set_proper_instance_state_called_at_least_once = True
 
+    def check_removable(self):
+        """void (but throws RuntimeError)
+        A backup that was never validated may still be being written."""
+        if not self.hydrated and self.any_files_being_written():
+            msg = "Files are being written.  Not removing %s" % self
+            MysqlBackupInstance.backup_logger.warning(msg, extra={'object': self})
+            raise FilesBeingWrittenError(msg)
+
+    def get_removal_stages(self):
+        """Return: (long term copies, incremental files) as full paths,
+        in the order they must be removed"""
+        long_term_files = [bkobj.get_long_term_backup_full_name() for bkobj in self.get_data_file_objs()
+                           if bkobj.is_a_long_term_version()]
+        return long_term_files, [bkobj.file_name_full_path for bkobj in self.bkup_file_objs]
+
     def self_destruct(self):
-        """Delete all files associated with this instance"""
+        """Delete all files associated with this instance.
+        Raises RuntimeError, deleting nothing, if a backup that
+        was never validated is still being written."""
+        self.check_removable()
+        for bkobj in self.get_data_file_objs():
+            bkobj.remove_long_term_version()
         for bkfobj in self.bkup_file_objs:
                 bkfobj.self_destruct()
 
@@ -141,9 +260,10 @@ class MysqlBackupInstance:
         checksum_file_has_content = False
         has_uncompressed_file = False
         has_compresssed_file = False
+        has_manifest_file = False
         # less obvious but noting these things are also being factored
         # self.should_be_long_term_version
-        # mysql_backup.MysqlBackup.compression_enabled
+        # self.config.compression_enabled
 
         for bkup_file_obj in self.bkup_file_objs:
             if isinstance(bkup_file_obj, mysql_backup.CheckSumFile):
@@ -155,6 +275,8 @@ class MysqlBackupInstance:
                 has_uncompressed_file = True
             elif isinstance(bkup_file_obj, mysql_backup.CompressedFile):
                 has_compresssed_file = True
+            elif isinstance(bkup_file_obj, mysql_backup.ManifestFile):
+                has_manifest_file = True
 
         # Missing a checksum object, game over.  Backup not to be trusted
         # Missing a checksum object, game over.  Backup not to be trusted
@@ -184,9 +306,34 @@ class MysqlBackupInstance:
                         raise RuntimeError(msg)
                     has_uncompressed_file = False
 
+        # An index is of no use without its compressed file
+        if not has_compresssed_file:
+            for bkup_file_obj in self.bkup_file_objs:
+                if isinstance(bkup_file_obj, mysql_backup.IndexFile):
+                    bkup_file_obj.self_destruct()
+            self.bkup_file_objs = [bkobj for bkobj in self.bkup_file_objs
+                                   if not isinstance(bkobj, mysql_backup.IndexFile)]
+
+        # A manifest is only a backup as long as all of its segments are
+        if has_manifest_file:
+            for bkup_file_obj in self.bkup_file_objs:
+                if not isinstance(bkup_file_obj, mysql_backup.ManifestFile):
+                    continue
+                try:
+                    missing = [segment_file for segment_file in bkup_file_obj.get_segment_files()
+                               if not BackupDirectorySnapshot.exists(
+                                   mysql_backup.TableSegments.get_path(self.config, self.db_name, segment_file))]
+                except (IOError, ValueError) as e:
+                    missing = [str(e)]
+                if missing:
+                    self.self_destruct()
+                    msg = "Manifest refers to segments that do not exist: %s" % ', '.join(missing)
+                    MysqlBackupInstance.backup_logger.error(msg, extra={'object': self})
+                    raise RuntimeError(msg)
+
         # If neither a compressed or uncompressed version exists
         # this is a bad backup and should not be trusted
-        if True not in (has_uncompressed_file, has_compresssed_file):
+        if True not in (has_uncompressed_file, has_compresssed_file, has_manifest_file):
 
             self.self_destruct()
             msg = "No backups actually exist.  Self destructing this instance."
@@ -201,7 +348,8 @@ class MysqlBackupInstance:
         bkup_file_obj_count = 0
 
         for bkup_file_obj in self.bkup_file_objs:
-            if isinstance(bkup_file_obj, (mysql_backup.UncompressedFile, mysql_backup.CompressedFile)):
+            if isinstance(bkup_file_obj, (mysql_backup.UncompressedFile, mysql_backup.CompressedFile,
+                                          mysql_backup.ManifestFile)):
                 bkup_file_obj_count += 1
                 bkpfileobj = bkup_file_obj
             elif isinstance(bkup_file_obj, mysql_backup.CheckSumFile):
@@ -250,12 +398,17 @@ class MysqlBackupInstance:
         else:
 
             # When compression should exist, make it so
-            if mysql_backup.MysqlBackup.compression_enabled and isinstance(self.incremental_backup_file_obj,
-                                                                           mysql_backup.UncompressedFile):
-                cmpf = mysql_backup.MysqlBackupFileFactory.create_file_object(self.db_name,
-                                                                              ucpf=self.incremental_backup_file_obj)
+            if self.config.compression_enabled and isinstance(self.incremental_backup_file_obj,
+                                                              mysql_backup.UncompressedFile):
+                with RunMetrics.timer('compression_duration_seconds', db_name=self.db_name):
+                    cmpf = mysql_backup.MysqlBackupFileFactory.create_file_object(self.config, self.db_name,
+                                                                                  ucpf=self.incremental_backup_file_obj)
+                RunMetrics.add('compressed_bytes', BackupDirectorySnapshot.get_size(cmpf.file_name_full_path), db_name=self.db_name)
                 # Add the compressed file object as managed by this instance
                 self.bkup_file_objs.append(cmpf)
+                index_file = cmpf.get_index_file_object()
+                if index_file.exists():
+                    self.bkup_file_objs.append(index_file)
 
                 # at this point the uncompressed file should have been removed.  Let's double check or fail.
                 # before removing it from the backup file objects here and pointing to the new file
@@ -272,8 +425,8 @@ class MysqlBackupInstance:
                 self.incremental_backup_file_obj = cmpf
 
             # When compression should not exist, make it so
-            elif not mysql_backup.MysqlBackup.compression_enabled and isinstance(self.incremental_backup_file_obj,
-                                                                                 mysql_backup.CompressedFile):
+            elif not self.config.compression_enabled and isinstance(self.incremental_backup_file_obj,
+                                                                    mysql_backup.CompressedFile):
                 ucmf = self.incremental_backup_file_obj.decompress()
 
                 # Add the decompressed file object as managed by this instance
@@ -290,7 +443,7 @@ class MysqlBackupInstance:
                 # it is now safe to drop the uncompressed file object as managed by this instance.
                 # and set the new incremental_backup_file_obj to the compressed file object
                 self.bkup_file_objs = [bkobj for bkobj in self.bkup_file_objs
-                                       if not isinstance(bkobj, mysql_backup.CompressedFile)]
+                                       if not isinstance(bkobj, (mysql_backup.CompressedFile, mysql_backup.IndexFile))]
                 self.incremental_backup_file_obj = ucmf
 
     def set_as_long_term_version(self, lt_state):
@@ -301,6 +454,10 @@ class MysqlBackupInstance:
         lt_cur_state = self.is_a_long_term_version()
         if lt_cur_state != lt_state:
             if lt_state:
+                self.hydrate()
                 self.incremental_backup_file_obj.copy_to_long_term_backup()
+                RunMetrics.add('long_term_promotions', 1, db_name=self.db_name)
             else:
-                self.incremental_backup_file_obj.remove_long_term_version()
+                for bkobj in self.get_data_file_objs():
+                    bkobj.remove_long_term_version()
+                RunMetrics.add('long_term_removals', 1, db_name=self.db_name)
@@ -0,0 +1,136 @@
+# Job Retry
+# Each database is processed as a job of its own, and a job
+# that fails does not take the run down with it.  A failure
+# that may well not happen again, a dump mysqldump gave up
+# on because the server dropped or refused its connection or
+# a lock wait timed out, is tried again after a delay
+# doubling with each attempt, up to job_retries more times.
+# mysqldump is taken at its word: it exits with EX_MYSQLERR
+# and names the server error on stderr.  Anything else, such
+# as an unknown database, denied access or running out of
+# space, fails the job straight away.  The run goes
+# on with the other databases, reports the failed ones
+# together and restarts replication as after any other run.
+# A failed database is due again on the next run.
+
+import errno
+import re
+import sys
+import time
+from mysql_backup_deletion_pool import TRANSIENT_ERRNOS
+from run_metrics.run_metrics import RunMetrics
+
+# Lost or refused connections, lock wait timeouts and deadlocks
+TRANSIENT_MYSQL_ERRORS = (1040, 1205, 1213, 2002, 2003, 2006, 2013)
+
+# mysqldump's exit code for an error the server reported
+EX_MYSQLERR = 2
+
+# The server error codes in mysqldump's messages, as in
+# "Got error: 2013: Lost connection ...", "Error 2013: ..." or
+# "Couldn't execute '...': Lock wait timeout exceeded ... (1205)"
+MYSQL_ERROR_CODE = re.compile(r'(?:[Ee]rror:? |\()(\d{4})\b')
+
+# The end of a long stderr is kept, mysqldump names the error last
+STDERR_MAX_BYTES = 4096
+
+
+class DumpFailedError(RuntimeError):
+    """mysqldump exited with an error, returncode and what it wrote
+    to stderr tell whether it is worth another attempt"""
+
+    def __init__(self, msg, returncode, stderr=''):
+        stderr = stderr.strip()
+        RuntimeError.__init__(self, "%s. %s" % (msg, stderr) if stderr else msg)
+        self.returncode = returncode
+        self.stderr = stderr
+
+    @staticmethod
+    def read_stderr(stderr_pointer):
+        """Return: the end of what was written to stderr_pointer"""
+        stderr_pointer.seek(0, 2)
+        stderr_pointer.seek(max(0, stderr_pointer.tell() - STDERR_MAX_BYTES))
+        return stderr_pointer.read()
+
+    def get_mysql_errors(self):
+        """Return: the server error codes named on stderr"""
+        return [int(code) for code in MYSQL_ERROR_CODE.findall(self.stderr)]
+
+    def is_transient(self):
+        return self.returncode == EX_MYSQLERR and \
+            any(code in TRANSIENT_MYSQL_ERRORS for code in self.get_mysql_errors())
+
+
+class JobRetry(object):
+
+    backup_logger = None
+
+    def __init__(self, config, db_name):
+        JobRetry.backup_logger = config.get_logger('database')
+        self.db_name = db_name
+        self.retries = max(0, config.job_retries or 0)
+        self.retry_delay = max(0, config.job_retry_delay_seconds or 0)
+
+    def __str__(self):
+        return "%s job" % self.db_name
+
+    @staticmethod
+    def is_transient(e):
+        """Return: True when e is worth another attempt"""
+        if isinstance(e, DumpFailedError):
+            return e.is_transient()
+        if isinstance(e, EnvironmentError):
+            return e.errno in TRANSIENT_ERRNOS
+        try:
+            import MySQLdb
+        except ImportError:
+            return False
+        return isinstance(e, MySQLdb.OperationalError) and bool(e.args) and e.args[0] in TRANSIENT_MYSQL_ERRORS
+
+    @staticmethod
+    def describe(e):
+        if isinstance(e, EnvironmentError) and e.errno is not None and e.errno in errno.errorcode:
+            return "%s (%s): %s" % (e.__class__.__name__, errno.errorcode[e.errno], e)
+        return "%s: %s" % (e.__class__.__name__, e)
+
+    def run(self, job):
+        """Call job until it returns, or fails with an error not worth
+        another attempt or on its last attempt.
+        return: None when the job succeeded, else a picklable dict of
+        the database, the error, whether it was transient and the
+        number of attempts"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                job()
+                return None
+            except Exception as e:
+                transient = JobRetry.is_transient(e)
+                if transient and attempt <= self.retries:
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    RunMetrics.add('job_retries', 1, db_name=self.db_name)
+                    JobRetry.backup_logger.warning("%s failed, attempt %d of %d, trying again in %d seconds. %s",
+                                                   self, attempt, self.retries + 1, delay, JobRetry.describe(e),
+                                                   extra={'object': self})
+                    time.sleep(delay)
+                    continue
+                RunMetrics.add('job_failures', 1, db_name=self.db_name)
+                JobRetry.backup_logger.error("%s failed after %d attempt(s), leaving it for the next run.", self,
+                                             attempt, exc_info=sys.exc_info(), extra={'object': self})
+                return {
+                    'db_name': self.db_name,
+                    'error': JobRetry.describe(e),
+                    'transient': transient,
+                    'attempts': attempt,
+                }
+
+    def after(self, what, function, *args):
+        """(void)
+        Call function once the job is done.  Its errors are logged,
+        they fail neither the job nor the run."""
+        try:
+            function(*args)
+        except Exception:
+            JobRetry.backup_logger.error("%s: %s failed.", self, what, exc_info=sys.exc_info(),
+                                         extra={'object': self})
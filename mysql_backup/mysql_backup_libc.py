@@ -0,0 +1,59 @@
+# Libc
+# The glibc calls Python 2.7 does not offer, made through
+# ctypes.  ctypes is only imported once a call is made, and
+# a call glibc does not have is None to the caller, which
+# goes without it.
+
+import os
+
+# name -> (glibc symbols to try, argument types, result type), types named as in ctypes
+FUNCTIONS = {
+    # page cache
+    'posix_fadvise': (('posix_fadvise64', 'posix_fadvise'), ('c_int', 'c_int64', 'c_int64', 'c_int'), 'c_int'),
+    'fallocate': (('fallocate64', 'fallocate'), ('c_int', 'c_int', 'c_int64', 'c_int64'), 'c_int'),
+    'sync_file_range': (('sync_file_range',), ('c_int', 'c_int64', 'c_int64', 'c_uint'), 'c_int'),
+    'mmap': (('mmap64', 'mmap'), ('c_void_p', 'c_size_t', 'c_int', 'c_int', 'c_int', 'c_int64'), 'c_void_p'),
+    'munmap': (('munmap',), ('c_void_p', 'c_size_t'), 'c_int'),
+    'mincore': (('mincore',), ('c_void_p', 'c_size_t', 'c_void_p'), 'c_int'),
+    # directory watches
+    'inotify_init1': (('inotify_init1',), ('c_int',), 'c_int'),
+    'inotify_add_watch': (('inotify_add_watch',), ('c_int', 'c_char_p', 'c_uint32'), 'c_int'),
+    'inotify_rm_watch': (('inotify_rm_watch',), ('c_int', 'c_int'), 'c_int'),
+}
+
+
+class Libc:
+    """Process wide"""
+
+    # Loaded on first use, False where there is no libc to load
+    libc = None
+    functions = dict()
+
+    @staticmethod
+    def get_function(name):
+        """Return: the ctypes function for name, None when unavailable"""
+        if name not in Libc.functions:
+            import ctypes
+            if Libc.libc is None:
+                import ctypes.util
+                try:
+                    Libc.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                except OSError:
+                    Libc.libc = False
+            symbols, argtypes, restype = FUNCTIONS[name]
+            function = None
+            for symbol in symbols:
+                function = getattr(Libc.libc, symbol, None) if Libc.libc else None
+                if function is not None:
+                    function.argtypes = [getattr(ctypes, argtype) for argtype in argtypes]
+                    function.restype = getattr(ctypes, restype)
+                    break
+            Libc.functions[name] = function
+        return Libc.functions[name]
+
+    @staticmethod
+    def get_error(message):
+        """Return: OSError for the errno the last call left"""
+        import ctypes
+        error = ctypes.get_errno()
+        return OSError(error, "%s: %s" % (message, os.strerror(error)))
@@ -0,0 +1,187 @@
+# Logging
+# Log records are put on a queue and written to the log
+# file by a listener thread, so logging never waits on the
+# disk.  The queue is a multiprocessing one: workers forked
+# from the run inherit the handler and their records reach
+# the run's listener and are written by the one process.
+# Putting a record writes it to the queue's pipe right away,
+# no feeder thread holds it back when a worker is ended.
+# A spawned worker has no way to the run's queue and starts
+# a listener of its own on the same log file.
+#
+# Every subsystem logs to a child of the run's logger and
+# may be given its own level, see SUBSYSTEMS and the levels
+# setting of the Logging section.
+#
+# Python 2.7 has no QueueHandler or QueueListener in
+# logging.handlers, these are the parts of them needed here.
+
+import atexit
+import logging
+import os
+import threading
+from multiprocessing.queues import SimpleQueue
+
+# Children of the run's logger that may be given their own level
+SUBSYSTEMS = ('database', 'instance', 'file', 'retention', 'long_term', 'throttle', 'schedule', 'cache',
+              'snapshot', 'replication')
+
+FORMAT = '[%(name)s][TIME:%(asctime)s][OBJ:%(object)s][LOGLEVEL:%(levelname)s][METHOD:%(funcName)s]' \
+         '[LINE:%(lineno)d][MSG:%(message)s]'
+
+
+class QueueHandler(logging.Handler):
+    """Formats the message where it was logged and puts the record
+    on queue.  Arguments and the logged object are made strings
+    first: they need not pickle and may change after the call."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.msg += '\n' + logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if hasattr(record, 'object'):
+            record.object = str(record.object)
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    """Hands the records on queue to handler until stopped"""
+
+    stop_marker = 'stop'
+    flush_marker = 'flush'
+
+    def __init__(self, queue, handler):
+        threading.Thread.__init__(self, name='log listener')
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+        self.flushed = threading.Event()
+        # Forked children inherit the listener object but not its thread
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record == QueueListener.stop_marker:
+                break
+            if record == QueueListener.flush_marker:
+                self.handler.flush()
+                self.flushed.set()
+                continue
+            self.handler.handle(record)
+        self.handler.flush()
+
+    def flush(self, timeout=30):
+        """Wait for the records put so far to be written"""
+        self.flushed.clear()
+        self.queue.put(QueueListener.flush_marker)
+        self.flushed.wait(timeout)
+
+    def stop(self, timeout=30):
+        """Write the remaining records and end the thread"""
+        self.queue.put(QueueListener.stop_marker)
+        self.join(timeout)
+        self.handler.close()
+
+
+class RunLog:
+    """Process wide.  listeners maps a run's logger name to the
+    listener writing its records in this process."""
+
+    listeners = dict()
+
+    @staticmethod
+    def get_logger_name(config):
+        return "Backup ID:" + config.backup_id
+
+    @staticmethod
+    def get_logger(config, subsystem=None):
+        """Return: the run's logger, or the child of it for subsystem.
+        The queue and listener are started the first time a process
+        asks for either."""
+        name = RunLog.get_logger_name(config)
+        logger = logging.getLogger(name)
+        if not logger.handlers:
+            RunLog.start(config, logger)
+        if subsystem is None:
+            return logger
+        return logger.getChild(subsystem)
+
+    @staticmethod
+    def start(config, logger):
+        handler = logging.FileHandler(config.logfile)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        queue = SimpleQueue()
+        listener = QueueListener(queue, handler)
+        listener.start()
+        RunLog.listeners[logger.name] = listener
+
+        logger.addHandler(QueueHandler(queue))
+        logger.setLevel(config.loglevel)
+        # Records go to the run's handler only
+        logger.propagate = False
+        for subsystem, level in config.log_levels or ():
+            logger.getChild(subsystem).setLevel(level)
+
+    @staticmethod
+    def flush(config):
+        """Wait until the records logged so far in this process are in
+        the log file.  Nothing to wait for in a forked worker, whose
+        records the run's listener writes."""
+        listener = RunLog.listeners.get(RunLog.get_logger_name(config))
+        if listener is not None and listener.pid == os.getpid() and listener.is_alive():
+            listener.flush()
+
+    @staticmethod
+    def stop(config):
+        """Write the remaining records of config's run and let go of its
+        log file, for a process going on with another config"""
+        name = RunLog.get_logger_name(config)
+        listener = RunLog.listeners.pop(name, None)
+        if listener is not None and listener.pid == os.getpid() and listener.is_alive():
+            listener.stop()
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+    @staticmethod
+    def stop_all():
+        for name, listener in RunLog.listeners.items():
+            if listener.pid == os.getpid() and listener.is_alive():
+                listener.stop()
+        RunLog.listeners = dict()
+
+    @staticmethod
+    def parse_levels(value):
+        """Return: tuple of (subsystem, level name) from a setting such
+        as "file:WARNING, retention:DEBUG" """
+        levels = list()
+        for item in (value or '').split(','):
+            if not item.strip():
+                continue
+            subsystem, _, level = item.partition(':')
+            subsystem = subsystem.strip()
+            level = level.strip().upper()
+            if subsystem not in SUBSYSTEMS:
+                raise ValueError("Unknown logging subsystem %s. Choose from %s" % (subsystem, ', '.join(SUBSYSTEMS)))
+            if not isinstance(logging.getLevelName(level), int):
+                raise ValueError("Unknown log level %s for %s" % (level, subsystem))
+            levels.append((subsystem, level))
+        return tuple(levels)
+
+
+atexit.register(RunLog.stop_all)
@@ -0,0 +1,107 @@
+# Long Term Copier
+# Copies backups to the long term storage.  The storage
+# makes a copy visible only once it is whole and verified,
+# so nothing ever sees a partial long term copy.
+#
+# During a run, forked workers hand promotions to a queue and
+# go on with the next database while the parent process drains
+# the queue on long_term_copy_streams threads.  Spawned workers
+# never see the queue and copy for themselves.
+
+import threading
+from multiprocessing.queues import SimpleQueue
+from mysql_backup_deletion_pool import DeletionPool
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup_long_term_storage import LongTermStorage
+from run_metrics.run_metrics import RunMetrics
+
+
+class LongTermCopier(object):
+
+    backup_logger = None
+
+    config = None
+
+    # Set while a run's copy streams are open.  Forked workers
+    # inherit the queue and submit to it.
+    queue = None
+    streams = list()
+
+    def __str__(self):
+        return "long term copier"
+
+    @staticmethod
+    def copy(src, dst, verify=True):
+        """void (but throws RuntimeError)
+        Copy src to dst in the long term storage, verifying the
+        copy against the source before it becomes visible."""
+        LongTermStorage.get().put(src, dst, verify=verify)
+
+    # The queue
+
+    @staticmethod
+    def is_started():
+        return LongTermCopier.queue is not None
+
+    @staticmethod
+    def start(config):
+        """Open the queue and start config's long_term_copy_streams copy streams"""
+        LongTermCopier.backup_logger = config.get_logger('long_term')
+        LongTermCopier.config = config
+        LongTermCopier.queue = SimpleQueue()
+        LongTermCopier.streams = list()
+        for i in range(max(1, config.long_term_copy_streams)):
+            stream = threading.Thread(target=LongTermCopier.run_stream, name="long term copy %d" % i)
+            stream.daemon = True
+            stream.start()
+            LongTermCopier.streams.append(stream)
+
+    @staticmethod
+    def submit(db_name, src, dst, demote_files, demote_count, remove_src=False):
+        """Queue a promotion.  demote_files are long term copies the
+        promotion replaces; they are removed only once the copy landed.
+        With remove_src, src was made for the copy and goes after it."""
+        LongTermCopier.queue.put((db_name, src, dst, list(demote_files), demote_count, remove_src))
+
+    @staticmethod
+    def drain():
+        """Wait for every queued promotion and stop the copy streams"""
+        if not LongTermCopier.is_started():
+            return
+        for _ in LongTermCopier.streams:
+            LongTermCopier.queue.put(None)
+        with RunMetrics.timer('long_term_drain_seconds'):
+            for stream in LongTermCopier.streams:
+                stream.join()
+        LongTermCopier.queue = None
+        LongTermCopier.streams = list()
+
+    @staticmethod
+    def run_stream():
+        while True:
+            job = LongTermCopier.queue.get()
+            if job is None:
+                return
+            LongTermCopier.promote(*job)
+
+    @staticmethod
+    def promote(db_name, src, dst, demote_files, demote_count, remove_src=False):
+        copier = LongTermCopier()
+        LongTermCopier.backup_logger.info("copying %s to %s", src, dst, extra={'object': copier})
+        try:
+            with RunMetrics.timer('long_term_copy_seconds', db_name=db_name):
+                LongTermCopier.copy(src, dst, verify=LongTermCopier.config.long_term_copy_verify)
+        except RuntimeError as e:
+            LongTermCopier.backup_logger.error("%s: %s Older long term copies are kept.", db_name, e,
+                                               extra={'object': copier})
+            RunMetrics.add('long_term_copy_failures', 1, db_name=db_name)
+            return
+        finally:
+            if remove_src:
+                BackupDirectorySnapshot.remove(src)
+
+        RunMetrics.add('long_term_promotions', 1, db_name=db_name)
+        if demote_files:
+            failed = DeletionPool(LongTermCopier.config, threads=1).delete(demote_files)
+            if not failed:
+                RunMetrics.add('long_term_removals', demote_count, db_name=db_name)
@@ -0,0 +1,187 @@
+# Long Term Storage
+# Where long term copies live.  Everything that asks
+# whether a long term copy exists, lists them, writes or
+# removes one goes through the configured storage, so the
+# long term path can be a directory or an object store.
+#
+# A long term copy is named by its full name: a path for
+# the filesystem, s3://bucket/prefix/file for S3.  Files
+# outside of the storage are answered for by the directory
+# snapshot, which has the same exists, get_size, get_mtime
+# and remove methods.
+
+import errno
+import os
+import threading
+from mysql_backup_checksum import MysqlBackupChecksum
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup_page_cache import PageCache
+from mysql_backup_throttle import MysqlBackupThrottle
+from run_metrics.run_trace import RunTrace
+
+
+class LongTermStorage(object):
+    """Interface of a long term storage.  The configured storage
+    is process wide, each worker process configures its own."""
+
+    backup_logger = None
+
+    storage = None
+
+    @staticmethod
+    def configure(config):
+        """Use the storage named by config's long_term_storage"""
+        LongTermStorage.backup_logger = config.get_logger('long_term')
+        if config.long_term_storage == 'filesystem':
+            LongTermStorage.storage = FilesystemStorage(config)
+        elif config.long_term_storage == 's3':
+            # boto3 is only imported when s3 is used
+            from mysql_backup_s3_storage import S3Storage
+            LongTermStorage.storage = S3Storage(config)
+        else:
+            raise ValueError("long_term_storage must be filesystem or s3, not %s" % config.long_term_storage)
+
+    @staticmethod
+    def get():
+        return LongTermStorage.storage
+
+    @staticmethod
+    def storage_for(file_name):
+        """Return: what answers for file_name, the configured storage
+        for long term copies, the directory snapshot for anything else"""
+        if LongTermStorage.storage is not None and LongTermStorage.storage.owns(file_name):
+            return LongTermStorage.storage
+        return BackupDirectorySnapshot
+
+    def reset(self):
+        """Forget what is cached about the storage's contents"""
+        raise NotImplementedError()
+
+    def get_full_name(self, file_name):
+        raise NotImplementedError()
+
+    def owns(self, file_name):
+        """Return: True when the full name file_name is in this storage"""
+        raise NotImplementedError()
+
+    def list_files(self):
+        """Return: full names of everything in the storage"""
+        raise NotImplementedError()
+
+    def exists(self, file_name):
+        raise NotImplementedError()
+
+    def get_size(self, file_name):
+        """Return: size in bytes, 0 when the file does not exist"""
+        raise NotImplementedError()
+
+    def get_mtime(self, file_name):
+        """Return: modification time or None when the file does not exist"""
+        raise NotImplementedError()
+
+    def put(self, src, file_name, verify=True):
+        """void (but throws RuntimeError)
+        Copy the local file src into the storage as file_name.
+        Nothing is visible under file_name until the copy is whole."""
+        raise NotImplementedError()
+
+    def remove(self, file_name):
+        """Remove file_name.  A file already gone is not an error,
+        failures raise OSError so the deletion pool can retry them."""
+        raise NotImplementedError()
+
+
+class FilesystemStorage(LongTermStorage):
+    """Long term copies in a directory, long_term_backup_path"""
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config.long_term_backup_path.rstrip('/') or '/'
+
+    def __str__(self):
+        return self.path
+
+    def reset(self):
+        # Kept current by the directory snapshot
+        pass
+
+    def get_full_name(self, file_name):
+        return self.path.rstrip('/') + '/' + file_name
+
+    def owns(self, file_name):
+        return os.path.dirname(file_name).rstrip('/') == self.path.rstrip('/')
+
+    def list_files(self):
+        return BackupDirectorySnapshot.list_files(self.path)
+
+    def exists(self, file_name):
+        return BackupDirectorySnapshot.exists(file_name)
+
+    def get_size(self, file_name):
+        return BackupDirectorySnapshot.get_size(file_name)
+
+    def get_mtime(self, file_name):
+        return BackupDirectorySnapshot.get_mtime(file_name)
+
+    def remove(self, file_name):
+        BackupDirectorySnapshot.remove(file_name)
+
+    @staticmethod
+    def get_temporary_name(dst):
+        """Return: where dst is written before being renamed into place.
+        The leading dot and suffix never match a backup file name."""
+        return os.path.join(os.path.dirname(dst), '.%s.partial.%d.%d'
+                            % (os.path.basename(dst), os.getpid(), threading.current_thread().ident))
+
+    def put(self, src, file_name, verify=True):
+        """The copy is written under a temporary dot name, fsynced,
+        verified against the source and only then renamed into place."""
+        algorithm = self.config.checksum_algorithm or 'md5'
+        buffer_size = self.config.checksum_buffer_size
+        tmp = FilesystemStorage.get_temporary_name(file_name)
+
+        try:
+            with RunTrace.span('long_term_copy', file=os.path.basename(file_name)):
+                src_hash = MysqlBackupChecksum.new_hash(algorithm)
+                with open(src, 'rb', 0) as src_pointer, \
+                        PageCache.open_output(tmp, os.path.getsize(src), direct=PageCache.copy_direct_io) as tmp_pointer:
+                    MysqlBackupThrottle.stream('copy', src_pointer, tmp_pointer,
+                                               buffer_size or MysqlBackupChecksum.default_buffer_size, src_hash)
+                    tmp_pointer.flush()
+                    os.fsync(tmp_pointer.fileno())
+                PageCache.drop_file(src)
+
+                if verify:
+                    copy_digest = MysqlBackupChecksum.get_digest_from_file(tmp, algorithm, buffer_size)
+                    # Reading the copy back brought it into the page cache
+                    PageCache.drop_file(tmp)
+                    if copy_digest != src_hash.hexdigest():
+                        raise RuntimeError("Verification of the long term copy of %s failed." % src)
+
+                os.rename(tmp, file_name)
+                FilesystemStorage.fsync_directory(os.path.dirname(file_name))
+        except (IOError, OSError) as e:
+            FilesystemStorage.remove_temporary(tmp)
+            raise RuntimeError("Copying %s to %s failed. %s" % (src, file_name, e))
+        except RuntimeError:
+            FilesystemStorage.remove_temporary(tmp)
+            raise
+
+        BackupDirectorySnapshot.add(file_name)
+
+    @staticmethod
+    def remove_temporary(tmp):
+        try:
+            os.remove(tmp)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @staticmethod
+    def fsync_directory(directory):
+        """Make the rename itself durable"""
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,69 @@
+# Open Files
+# Whether a backup file is still being written is told by
+# looking through the open files of every process, a scan
+# costing the same whatever the number of files asked about.
+# Phases asking about many files in a row, reconciling the
+# backup instances or cleaning up, share one scan taken on
+# the phase's first question.  Outside a phase every question
+# scans.
+#
+# A file opened after the shared scan was taken is not seen
+# as open until the phase ends, so phases are kept short and
+# to files that existed when they started.
+
+import threading
+from contextlib import contextmanager
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
+
+
+class OpenFiles:
+    """Process wide"""
+
+    # The paths open at the shared phase's first question, None before it
+    paths = None
+    depth = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def scan():
+        """Return: set of the paths any process has open"""
+        import psutil
+
+        RunMetrics.add('open_file_scans', 1)
+        with RunMetrics.timer('open_file_scan_seconds'), RunTrace.span('open_file_scan'):
+            open_files = set()
+            for p in psutil.process_iter():
+                try:
+                    for f in p.open_files():
+                        open_files.add(f.path)
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    # Exited while iterating, or not ours to inspect when
+                    # not running as root.
+                    continue
+        return open_files
+
+    @staticmethod
+    @contextmanager
+    def shared():
+        """Usage: with OpenFiles.shared(): ... every is_open in the
+        block, from any thread, answers from one scan.  Nests."""
+        with OpenFiles.lock:
+            OpenFiles.depth += 1
+        try:
+            yield
+        finally:
+            with OpenFiles.lock:
+                OpenFiles.depth -= 1
+                if OpenFiles.depth == 0:
+                    OpenFiles.paths = None
+
+    @staticmethod
+    def is_open(file_name):
+        if OpenFiles.depth == 0:
+            return file_name in OpenFiles.scan()
+        # Threads asking together wait for the one scan
+        with OpenFiles.lock:
+            if OpenFiles.paths is None:
+                OpenFiles.paths = OpenFiles.scan()
+            return file_name in OpenFiles.paths
@@ -0,0 +1,272 @@
+# Page Cache
+# Backup output is written once and hardly read again, yet
+# buffered writes leave it in the page cache, evicting the
+# pages replication and read queries on the slave need.
+# Output written in this process goes through open_output:
+# writeback of each window of written bytes is started once
+# the window is full and, one window later, waited for and
+# the now clean pages dropped with posix_fadvise(DONTNEED).
+# Files whose size is known or estimable are preallocated
+# with fallocate, keeping their size, and trimmed to what was
+# written.
+#
+# The long term copy may be written with O_DIRECT instead,
+# bypassing the page cache.  O_DIRECT needs aligned buffers
+# and lengths: writes are gathered in a page aligned mmap
+# buffer and the unaligned tail is written after clearing
+# O_DIRECT.  Filesystems refusing O_DIRECT (tmpfs) get the
+# buffered writer.
+#
+# Python 2.7 has none of these calls, they are made through
+# Libc and skipped where unavailable.
+
+import errno
+import fcntl
+import mmap
+import os
+from mysql_backup_libc import Libc
+from run_metrics.run_metrics import RunMetrics
+
+POSIX_FADV_DONTNEED = 4
+FALLOC_FL_KEEP_SIZE = 1
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+# Buffers and lengths written with O_DIRECT are multiples of this
+DIRECT_IO_ALIGNMENT = 4096
+
+
+class PageCache:
+    """Process wide settings, set from the run's config"""
+
+    drop = False
+    window = 64 * 1024 * 1024
+    preallocate = False
+    copy_direct_io = False
+
+    @staticmethod
+    def configure(config):
+        PageCache.drop = config.throttle_page_cache_drop
+        PageCache.window = config.throttle_page_cache_window
+        PageCache.preallocate = config.throttle_preallocate
+        PageCache.copy_direct_io = config.throttle_copy_direct_io
+
+    # libc
+
+    @staticmethod
+    def fadvise_dontneed(fd, offset, length):
+        """Drop the clean pages of fd in the range, length 0 to the end.
+        return: True when the advice was taken"""
+        posix_fadvise = Libc.get_function('posix_fadvise')
+        # posix_fadvise returns the error number rather than setting errno
+        return posix_fadvise is not None and posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED) == 0
+
+    @staticmethod
+    def sync_range(fd, offset, length, flags):
+        sync_file_range = Libc.get_function('sync_file_range')
+        return sync_file_range is not None and sync_file_range(fd, offset, length, flags) == 0
+
+    @staticmethod
+    def allocate(fd, size):
+        """Reserve size bytes for fd without changing its size.
+        return: True when the space was reserved"""
+        fallocate = Libc.get_function('fallocate')
+        return fallocate is not None and size > 0 and fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0
+
+    @staticmethod
+    def drop_file(file_name):
+        """Drop the clean pages of file_name, as after reading it once"""
+        if not PageCache.drop:
+            return
+        try:
+            fd = os.open(file_name, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            PageCache.fadvise_dontneed(fd, 0, 0)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def get_resident_bytes(file_name):
+        """Return: (bytes of file_name in the page cache, size), found
+        with mincore, or (None, size) where mincore is unavailable"""
+        size = os.path.getsize(file_name)
+        mmap_function = Libc.get_function('mmap')
+        munmap = Libc.get_function('munmap')
+        mincore = Libc.get_function('mincore')
+        if size == 0 or None in (mmap_function, munmap, mincore):
+            return (0 if size == 0 else None), size
+        import ctypes
+        page_size = mmap.PAGESIZE
+        pages = (size + page_size - 1) // page_size
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            address = mmap_function(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+            if address in (None, ctypes.c_void_p(-1).value):
+                return None, size
+            try:
+                vector = (ctypes.c_ubyte * pages)()
+                if mincore(address, size, vector) != 0:
+                    return None, size
+                resident = sum(1 for page in vector if page & 1)
+            finally:
+                munmap(address, size)
+        finally:
+            os.close(fd)
+        return min(size, resident * page_size), size
+
+    # Writing
+
+    @staticmethod
+    def open_output(file_name, size_hint=None, direct=False):
+        """Open file_name for writing through a page cache friendly writer.
+        size_hint: expected size, preallocated when preallocate is on.
+        direct: write with O_DIRECT where the filesystem allows it."""
+        if direct and O_DIRECT:
+            try:
+                return DirectWriter(file_name, size_hint)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                RunMetrics.add('direct_io_fallbacks', 1)
+        return WindowedWriter(file_name, size_hint)
+
+
+class WindowedWriter(object):
+    """Writes file_name through the page cache, dropping what was
+    written a window behind.  A file like object for stream."""
+
+    def __init__(self, file_name, size_hint=None):
+        self.file_pointer = open(file_name, 'wb')
+        self.fd = self.file_pointer.fileno()
+        self.written = 0
+        # Writeback was started up to synced and pages are dropped up to dropped
+        self.synced = 0
+        self.dropped = 0
+        self.preallocated = 0
+        if PageCache.preallocate and size_hint and PageCache.allocate(self.fd, size_hint):
+            self.preallocated = size_hint
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def flush(self):
+        self.file_pointer.flush()
+
+    def write(self, data):
+        self.file_pointer.write(data)
+        self.written += len(data)
+        if PageCache.drop and self.written - self.synced >= PageCache.window:
+            self.file_pointer.flush()
+            # Start writing back the new window, wait for the one before and drop it
+            PageCache.sync_range(self.fd, self.synced, self.written - self.synced, SYNC_FILE_RANGE_WRITE)
+            if self.synced > self.dropped:
+                PageCache.sync_range(self.fd, self.dropped, self.synced - self.dropped,
+                                     SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                if PageCache.fadvise_dontneed(self.fd, self.dropped, self.synced - self.dropped):
+                    RunMetrics.add('page_cache_dropped_bytes', self.synced - self.dropped)
+                self.dropped = self.synced
+            self.synced = self.written
+
+    def close(self):
+        """Trim the preallocation and drop what is left"""
+        if self.file_pointer.closed:
+            return
+        try:
+            self.file_pointer.flush()
+            if self.preallocated > self.written:
+                os.ftruncate(self.fd, self.written)
+            if PageCache.drop and self.written > self.dropped:
+                PageCache.sync_range(self.fd, self.dropped, self.written - self.dropped,
+                                     SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                if PageCache.fadvise_dontneed(self.fd, 0, 0):
+                    RunMetrics.add('page_cache_dropped_bytes', self.written - self.dropped)
+                self.dropped = self.written
+        finally:
+            self.file_pointer.close()
+
+
+class DirectWriter(object):
+    """Writes file_name with O_DIRECT, bypassing the page cache.
+    Raises OSError EINVAL when the filesystem does not allow it."""
+
+    buffer_size = 8 * 1024 * 1024
+
+    def __init__(self, file_name, size_hint=None):
+        self.fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_DIRECT, 0666)
+        # Anonymous maps are page aligned, as O_DIRECT wants
+        self.buf = mmap.mmap(-1, DirectWriter.buffer_size)
+        self.buffered = 0
+        self.written = 0
+        self.direct = True
+        self.closed = False
+        if PageCache.preallocate and size_hint:
+            PageCache.allocate(self.fd, size_hint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def write_fully(self, length):
+        offset = 0
+        while offset < length:
+            # A buffer of the map, slicing would copy to an unaligned string
+            offset += os.write(self.fd, buffer(self.buf, offset, length - offset))
+        self.written += length
+        self.buffered = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            count = min(len(data), DirectWriter.buffer_size - self.buffered)
+            self.buf[self.buffered:self.buffered + count] = data[:count].tobytes()
+            self.buffered += count
+            data = data[count:]
+            if self.buffered == DirectWriter.buffer_size:
+                self.write_fully(self.buffered)
+
+    def flush(self):
+        """Write out everything gathered so far.  The unaligned tail is
+        written without O_DIRECT, and so is anything written after it."""
+        aligned = self.buffered - self.buffered % DIRECT_IO_ALIGNMENT
+        if aligned and self.direct:
+            remaining = self.buffered - aligned
+            self.write_fully(aligned)
+            self.buf.move(0, aligned, remaining)
+            self.buffered = remaining
+        if self.buffered:
+            if self.direct:
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~O_DIRECT)
+                self.direct = False
+            self.write_fully(self.buffered)
+
+    def close(self):
+        """Write what is left, drop the part written through the page
+        cache and trim the preallocation"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            if not self.direct:
+                PageCache.sync_range(self.fd, 0, 0, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                                     SYNC_FILE_RANGE_WAIT_AFTER)
+                PageCache.fadvise_dontneed(self.fd, 0, 0)
+            os.ftruncate(self.fd, self.written)
+        finally:
+            self.buf.close()
+            os.close(self.fd)
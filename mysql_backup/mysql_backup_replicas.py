@@ -0,0 +1,244 @@
+# Replicas
+# The [MySQL] host may name several equivalent replicas of one
+# master, the first of which is the run's own server: its
+# slave is stopped for the whole run and its position is the
+# one recorded, as with a single host.  The databases due for
+# a dump are spread over the first and those of the others
+# that are replicating within replica_max_lag_seconds, the
+# largest first onto the replica with the fewest bytes placed
+# (longest processing time first), sized by the smoothed dump
+# sizes of the schedule.  Databases that will not be dumped
+# stay with the first replica.
+#
+# A replica given databases is stopped once the first one is,
+# and one behind the first's position applies up to it with
+# START SLAVE UNTIL, so every dump of the run is at least as
+# recent as the recorded position.  A replica that does not
+# catch up within replica_catch_up_seconds is started again
+# and its databases placed on the rest.  The worker finishing
+# the last database of a replica starts its slave again; what
+# each replica still has is kept in a file next to the running
+# cache, locked with flock, whatever the worker backend.
+# Replicas given nothing are left replicating.
+
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import mysql_backup
+from mysql_backup_replication import ReplicationPosition
+
+
+class Replica(object):
+    """Slave control of one replica, each call on a connection of its own"""
+
+    # wait for the slave to catch up before failing
+    seconds_between_tries = 5
+    retries = 20
+
+    def __init__(self, config, host):
+        self.config = config
+        self.host = host
+
+    def __str__(self):
+        return self.host
+
+    def execute(self, statement, args=None):
+        """Return: the rows of statement"""
+        db_connection = mysql_backup.MysqlBackup.connect(self.config, "mysql", host=self.host)
+        try:
+            cursor = db_connection.cursor()
+            cursor.execute(statement, args)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        finally:
+            db_connection.close()
+
+    def get_status(self):
+        """Return: the row of SHOW SLAVE STATUS"""
+        return self.execute("SHOW SLAVE STATUS;")[0]
+
+    @staticmethod
+    def is_running(status):
+        return status["Slave_IO_Running"] == "Yes" and status["Slave_SQL_Running"] == "Yes"
+
+    def set_running(self, running_state):
+        """(void but raises SystemError)
+        Start or stop the slave, waiting for it to get there"""
+        if Replica.is_running(self.get_status()) == running_state:
+            return
+        BackupReplicas.backup_logger.info("%s slave on %s.", "Starting" if running_state else "Stopping", self,
+                                          extra={'object': self})
+        self.execute("START SLAVE;" if running_state else "STOP SLAVE;")
+        i = 0
+        while i < Replica.retries and Replica.is_running(self.get_status()) != running_state:
+            i += 1
+            time.sleep(Replica.seconds_between_tries)
+        if Replica.is_running(self.get_status()) != running_state:
+            msg = "MySQL slave on %s failed to %s" % (self, "start" if running_state else "stop")
+            BackupReplicas.backup_logger.error(msg, extra={'object': self})
+            raise SystemError(msg)
+
+    def catch_up(self, position, timeout):
+        """Stop the slave at position, the master (file, position) of
+        another replica, applying up to it first when behind.
+        return: True when the stopped slave is at or past position"""
+        self.set_running(False)
+        status = self.get_status()
+        behind = ReplicationPosition.compare_master_positions(ReplicationPosition.get_master_position(status),
+                                                              position)
+        if behind is None:
+            BackupReplicas.backup_logger.warning("%s replicates from %s, not comparable with %s.", self,
+                                                 status.get('Relay_Master_Log_File'), position[0],
+                                                 extra={'object': self})
+            return False
+        if behind >= 0:
+            return True
+
+        BackupReplicas.backup_logger.info("%s is behind, applying up to %s:%d.", self, position[0], position[1],
+                                          extra={'object': self})
+        self.execute("START SLAVE UNTIL MASTER_LOG_FILE = %s, MASTER_LOG_POS = %s;", position)
+        deadline = time.time() + timeout
+        while True:
+            status = self.get_status()
+            reached = ReplicationPosition.compare_master_positions(
+                ReplicationPosition.get_master_position(status), position) >= 0
+            if (reached and status["Slave_SQL_Running"] != "Yes") or time.time() >= deadline:
+                break
+            time.sleep(1)
+        # The io thread is still fetching
+        self.execute("STOP SLAVE;")
+        return reached
+
+
+class BackupReplicas:
+    """Process wide"""
+
+    hosts = ()
+    # The replica the job running in this process dumps from, None
+    # for the [MySQL] host as given
+    current = None
+    # What each replica but the first still has to dump, while fanned out
+    remaining_file = None
+    backup_logger = None
+
+    @staticmethod
+    def configure(config):
+        BackupReplicas.backup_logger = config.get_logger('replication')
+        BackupReplicas.hosts = config.mysql_hosts
+        BackupReplicas.current = None
+        BackupReplicas.remaining_file = config.running_cache_file + '.replicas'
+
+    @staticmethod
+    def is_fanned_out():
+        return len(BackupReplicas.hosts) > 1
+
+    # Hosts
+
+    @staticmethod
+    def split_host(host):
+        """Return: (host name, port or None) of host[:port]"""
+        if host and host.count(':') == 1:
+            name, port = host.split(':')
+            return name, int(port)
+        return host, None
+
+    @staticmethod
+    def get_host(config):
+        return BackupReplicas.current or config.mysql_host
+
+    @staticmethod
+    @contextmanager
+    def using(host):
+        """Usage: with BackupReplicas.using(host): ... connections and
+        dumps go to host"""
+        previous = BackupReplicas.current
+        BackupReplicas.current = host
+        try:
+            yield
+        finally:
+            BackupReplicas.current = previous
+
+    @staticmethod
+    def get_dump_options():
+        """Return: the mysqldump arguments naming the current replica"""
+        if BackupReplicas.current is None:
+            return []
+        name, port = BackupReplicas.split_host(BackupReplicas.current)
+        return ['-h', name] + (['-P', str(port)] if port is not None else [])
+
+    # Placement
+
+    @staticmethod
+    def place(weights, hosts):
+        """Spread the databases over hosts, the heaviest first onto
+        the host with the least weight placed.  Ties go to the
+        earlier host, so the placement is the same for the same input.
+        weights: dict of database -> weight, 0 for databases only
+        needing retention, which stay with the first host
+        return: dict of host -> list of databases"""
+        placement = dict((host, list()) for host in hosts)
+        loads = dict((host, 0) for host in hosts)
+        for db_name in sorted(weights, key=lambda db: (-weights[db], db)):
+            if not weights[db_name]:
+                host = hosts[0]
+            else:
+                host = min(hosts, key=lambda h: (loads[h], hosts.index(h)))
+            placement[host].append(db_name)
+            loads[host] += weights[db_name]
+        return placement
+
+    # Handing replicas back
+
+    @staticmethod
+    def write_remaining(placement):
+        """(void)
+        Record the databases of every replica but the first for release"""
+        with open(BackupReplicas.remaining_file, 'w') as remaining_pointer:
+            json.dump(dict((host, db_names) for host, db_names in placement.items()
+                           if host != BackupReplicas.hosts[0] and db_names), remaining_pointer)
+
+    @staticmethod
+    def remove_remaining():
+        try:
+            os.remove(BackupReplicas.remaining_file)
+        except OSError:
+            pass
+
+    @staticmethod
+    def release(config, host, db_name):
+        """(void)
+        The job of db_name on host is done.  Start the slave of host
+        when that was its last database and no other backup runs."""
+        try:
+            remaining_pointer = open(BackupReplicas.remaining_file, 'r+')
+        except IOError:
+            return
+        with remaining_pointer:
+            fcntl.flock(remaining_pointer, fcntl.LOCK_EX)
+            remaining = json.load(remaining_pointer)
+            if db_name not in remaining.get(host, ()):
+                return
+            remaining[host].remove(db_name)
+            last = not remaining[host]
+            if last:
+                del remaining[host]
+            remaining_pointer.seek(0)
+            remaining_pointer.truncate()
+            json.dump(remaining, remaining_pointer)
+        if not last:
+            return
+
+        from run_cache.run_cache_manager import RunningCacheManager
+        if RunningCacheManager(config).get_current_running_count() != 1:
+            BackupReplicas.backup_logger.info("%s has no more databases to dump, but another backup is running. "
+                                              "Leaving its slave stopped.", host, extra={'object': host})
+            return
+        try:
+            Replica(config, host).set_running(True)
+        except SystemError:
+            # The run tries again when it ends
+            pass
@@ -0,0 +1,119 @@
+# Replication
+# What replication applied between two runs.  A run records
+# the slave's position (Executed_Gtid_Set, or the master log
+# file and Exec_Master_Log_Pos) while the slave is stopped
+# for the dumps.  The next run compares it with the current
+# position: when nothing was applied there is nothing new to
+# back up.
+#
+# When the slave writes its own binlog (log_slave_updates)
+# in row format, the row events between the slave's binlog
+# positions of two runs also name every database touched in
+# between, so untouched databases need not be dumped.
+
+import re
+
+# A database that can not be determined from an event
+UNKNOWN = object()
+
+# Events that never change data by themselves.  Row events
+# follow a Table_map naming their table.
+IGNORED_EVENT_TYPES = ('Format_desc', 'Previous_gtids', 'Gtid', 'Anonymous_Gtid', 'Rotate', 'Xid', 'Stop',
+                       'Write_rows', 'Update_rows', 'Delete_rows', 'Write_rows_v1', 'Update_rows_v1',
+                       'Delete_rows_v1', 'Rows_query', 'Heartbeat', 'Intvar', 'Rand', 'User var',
+                       'Transaction_payload')
+
+# Query events that only delimit transactions.  BEGIN stands alone,
+# a compound statement such as BEGIN NOT ATOMIC may change data.
+TRANSACTION_QUERY = re.compile(r'^\s*((BEGIN|COMMIT|ROLLBACK)(\s+WORK)?\s*;?\s*$|'
+                               r'(XA|SAVEPOINT|RELEASE\s+SAVEPOINT|ROLLBACK\s+TO)\s)', re.I)
+
+# name.sequence of a binlog file
+BINLOG_NAME = re.compile(r'^(.*)\.(\d+)$')
+
+TABLE_MAP = re.compile(r'^table_id: \d+ \(`?([^`.]+)`?\.`?[^`)]+`?\)')
+
+
+class ReplicationPosition:
+
+    @staticmethod
+    def get_slave_position(slave_status):
+        """Return: what the slave executed, comparable between runs"""
+        gtid_set = re.sub(r'\s', '', slave_status.get('Executed_Gtid_Set') or '')
+        return (gtid_set, slave_status.get('Relay_Master_Log_File'),
+                int(slave_status.get('Exec_Master_Log_Pos') or 0))
+
+    @staticmethod
+    def get_master_position(slave_status):
+        """Return: (master binlog file, position) the slave executed up to"""
+        return slave_status.get('Relay_Master_Log_File'), int(slave_status.get('Exec_Master_Log_Pos') or 0)
+
+    @staticmethod
+    def compare_master_positions(a, b):
+        """Return: -1, 0 or 1 as master position a is before, at or
+        after b, None when they are in binlogs of different names"""
+        match_a = BINLOG_NAME.match(a[0] or '')
+        match_b = BINLOG_NAME.match(b[0] or '')
+        if not match_a or not match_b or match_a.group(1) != match_b.group(1):
+            return None
+        return cmp((int(match_a.group(2)), a[1]), (int(match_b.group(2)), b[1]))
+
+    @staticmethod
+    def get_binlog_position(cursor):
+        """Return: (file, position) of the server's own binlog or
+        None when binary logging is off"""
+        cursor.execute("SHOW MASTER STATUS;")
+        row = cursor.fetchone()
+        if not row or not row.get('File'):
+            return None
+        return row['File'], int(row['Position'])
+
+    @staticmethod
+    def get_event_database(event):
+        """Return: the database event changes, None when it changes
+        none or UNKNOWN"""
+        event_type = event.get('Event_type')
+        info = event.get('Info') or ''
+        if event_type in IGNORED_EVENT_TYPES:
+            return None
+        if event_type == 'Table_map':
+            match = TABLE_MAP.match(info)
+            return match.group(1) if match else UNKNOWN
+        if event_type == 'Query' and TRANSACTION_QUERY.match(info):
+            return None
+        # Statements and DDL may name any database
+        return UNKNOWN
+
+    @staticmethod
+    def get_touched_databases(cursor, start, end, max_events, page_size=1000):
+        """Read the binlog from start to end, both (file, position).
+        Return: set of the databases touched in between or None when
+        that can not be told, for example because a log was purged,
+        a statement was logged or more than max_events were read."""
+        cursor.execute("SHOW BINARY LOGS;")
+        log_files = [row['Log_name'] for row in cursor.fetchall()]
+        if start[0] not in log_files or end[0] not in log_files:
+            return None
+
+        touched = set()
+        event_count = 0
+        for log_file in log_files[log_files.index(start[0]):log_files.index(end[0]) + 1]:
+            position = start[1] if log_file == start[0] else 4
+            while True:
+                cursor.execute("SHOW BINLOG EVENTS IN %s FROM %s LIMIT %s", (log_file, position, page_size))
+                events = cursor.fetchall()
+                for event in events:
+                    if log_file == end[0] and event['Pos'] >= end[1]:
+                        return touched
+                    db_name = ReplicationPosition.get_event_database(event)
+                    if db_name is UNKNOWN:
+                        return None
+                    if db_name is not None:
+                        touched.add(db_name)
+                    event_count += 1
+                    if event_count > max_events:
+                        return None
+                if len(events) < page_size:
+                    break
+                position = events[-1]['End_log_pos']
+        return touched
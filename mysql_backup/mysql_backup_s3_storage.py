@@ -0,0 +1,260 @@
+# S3 Storage
+# Long term copies in an S3 bucket, or anything speaking
+# the S3 API such as MinIO through endpoint_url.
+#
+# A copy is a multipart upload.  The source is read once;
+# as each part fills it is handed to a pool of upload
+# threads while reading goes on, and the part's md5 and
+# the multipart ETag are computed on the way.  S3 checks
+# each part against its Content-MD5, the completed object's
+# ETag is checked against the one computed here and an
+# upload that fails is aborted, so a partial object is
+# never visible.
+
+import base64
+import calendar
+import errno
+import hashlib
+import math
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from mysql_backup_checksum import MysqlBackupChecksum
+from mysql_backup_long_term_storage import LongTermStorage
+from mysql_backup_throttle import MysqlBackupThrottle
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
+
+# Only required when long_term_storage is s3
+try:
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+
+class S3MultipartUpload(object):
+    """One object being uploaded in parts of part_size bytes.  write()
+    as the data comes, then complete(), or abort() on any failure."""
+
+    def __init__(self, storage, key, part_size):
+        self.storage = storage
+        self.key = key
+        self.part_size = part_size
+        self.client = storage.get_client()
+        kwargs = dict(Bucket=storage.bucket, Key=key)
+        if storage.storage_class:
+            kwargs['StorageClass'] = storage.storage_class
+        self.upload_id = self.client.create_multipart_upload(**kwargs)['UploadId']
+
+        self.buffer = bytearray()
+        self.part_count = 0
+        self.size = 0
+        self.completed = False
+        self.results = list()
+        self.pool = ThreadPool(storage.upload_threads)
+        # Parts read but not yet uploaded, bounds the memory used
+        self.slots = threading.BoundedSemaphore(storage.upload_threads * 2)
+
+    def __str__(self):
+        return self.storage.get_full_name_of_key(self.key)
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.submit(part)
+
+    def submit(self, part):
+        # Stop reading as soon as any part has failed
+        for result in self.results:
+            if result.ready() and not result.successful():
+                result.get()
+        self.slots.acquire()
+        self.part_count += 1
+        self.results.append(self.pool.apply_async(self.upload_part, (self.part_count, part)))
+
+    def upload_part(self, part_number, part):
+        """Return: (part number, ETag, md5 digest of the part)"""
+        try:
+            digest = hashlib.md5(part).digest()
+            response = self.client.upload_part(Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id,
+                                               PartNumber=part_number, Body=part,
+                                               ContentMD5=base64.b64encode(digest))
+            RunMetrics.add('long_term_upload_parts', 1)
+            return part_number, response['ETag'], digest
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        """Return: (ETag computed while uploading, ETag S3 reports)"""
+        # An empty source is still one (empty) part
+        if self.buffer or not self.part_count:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = sorted(result.get() for result in self.results)
+        self.pool.close()
+        self.pool.join()
+
+        response = self.client.complete_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etag}
+                                       for part_number, etag, _ in parts]})
+        self.completed = True
+        expected = '%s-%d' % (hashlib.md5(b''.join(digest for _, _, digest in parts)).hexdigest(), len(parts))
+        return expected, response['ETag'].strip('"')
+
+    def abort(self):
+        """Drop the parts, or the object when it was already completed"""
+        self.pool.terminate()
+        self.pool.join()
+        try:
+            if self.completed:
+                self.client.delete_object(Bucket=self.storage.bucket, Key=self.key)
+            else:
+                self.client.abort_multipart_upload(Bucket=self.storage.bucket, Key=self.key,
+                                                   UploadId=self.upload_id)
+        except (BotoCoreError, ClientError) as e:
+            S3Storage.backup_logger.warning("Could not abort the upload of %s, the bucket's lifecycle rules must "
+                                            "clean it up. %s", self, e, extra={'object': self.storage})
+
+
+class S3Storage(LongTermStorage):
+    """Long term copies are the objects directly under prefix in bucket"""
+
+    backup_logger = None
+
+    # S3's smallest part but for the last
+    min_part_size = 5 * 1024 * 1024
+    # S3's most parts in an upload
+    max_parts = 10000
+
+    def __init__(self, config):
+        if boto3 is None:
+            raise ValueError("long_term_storage s3 requires the boto3 module")
+        if not config.s3_bucket:
+            raise ValueError("long_term_storage s3 requires a bucket")
+        S3Storage.backup_logger = config.get_logger('long_term')
+
+        self.config = config
+        self.bucket = config.s3_bucket
+        prefix = config.s3_prefix
+        self.prefix = prefix.strip('/') + '/' if prefix and prefix.strip('/') else ''
+        self.endpoint_url = config.s3_endpoint_url
+        self.region = config.s3_region
+        self.access_key_id = config.s3_access_key_id
+        self.secret_access_key = config.s3_secret_access_key
+        self.part_size = max(S3Storage.min_part_size, config.s3_part_size or S3Storage.min_part_size)
+        self.upload_threads = max(1, config.s3_upload_threads or 1)
+        self.storage_class = config.s3_storage_class
+
+        # boto3 clients must not cross a fork, one per process
+        self.clients = dict()
+        self.lock = threading.RLock()
+        # object name -> (size, mtime), listed once per run
+        self.objects = None
+
+    def __str__(self):
+        return 's3://%s/%s' % (self.bucket, self.prefix)
+
+    def get_client(self):
+        pid = os.getpid()
+        with self.lock:
+            if pid not in self.clients:
+                self.clients = {pid: boto3.session.Session().client(
+                    's3', endpoint_url=self.endpoint_url, region_name=self.region,
+                    aws_access_key_id=self.access_key_id, aws_secret_access_key=self.secret_access_key)}
+            return self.clients[pid]
+
+    def reset(self):
+        with self.lock:
+            self.objects = None
+
+    def get_full_name(self, file_name):
+        return self.get_full_name_of_key(self.prefix + file_name)
+
+    def get_full_name_of_key(self, key):
+        return 's3://%s/%s' % (self.bucket, key)
+
+    def get_name(self, file_name):
+        """Return: the object name without bucket and prefix"""
+        return file_name[len(self.get_full_name('')):]
+
+    def owns(self, file_name):
+        return file_name.startswith(self.get_full_name('')) and '/' not in self.get_name(file_name)
+
+    def get_objects(self):
+        with self.lock:
+            if self.objects is None:
+                objects = dict()
+                with RunMetrics.timer('directory_scan_seconds'):
+                    paginator = self.get_client().get_paginator('list_objects_v2')
+                    for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter='/'):
+                        for item in page.get('Contents', ()):
+                            objects[item['Key'][len(self.prefix):]] = \
+                                (item['Size'], calendar.timegm(item['LastModified'].utctimetuple()))
+                RunMetrics.add('directory_scans', 1)
+                self.objects = objects
+            return self.objects
+
+    def list_files(self):
+        with self.lock:
+            return [self.get_full_name(name) for name in self.get_objects()]
+
+    def get_entry(self, file_name):
+        return self.get_objects().get(self.get_name(file_name))
+
+    def exists(self, file_name):
+        return self.get_entry(file_name) is not None
+
+    def get_size(self, file_name):
+        entry = self.get_entry(file_name)
+        return entry[0] if entry is not None else 0
+
+    def get_mtime(self, file_name):
+        entry = self.get_entry(file_name)
+        return entry[1] if entry is not None else None
+
+    def get_part_size(self, size):
+        """Return: the part size for a source of size bytes, s3_part_size
+        unless that would take more parts than S3 allows"""
+        return max(self.part_size, int(math.ceil(size / float(S3Storage.max_parts))))
+
+    def put(self, src, file_name, verify=True):
+        """Uploaded parts are always checked against their Content-MD5.
+        With verify, the completed object's ETag must also match."""
+        buffer_size = self.config.checksum_buffer_size or MysqlBackupChecksum.default_buffer_size
+        upload = None
+        try:
+            with RunTrace.span('long_term_upload', file=os.path.basename(file_name)):
+                part_size = self.get_part_size(os.path.getsize(src))
+                upload = S3MultipartUpload(self, self.prefix + self.get_name(file_name), part_size)
+                with open(src, 'rb', 0) as src_pointer:
+                    MysqlBackupThrottle.stream('copy', src_pointer, upload, buffer_size)
+                expected, etag = upload.complete()
+                if verify and expected != etag:
+                    raise RuntimeError("Verification of the long term upload of %s failed, ETag %s, expected %s."
+                                       % (src, etag, expected))
+        except (IOError, OSError, BotoCoreError, ClientError, RuntimeError) as e:
+            if upload is not None:
+                upload.abort()
+            if isinstance(e, RuntimeError):
+                raise
+            raise RuntimeError("Uploading %s to %s failed. %s" % (src, file_name, e))
+
+        RunMetrics.add('long_term_upload_bytes', upload.size)
+        with self.lock:
+            if self.objects is not None:
+                self.objects[self.get_name(file_name)] = (upload.size, time.time())
+
+    def remove(self, file_name):
+        try:
+            self.get_client().delete_object(Bucket=self.bucket, Key=self.prefix + self.get_name(file_name))
+        except (BotoCoreError, ClientError) as e:
+            raise OSError(errno.EIO, "Removing %s failed. %s" % (file_name, e))
+        with self.lock:
+            if self.objects is not None:
+                self.objects.pop(self.get_name(file_name), None)
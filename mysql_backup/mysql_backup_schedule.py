@@ -0,0 +1,141 @@
+# Schedule
+# Learns, per database, how often successive dumps differ
+# and how large they are, and from that how long to wait
+# before the next attempt.  A database whose dumps usually
+# change is attempted as often as adaptive_min allows, one
+# whose dumps are usually thrown away for matching the
+# previous checksum backs off towards adaptive_max.  The
+# learned state is kept in the running cache between runs.
+
+import time
+from run_metrics.run_metrics import RunMetrics
+
+
+class BackupSchedule:
+    """stats maps a database to a dict of
+        change_ratio: smoothed fraction of attempts whose dump differed
+        size_bytes: smoothed size of a dump
+        attempts: attempts observed
+        interval_seconds: how long to wait after the youngest backup
+        last_attempt: unix time of the last observed attempt"""
+
+    backup_logger = None
+
+    config = None
+    enabled = False
+    min_seconds = None
+    max_seconds = None
+    max_dump_bytes_per_day = None
+
+    # Weight of the newest attempt in the smoothed values
+    smoothing = 0.3
+
+    stats = dict()
+
+    @staticmethod
+    def configure(config):
+        BackupSchedule.backup_logger = config.get_logger('schedule')
+        min_seconds = config.adaptive_min_backup_frequency_seconds
+        max_seconds = config.adaptive_max_backup_frequency_seconds
+        if config.adaptive_frequency and (min_seconds is None or max_seconds is None or min_seconds > max_seconds):
+            raise ValueError("adaptive_frequency requires adaptive_min_backup_frequency_seconds no larger than "
+                             "adaptive_max_backup_frequency_seconds")
+        BackupSchedule.config = config
+        BackupSchedule.enabled = config.adaptive_frequency
+        BackupSchedule.min_seconds = min_seconds
+        BackupSchedule.max_seconds = max_seconds
+        BackupSchedule.max_dump_bytes_per_day = config.adaptive_max_dump_bytes_per_day
+        BackupSchedule.stats = dict()
+
+    @staticmethod
+    def load(stats):
+        """Start from the stats saved by earlier runs"""
+        BackupSchedule.stats = dict((db_name, dict(entry)) for db_name, entry in (stats or {}).items())
+
+    @staticmethod
+    def get_stats():
+        return BackupSchedule.stats
+
+    @staticmethod
+    def get_min_frequency_seconds():
+        """Return: the smallest allowed time between two backups of a database"""
+        if BackupSchedule.enabled:
+            return BackupSchedule.min_seconds
+        return BackupSchedule.config.incremental_min_backup_frequency_seconds
+
+    @staticmethod
+    def get_interval(db_name):
+        """Return: seconds to wait after db_name's youngest backup before
+        the next attempt, None for no wait.  Databases not seen before
+        start at the lower bound."""
+        if not BackupSchedule.enabled:
+            return BackupSchedule.config.incremental_min_backup_frequency_seconds
+        entry = BackupSchedule.stats.get(db_name)
+        if entry is None:
+            return BackupSchedule.min_seconds
+        # Bounds may have changed since the entry was learned
+        return BackupSchedule.get_learned_interval(entry)
+
+    @staticmethod
+    def get_dump_size(db_name):
+        """Return: the smoothed size of db_name's dumps, None when not known"""
+        entry = BackupSchedule.stats.get(db_name)
+        return (entry['size_bytes'] or None) if entry else None
+
+    @staticmethod
+    def get_learned_interval(entry):
+        """Return: the interval for entry within the configured bounds.
+        Intervals shrink linearly with the change ratio and are never
+        so short that a database dumps more than max_dump_bytes_per_day."""
+        if BackupSchedule.min_seconds is None or BackupSchedule.max_seconds is None:
+            return None
+        interval = BackupSchedule.max_seconds - \
+            (BackupSchedule.max_seconds - BackupSchedule.min_seconds) * entry['change_ratio']
+        if BackupSchedule.max_dump_bytes_per_day:
+            interval = max(interval, entry['size_bytes'] * 86400.0 / BackupSchedule.max_dump_bytes_per_day)
+        return int(min(BackupSchedule.max_seconds, max(BackupSchedule.min_seconds, interval)))
+
+    @staticmethod
+    def record(db_name, changed, size_bytes, now=None):
+        """Fold the outcome of one attempt into db_name's stats"""
+        now = now or int(time.time())
+        entry = BackupSchedule.stats.get(db_name)
+        if entry is None:
+            entry = {'change_ratio': 1.0 if changed else 0.0, 'size_bytes': size_bytes or 0, 'attempts': 0}
+        else:
+            alpha = BackupSchedule.smoothing
+            entry['change_ratio'] = (1 - alpha) * entry['change_ratio'] + alpha * (1.0 if changed else 0.0)
+            if size_bytes:
+                entry['size_bytes'] = int((1 - alpha) * entry['size_bytes'] + alpha * size_bytes)
+        entry['attempts'] += 1
+        entry['last_attempt'] = now
+        entry['interval_seconds'] = BackupSchedule.get_learned_interval(entry)
+        BackupSchedule.stats[db_name] = entry
+
+    @staticmethod
+    def record_run(database_values, now=None):
+        """Record the attempts in a run's per database metrics"""
+        for db_name, values in database_values.items():
+            if values.get('dump_attempts'):
+                BackupSchedule.record(db_name, values.get('dumps_changed', 0) > 0, values.get('dump_bytes'), now)
+
+    @staticmethod
+    def export_metrics():
+        """Show the learned state in the run report and textfile"""
+        for db_name, entry in BackupSchedule.stats.items():
+            if not BackupSchedule.config.is_database_in_scope(db_name):
+                continue
+            RunMetrics.set('schedule_change_ratio', entry['change_ratio'], db_name=db_name)
+            RunMetrics.set('schedule_dump_size_bytes', entry['size_bytes'], db_name=db_name)
+            if BackupSchedule.enabled:
+                RunMetrics.set('schedule_interval_seconds', BackupSchedule.get_interval(db_name), db_name=db_name)
+
+    @staticmethod
+    def prune(max_age_seconds, now=None):
+        """Forget databases not attempted for max_age_seconds"""
+        if max_age_seconds is None:
+            return
+        now = now or int(time.time())
+        for db_name in [db_name for db_name, entry in BackupSchedule.stats.items()
+                        if now - entry.get('last_attempt', now) > max_age_seconds]:
+            del BackupSchedule.stats[db_name]
@@ -0,0 +1,277 @@
+# Segments
+# With table_level_incremental a backup is a manifest of
+# dump segments, one per table plus one of the database's
+# routines and events.  A table is only dumped again when
+# its fingerprint (update time, row count and optionally
+# CHECKSUM TABLE) changed since the previous backup; else
+# the new manifest refers to the previous backup's segment.
+# Every manifest is so still a full backup, and a segment
+# is shared by every manifest referring to it.
+#
+# Segments live in segments/<database>/ under the
+# incremental path, named <date>.<table>.sql for the backup
+# that dumped them.  MySQL table names hold no '.'.  A
+# segment is only removed once no manifest refers to it.
+
+import errno
+import json
+import mysql_backup
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from mysql_backup_checksum import MysqlBackupChecksum
+from mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup_job_retry import DumpFailedError
+from mysql_backup_page_cache import PageCache
+from mysql_backup_replicas import BackupReplicas
+from mysql_backup_throttle import MysqlBackupThrottle
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
+
+SEGMENT_DIRECTORY = 'segments'
+MANIFEST_EXTENSION = 'manifest'
+MANIFEST_VERSION = 1
+
+# Unreferenced segments younger than this may belong to a backup
+# being written, cleanup_delay_days overrides it when set
+SWEEP_MIN_AGE_SECONDS = 86400
+
+
+class TableSegments:
+
+    @staticmethod
+    def get_directory(config, db_name):
+        """Return: the segment directory of db_name, created when missing"""
+        directory = os.path.join(config.incremental_path, SEGMENT_DIRECTORY, db_name)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return directory
+
+    @staticmethod
+    def get_path(config, db_name, segment_file):
+        return os.path.join(config.incremental_path, SEGMENT_DIRECTORY, db_name, segment_file)
+
+    # Fingerprints
+
+    @staticmethod
+    def get_fingerprints(config, db_name):
+        """Return: OrderedDict of table -> fingerprint, a list that is
+        the same as long as the table did not change, or None for
+        tables (views) that can not be told and are always dumped."""
+        connection = mysql_backup.MysqlBackup.connect(config, db_name)
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT TABLE_NAME, TABLE_TYPE, UPDATE_TIME, TABLE_ROWS FROM information_schema.TABLES "
+                           "WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME;", (db_name,))
+            fingerprints = OrderedDict()
+            for row in cursor.fetchall():
+                if row['TABLE_TYPE'] != 'BASE TABLE':
+                    fingerprints[row['TABLE_NAME']] = None
+                else:
+                    update_time = row['UPDATE_TIME']
+                    fingerprints[row['TABLE_NAME']] = [str(update_time) if update_time is not None else None,
+                                                       row['TABLE_ROWS']]
+
+            if config.table_checksum:
+                tables = [table for table, fingerprint in fingerprints.items() if fingerprint is not None]
+                # One statement per hundred tables keeps the statements short
+                for start in range(0, len(tables), 100):
+                    cursor.execute("CHECKSUM TABLE %s;" % ', '.join('`%s`' % table.replace('`', '``')
+                                                                      for table in tables[start:start + 100]))
+                    for row in cursor.fetchall():
+                        table = row['Table'].split('.', 1)[1]
+                        if table in fingerprints and fingerprints[table] is not None:
+                            fingerprints[table].append(row['Checksum'])
+            cursor.close()
+        finally:
+            connection.close()
+
+        # Without a checksum, a table never updated since the server
+        # started has no update time to compare
+        for table, fingerprint in fingerprints.items():
+            if fingerprint is not None and not config.table_checksum and fingerprint[0] is None:
+                fingerprints[table] = None
+        return fingerprints
+
+    # Dumping
+
+    @staticmethod
+    @RunTrace.traced('TableSegments.dump')
+    def dump(config, db_name, date_string, table, fingerprint):
+        """Dump one table, or with table None the routines and events,
+        compressed when compression is enabled.
+        return: the manifest entry of the segment"""
+        directory = TableSegments.get_directory(config, db_name)
+        if table is None:
+            segment_file = date_string + '-routines.sql'
+            options = ['--no-create-info', '--no-data', '--skip-triggers']
+        else:
+            segment_file = '%s.%s.sql' % (date_string, table)
+            options = ['--skip-routines', '--skip-events', table]
+        command = [config.mysqldump_command, '-u', config.mysql_username] + BackupReplicas.get_dump_options() + \
+            [db_name] + config.mysql_dump_options.split() + options
+
+        os.environ['MYSQL_PWD'] = config.mysql_password
+        hash_obj = MysqlBackupChecksum.new_hash(config.checksum_algorithm)
+        segment_path = os.path.join(directory, segment_file)
+        stderr_pointer = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_pointer, close_fds=True)
+        try:
+            with PageCache.open_output(segment_path) as dump_pointer:
+                size = MysqlBackupThrottle.stream('dump', process.stdout, dump_pointer, config.checksum_buffer_size,
+                                                  hash_obj)
+        except Exception:
+            exc_info = sys.exc_info()
+            process.kill()
+            process.wait()
+            BackupDirectorySnapshot.remove(segment_path)
+            stderr_pointer.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        process.wait()
+        with stderr_pointer:
+            stderr = DumpFailedError.read_stderr(stderr_pointer)
+        if process.returncode != 0:
+            BackupDirectorySnapshot.remove(segment_path)
+            raise DumpFailedError("Something went wrong while trying to backup %s of %s"
+                                  % (table or 'routines', db_name), process.returncode, stderr)
+        BackupDirectorySnapshot.add(segment_path)
+        RunMetrics.add('segments_dumped', 1, db_name=db_name)
+        RunMetrics.add('dump_bytes', size, db_name=db_name)
+
+        if config.compression_enabled:
+            segment_file = TableSegments.compress(config, db_name, segment_path)
+
+        return {
+            'table': table,
+            'fingerprint': fingerprint,
+            'file': segment_file,
+            'checksum': MysqlBackupChecksum.format_checksum(config.checksum_algorithm, hash_obj.hexdigest()),
+        }
+
+    @staticmethod
+    def compress(config, db_name, segment_path):
+        """Compress the segment with compress_command, throttled as the
+        compress stage, and remove the uncompressed one.
+        return: the compressed segment's file name"""
+        compressed_path = segment_path + '.' + config.compressed_file_extension
+        stderr_pointer = tempfile.TemporaryFile()
+        process = subprocess.Popen(config.compress_command.split() + ['-c', segment_path], stdout=subprocess.PIPE,
+                                   stderr=stderr_pointer, close_fds=True)
+        try:
+            with PageCache.open_output(compressed_path) as compressed_pointer:
+                MysqlBackupThrottle.stream('compress', process.stdout, compressed_pointer,
+                                           config.checksum_buffer_size)
+        except Exception:
+            exc_info = sys.exc_info()
+            process.kill()
+            process.wait()
+            BackupDirectorySnapshot.remove(compressed_path)
+            BackupDirectorySnapshot.remove(segment_path)
+            stderr_pointer.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        process.wait()
+        with stderr_pointer:
+            stderr = DumpFailedError.read_stderr(stderr_pointer).strip()
+        if process.returncode != 0:
+            BackupDirectorySnapshot.remove(compressed_path)
+            BackupDirectorySnapshot.remove(segment_path)
+            msg = "Something went wrong while trying to compress %s" % segment_path
+            if stderr:
+                msg = "%s. %s" % (msg, stderr)
+            raise RuntimeError(msg)
+        BackupDirectorySnapshot.add(compressed_path)
+        BackupDirectorySnapshot.remove(segment_path)
+        RunMetrics.add('compressed_bytes', os.path.getsize(compressed_path), db_name=db_name)
+        return os.path.basename(compressed_path)
+
+    @staticmethod
+    def get_instance_checksum(config, segments):
+        """Return: the checksum of a manifest's backup, equal for two
+        manifests exactly when every segment's content is"""
+        hash_obj = MysqlBackupChecksum.new_hash(config.checksum_algorithm)
+        for segment in sorted(segments, key=lambda segment: segment['table']):
+            hash_obj.update('%s\0%s\n' % (segment['table'] or '', segment['checksum']))
+        return MysqlBackupChecksum.format_checksum(config.checksum_algorithm, hash_obj.hexdigest())
+
+    # Manifests
+
+    @staticmethod
+    def write_manifest(manifest, manifest_name):
+        """Write manifest so it is either whole or missing"""
+        with open(manifest_name + '.tmp', 'w') as manifest_pointer:
+            json.dump(manifest, manifest_pointer, separators=(',', ':'))
+        os.rename(manifest_name + '.tmp', manifest_name)
+
+    @staticmethod
+    def read_manifest(manifest_name):
+        """return: the manifest, raises ValueError when it can not be used"""
+        with open(manifest_name) as manifest_pointer:
+            manifest = json.load(manifest_pointer)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError("%s is a manifest of version %s, expected %s"
+                             % (manifest_name, manifest.get('version'), MANIFEST_VERSION))
+        return manifest
+
+    # Long term copies
+
+    @staticmethod
+    def assemble(config, db_name, segments, dst):
+        """Write the segments one after another to dst, a full dump.
+        Concatenated bzip2 and gzip streams decompress as one, so
+        compressed segments are not decompressed for it."""
+        compressed = set(segment['file'].endswith('.' + config.compressed_file_extension) for segment in segments)
+        if len(compressed) > 1:
+            raise RuntimeError("The segments of %s were not all compressed alike, it can not be assembled." % dst)
+        size = sum(BackupDirectorySnapshot.get_size(TableSegments.get_path(config, db_name, segment['file'])) or 0
+                   for segment in segments)
+        with RunTrace.span('assemble_segments', db=db_name), PageCache.open_output(dst, size) as dst_pointer:
+            for segment in segments:
+                with open(TableSegments.get_path(config, db_name, segment['file']), 'rb', 0) as segment_pointer:
+                    MysqlBackupThrottle.stream('copy', segment_pointer, dst_pointer, config.checksum_buffer_size)
+        return compressed.pop() if compressed else False
+
+    # Cleaning up
+
+    @staticmethod
+    def sweep(config, db_name, references, min_age_seconds, now):
+        """Return: segments of db_name no manifest refers to that are
+        older than min_age_seconds, left behind by interrupted runs"""
+        directory = TableSegments.get_directory(config, db_name)
+        leftovers = list()
+        for segment_path in BackupDirectorySnapshot.list_files(directory):
+            mtime = BackupDirectorySnapshot.get_mtime(segment_path)
+            if references.get(os.path.basename(segment_path), 0) == 0 and mtime is not None and \
+                    now - mtime > min_age_seconds:
+                leftovers.append(segment_path)
+        return leftovers
+
+
+class SegmentReferences(object):
+    """How many manifests of a database refer to each of its segments"""
+
+    def __init__(self):
+        self.counts = dict()
+
+    def get(self, segment_file, default=0):
+        return self.counts.get(segment_file, default)
+
+    def add(self, segment_files):
+        for segment_file in segment_files:
+            self.counts[segment_file] = self.counts.get(segment_file, 0) + 1
+
+    def release(self, segment_files):
+        """Return: the segments no manifest refers to anymore"""
+        unreferenced = list()
+        for segment_file in segment_files:
+            count = self.counts.get(segment_file, 0) - 1
+            if count <= 0:
+                self.counts.pop(segment_file, None)
+                unreferenced.append(segment_file)
+            else:
+                self.counts[segment_file] = count
+        return unreferenced
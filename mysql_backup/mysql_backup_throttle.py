@@ -0,0 +1,252 @@
+# Throttle
+# Keeps backup I/O from starving replication on the slave.
+# Streaming writes of the dump, compression and copy stages
+# pass through per stage token buckets, the backup processes
+# and their children run with a lowered CPU and I/O priority
+# and an optional CPU affinity, and in adaptive mode every
+# rate backs off while Seconds_Behind_Master grows.  The lag
+# is only known while the slave replicates, which it does
+# while a run reconciles its backups; the dumps are made with
+# it stopped, at the full rates.  psutil is only imported
+# when a priority is configured.
+
+import multiprocessing
+import os
+import threading
+import time
+from run_metrics.run_metrics import RunMetrics
+
+STAGES = ('dump', 'compress', 'copy')
+
+
+class TokenBucket(object):
+    """rate bytes per second, allowing bursts of up to burst bytes.
+    A write larger than what is available goes into debt and the
+    next caller waits it off."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count, factor=1.0):
+        """Return: seconds slept"""
+        rate = self.rate * factor
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= count
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class MysqlBackupThrottle:
+    """Process wide throttle settings, set from the run's config"""
+
+    backup_logger = None
+
+    # stage -> bytes per second, None = unlimited.  Each worker
+    # process has its own buckets so the limit is per stream.
+    rates = dict()
+    buckets = dict()
+
+    nice = None
+    ionice = None
+    cpu_affinity = None
+
+    adaptive = False
+    adaptive_max_lag_seconds = 60
+    adaptive_min_fraction = 0.1
+    adaptive_check_interval_seconds = 10
+
+    # Shared with forked workers: the fraction of each rate in use.
+    # Spawned workers configure their own and keep their full rates.
+    factor = None
+    monitor = None
+    monitor_stop = None
+
+    @staticmethod
+    def configure(config):
+        MysqlBackupThrottle.backup_logger = config.get_logger('throttle')
+        MysqlBackupThrottle.rates = dict((stage, rate) for stage, rate in config.throttle_rates if rate)
+        MysqlBackupThrottle.buckets = dict()
+        MysqlBackupThrottle.nice = config.throttle_nice
+        MysqlBackupThrottle.ionice = MysqlBackupThrottle.parse_ionice(config.throttle_ionice)
+        MysqlBackupThrottle.cpu_affinity = MysqlBackupThrottle.parse_cpu_list(config.throttle_cpu_affinity)
+        MysqlBackupThrottle.adaptive = config.throttle_adaptive
+        MysqlBackupThrottle.adaptive_max_lag_seconds = config.throttle_adaptive_max_lag_seconds
+        MysqlBackupThrottle.adaptive_min_fraction = config.throttle_adaptive_min_fraction
+        MysqlBackupThrottle.adaptive_check_interval_seconds = config.throttle_adaptive_check_interval_seconds
+        MysqlBackupThrottle.factor = multiprocessing.Value('d', 1.0, lock=False)
+
+    @staticmethod
+    def parse_ionice(ionice):
+        """input: idle, best-effort[:level] or realtime[:level]
+        return: (psutil io class, level or None) or None"""
+        if not ionice:
+            return None
+        import psutil
+        classes = {
+            'idle': psutil.IOPRIO_CLASS_IDLE,
+            'best-effort': psutil.IOPRIO_CLASS_BE,
+            'realtime': psutil.IOPRIO_CLASS_RT,
+        }
+        name, _, level = ionice.strip().partition(':')
+        if name not in classes:
+            raise ValueError("ionice must be one of %s, optionally followed by :level" % ', '.join(sorted(classes)))
+        if name == 'idle':
+            return classes[name], None
+        return classes[name], int(level) if level else None
+
+    @staticmethod
+    def parse_cpu_list(cpu_list):
+        """input: 0,2,4-7
+        return: sorted list of cpu numbers or None"""
+        if not cpu_list:
+            return None
+        cpus = set()
+        for part in cpu_list.split(','):
+            part = part.strip()
+            if '-' in part:
+                first, last = part.split('-', 1)
+                cpus.update(range(int(first), int(last) + 1))
+            elif part:
+                cpus.add(int(part))
+        return sorted(cpus)
+
+    # Priority
+
+    @staticmethod
+    def apply_process_priority():
+        """(void)
+        Lower this process's priority.  Workers forked afterwards and
+        every child they start (mysqldump, the compressor) inherit it."""
+        if MysqlBackupThrottle.nice is None and MysqlBackupThrottle.ionice is None and \
+                not MysqlBackupThrottle.cpu_affinity:
+            return
+        import psutil
+        process = psutil.Process()
+        if MysqlBackupThrottle.nice is not None:
+            process.nice(MysqlBackupThrottle.nice)
+        if MysqlBackupThrottle.ionice is not None:
+            ioclass, level = MysqlBackupThrottle.ionice
+            if level is None:
+                process.ionice(ioclass)
+            else:
+                process.ionice(ioclass, level)
+        if MysqlBackupThrottle.cpu_affinity:
+            process.cpu_affinity(MysqlBackupThrottle.cpu_affinity)
+        MysqlBackupThrottle.backup_logger.info(
+            "Backup processes run with nice %s, ionice %s and cpu affinity %s.",
+            MysqlBackupThrottle.nice, MysqlBackupThrottle.ionice, MysqlBackupThrottle.cpu_affinity,
+            extra={'object': 'throttle'})
+
+    # Bandwidth
+
+    @staticmethod
+    def get_factor():
+        if MysqlBackupThrottle.factor is None:
+            return 1.0
+        return MysqlBackupThrottle.factor.value
+
+    @staticmethod
+    def throttle(stage, byte_count):
+        """(void)
+        Account for byte_count bytes written by stage, sleeping as
+        needed to keep under the stage's rate"""
+        rate = MysqlBackupThrottle.rates.get(stage)
+        if not rate:
+            return
+        # Buckets are per process; forked workers start their own
+        key = (stage, os.getpid())
+        bucket = MysqlBackupThrottle.buckets.get(key)
+        if bucket is None:
+            bucket = MysqlBackupThrottle.buckets.setdefault(key, TokenBucket(rate))
+        waited = bucket.consume(byte_count, MysqlBackupThrottle.get_factor())
+        if waited:
+            RunMetrics.add('throttle_wait_seconds', waited)
+
+    @staticmethod
+    def is_throttled(stage):
+        return bool(MysqlBackupThrottle.rates.get(stage))
+
+    @staticmethod
+    def stream(stage, src_pointer, dst_pointer, buffer_size, hash_obj=None):
+        """Copy src_pointer to dst_pointer through one reusable buffer,
+        throttled as stage and optionally hashed on the way.
+        return: bytes copied"""
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        total = 0
+        while True:
+            bytes_read = src_pointer.readinto(buf)
+            if not bytes_read:
+                break
+            if hash_obj is not None:
+                hash_obj.update(view[:bytes_read])
+            MysqlBackupThrottle.throttle(stage, bytes_read)
+            dst_pointer.write(view[:bytes_read])
+            total += bytes_read
+        return total
+
+    # Adaptive mode
+
+    @staticmethod
+    def adjust(lag):
+        """Halve the rates while lag exceeds adaptive_max_lag_seconds,
+        double them back once it is under half of that.  An unknown
+        lag, as when the slave is stopped, changes nothing."""
+        if lag is None or MysqlBackupThrottle.factor is None:
+            return
+        factor = MysqlBackupThrottle.factor.value
+        if lag > MysqlBackupThrottle.adaptive_max_lag_seconds:
+            new_factor = max(MysqlBackupThrottle.adaptive_min_fraction, factor / 2)
+        elif lag <= MysqlBackupThrottle.adaptive_max_lag_seconds / 2.0:
+            new_factor = min(1.0, factor * 2)
+        else:
+            new_factor = factor
+        if new_factor != factor:
+            MysqlBackupThrottle.factor.value = new_factor
+            MysqlBackupThrottle.backup_logger.info("Seconds_Behind_Master is %s, backup I/O rates now at %d%%.",
+                                                   lag, new_factor * 100, extra={'object': 'throttle'})
+            if new_factor < factor:
+                RunMetrics.add('throttle_backoffs', 1)
+
+    @staticmethod
+    def start_adaptive(get_lag):
+        """Sample get_lag() now and every adaptive_check_interval_seconds
+        on a thread of this process, for a phase of the run during which
+        the slave replicates.  get_lag must use its own connection."""
+        if not MysqlBackupThrottle.adaptive or not MysqlBackupThrottle.rates:
+            return
+        MysqlBackupThrottle.monitor_stop = threading.Event()
+
+        def monitor():
+            while True:
+                try:
+                    MysqlBackupThrottle.adjust(get_lag())
+                except Exception as e:
+                    MysqlBackupThrottle.backup_logger.warning("Could not read Seconds_Behind_Master. %s", e,
+                                                              extra={'object': 'throttle'})
+                if MysqlBackupThrottle.monitor_stop.wait(MysqlBackupThrottle.adaptive_check_interval_seconds):
+                    break
+
+        MysqlBackupThrottle.monitor = threading.Thread(target=monitor, name="replication lag monitor")
+        MysqlBackupThrottle.monitor.daemon = True
+        MysqlBackupThrottle.monitor.start()
+
+    @staticmethod
+    def stop_adaptive():
+        """(void)
+        Stop sampling and go back to the full rates, the lag of a
+        stopped slave says nothing about what the backup may write"""
+        if MysqlBackupThrottle.monitor is not None:
+            MysqlBackupThrottle.monitor_stop.set()
+            MysqlBackupThrottle.monitor.join()
+            MysqlBackupThrottle.monitor = None
+            MysqlBackupThrottle.factor.value = 1.0
@@ -4,24 +4,46 @@
 # and removing instances.
 
 import mysql_backup
-from mysql_backup_instance import MysqlBackupInstance
+from mysql_backup_instance import MysqlBackupInstance, FilesBeingWrittenError
+from mysql_backup_deletion_pool import DeletionPool
+from mysql_backup_open_files import OpenFiles
+from mysql_backup_schedule import BackupSchedule
+from mysql_backup_segments import SegmentReferences, TableSegments, SWEEP_MIN_AGE_SECONDS
+from mysql_retention_planner import RetentionColumns, RetentionPlanner, RetentionExecutor, DELETE
 from operator import methodcaller
+import time
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
 
 
 class MysqlDbInstance:
 
     backup_logger = None
 
-    def __init__(self, db_name, mysql_backup_instances=(), valid=None):
+    def __init__(self, config, db_name, mysql_backup_instances=(), valid=None):
 
-        MysqlDbInstance.backup_logger = mysql_backup.mysql_backup.MysqlBackup.backup_logger
+        MysqlDbInstance.backup_logger = config.get_logger('database')
 
+        self.config = config
         self.mysql_backup_instances = list(mysql_backup_instances)
         self.db_name = db_name
 
         # Is the database valid (ie. The underlying database exists)
         self.valid = valid
 
+        # Nothing touched the database since its youngest backup
+        self.unchanged = False
+
+        # The replica dumped from when the run fans out, see mysql_backup_replicas
+        self.replica = None
+
+        # (instance, error) of the instances dropped since the last reconcile
+        self.forgotten = list()
+
+        # Seconds to wait after the youngest backup, decided by the
+        # schedule of the process creating this, which is the run's
+        self.backup_interval = BackupSchedule.get_interval(db_name)
+
     def __str__(self):
         return self.db_name
 
@@ -38,9 +60,9 @@ class MysqlDbInstance:
             self.set_correct_state()
         else:
             # What we should be doing when the database no longer exists but some files were left hanging around.
-            if mysql_backup.MysqlBackup.cleanup_delay_days is not None:
-                age_in_days = self.get_age_secs() * 86400
-                if age_in_days > mysql_backup.MysqlBackup.cleanup_delay_days:
+            if self.config.cleanup_delay_days is not None:
+                age_in_days = self.get_age_secs() / 86400.0
+                if age_in_days > self.config.cleanup_delay_days:
                     msg = "This databse is not valid and exceeds the configured amount of time to preserve. Removing."
                     MysqlBackupInstance.backup_logger.debug(msg, extra={'object': self})
                     self.self_destruct()
@@ -68,6 +90,70 @@ class MysqlDbInstance:
                 my_youngest_instance = mbi
         return my_youngest_instance
 
+    def hydrate_instances_needing_attention(self):
+        """Validate only the instances whose file names show they are
+        incomplete or in the wrong compression state.  Those failing
+        validation are no longer managed."""
+        for mbi in self.mysql_backup_instances[:]:
+            if mbi.needs_hydration():
+                self.hydrate_or_forget(mbi)
+
+    def hydrate_or_forget(self, mbi):
+        """Return: True if mbi validated, otherwise it is dropped from
+        the managed instances and False is returned."""
+        try:
+            mbi.hydrate()
+        except RuntimeError as e:
+            # Reported together by reconcile
+            MysqlDbInstance.backup_logger.debug("%s: %s could not be validated and is no longer managed. %s",
+                                                self, mbi, e, extra={'object': self})
+            self.forgotten.append((mbi, e))
+            self.mysql_backup_instances = [bkinst for bkinst in self.mysql_backup_instances if bkinst is not mbi]
+            return False
+        return True
+
+    def reconcile(self):
+        """Validate the instances needing attention and the youngest,
+        the one a new backup is compared with, sharing one open file
+        scan.  Safe to call on a thread of its own, one per database.
+        return: dict of 'validated', the number of instances validated,
+        and 'being_written' and 'self_destructed', the names of the
+        instances no longer managed since the last call"""
+        hydrated_before = set(id(mbi) for mbi in self.mysql_backup_instances if mbi.hydrated)
+        with OpenFiles.shared():
+            self.hydrate_instances_needing_attention()
+            self.get_youngest_hydrated_instance()
+        forgotten, self.forgotten = self.forgotten, list()
+
+        result = {
+            'validated': len([mbi for mbi in self.mysql_backup_instances
+                              if mbi.hydrated and id(mbi) not in hydrated_before]),
+            'being_written': [str(mbi) for mbi, e in forgotten if isinstance(e, FilesBeingWrittenError)],
+            'self_destructed': [str(mbi) for mbi, e in forgotten if not isinstance(e, FilesBeingWrittenError)],
+        }
+        RunMetrics.add('instances_validated', result['validated'], db_name=self.db_name)
+        RunMetrics.add('instances_being_written', len(result['being_written']), db_name=self.db_name)
+        RunMetrics.add('instances_self_destructed', len(result['self_destructed']), db_name=self.db_name)
+        return result
+
+    def log_reconciliation(self, result):
+        if result['being_written']:
+            MysqlDbInstance.backup_logger.warning("%s: %d backups are still being written and were left alone: %s",
+                                                  self, len(result['being_written']),
+                                                  ', '.join(result['being_written']), extra={'object': self})
+        if result['self_destructed']:
+            MysqlDbInstance.backup_logger.warning("%s: %d backups could not be validated, self destructed and are no "
+                                                  "longer managed: %s", self, len(result['self_destructed']),
+                                                  ', '.join(result['self_destructed']), extra={'object': self})
+
+    def get_youngest_hydrated_instance(self):
+        """Returns the youngest backup instance that validates or None.
+        Instances failing validation are dropped along the way."""
+        for mbi in self.get_instances_from_youngest_to_oldest():
+            if self.hydrate_or_forget(mbi):
+                return mbi
+        return None
+
     def get_youngest_long_term_backup(self):
         my_youngest_long_term_backup = None
         for mbi in self.mysql_backup_instances:
@@ -97,217 +183,207 @@ class MysqlDbInstance:
         age, youngest to oldest"""
         return sorted(self.mysql_backup_instances, key=methodcaller('get_age_secs'), reverse=False)
 
+    @RunTrace.traced('set_correct_state')
     def set_correct_state(self):
-        self.set_correct_short_term_state()
-        self.set_correct_long_term_state()
+        """Plan the short and long term state of every instance in
+        one pass, then apply the plan.  With retention_dry_run the
+        plan is only logged."""
 
-    def get_current_long_term_count(self):
-        lt_count = 0
-        for instance in self.mysql_backup_instances:
-            if instance.is_a_long_term_version():
-                lt_count += 1
-        return lt_count
-
-    def get_most_recent_lt_age(self):
-        for instance in self.get_instances_from_youngest_to_oldest():
-            if instance.is_a_long_term_version():
-                return instance.get_age_secs()
-        return None
-
-    def set_correct_long_term_state(self):
-        """This does not likely need called directly.  Use set_correct_state.
-        This will check criteria and set the correct long term backup status of a
-        database."""
+        # Usually done by the run before any database was processed
+        self.log_reconciliation(self.reconcile())
 
-        if self.get_youngest_instance() is None:
-            # No backups available, just return.
+        # The youngest is the only promotion candidate, made sure it is sound
+        if self.get_youngest_hydrated_instance() is None:
+            # No backups exist, just return
+            MysqlDbInstance.backup_logger.info("%s: No backups exist.  Nothing to do when setting the correct state.",
+                                               self, extra={'object': self})
             return None
 
-        # Are long term backups even allowed
-        if mysql_backup.MysqlBackup.long_term_backup_max_copies is None or \
-           mysql_backup.MysqlBackup.long_term_backup_max_copies != 0:
-
-            # Okay to shift the stack?
-            make_youngest_new_lt = False
-            # First off, is the current youngest already the long term?
-            if not self.get_youngest_instance().is_a_long_term_version():
-                # Has enough time passed between the last long term and this one?
-                if self.get_most_recent_lt_age() is None or \
-                   (mysql_backup.MysqlBackup.long_term_backup_min_frequency_seconds <
-                   (self.get_most_recent_lt_age() - self.get_youngest_instance().get_age_secs())):
-                    make_youngest_new_lt = True
-                    MysqlDbInstance.backup_logger.info("%s: Enough time has passed between the last long term copy and "
-                                                       "this one." % self, extra={'object': self})
-                else:
-                    make_youngest_new_lt = False
-                    MysqlDbInstance.backup_logger.info("Not enough time has passed between the last long term copy and "
-                                                       "this one. Per configuration, the latest version should not be "
-                                                       "made a long term version.", extra={'object': self})
-            else:
-                make_youngest_new_lt = True
-                MysqlDbInstance.backup_logger.info("%s: The newest backup is already the long term backup version."
-                                                   % self, extra={'object': self})
-
-            if make_youngest_new_lt:
-                self.get_youngest_instance().set_as_long_term_version(lt_state=make_youngest_new_lt)
-                MysqlDbInstance.backup_logger.info("%s: Created or ensured this instance was a long term backup copy."
-                                                   % self, extra={'object': self})
-            else:
-                MysqlDbInstance.backup_logger.info("%s: Not creating a new long term backup copy" % self,
-                                                   extra={'object': self})
-
-            # Now to enforcing all requirements
-            lt_instance_count = 0
-            last_instance_age = None
-            # Loop and look for a reason not to keep the lt_backup
-            for instance in self.get_instances_from_youngest_to_oldest():
-                if instance.is_a_long_term_version():
-                    keep_instance = True
-
-                    # Too many
-                    if mysql_backup.MysqlBackup.long_term_backup_max_copies is not None and lt_instance_count >= \
-                            mysql_backup.MysqlBackup.long_term_backup_max_copies:
-
-                        MysqlDbInstance.backup_logger.info("%s: %s exceeds the max number of long term backups per "
-                                                           "configuration." % (self, instance), extra={'object': self})
-                        keep_instance = False
-
-                    # Not enough time between
-                    if last_instance_age is not None and \
-                       mysql_backup.MysqlBackup.long_term_backup_min_frequency_seconds is not None:
-
-                        age_between_instances = instance.get_age_secs() - last_instance_age
-                        if age_between_instances < mysql_backup.MysqlBackup.long_term_backup_min_frequency_seconds:
-                            keep_instance = False
-
-                            MysqlDbInstance.backup_logger.info("%s: %s is to close in age from the last long term copy."
-                                                               % (self, instance), extra={'object': self})
-
-                    # Too old
-                    if mysql_backup.MysqlBackup.long_term_max_lifespan_seconds is not None and \
-                       instance.get_age_secs() > mysql_backup.MysqlBackup.long_term_max_lifespan_seconds:
-
-                        keep_instance = False
-
-                        MysqlDbInstance.backup_logger.info("%s: %s is too old" % (self, instance),
-                                                           extra={'object': self})
-
-                    if keep_instance:
-                        MysqlDbInstance.backup_logger.info("%s: %s meets the criteria to preserve.  Keeping this "
-                                                           "backup." % (self, instance), extra={'object': self})
-                        instance.set_as_long_term_version(lt_state=True)
-                        lt_instance_count += 1
-                    else:
-                        MysqlDbInstance.backup_logger.info("%s: %s does not meet the criteria to preserve.  Removing "
-                                                           "this backup." % (self,instance), extra={'object': self})
-                        instance.set_as_long_term_version(lt_state=False)
-
-        else:
-            MysqlDbInstance.backup_logger.info("%s: Max backup copies is set to 0.  All should be removed."
-                                               % (self, ), extra={'object': self})
-            for instance in self.get_instances_from_youngest_to_oldest():
-                instance.set_as_long_term_version(lt_state=False)
+        columns = RetentionColumns()
+        self.add_to_retention_columns(columns)
+        plan = MysqlDbInstance.get_retention_planner(self.config).plan(columns, int(time.time()))
 
-    def set_correct_short_term_state(self):
-        """This does not likely need called directly.  Use set_correct_state.
-        This will check criteria and set the correct short term backup status of a
-        database."""
+        for change in plan.get_diff():
+            MysqlDbInstance.backup_logger.info("Retention plan: %s", change, extra={'object': self})
 
-        if self.get_youngest_instance() is None:
-            # No backups exist, just return
-            MysqlDbInstance.backup_logger.info("%s: No short term backups exist.  Nothing to do when setting the "
-                                               "correct short term state."
-                                               % (self,), extra={'object': self})
+        if self.config.retention_dry_run:
+            MysqlDbInstance.backup_logger.info("%s: retention_dry_run is enabled, not applying the retention plan.",
+                                               self, extra={'object': self})
             return None
 
-        st_counter = 0
-        for instance in self.get_instances_from_youngest_to_oldest():
-            previous_instances_age = None
-            destroy_this = False
-            # look for a reason to destroy this
-
-            # More copies than allowed?
-            if mysql_backup.MysqlBackup.incremental_max_copies is not None and \
-                            st_counter >= mysql_backup.MysqlBackup.incremental_max_copies:
-                MysqlDbInstance.backup_logger.info("%s: %s will be removed.  It would be more instances than allowed by"
-                                                   " configuration." % (self, instance,), extra={'object': self})
-                destroy_this = True
-
-            # Too old?
-            if mysql_backup.MysqlBackup.incremental_max_lifespan_seconds is not None and \
-                            instance.get_age_secs() > mysql_backup.MysqlBackup.incremental_max_lifespan_seconds:
-                MysqlDbInstance.backup_logger.info("%s: %s will be removed.  It is older than allowed by configuration."
-                                                   % (self, instance,), extra={'object': self})
-                destroy_this = True
-
-            # Too soon?
-            if None not in (previous_instances_age, mysql_backup.MysqlBackup.incremental_min_backup_frequency_seconds) \
-                    and (instance.get_age_secs() - previous_instances_age) < \
-                    mysql_backup.MysqlBackup.incremental_min_backup_frequency_seconds:
-                MysqlDbInstance.backup_logger.info("%s: %s will be removed.  It is too close in age than the previous "
-                                                   "backup by configuration."% (self, instance,),
-                                                   extra={'object': self})
-                destroy_this = True
-
-            if not destroy_this:
-                MysqlDbInstance.backup_logger.info("%s: %s will be preserved.  Configuration criteria has been met." %
-                                                   (self, instance,), extra={'object': self})
-                st_counter += 1
-                previous_instances_age = instance.get_age_secs()
-            else:
-                MysqlDbInstance.backup_logger.info("%s: Deleting %s." % (self, instance,), extra={'object': self})
-                self.delete_instance(instance)
+        instances_by_key = dict((instance.date_string, instance) for instance in self.mysql_backup_instances)
+        # Counted before the files are gone, for the instances actually deleted
+        file_counts = dict((id(instances_by_key[key]), len(instances_by_key[key].get_all_files()))
+                           for key, action in plan.get_actions(self.db_name).items() if action == DELETE)
+
+        # Manifests are read before the retention plan removes them
+        segment_files = self.get_segment_files_by_instance(self.mysql_backup_instances)
+        deleted = RetentionExecutor(self.config).apply(plan, self.db_name, instances_by_key)
+        for instance in deleted:
+            RunMetrics.add('files_pruned', file_counts[id(instance)], db_name=self.db_name)
+
+        deleted_ids = set(id(instance) for instance in deleted)
+        self.mysql_backup_instances = [instance for instance in self.mysql_backup_instances
+                                       if id(instance) not in deleted_ids]
+        self.remove_unreferenced_segments(segment_files, deleted)
+        self.sweep_segments()
+
+    def add_to_retention_columns(self, columns):
+        """Describe this database's instances to the retention planner"""
+        for instance in self.mysql_backup_instances:
+            columns.add(self.db_name, instance.date_string,
+                        mysql_backup.MysqlBackup.ts_from_human_readable_date(instance.date_string),
+                        instance.is_a_long_term_version(), instance.get_size_bytes())
+
+    @staticmethod
+    def get_retention_planner(config):
+        return RetentionPlanner(
+            incremental_max_copies=config.incremental_max_copies,
+            incremental_max_lifespan_seconds=config.incremental_max_lifespan_seconds,
+            long_term_backup_max_copies=config.long_term_backup_max_copies,
+            long_term_backup_min_frequency_seconds=config.long_term_backup_min_frequency_seconds,
+            long_term_max_lifespan_seconds=config.long_term_max_lifespan_seconds)
+
+    def get_current_long_term_count(self):
+        lt_count = 0
+        for instance in self.mysql_backup_instances:
+            if instance.is_a_long_term_version():
+                lt_count += 1
+        return lt_count
 
     def delete_instance(self, instance):
         """Request the instance file delete associated files.
         Remove the instance from the managed instances list"""
-        self.mysql_backup_instances = [bkinst for bkinst in self.mysql_backup_instances if bkinst is not instance]
+        instances = self.mysql_backup_instances + [instance]
+        segment_files = self.get_segment_files_by_instance(instances)
         instance.self_destruct()
+        self.mysql_backup_instances = [bkinst for bkinst in self.mysql_backup_instances if bkinst is not instance]
+        self.remove_unreferenced_segments(segment_files, [instance])
+
+    # Table segments
+
+    @staticmethod
+    def get_segment_files_by_instance(instances):
+        """Return: dict of id(instance) -> the segments its manifest refers to"""
+        return dict((id(instance), instance.get_segment_files()) for instance in instances)
+
+    def remove_unreferenced_segments(self, segment_files, removed):
+        """segment_files: get_segment_files_by_instance from before removed
+        were deleted.  Remove the segments only removed referred to."""
+        references = SegmentReferences()
+        for files in segment_files.values():
+            references.add(files)
+        unreferenced = list()
+        for instance in removed:
+            unreferenced.extend(references.release(segment_files.get(id(instance), ())))
+        if not unreferenced:
+            return
+        MysqlDbInstance.backup_logger.debug("%s: Removing %d segments no backup refers to.", self,
+                                            len(unreferenced), extra={'object': self})
+        DeletionPool(self.config).delete([TableSegments.get_path(self.config, self.db_name, segment_file)
+                                          for segment_file in unreferenced])
+
+    def sweep_segments(self):
+        """Remove segments left behind by interrupted runs"""
+        if not self.config.table_level_incremental:
+            return
+        references = SegmentReferences()
+        for files in MysqlDbInstance.get_segment_files_by_instance(self.mysql_backup_instances).values():
+            references.add(files)
+        if self.config.cleanup_delay_days is not None:
+            min_age_seconds = self.config.cleanup_delay_days * 86400
+        else:
+            min_age_seconds = SWEEP_MIN_AGE_SECONDS
+        leftovers = TableSegments.sweep(self.config, self.db_name, references, min_age_seconds, time.time())
+        if leftovers:
+            MysqlDbInstance.backup_logger.info("%s: Removing %d segments left behind.", self, len(leftovers),
+                                               extra={'object': self})
+            DeletionPool(self.config).delete(leftovers)
 
     def is_criteria_for_an_attempt_met(self):
 
         if self.get_youngest_instance() is None:
             return True
 
-        if mysql_backup.MysqlBackup.incremental_min_backup_frequency_seconds is not None:
-            if self.get_youngest_instance().get_age_secs() > \
-                    mysql_backup.MysqlBackup.incremental_min_backup_frequency_seconds:
+        if self.unchanged:
+            MysqlDbInstance.backup_logger.info("%s: Replication has not touched this database since its last backup.",
+                                               self, extra={'object': self})
+            return False
+
+        # incremental_min_backup_frequency_seconds, or what was learned for
+        # this database with adaptive_frequency
+        interval = self.backup_interval
+        if interval is not None:
+            if self.get_youngest_instance().get_age_secs() > interval:
                 return True
             else:
-                MysqlDbInstance.backup_logger.info("%s: Minimum backup frequency requirement for incrementals was not "
-                                                   "met." % (self, ), extra={'object': self})
+                MysqlDbInstance.backup_logger.info("%s: Minimum backup frequency requirement for incrementals, %d "
+                                                   "seconds, was not met.", self, interval, extra={'object': self})
         else:
             return True
 
         return False
 
+    def is_dump_expected(self):
+        """Return: True when execute is about to dump, decided as
+        is_criteria_for_an_attempt_met does but without logging"""
+        if not self.is_valid():
+            return False
+        youngest = self.get_youngest_instance()
+        if youngest is None:
+            return True
+        if self.unchanged:
+            return False
+        return self.backup_interval is None or youngest.get_age_secs() > self.backup_interval
+
+    def get_next_attempt_time(self):
+        """Return: unix time is_criteria_for_an_attempt_met will next be
+        met, None when it is now.  Counted from the youngest backup or
+        the last attempt, whose dump may have been thrown away for
+        matching it, whichever is later."""
+        youngest = self.get_youngest_instance()
+        interval = BackupSchedule.get_interval(self.db_name)
+        if youngest is None or interval is None:
+            return None
+        last = youngest.timestamp
+        entry = BackupSchedule.get_stats().get(self.db_name)
+        if entry and entry.get('last_attempt'):
+            last = max(last, entry['last_attempt'])
+        return last + interval
+
     def initialize_a_new_instance(self):
         """Return: New mysql_backup instance
         that has not yet set_proper_instance state.
         This is useful to be able to inspect the
         checksum before requesting compression."""
-        MysqlDbInstance.backup_logger.debug("%s: Requesting initialization of a new backup instance."
-                                            % (self,), extra={'object': self})
-        return MysqlBackupInstance(self.db_name)
+        MysqlDbInstance.backup_logger.debug("%s: Requesting initialization of a new backup instance.",
+                                            self, extra={'object': self})
+        if self.config.table_level_incremental:
+            # Tables unchanged since the youngest backup are not dumped again
+            return MysqlBackupInstance(self.config, self.db_name, previous=self.get_youngest_hydrated_instance())
+        return MysqlBackupInstance(self.config, self.db_name)
 
     def add_new_instance_if_criteria_is_met(self):
         if self.is_criteria_for_an_attempt_met():
             newinst = self.initialize_a_new_instance()
-            youngest_instance = self.get_youngest_instance()
+            RunMetrics.add('dump_attempts', 1, db_name=self.db_name)
+            youngest_instance = self.get_youngest_hydrated_instance()
             if youngest_instance is not None:
                 if youngest_instance != newinst:
+                    RunMetrics.add('dumps_changed', 1, db_name=self.db_name)
                     MysqlDbInstance.backup_logger.info("%s: Most recent incremental has a different checksum. "
-                                                       "Preserving this instance." % (self, ), extra={'object': self})
+                                                       "Preserving this instance.", self, extra={'object': self})
                     newinst.set_proper_instance_state()
                     self.mysql_backup_instances.append(newinst)
                 else:
                     MysqlDbInstance.backup_logger.info("%s: The previous backup and this one have matching checksums. "
-                                                       "No reason to keep this backup.  Destroying it." % (self, ),
+                                                       "No reason to keep this backup.  Destroying it.", self,
                                                        extra={'object': self})
                     self.delete_instance(newinst)
             else:
-                MysqlDbInstance.backup_logger.info("%s: No previous backups exists.  Assuming this should be preserved."
-                                                   % (self, ), extra={'object': self})
+                MysqlDbInstance.backup_logger.info("%s: No previous backups exists.  Assuming this should be preserved.",
+                                                   self, extra={'object': self})
+                RunMetrics.add('dumps_changed', 1, db_name=self.db_name)
                 newinst.set_proper_instance_state()
                 self.mysql_backup_instances.append(newinst)
 
@@ -328,7 +404,24 @@ class MysqlDbInstance:
             return None
 
     def self_destruct(self):
-        MysqlDbInstance.backup_logger.info("%s: Self destruct requested." % (self,), extra={'object': self})
-        instances = self.mysql_backup_instances[:]
-        for instance in instances:
-            self.delete_instance(instance)
+        MysqlDbInstance.backup_logger.info("%s: Self destruct requested.", self, extra={'object': self})
+        removable = list()
+        with OpenFiles.shared():
+            for instance in self.mysql_backup_instances:
+                try:
+                    instance.check_removable()
+                except RuntimeError as e:
+                    MysqlDbInstance.backup_logger.warning("%s: Could not remove %s. %s", self, instance, e,
+                                                          extra={'object': self})
+                else:
+                    removable.append(instance)
+
+        file_counts = dict((id(instance), len(instance.get_all_files())) for instance in removable)
+        segment_files = self.get_segment_files_by_instance(self.mysql_backup_instances)
+        removed = DeletionPool(self.config).delete_instances(removable)
+        removed_ids = set(id(instance) for instance in removed)
+        for instance in removed:
+            RunMetrics.add('files_pruned', file_counts[id(instance)], db_name=self.db_name)
+        self.mysql_backup_instances = [instance for instance in self.mysql_backup_instances
+                                       if id(instance) not in removed_ids]
+        self.remove_unreferenced_segments(segment_files, removed)
@@ -0,0 +1,270 @@
+# Retention Planner
+# Decides, for every backup instance of every database,
+# whether it is kept, deleted, promoted to a long term
+# copy or demoted from one.  Planning is pure: it works
+# on compact columns of timestamps, long term flags and
+# sizes and never touches the filesystem.  Applying a
+# plan is left to RetentionExecutor.
+
+from array import array
+from multiprocessing.pool import ThreadPool
+from mysql_backup_deletion_pool import DeletionPool
+from mysql_backup_long_term_copier import LongTermCopier
+from mysql_backup_open_files import OpenFiles
+
+KEEP = 'keep'
+DELETE = 'delete'
+PROMOTE = 'promote'
+DEMOTE = 'demote'
+
+
+class RetentionColumns(object):
+    """Column oriented description of backup instances.
+    Row i is database db_names[db_index[i]], instance key keys[i]."""
+
+    def __init__(self):
+        self.db_names = list()
+        self.db_positions = dict()
+        self.keys = list()
+        self.db_index = array('i')
+        self.timestamps = array('l')
+        self.long_term = array('b')
+        self.sizes = array('l')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, db_name, key, timestamp, is_long_term, size=0):
+        if db_name not in self.db_positions:
+            self.db_positions[db_name] = len(self.db_names)
+            self.db_names.append(db_name)
+        self.db_index.append(self.db_positions[db_name])
+        self.keys.append(key)
+        self.timestamps.append(timestamp)
+        self.long_term.append(1 if is_long_term else 0)
+        self.sizes.append(size)
+
+
+class RetentionPlan(object):
+    """The outcome of RetentionPlanner.plan.  actions[i] and
+    reasons[i] describe row i of the planned columns."""
+
+    def __init__(self, columns, actions, reasons):
+        self.columns = columns
+        self.actions = actions
+        self.reasons = reasons
+
+    def get_rows(self, db_name=None, action=None):
+        """Return: row numbers, optionally limited to a database and action"""
+        db_position = self.columns.db_positions.get(db_name) if db_name is not None else None
+        if db_name is not None and db_position is None:
+            return []
+        return [i for i in range(len(self.columns))
+                if (db_position is None or self.columns.db_index[i] == db_position) and
+                (action is None or self.actions[i] == action)]
+
+    def get_actions(self, db_name):
+        """Return: dict of instance key -> action for one database"""
+        return dict((self.columns.keys[i], self.actions[i]) for i in self.get_rows(db_name))
+
+    def get_diff(self):
+        """Return: list of human readable changes, the dry run view of the plan"""
+        diff = list()
+        for i in range(len(self.columns)):
+            if self.actions[i] != KEEP:
+                diff.append("%s %s: %s (%s)" % (self.columns.db_names[self.columns.db_index[i]],
+                                                self.columns.keys[i], self.actions[i], self.reasons[i]))
+        return diff
+
+    def get_bytes_freed(self):
+        return sum(self.columns.sizes[i] for i in range(len(self.columns)) if self.actions[i] == DELETE)
+
+
+class RetentionPlanner(object):
+    """Computes keep/promote/demote/delete for all databases in one pass.
+    Settings mirror the [Backup] section, None meaning unlimited.
+    The decisions are those of the per instance loops it replaced:
+    long_term_backup_min_frequency_seconds only decides whether the
+    youngest backup is promoted, and neither it nor the incremental
+    backup frequency removes backups for being too close together."""
+
+    def __init__(self, incremental_max_copies=None, incremental_max_lifespan_seconds=None,
+                 long_term_backup_max_copies=None, long_term_backup_min_frequency_seconds=None,
+                 long_term_max_lifespan_seconds=None):
+        self.incremental_max_copies = incremental_max_copies
+        self.incremental_max_lifespan_seconds = incremental_max_lifespan_seconds
+        self.long_term_backup_max_copies = long_term_backup_max_copies
+        self.long_term_backup_min_frequency_seconds = long_term_backup_min_frequency_seconds
+        self.long_term_max_lifespan_seconds = long_term_max_lifespan_seconds
+
+    def plan(self, columns, now):
+        """Return: RetentionPlan
+        Rows are ordered once by database and youngest first, then
+        each database's run of rows is decided in a single sweep."""
+        row_count = len(columns)
+        actions = [KEEP] * row_count
+        reasons = ['meets the configured criteria'] * row_count
+
+        order = sorted(range(row_count), key=lambda i: (columns.db_index[i], -columns.timestamps[i]))
+
+        start = 0
+        while start < row_count:
+            end = start
+            while end < row_count and columns.db_index[order[end]] == columns.db_index[order[start]]:
+                end += 1
+            self.plan_database(columns, order[start:end], now, actions, reasons)
+            start = end
+
+        return RetentionPlan(columns, actions, reasons)
+
+    def plan_database(self, columns, rows, now, actions, reasons):
+        """Decide the rows of one database, given youngest to oldest"""
+        survivors = list()
+        kept_count = 0
+
+        # Short term criteria
+        for i in rows:
+            age = now - columns.timestamps[i]
+            reason = None
+            if self.incremental_max_copies is not None and kept_count >= self.incremental_max_copies:
+                reason = 'exceeds incremental_max_copies'
+            elif self.incremental_max_lifespan_seconds is not None and age > self.incremental_max_lifespan_seconds:
+                reason = 'older than incremental_max_lifespan_seconds'
+
+            if reason is not None:
+                actions[i] = DELETE
+                reasons[i] = reason
+            else:
+                kept_count += 1
+                survivors.append(i)
+
+        if not survivors:
+            return
+
+        # Long term criteria, only amongst what survived
+        if self.long_term_backup_max_copies == 0:
+            for i in survivors:
+                if columns.long_term[i]:
+                    actions[i] = DEMOTE
+                    reasons[i] = 'long_term_backup_max_copies is 0'
+            return
+
+        long_term = dict((i, bool(columns.long_term[i])) for i in survivors)
+        youngest = survivors[0]
+        if not long_term[youngest]:
+            most_recent_lt = None
+            for i in survivors:
+                if long_term[i]:
+                    most_recent_lt = i
+                    break
+            if most_recent_lt is None or self.long_term_backup_min_frequency_seconds is None or \
+                    columns.timestamps[youngest] - columns.timestamps[most_recent_lt] > \
+                    self.long_term_backup_min_frequency_seconds:
+                long_term[youngest] = True
+
+        lt_count = 0
+        for i in survivors:
+            if not long_term[i]:
+                continue
+            age = now - columns.timestamps[i]
+            reason = None
+            if self.long_term_backup_max_copies is not None and lt_count >= self.long_term_backup_max_copies:
+                reason = 'exceeds long_term_backup_max_copies'
+            elif self.long_term_max_lifespan_seconds is not None and age > self.long_term_max_lifespan_seconds:
+                reason = 'older than long_term_max_lifespan_seconds'
+
+            if reason is None:
+                lt_count += 1
+                if not columns.long_term[i]:
+                    actions[i] = PROMOTE
+                    reasons[i] = 'youngest backup and enough time since the last long term copy'
+            elif columns.long_term[i]:
+                actions[i] = DEMOTE
+                reasons[i] = reason
+
+
+class RetentionExecutor(object):
+    """Applies a RetentionPlan to MysqlBackupInstance objects.
+    Each kind of action is applied as one batch across a thread
+    pool, deletes through a DeletionPool.  Promotions finish before
+    any demotion starts so a failed copy never leaves a database
+    without a long term copy.  While the LongTermCopier queue is
+    open a promotion is queued instead, carrying the demotions it
+    replaces."""
+
+    backup_logger = None
+
+    def __init__(self, config):
+        RetentionExecutor.backup_logger = config.get_logger('retention')
+        self.config = config
+        self.threads = max(1, config.retention_io_threads or 1)
+
+    def __str__(self):
+        return "retention executor"
+
+    def run_batch(self, func, items):
+        """Return: the items func raised a RuntimeError for.
+        Those are logged and the rest of the batch carries on."""
+        def attempt(item):
+            try:
+                func(item)
+            except RuntimeError as e:
+                RetentionExecutor.backup_logger.warning("Retention action on %s failed. %s", item, e,
+                                                        extra={'object': self})
+                return item
+            return None
+
+        if not items:
+            return []
+        if self.threads == 1 or len(items) == 1:
+            results = [attempt(item) for item in items]
+        else:
+            pool = ThreadPool(min(self.threads, len(items)))
+            try:
+                results = pool.map(attempt, items)
+            finally:
+                pool.close()
+                pool.join()
+        return [item for item in results if item is not None]
+
+    def queue_promotion(self, db_name, promoted, demoted):
+        """Hand the copy to the LongTermCopier; the older long term
+        copies are removed by it once the copy has landed."""
+        try:
+            promoted.hydrate()
+        except RuntimeError as e:
+            RetentionExecutor.backup_logger.warning("%s: Not promoting %s, keeping older long term copies. %s",
+                                                    db_name, promoted, e, extra={'object': self})
+            return
+        bkobj = promoted.incremental_backup_file_obj
+        demote_files = [file_name for instance in demoted for file_name in instance.get_removal_stages()[0]]
+        src, temporary = bkobj.get_long_term_source()
+        LongTermCopier.submit(db_name, src, bkobj.get_long_term_backup_full_name(), demote_files, len(demoted),
+                              remove_src=temporary)
+
+    def apply(self, plan, db_name, instances_by_key):
+        """instances_by_key: dict of plan key -> MysqlBackupInstance
+        return: list of the instances deleted, for the caller to stop managing"""
+        actions = plan.get_actions(db_name)
+
+        def of(action):
+            return [instances_by_key[key] for key in sorted(actions) if actions[key] == action]
+
+        deleted = of(DELETE)
+        with OpenFiles.shared():
+            failed_ids = set(id(instance) for instance in
+                             self.run_batch(lambda instance: instance.check_removable(), deleted))
+        removed = DeletionPool(self.config, threads=self.threads).delete_instances(
+            [instance for instance in deleted if id(instance) not in failed_ids])
+        if LongTermCopier.is_started() and len(of(PROMOTE)) == 1:
+            self.queue_promotion(db_name, of(PROMOTE)[0], of(DEMOTE))
+            return removed
+
+        failed_promotions = self.run_batch(lambda instance: instance.set_as_long_term_version(lt_state=True),
+                                           of(PROMOTE))
+        if failed_promotions:
+            RetentionExecutor.backup_logger.warning("%s: Not removing older long term copies because a promotion "
+                                                    "failed.", db_name, extra={'object': self})
+        else:
+            self.run_batch(lambda instance: instance.set_as_long_term_version(lt_state=False), of(DEMOTE))
+        return removed
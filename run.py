@@ -12,26 +12,88 @@ def main():
     parser = OptionParser(usage="usage: %prog [options] filename",
                           version="%prog 1.0")
     parser.add_option("-s", "--settings-file",
-                      action="store",
-                      dest="settings_file",
+                      action="append",
+                      dest="settings_files",
+                      default=[],
+                      help="The settings file to execute.  May be given more than once.")
+    parser.add_option("-d", "--daemon",
+                      action="store_true",
+                      dest="daemon",
                       default=False,
-                      help="The settings file to execute.")
+                      help="Keep running, running the settings files whenever a backup is due.")
+    parser.add_option("--control-socket",
+                      action="store",
+                      dest="control_socket",
+                      default=None,
+                      help="The UNIX socket the daemon takes commands on.")
+    parser.add_option("-c", "--command",
+                      action="store",
+                      dest="command",
+                      default=None,
+                      help="Send a command to the daemon listening on --control-socket and print its answer: "
+                           "status, run [settings file], reload or stop.")
+    parser.add_option("--max-idle-seconds",
+                      action="store",
+                      type="int",
+                      dest="max_idle_seconds",
+                      default=3600,
+                      help="The daemon runs each settings file at least this often.")
+    parser.add_option("--min-idle-seconds",
+                      action="store",
+                      type="int",
+                      dest="min_idle_seconds",
+                      default=60,
+                      help="The daemon runs a settings file at most this often, unless asked to.")
+    parser.add_option("--retry-seconds",
+                      action="store",
+                      type="int",
+                      dest="retry_seconds",
+                      default=300,
+                      help="How long the daemon waits after a failed run.")
 
     (options, args) = parser.parse_args()
 
-    if not options.settings_file:
+    if options.command:
+        if not options.control_socket:
+            print "--command needs --control-socket.  Run with -h to see more information."
+            sys.exit(-1)
+        control_socket = os.path.abspath(options.control_socket)
+        command = options.command.split(None, 1)
+        if len(command) > 1:
+            # The daemon runs elsewhere, name the settings file in full
+            command[1] = os.path.abspath(command[1].strip())
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+        import json
+        from mysql_backup.mysql_backup_daemon import BackupDaemon
+
+        answer = BackupDaemon.send_command(control_socket, ' '.join(command))
+        print json.dumps(answer, indent=2, sort_keys=True)
+        sys.exit(-1 if 'error' in answer else 0)
+
+    if not options.settings_files:
         print "Settings file argument is required.  Run with -h to see more information."
         sys.exit(-1)
 
-    config_file = os.path.abspath(options.settings_file)
+    config_files = [os.path.abspath(settings_file) for settings_file in options.settings_files]
+    control_socket = options.control_socket and os.path.abspath(options.control_socket)
 
     # Always run local to the run.py so user modules import properly.
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+    if options.daemon:
+        from mysql_backup.mysql_backup_daemon import BackupDaemon
+
+        daemon = BackupDaemon(config_files, control_socket, max_idle_seconds=options.max_idle_seconds,
+                              min_idle_seconds=options.min_idle_seconds, retry_seconds=options.retry_seconds)
+        daemon.serve()
+        return
+
     from mysql_backup.mysql_backup import MysqlBackup
 
-    mysql_backup_obj = MysqlBackup(config_file)
-    mysql_backup_obj.execute()
+    for config_file in config_files:
+        mysql_backup_obj = MysqlBackup(config_file)
+        mysql_backup_obj.execute()
 
 if __name__ == '__main__':
     main()
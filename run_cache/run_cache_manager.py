@@ -1,8 +1,7 @@
 from lockfile import LockFile, NotLocked
 import os
 import shelve
-import mysql_backup.mysql_backup
-import psutil
+# psutil is imported only where a pid has to be inspected
 from time import time
 
 
@@ -10,11 +9,11 @@ class RunningCacheManager:
 
     backup_logger = None
 
-    def __init__(self, settings_file, cache_lock_wait, running_cache_file, cache_successful_run_purge_days):
+    def __init__(self, config):
 
-        RunningCacheManager.backup_logger = mysql_backup.mysql_backup.MysqlBackup.backup_logger
-        self.settings_file = os.path.abspath(settings_file)
-        self.running_cache_file = running_cache_file
+        RunningCacheManager.backup_logger = config.get_logger('cache')
+        self.settings_file = os.path.abspath(config.settings_file)
+        self.running_cache_file = config.running_cache_file
         """
         self.running_cache_file = {
             successful_run_times = {
@@ -24,12 +23,20 @@ class RunningCacheManager:
             running_backups = {
                 self.settings_file:pid,
                 ...
+            },
+            database_schedules = {
+                self.settings_file:{db name:learned schedule stats},
+                ...
+            },
+            replication_states = {
+                self.settings_file:{slave_position, binlog_position, dirty, timestamp},
+                ...
             }
         }
         """
 
-        self.cache_lock_wait = cache_lock_wait
-        self.cache_successful_run_purge_days = cache_successful_run_purge_days
+        self.cache_lock_wait = config.cache_lock_wait
+        self.cache_successful_run_purge_days = config.cache_successful_run_purge_days
         self.LockFileObj = LockFile(self.running_cache_file)
         self.cache_shelve_handle = None
         self.sanitize_cache()
@@ -71,6 +78,11 @@ class RunningCacheManager:
             self.cache_shelve_handle['successful_run_times'] = dict()
             self.cache_shelve_handle['running_backups'] = dict()
 
+        # Added later, caches written before it do not need a reset
+        for category in ('database_schedules', 'replication_states'):
+            if not isinstance(self.cache_shelve_handle.get(category), dict):
+                self.cache_shelve_handle[category] = dict()
+
         # Make sure all of the pids in the running cache are
         # actually still running
         dead_instances = set()
@@ -84,6 +96,7 @@ class RunningCacheManager:
                 dead_instances.add(sf)
             else:
                 # the pid is there, but is it actually a python script
+                import psutil
                 p = psutil.Process(pid)
                 if 'python' not in p.cmdline()[0]:
                     RunningCacheManager.backup_logger.debug("Found a running pid but it does not have python in the path. "
@@ -221,11 +234,12 @@ class RunningCacheManager:
             RunningCacheManager.backup_logger.debug("Closing the cache", extra={'object': self})
             self.cache_shelve_handle.close()
 
-    def update_last_successful_runtime(self):
+    def update_last_successful_runtime(self, started=None):
         """
         void()
         Inserts or updates the tracking of the last successful runtime of this
-        backup.
+        backup.  started: when the run started, the process start time
+        when not given.  A daemon runs many times per process.
         """
 
         RunningCacheManager.backup_logger.debug("Updating the stored successful runtime of this backup.",
@@ -234,11 +248,27 @@ class RunningCacheManager:
         self.should_have_cache_locked(locked=True)
         self.shelve_open(state=True)
 
-        p = psutil.Process(os.getpid())
-        self.cache_shelve_handle['successful_run_times'][self.settings_file] = int(p.create_time())
+        if started is None:
+            import psutil
+            started = int(psutil.Process(os.getpid()).create_time())
+        self.cache_shelve_handle['successful_run_times'][self.settings_file] = started
+
+        self.shelve_open(state=False)
+        self.should_have_cache_locked(locked=False)
+
+    def get_last_successful_runtime(self):
+        """
+        return: int or None, when the last successful run of this
+        settings file started
+        """
+        self.should_have_cache_locked(locked=True)
+        self.shelve_open(state=True)
+
+        last_successful_ts = self.cache_shelve_handle['successful_run_times'].get(self.settings_file)
 
         self.shelve_open(state=False)
         self.should_have_cache_locked(locked=False)
+        return last_successful_ts
 
     def have_already_run_while_others_are_still_running(self):
         """It does not make sense to run a backup again
@@ -257,7 +287,8 @@ class RunningCacheManager:
         if self.settings_file in self.cache_shelve_handle['successful_run_times']:
             last_successful_ts = self.cache_shelve_handle['successful_run_times'][self.settings_file]
 
-        if last_successful_ts is not None:
+        if last_successful_ts is not None and self.cache_shelve_handle['running_backups']:
+            import psutil
             for sf in self.cache_shelve_handle['running_backups']:
                 p = psutil.Process(self.cache_shelve_handle['running_backups'][sf])
                 start_time = int(p.create_time())
@@ -268,3 +299,63 @@ class RunningCacheManager:
         self.shelve_open(state=False)
         self.should_have_cache_locked(locked=False)
         return already_ran
+
+    def get_database_schedules(self):
+        """
+        return: dict, the per database schedule stats saved by the
+        last run of this settings file
+        """
+        self.should_have_cache_locked(locked=True)
+        self.shelve_open(state=True)
+
+        schedules = dict(self.cache_shelve_handle['database_schedules'].get(self.settings_file, {}))
+
+        self.shelve_open(state=False)
+        self.should_have_cache_locked(locked=False)
+        return schedules
+
+    def save_database_schedules(self, schedules):
+        """
+        void()
+        Replace the per database schedule stats of this settings file
+        """
+        RunningCacheManager.backup_logger.debug("Saving the learned database schedules.", extra={'object': self})
+
+        self.should_have_cache_locked(locked=True)
+        self.shelve_open(state=True)
+
+        self.cache_shelve_handle['database_schedules'][self.settings_file] = dict(schedules)
+
+        self.shelve_open(state=False)
+        self.should_have_cache_locked(locked=False)
+
+    def get_replication_state(self):
+        """
+        return: dict or None, the replication positions recorded by
+        the last successful run of this settings file
+        """
+        self.should_have_cache_locked(locked=True)
+        self.shelve_open(state=True)
+
+        state = self.cache_shelve_handle['replication_states'].get(self.settings_file)
+        if state is not None:
+            state = dict(state)
+
+        self.shelve_open(state=False)
+        self.should_have_cache_locked(locked=False)
+        return state
+
+    def save_replication_state(self, state):
+        """
+        void()
+        Replace the replication positions recorded for this settings file
+        """
+        RunningCacheManager.backup_logger.debug("Saving the replication position.", extra={'object': self})
+
+        self.should_have_cache_locked(locked=True)
+        self.shelve_open(state=True)
+
+        self.cache_shelve_handle['replication_states'][self.settings_file] = dict(state)
+
+        self.shelve_open(state=False)
+        self.should_have_cache_locked(locked=False)
@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+
+
+class MetricTimer(object):
+    """Context manager adding the elapsed wall time,
+    in seconds, to a metric when the block exits."""
+
+    def __init__(self, name, db_name=None):
+        self.name = name
+        self.db_name = db_name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        RunMetrics.add(self.name, time.time() - self.start, db_name=self.db_name)
+        return False
+
+
+class RunMetrics:
+    """Collects measurements for a single backup run.
+
+    Values are kept per run and per database.  Worker processes
+    collect into their own copy, return get_snapshot() and the
+    parent process merges those with merge()."""
+
+    run_values = dict()
+    database_values = dict()
+    lock = threading.Lock()
+
+    prefix = 'mysql_backup_'
+
+    descriptions = {
+        'run_duration_seconds': 'Wall time of the whole backup run.',
+        'run_skipped': '1 when the run exited early because another run already covered it.',
+        'run_timestamp_seconds': 'Unix time the run finished.',
+        'databases_processed': 'Number of databases handed to the parallel workers.',
+        'slave_stopped_seconds': 'Time the mysql slave was held stopped by this run.',
+        'replicas_used': 'Replicas dumped from, the first included, when the host names several.',
+        'replica_catch_up_seconds': 'Time spent stopping replicas at the first replica\'s position.',
+        'snapshot_refresh_seconds': 'Time spent refreshing the lvm snapshot.',
+        'open_file_scan_seconds': 'Time spent scanning processes for open backup files.',
+        'open_file_scans': 'Number of open file scans performed.',
+        'reconcile_seconds': 'Time spent validating existing backups before any database was processed.',
+        'instances_validated': 'Existing backups validated, fixing their compression where needed.',
+        'instances_being_written': 'Existing backups left alone because their files were still being written.',
+        'instances_self_destructed': 'Existing backups that failed validation and were removed.',
+        'directory_scan_seconds': 'Time spent listing the backup directories.',
+        'directory_scans': 'Number of backup directory listings.',
+        'directory_cursor_hits': 'Backup directory listings taken from the cursor file instead of listing.',
+        'directory_watch_changes': 'Files stat\'ed again because the directory watcher saw them change.',
+        'directory_watch_overflows': 'Times the directory watcher lost events and directories were listed again.',
+        'dump_duration_seconds': 'Time spent running mysqldump.',
+        'dump_bytes': 'Size of the uncompressed dump.',
+        'dump_attempts': 'Dumps taken to compare with the previous backup.',
+        'dumps_changed': 'Dumps that differed from the previous backup and were kept.',
+        'segments_dumped': 'Table segments dumped, table_level_incremental.',
+        'segments_reused': 'Unchanged tables whose segment from the previous backup was reused.',
+        'schedule_change_ratio': 'Smoothed fraction of dump attempts that found a change.',
+        'schedule_dump_size_bytes': 'Smoothed size of a dump.',
+        'schedule_interval_seconds': 'Learned wait after the youngest backup before the next attempt.',
+        'compression_duration_seconds': 'Time spent compressing dumps.',
+        'compressed_bytes': 'Size of the compressed dump.',
+        'compression_frames': 'Independently compressed frames written, compression_format frames.',
+        'compression_ratio': 'Uncompressed bytes divided by compressed bytes.',
+        'hash_duration_seconds': 'Time spent computing dump checksums.',
+        'files_pruned': 'Backup files removed by retention or cleanup.',
+        'long_term_promotions': 'Backups copied to the long term backup path.',
+        'long_term_removals': 'Backups removed from the long term backup path.',
+        'files_deleted': 'Files removed through the deletion pool.',
+        'bytes_deleted': 'Bytes removed through the deletion pool.',
+        'deletion_seconds': 'Wall time spent in the deletion pool.',
+        'deletion_retries': 'File removals retried after a transient error.',
+        'job_retries': 'Database jobs tried again after a transient error.',
+        'job_failures': 'Database jobs that failed, left for the next run.',
+        'databases_failed': 'Databases whose job failed this run.',
+        'long_term_copy_seconds': 'Time spent copying, syncing and verifying long term copies.',
+        'long_term_copy_failures': 'Long term copies that failed; older copies were kept.',
+        'long_term_upload_bytes': 'Bytes uploaded to S3 long term storage.',
+        'long_term_upload_parts': 'Multipart upload parts sent to S3 long term storage.',
+        'long_term_drain_seconds': 'Time waiting for queued long term copies after the last dump.',
+        'binlog_scan_seconds': 'Time spent reading the binlog for the databases replication touched.',
+        'replication_unchanged_databases': 'Databases skipped because replication did not touch them.',
+        'page_cache_dropped_bytes': 'Bytes written and dropped from the page cache, page_cache_drop.',
+        'direct_io_fallbacks': 'Long term copies written through the page cache, O_DIRECT was refused.',
+        'throttle_wait_seconds': 'Time writes were held back by the configured byte rates.',
+        'throttle_backoffs': 'Times adaptive mode lowered the byte rates because of replication lag.',
+    }
+
+    @staticmethod
+    def reset():
+        RunMetrics.run_values = dict()
+        RunMetrics.database_values = dict()
+
+    @staticmethod
+    def get_values(db_name=None):
+        if db_name is None:
+            return RunMetrics.run_values
+        return RunMetrics.database_values.setdefault(db_name, dict())
+
+    @staticmethod
+    def add(name, value, db_name=None):
+        """Accumulate value into the named metric"""
+        with RunMetrics.lock:
+            values = RunMetrics.get_values(db_name)
+            values[name] = values.get(name, 0) + value
+
+    @staticmethod
+    def set(name, value, db_name=None):
+        """Replace the named metric with value"""
+        with RunMetrics.lock:
+            RunMetrics.get_values(db_name)[name] = value
+
+    @staticmethod
+    def timer(name, db_name=None):
+        """Usage: with RunMetrics.timer('dump_duration_seconds', db): ..."""
+        return MetricTimer(name, db_name=db_name)
+
+    @staticmethod
+    def get_snapshot():
+        """Return: a picklable copy of everything collected so far"""
+        return {
+            'run': dict(RunMetrics.run_values),
+            'databases': dict((db, dict(values)) for db, values in RunMetrics.database_values.items()),
+        }
+
+    @staticmethod
+    def take_snapshot():
+        """Return: get_snapshot(), reset in the same step.  A value
+        another thread adds meanwhile is in one or the other."""
+        with RunMetrics.lock:
+            snapshot = RunMetrics.get_snapshot()
+            RunMetrics.reset()
+        return snapshot
+
+    @staticmethod
+    def merge(snapshot):
+        """Fold a snapshot returned by a worker into this process"""
+        if not snapshot:
+            return
+        for name, value in snapshot.get('run', {}).items():
+            RunMetrics.add(name, value)
+        for db_name, values in snapshot.get('databases', {}).items():
+            for name, value in values.items():
+                RunMetrics.add(name, value, db_name=db_name)
+
+    @staticmethod
+    def get_database_values_with_derived():
+        database_values = dict()
+        for db_name, values in RunMetrics.database_values.items():
+            values = dict(values)
+            if values.get('dump_bytes') and values.get('compressed_bytes'):
+                values['compression_ratio'] = float(values['dump_bytes']) / values['compressed_bytes']
+            database_values[db_name] = values
+        return database_values
+
+    @staticmethod
+    def format_labels(labels):
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in sorted(labels.items())) + '}'
+
+    @staticmethod
+    def get_textfile_content(labels):
+        """Return: node_exporter textfile collector formatted metrics"""
+        database_values = RunMetrics.get_database_values_with_derived()
+
+        names = set(RunMetrics.run_values)
+        for values in database_values.values():
+            names.update(values)
+
+        lines = list()
+        for name in sorted(names):
+            metric_name = RunMetrics.prefix + name
+            lines.append('# HELP %s %s' % (metric_name, RunMetrics.descriptions.get(name, name)))
+            lines.append('# TYPE %s gauge' % metric_name)
+            if name in RunMetrics.run_values:
+                lines.append('%s%s %s' % (metric_name, RunMetrics.format_labels(labels),
+                                          repr(float(RunMetrics.run_values[name]))))
+            for db_name in sorted(database_values):
+                if name in database_values[db_name]:
+                    db_labels = dict(labels)
+                    db_labels['database'] = db_name
+                    lines.append('%s%s %s' % (metric_name, RunMetrics.format_labels(db_labels),
+                                              repr(float(database_values[db_name][name]))))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def get_report(**extra):
+        """Return: dict suitable for the json run report"""
+        report = dict(extra)
+        report['run'] = dict(RunMetrics.run_values)
+        report['databases'] = RunMetrics.get_database_values_with_derived()
+        return report
+
+    @staticmethod
+    def write_textfile(file_name, labels):
+        RunMetrics.write_atomically(file_name, RunMetrics.get_textfile_content(labels))
+
+    @staticmethod
+    def write_json_report(file_name, **extra):
+        RunMetrics.write_atomically(file_name, json.dumps(RunMetrics.get_report(**extra), indent=2,
+                                                          sort_keys=True))
+
+    @staticmethod
+    def write_atomically(file_name, content):
+        """Write to a temporary file in the same directory and rename
+        over the destination so readers never see a partial file."""
+        tmp_file_name = '%s.tmp.%d' % (file_name, os.getpid())
+        with open(tmp_file_name, 'w') as file_pointer:
+            file_pointer.write(content)
+            file_pointer.flush()
+            os.fsync(file_pointer.fileno())
+        os.rename(tmp_file_name, file_name)
@@ -0,0 +1,110 @@
+import json
+import os
+import thread
+import time
+from functools import wraps
+from run_metrics import RunMetrics
+
+
+class TraceSpan(object):
+    """Context manager recording one complete (ph X) trace event.
+    Spans opened inside another span on the same thread nest
+    naturally in the trace viewer because their times overlap."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if RunTrace.enabled:
+            end = time.time()
+            args = dict(self.args)
+            if exc_type is not None:
+                args['exception'] = exc_type.__name__
+            RunTrace.events.append({
+                'name': self.name,
+                'cat': 'mysql_backup',
+                'ph': 'X',
+                'ts': int(self.start * 1000000),
+                'dur': int((end - self.start) * 1000000),
+                'pid': os.getpid(),
+                'tid': thread.get_ident(),
+                'args': args,
+            })
+        return False
+
+
+class RunTrace:
+    """Collects nested timing spans for a single backup run and
+    writes them in the Chrome trace event format, which loads in
+    chrome://tracing and Perfetto.
+
+    Worker processes collect into their own copy, return
+    get_events() and the parent process merges those with merge()."""
+
+    enabled = False
+    events = list()
+
+    @staticmethod
+    def reset():
+        RunTrace.events = list()
+
+    @staticmethod
+    def span(name, **args):
+        """Usage: with RunTrace.span('compress', db='mydb'): ..."""
+        return TraceSpan(name, args)
+
+    @staticmethod
+    def traced(name):
+        """Decorator wrapping a method in a span.  The object the
+        method is called on is recorded as the span's object."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                span_args = dict()
+                if args:
+                    span_args['object'] = str(args[0])
+                with TraceSpan(name, span_args):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def name_process(process_name):
+        """Label the current process in the trace viewer"""
+        if RunTrace.enabled:
+            RunTrace.events.append({
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': os.getpid(),
+                'args': {'name': process_name},
+            })
+
+    @staticmethod
+    def get_events():
+        return list(RunTrace.events)
+
+    @staticmethod
+    def take_events():
+        """Return: the events collected so far, collecting anew from
+        here.  A span another thread ends meanwhile is in one or the
+        other."""
+        events, RunTrace.events = RunTrace.events, list()
+        return events
+
+    @staticmethod
+    def merge(events):
+        if events:
+            RunTrace.events.extend(events)
+
+    @staticmethod
+    def write_chrome_trace(file_name):
+        RunMetrics.write_atomically(file_name, json.dumps({
+            'traceEvents': sorted(RunTrace.events, key=lambda e: (e.get('ts', 0), -e.get('dur', 0))),
+            'displayTimeUnit': 'ms',
+        }))
@@ -0,0 +1,23 @@
+import os
+
+from mysql_backup.mysql_backup_config import BackupConfig, FIELDS
+from mysql_backup.mysql_backup_logging import RunLog
+
+
+def make_config(work_dir, **settings):
+    """Return: a BackupConfig logging to work_dir, every setting not
+    given None"""
+    values = dict((field, None) for field in FIELDS)
+    values.update({
+        'backup_id': 'test %s' % os.path.basename(work_dir),
+        'settings_file': os.path.join(work_dir, 'settings.ini'),
+        'logfile': os.path.join(work_dir, 'backup.log'),
+        'loglevel': 'DEBUG',
+        'checksum_algorithm': 'md5',
+    })
+    values.update(settings)
+    return BackupConfig(**values)
+
+
+def stop_config(config):
+    RunLog.stop(config)
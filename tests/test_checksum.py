@@ -0,0 +1,64 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mysql_backup.mysql_backup_checksum import MysqlBackupChecksum
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, content):
+        file_name = os.path.join(self.work_dir, 'dump.sql')
+        with open(file_name, 'wb') as file_pointer:
+            file_pointer.write(content)
+        return file_name
+
+    def test_digest_matches_hashlib_across_buffer_boundaries(self):
+        content = ''.join(chr(i % 251) for i in range(10000))
+        file_name = self.write_file(content)
+        for algorithm in ('md5', 'sha1', 'sha256'):
+            expected = hashlib.new(algorithm, content).hexdigest()
+            for buffer_size in (1, 7, 4096, 10000, 65536, None):
+                self.assertEqual(MysqlBackupChecksum.get_digest_from_file(file_name, algorithm, buffer_size),
+                                 expected, (algorithm, buffer_size))
+
+    def test_digest_of_empty_file(self):
+        file_name = self.write_file('')
+        self.assertEqual(MysqlBackupChecksum.get_digest_from_file(file_name, 'md5'), hashlib.md5('').hexdigest())
+
+    def test_every_supported_algorithm_hashes(self):
+        file_name = self.write_file('create table t (id int);\n')
+        for algorithm in MysqlBackupChecksum.get_supported_algorithms():
+            digest = MysqlBackupChecksum.get_digest_from_file(file_name, algorithm, 4)
+            hash_obj = MysqlBackupChecksum.new_hash(algorithm)
+            hash_obj.update('create table t (id int);\n')
+            self.assertEqual(digest, hash_obj.hexdigest(), algorithm)
+
+    def test_unsupported_algorithm(self):
+        self.assertRaises(ValueError, MysqlBackupChecksum.new_hash, 'crc7')
+
+    def test_md5_written_bare_like_md5sum(self):
+        digest = hashlib.md5('x').hexdigest()
+        self.assertEqual(MysqlBackupChecksum.format_checksum('md5', digest), digest)
+        self.assertEqual(MysqlBackupChecksum.format_checksum('sha256', 'ab12'), 'sha256:ab12')
+
+    def test_parse_round_trips_and_reads_legacy_files(self):
+        for algorithm in ('md5', 'sha1', 'sha256'):
+            digest = hashlib.new(algorithm, 'x').hexdigest()
+            checksum = MysqlBackupChecksum.format_checksum(algorithm, digest)
+            self.assertEqual(MysqlBackupChecksum.parse_checksum(checksum), (algorithm, digest))
+        # md5sum output read back from an older checksum file
+        self.assertEqual(MysqlBackupChecksum.parse_checksum('ABCDEF0123\n'), ('md5', 'abcdef0123'))
+        self.assertEqual(MysqlBackupChecksum.parse_checksum('sha1:ABCD\n'), ('sha1', 'abcd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
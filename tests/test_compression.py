@@ -0,0 +1,114 @@
+import errno
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+# First, as a run does: the file module and the package's main module import each other
+import mysql_backup.mysql_backup
+from mysql_backup.mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup.mysql_backup_file import CompressedFile, UncompressedFile
+from mysql_backup.mysql_backup_long_term_storage import LongTermStorage
+from mysql_backup.mysql_backup_page_cache import PageCache
+from mysql_backup.mysql_backup_throttle import MysqlBackupThrottle
+from tests.helpers import make_config, stop_config
+
+FAILING_COMPRESSOR = """#!/bin/sh
+echo "gzip: write error: I/O or other error, bailing out" >&2
+exit 2
+"""
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.incremental_path = os.path.join(self.work_dir, 'incrementals')
+        os.mkdir(self.incremental_path)
+        os.mkdir(os.path.join(self.work_dir, 'long_term'))
+        self.failing_compressor = os.path.join(self.work_dir, 'failing_gzip')
+        with open(self.failing_compressor, 'w') as compressor_pointer:
+            compressor_pointer.write(FAILING_COMPRESSOR)
+        os.chmod(self.failing_compressor, 0o755)
+        self.drop = PageCache.drop
+        self.stream = MysqlBackupThrottle.stream
+        BackupDirectorySnapshot.reset()
+        # The compressor writes to stdout through the page cache writer
+        PageCache.drop = True
+
+    def tearDown(self):
+        PageCache.drop = self.drop
+        MysqlBackupThrottle.stream = staticmethod(self.stream)
+        LongTermStorage.storage = None
+        BackupDirectorySnapshot.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def compress(self, compress_command):
+        self.config = make_config(self.work_dir, incremental_path=self.incremental_path,
+                                  long_term_backup_path=os.path.join(self.work_dir, 'long_term'),
+                                  long_term_storage='filesystem', compress_command=compress_command,
+                                  compressed_file_extension='gz', checksum_buffer_size=4096)
+        LongTermStorage.configure(self.config)
+        ucpf = UncompressedFile(self.config, 'db__2020-01-01_00-00-00.sql', 'db', '2020-01-01_00-00-00')
+        with open(ucpf.file_name_full_path, 'w') as dump_pointer:
+            dump_pointer.write('INSERT INTO t VALUES (1);\n' * 10000)
+        cpf = CompressedFile(self.config, 'db__2020-01-01_00-00-00.sql.gz', 'db', '2020-01-01_00-00-00')
+        # Listed, so the snapshot is asked about what is left
+        BackupDirectorySnapshot.get_entries(self.incremental_path)
+        cpf.compress_ucpf(ucpf)
+        return ucpf, cpf
+
+    def test_compresses_through_stdout(self):
+        ucpf, cpf = self.compress('gzip')
+        self.assertFalse(os.path.exists(ucpf.file_name_full_path))
+        self.assertTrue(BackupDirectorySnapshot.exists(cpf.file_name_full_path))
+        compressed_pointer = gzip.open(cpf.file_name_full_path)
+        with compressed_pointer:
+            self.assertEqual(compressed_pointer.read(), 'INSERT INTO t VALUES (1);\n' * 10000)
+
+    def test_failed_compressor_leaves_no_partial_file(self):
+        try:
+            self.compress(self.failing_compressor)
+        except RuntimeError as e:
+            self.assertIn("bailing out", str(e))
+        else:
+            self.fail("compress_ucpf did not fail")
+        self.assertEqual(os.listdir(self.incremental_path), ['db__2020-01-01_00-00-00.sql'])
+        self.assertFalse(BackupDirectorySnapshot.exists(
+            os.path.join(self.incremental_path, 'db__2020-01-01_00-00-00.sql.gz')))
+
+    def test_failed_write_kills_the_compressor(self):
+        processes = list()
+        popen = subprocess.Popen
+
+        class Popen(popen):
+            def __init__(self, *args, **kwargs):
+                popen.__init__(self, *args, **kwargs)
+                processes.append(self)
+
+        def stream(stage, src_pointer, dst_pointer, buffer_size, hash_obj=None):
+            dst_pointer.write(src_pointer.read(1024))
+            raise IOError(errno.ENOSPC, "No space left on device")
+        MysqlBackupThrottle.stream = staticmethod(stream)
+        subprocess.Popen = Popen
+        self.addCleanup(setattr, subprocess, 'Popen', popen)
+        try:
+            self.compress('gzip')
+        except IOError as e:
+            self.assertEqual(e.errno, errno.ENOSPC)
+        else:
+            self.fail("compress_ucpf did not fail")
+        # Reaped, not left blocked on its pipe
+        self.assertEqual(len(processes), 1)
+        self.assertIsNotNone(processes[0].returncode)
+        # The uncompressed dump is kept for the next attempt, the partial file is gone
+        self.assertEqual(os.listdir(self.incremental_path), ['db__2020-01-01_00-00-00.sql'])
+        self.assertFalse(BackupDirectorySnapshot.exists(
+            os.path.join(self.incremental_path, 'db__2020-01-01_00-00-00.sql.gz')))
+
+
+if __name__ == '__main__':
+    unittest.main()
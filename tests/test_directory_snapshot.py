@@ -0,0 +1,175 @@
+import cPickle
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mysql_backup.mysql_backup_directory_snapshot import BackupDirectorySnapshot, CURSOR_VERSION
+from mysql_backup.mysql_backup_directory_watcher import DirectoryWatcher
+from run_metrics.run_metrics import RunMetrics
+
+
+class DirectorySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.directory = os.path.join(self.work_dir, 'incrementals')
+        os.mkdir(self.directory)
+        self.cursor_file = os.path.join(self.work_dir, 'cursor')
+        BackupDirectorySnapshot.reset()
+        BackupDirectorySnapshot.watch = False
+        BackupDirectorySnapshot.persistent = False
+        BackupDirectorySnapshot.cursor_file = None
+        BackupDirectorySnapshot.cursor = None
+        RunMetrics.reset()
+
+    def tearDown(self):
+        BackupDirectorySnapshot.reset()
+        BackupDirectorySnapshot.watch = False
+        BackupDirectorySnapshot.persistent = False
+        BackupDirectorySnapshot.cursor_file = None
+        BackupDirectorySnapshot.cursor = None
+        RunMetrics.reset()
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, file_name, content='x'):
+        file_name_full_path = os.path.join(self.directory, file_name)
+        with open(file_name_full_path, 'w') as file_pointer:
+            file_pointer.write(content)
+        return file_name_full_path
+
+    def age_directory(self, seconds=60):
+        """Back date the directory so a listing taken now is trusted"""
+        past = time.time() - seconds
+        os.utime(self.directory, (past, past))
+
+    def test_lists_regular_files_once(self):
+        self.write_file('a.sql', 'abc')
+        os.mkdir(os.path.join(self.directory, 'not_a_file'))
+        self.assertEqual(BackupDirectorySnapshot.list_files(self.directory + '/'),
+                         [os.path.join(self.directory, 'a.sql')])
+        self.assertEqual(BackupDirectorySnapshot.get_size(os.path.join(self.directory, 'a.sql')), 3)
+        # Asked again from the listing, not the filesystem
+        self.write_file('b.sql')
+        self.assertFalse(BackupDirectorySnapshot.exists(os.path.join(self.directory, 'b.sql')))
+        self.assertEqual(RunMetrics.get_values()['directory_scans'], 1)
+
+    def test_kept_current_by_the_run(self):
+        BackupDirectorySnapshot.get_entries(self.directory)
+        version = BackupDirectorySnapshot.get_version(self.directory)
+        created = self.write_file('a.sql', 'abcd')
+        BackupDirectorySnapshot.add(created)
+        self.assertEqual(BackupDirectorySnapshot.get_size(created), 4)
+        self.assertNotEqual(BackupDirectorySnapshot.get_version(self.directory), version)
+        BackupDirectorySnapshot.remove(created)
+        self.assertFalse(os.path.exists(created))
+        self.assertFalse(BackupDirectorySnapshot.exists(created))
+        # Removed by someone else already
+        BackupDirectorySnapshot.remove(created)
+        self.assertEqual(BackupDirectorySnapshot.get_size(created), 0)
+        self.assertIsNone(BackupDirectorySnapshot.get_mtime(created))
+
+    def test_add_leaves_unlisted_directories_alone(self):
+        BackupDirectorySnapshot.add(self.write_file('a.sql'))
+        self.assertNotIn(self.directory, BackupDirectorySnapshot.directories)
+
+    def test_stamp_rules(self):
+        self.age_directory()
+        stamp = BackupDirectorySnapshot.get_stamp(self.directory)
+        self.assertTrue(BackupDirectorySnapshot.is_unchanged(self.directory, stamp, time.time()))
+        # Changed within the second it was listed in, the mtime can not tell
+        self.assertFalse(BackupDirectorySnapshot.is_unchanged(self.directory, stamp, stamp[2] + 0.5))
+        self.write_file('a.sql')
+        self.assertFalse(BackupDirectorySnapshot.is_unchanged(self.directory, stamp, time.time()))
+        self.assertFalse(BackupDirectorySnapshot.is_unchanged(self.directory, None, time.time()))
+        self.assertIsNone(BackupDirectorySnapshot.get_stamp(os.path.join(self.work_dir, 'missing')))
+
+    def test_refresh_forgets_changed_directories_only(self):
+        self.age_directory()
+        BackupDirectorySnapshot.get_entries(self.directory)
+        BackupDirectorySnapshot.refresh()
+        self.assertIn(self.directory, BackupDirectorySnapshot.directories)
+        self.write_file('a.sql')
+        BackupDirectorySnapshot.refresh()
+        self.assertNotIn(self.directory, BackupDirectorySnapshot.directories)
+        self.assertTrue(BackupDirectorySnapshot.exists(os.path.join(self.directory, 'a.sql')))
+
+    def test_next_run_starts_from_the_cursor(self):
+        self.write_file('a.sql')
+        self.age_directory()
+        BackupDirectorySnapshot.cursor_file = self.cursor_file
+        BackupDirectorySnapshot.get_entries(self.directory)
+        BackupDirectorySnapshot.save_cursor()
+
+        # A new run, the directory untouched since
+        BackupDirectorySnapshot.reset()
+        BackupDirectorySnapshot.cursor = None
+        RunMetrics.reset()
+        self.assertEqual(BackupDirectorySnapshot.list_files(self.directory), [os.path.join(self.directory, 'a.sql')])
+        self.assertEqual(RunMetrics.get_values().get('directory_cursor_hits'), 1)
+        self.assertNotIn('directory_scans', RunMetrics.get_values())
+
+        # And once it changed, listed again
+        self.write_file('b.sql')
+        BackupDirectorySnapshot.reset()
+        BackupDirectorySnapshot.cursor = None
+        RunMetrics.reset()
+        self.assertEqual(len(BackupDirectorySnapshot.list_files(self.directory)), 2)
+        self.assertEqual(RunMetrics.get_values().get('directory_scans'), 1)
+
+    def test_cursor_skips_listings_taken_within_the_second_of_a_change(self):
+        self.write_file('a.sql')
+        BackupDirectorySnapshot.cursor_file = self.cursor_file
+        BackupDirectorySnapshot.get_entries(self.directory)
+        BackupDirectorySnapshot.save_cursor()
+        self.assertEqual(BackupDirectorySnapshot.read_cursor(), {})
+
+    def test_unreadable_cursor_is_empty(self):
+        BackupDirectorySnapshot.cursor_file = self.cursor_file
+        self.assertEqual(BackupDirectorySnapshot.read_cursor(), {})
+        with open(self.cursor_file, 'w') as cursor_pointer:
+            cursor_pointer.write('not a pickle')
+        self.assertEqual(BackupDirectorySnapshot.read_cursor(), {})
+        self.age_directory()
+        BackupDirectorySnapshot.get_entries(self.directory)
+        BackupDirectorySnapshot.save_cursor()
+        self.assertIn(self.directory, BackupDirectorySnapshot.read_cursor())
+        # Written by another version
+        with open(self.cursor_file, 'wb') as cursor_pointer:
+            cPickle.dump({'version': CURSOR_VERSION + 1, 'directories': {}}, cursor_pointer)
+        self.assertEqual(BackupDirectorySnapshot.read_cursor(), {})
+
+    def test_watched_changes_are_applied_without_listing_again(self):
+        try:
+            DirectoryWatcher().close()
+        except OSError:
+            self.skipTest("inotify is not available")
+        BackupDirectorySnapshot.watch = True
+        BackupDirectorySnapshot.persistent = True
+        removed = self.write_file('a.sql')
+        BackupDirectorySnapshot.get_entries(self.directory)
+        os.remove(removed)
+        created = self.write_file('b.sql', 'abcdef')
+        RunMetrics.reset()
+        BackupDirectorySnapshot.refresh()
+        self.assertNotIn('directory_scans', RunMetrics.get_values())
+        self.assertEqual(BackupDirectorySnapshot.list_files(self.directory), [created])
+        self.assertEqual(BackupDirectorySnapshot.get_size(created), 6)
+        self.assertNotIn('directory_scans', RunMetrics.get_values())
+
+    def test_watched_directory_removed_is_forgotten(self):
+        try:
+            DirectoryWatcher().close()
+        except OSError:
+            self.skipTest("inotify is not available")
+        BackupDirectorySnapshot.watch = True
+        BackupDirectorySnapshot.persistent = True
+        BackupDirectorySnapshot.get_entries(self.directory)
+        shutil.rmtree(self.directory)
+        BackupDirectorySnapshot.refresh()
+        self.assertNotIn(self.directory, BackupDirectorySnapshot.directories)
+
+
+if __name__ == '__main__':
+    unittest.main()
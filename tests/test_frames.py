@@ -0,0 +1,123 @@
+import bz2
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from mysql_backup.mysql_backup_frames import DumpFrames
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADER = '-- MySQL dump\n/*!40101 SET NAMES utf8 */;\n\n'
+STRUCTURE_A = '--\n-- Table structure for table `a`\n--\n\nCREATE TABLE a (id int);\n\n'
+DATA_A = '--\n-- Dumping data for table `a`\n--\n\nINSERT INTO a VALUES (1);\n\n'
+STRUCTURE_B = '--\n-- Table structure for table `b`\n--\n\nCREATE TABLE b (id int);\n\n'
+DATA_B = '--\n-- Dumping data for table `b`\n--\n\nINSERT INTO b VALUES (2);\n\n'
+FOOTER = '/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n\n-- Dump completed\n'
+DUMP = HEADER + STRUCTURE_A + DATA_A + STRUCTURE_B + DATA_B + FOOTER
+
+
+class ReadFramesTest(unittest.TestCase):
+
+    def read_frames(self, dump, frame_size):
+        return list(DumpFrames.read_frames(StringIO(dump), frame_size))
+
+    def test_a_frame_per_section(self):
+        self.assertEqual(self.read_frames(DUMP, 1000), [
+            (('header', None), HEADER),
+            (('structure', 'a'), STRUCTURE_A),
+            (('data', 'a'), DATA_A),
+            (('structure', 'b'), STRUCTURE_B),
+            (('data', 'b'), DATA_B),
+            (('footer', None), FOOTER),
+        ])
+
+    def test_the_comment_line_before_a_marker_goes_with_it(self):
+        frames = self.read_frames(DUMP, 1000)
+        # Not left at the end of the previous section
+        self.assertTrue(frames[0][1].endswith(';\n\n'))
+        self.assertTrue(frames[1][1].startswith('--\n-- Table structure'))
+        # One not followed by a marker stays where it is
+        self.assertEqual(self.read_frames('--\nSELECT 1;\n--\n', 1000), [(('header', None), '--\nSELECT 1;\n--\n')])
+
+    def test_large_sections_span_frames(self):
+        data = '--\n-- Dumping data for table `a`\n--\n' + 'INSERT INTO a VALUES (1);\n' * 10
+        frames = self.read_frames(HEADER + data + FOOTER, 60)
+        self.assertEqual(''.join(frame for _, frame in frames), HEADER + data + FOOTER)
+        sections = [section for section, _ in frames]
+        # The section is given with its first frame only
+        self.assertEqual([section for section in sections if section], [('header', None), ('data', 'a'),
+                                                                         ('footer', None)])
+        self.assertIsNone(sections[sections.index(('data', 'a')) + 1])
+        self.assertTrue(all(len(frame) < 60 + 26 for _, frame in frames))
+
+    def test_long_lines_are_read_in_pieces(self):
+        # A piece starting with what looks like a marker is still the middle of a line
+        line = 'INSERT INTO a VALUES (\'' + 'x' * 40 + '-- Dumping data for table `c`\n'
+        frames = self.read_frames(HEADER + line + FOOTER, 40)
+        self.assertEqual(''.join(frame for _, frame in frames), HEADER + line + FOOTER)
+        self.assertNotIn(('data', 'c'), [section for section, _ in frames])
+        self.assertTrue(all(len(frame) <= 40 + 40 for _, frame in frames))
+
+    def test_empty_dump(self):
+        self.assertEqual(self.read_frames('', 1000), [(('header', None), '')])
+
+
+class ExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.src = os.path.join(self.work_dir, 'db.sql')
+        self.dst = os.path.join(self.work_dir, 'db.sql.bz2')
+        with open(self.src, 'wb') as src_pointer:
+            src_pointer.write(DUMP)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_frames_for_tables(self):
+        index = DumpFrames.compress(self.src, self.dst, 1000)
+        # header, structure a, data a, structure b, data b, footer
+        self.assertEqual(DumpFrames.get_frames_for_tables(index, ['a']), [0, 1, 2, 5])
+        self.assertEqual(DumpFrames.get_frames_for_tables(index, ['b', 'a']), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(DumpFrames.get_frames_for_tables(index, []), [0, 5])
+
+    def test_frames_are_a_whole_bz2_file(self):
+        index = DumpFrames.compress(self.src, self.dst, 50, threads=3)
+        self.assertGreater(len(index['frames']), 6)
+        self.assertEqual(os.path.getsize(self.dst), index['compressed_bytes'])
+        # bzip2 decompresses the concatenated streams as one
+        self.assertEqual(subprocess.check_output(['bzip2', '-dc', self.dst]), DUMP)
+
+    def test_extract_only_the_tables_asked_for(self):
+        index = DumpFrames.compress(self.src, self.dst, 50, threads=2)
+        for threads in (1, 4):
+            output = StringIO()
+            written = DumpFrames.extract(self.dst, index, ['b'], output, threads)
+            self.assertEqual(output.getvalue(), HEADER + STRUCTURE_B + DATA_B + FOOTER)
+            self.assertEqual(written, len(output.getvalue()))
+
+    def test_extract_refuses_a_file_not_matching_its_index(self):
+        index = DumpFrames.compress(self.src, self.dst, 1000)
+        with open(self.dst, 'ab') as dst_pointer:
+            dst_pointer.write('garbage')
+        self.assertRaises(ValueError, DumpFrames.extract, self.dst, index, ['a'], StringIO())
+
+    def test_extract_checks_frame_sizes(self):
+        index = DumpFrames.compress(self.src, self.dst, 1000)
+        index['frames'][1][2] += 1
+        self.assertRaises(ValueError, DumpFrames.extract, self.dst, index, ['a'], StringIO())
+
+    def test_extract_script_writes_relative_output_where_it_was_run(self):
+        DumpFrames.write_index(DumpFrames.compress(self.src, self.dst, 1000), DumpFrames.get_index_name(self.dst))
+        subprocess.check_call([sys.executable, os.path.join(REPO_DIR, 'extract.py'), '-f', 'db.sql.bz2', '-t', 'a',
+                               '-o', 'part.sql'], cwd=self.work_dir)
+        with open(os.path.join(self.work_dir, 'part.sql')) as part_pointer:
+            self.assertEqual(part_pointer.read(), HEADER + STRUCTURE_A + DATA_A + FOOTER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from optparse import Values
+
+from benchmark.fakes import fake_server_state
+from benchmark.run_benchmark import Workspace, DEFERRED_MODULES, FAKES_DIR, REPO_DIR
+
+# Generous next to the benchmark's --import-budget-ms, a loaded test host
+# must not fail it, a deferred module imported at the top would
+IMPORT_BUDGET_SECONDS = 0.5
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import run
+import mysql_backup.mysql_backup
+print(json.dumps({'seconds': time.time() - start,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+NOTHING_DUE_SCRIPT = """
+import json, sys
+from mysql_backup.mysql_backup import MysqlBackup
+MysqlBackup(%r).execute()
+print(json.dumps({'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def run_script(script, env):
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_DIR, env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_defers_heavy_modules(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = REPO_DIR
+        measured = run_script(IMPORT_SCRIPT % (DEFERRED_MODULES,), env)
+        self.assertEqual(measured['loaded'], [])
+        self.assertLess(measured['seconds'], IMPORT_BUDGET_SECONDS)
+
+
+class NothingDueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.state_env = os.environ.get(fake_server_state.STATE_ENV)
+        self.workspace = Workspace(Values({
+            'databases': 3, 'instances': 4, 'junk_files': 2, 'dump_bytes': 1024, 'dump_bytes_per_second': 0,
+            'change_probability': 0.5, 'max_parallel': 0, 'replicas': 1, 'loglevel': 'WARNING',
+            'work_dir': self.work_dir,
+        }))
+        self.workspace.reset_tree()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        if self.state_env is None:
+            os.environ.pop(fake_server_state.STATE_ENV, None)
+        else:
+            os.environ[fake_server_state.STATE_ENV] = self.state_env
+
+    def test_nothing_due_never_loads_the_driver(self):
+        settings_file = os.path.join(self.workspace.workspace, 'settings_nothing_due.ini')
+        with open(self.workspace.settings_file) as settings, open(settings_file, 'w') as nothing_due:
+            nothing_due.write(settings.read().replace('\nincremental_min_backup_frequency_seconds\n',
+                                                      '\nincremental_min_backup_frequency_seconds = 315360000\n'))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([FAKES_DIR, REPO_DIR])
+        # The first run is due and records a successful run
+        first = run_script(NOTHING_DUE_SCRIPT % (settings_file, DEFERRED_MODULES), env)
+        self.assertIn('MySQLdb', first['loaded'])
+        second = run_script(NOTHING_DUE_SCRIPT % (settings_file, DEFERRED_MODULES), env)
+        self.assertNotIn('MySQLdb', second['loaded'])
+
+
+if __name__ == '__main__':
+    unittest.main()
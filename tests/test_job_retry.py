@@ -0,0 +1,141 @@
+import errno
+import shutil
+import sys
+import tempfile
+import unittest
+
+from benchmark.run_benchmark import FAKES_DIR
+from mysql_backup.mysql_backup_job_retry import DumpFailedError, JobRetry, EX_MYSQLERR, STDERR_MAX_BYTES
+from run_metrics.run_metrics import RunMetrics
+from tests.helpers import make_config, stop_config
+
+
+class OperationalError(Exception):
+    """Stands in for a driver error, which is_transient must not retry"""
+
+
+class DumpFailedErrorTest(unittest.TestCase):
+
+    def test_server_errors_worth_another_attempt(self):
+        for stderr in ("mysqldump: Got error: 2013: Lost connection to MySQL server during query when dumping "
+                       "table `t` at row: 10",
+                       "mysqldump: Got error: 2002: Can't connect to local MySQL server through socket",
+                       "mysqldump: Error 2006: MySQL server has gone away when dumping table `t`",
+                       "mysqldump: Couldn't execute 'SELECT ...': Lock wait timeout exceeded; try restarting "
+                       "transaction (1205)",
+                       "mysqldump: Got error: 1040: Too many connections when trying to connect"):
+            self.assertTrue(DumpFailedError("failed", EX_MYSQLERR, stderr).is_transient(), stderr)
+
+    def test_server_errors_not_worth_another_attempt(self):
+        for stderr in ("mysqldump: Got error: 1049: Unknown database 'gone' when selecting the database",
+                       "mysqldump: Got error: 1045: Access denied for user 'backup'@'localhost'",
+                       "mysqldump: Couldn't find table: \"t2013\"",
+                       ""):
+            self.assertFalse(DumpFailedError("failed", EX_MYSQLERR, stderr).is_transient(), stderr)
+
+    def test_only_server_errors_are_retried(self):
+        stderr = "mysqldump: Got error: 2013: Lost connection to MySQL server"
+        # Killed, out of memory or a usage error, whatever stderr says
+        for returncode in (1, 3, 5, -9, 137):
+            self.assertFalse(DumpFailedError("failed", returncode, stderr).is_transient(), returncode)
+
+    def test_message_names_the_error(self):
+        error = DumpFailedError("Something went wrong", EX_MYSQLERR, "mysqldump: Got error: 1049: Unknown\n")
+        self.assertEqual(str(error), "Something went wrong. mysqldump: Got error: 1049: Unknown")
+        self.assertEqual(error.get_mysql_errors(), [1049])
+        self.assertEqual(str(DumpFailedError("Something went wrong", 1)), "Something went wrong")
+
+    def test_read_stderr_keeps_the_end(self):
+        stderr_pointer = tempfile.TemporaryFile()
+        with stderr_pointer:
+            stderr_pointer.write('warning\n' * 2000 + 'mysqldump: Got error: 2013: Lost connection\n')
+            stderr = DumpFailedError.read_stderr(stderr_pointer)
+        self.assertEqual(len(stderr), STDERR_MAX_BYTES)
+        self.assertTrue(stderr.endswith('Got error: 2013: Lost connection\n'))
+        stderr_pointer = tempfile.TemporaryFile()
+        with stderr_pointer:
+            self.assertEqual(DumpFailedError.read_stderr(stderr_pointer), '')
+
+
+class JobRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.config = make_config(self.work_dir, job_retries=2, job_retry_delay_seconds=0)
+        RunMetrics.reset()
+
+    def tearDown(self):
+        RunMetrics.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def test_is_transient(self):
+        self.assertTrue(JobRetry.is_transient(DumpFailedError("failed", EX_MYSQLERR, "Got error: 2013: Lost")))
+        self.assertFalse(JobRetry.is_transient(DumpFailedError("failed", EX_MYSQLERR, "Got error: 1049: Unknown")))
+        self.assertTrue(JobRetry.is_transient(IOError(errno.EAGAIN, "Resource temporarily unavailable")))
+        self.assertFalse(JobRetry.is_transient(IOError(errno.ENOSPC, "No space left on device")))
+        self.assertFalse(JobRetry.is_transient(OSError(errno.EACCES, "Permission denied")))
+        self.assertFalse(JobRetry.is_transient(RuntimeError("compress failed")))
+        self.assertFalse(JobRetry.is_transient(OperationalError(2013, "Lost connection")))
+
+    def test_is_transient_driver_errors(self):
+        try:
+            import MySQLdb
+        except ImportError:
+            # The benchmark's stand in, its errors are what is_transient looks at
+            sys.path.insert(0, FAKES_DIR)
+            try:
+                import MySQLdb
+            finally:
+                sys.path.remove(FAKES_DIR)
+            self.addCleanup(sys.modules.pop, 'MySQLdb', None)
+        self.assertTrue(JobRetry.is_transient(MySQLdb.OperationalError(2013, "Lost connection")))
+        self.assertTrue(JobRetry.is_transient(MySQLdb.OperationalError(1205, "Lock wait timeout exceeded")))
+        self.assertFalse(JobRetry.is_transient(MySQLdb.OperationalError(1049, "Unknown database")))
+        self.assertFalse(JobRetry.is_transient(MySQLdb.OperationalError()))
+
+    def run_job(self, errors):
+        """Run a job raising errors one attempt after another, then succeeding.
+        return: (the failure, attempts made)"""
+        attempts = list()
+
+        def job():
+            attempts.append(None)
+            if len(attempts) <= len(errors):
+                raise errors[len(attempts) - 1]
+        return JobRetry(self.config, 'db').run(job), len(attempts)
+
+    def test_transient_failures_are_retried(self):
+        lost = DumpFailedError("failed", EX_MYSQLERR, "Got error: 2013: Lost connection")
+        self.assertEqual(self.run_job([lost, lost]), (None, 3))
+        self.assertEqual(RunMetrics.get_values('db').get('job_retries'), 2)
+        self.assertNotIn('job_failures', RunMetrics.get_values('db'))
+
+    def test_gives_up_after_the_last_retry(self):
+        lost = DumpFailedError("failed", EX_MYSQLERR, "Got error: 2013: Lost connection")
+        failure, attempts = self.run_job([lost] * 5)
+        self.assertEqual(attempts, 3)
+        self.assertEqual((failure['db_name'], failure['transient'], failure['attempts']), ('db', True, 3))
+        self.assertEqual(RunMetrics.get_values('db').get('job_failures'), 1)
+
+    def test_fatal_failure_is_not_retried(self):
+        failure, attempts = self.run_job([DumpFailedError("failed", EX_MYSQLERR, "Got error: 1049: Unknown")])
+        self.assertEqual(attempts, 1)
+        self.assertFalse(failure['transient'])
+        self.assertIn('DumpFailedError', failure['error'])
+        failure, attempts = self.run_job([IOError(errno.ENOSPC, "No space left on device")])
+        self.assertEqual(attempts, 1)
+        self.assertEqual(failure['error'], "IOError (ENOSPC): [Errno 28] No space left on device")
+
+    def test_after_swallows_errors(self):
+        calls = list()
+
+        def fails(*args):
+            calls.append(args)
+            raise IOError(errno.EIO, "Input/output error")
+        JobRetry(self.config, 'db').after("handing back replica db2", fails, 'db2', 'db')
+        self.assertEqual(calls, [('db2', 'db')])
+
+
+if __name__ == '__main__':
+    unittest.main()
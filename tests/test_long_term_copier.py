@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mysql_backup.mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup.mysql_backup_long_term_copier import LongTermCopier
+from mysql_backup.mysql_backup_long_term_storage import LongTermStorage
+from mysql_backup.mysql_retention_planner import RetentionColumns, RetentionExecutor, RetentionPlan, \
+    PROMOTE, DEMOTE, KEEP
+from run_metrics.run_metrics import RunMetrics
+from tests.helpers import make_config, stop_config
+
+
+class FakeInstance(object):
+    """Records the retention actions applied to it in a shared log"""
+
+    def __init__(self, name, log, fail=False):
+        self.name = name
+        self.log = log
+        self.fail = fail
+
+    def __str__(self):
+        return self.name
+
+    def set_as_long_term_version(self, lt_state):
+        if lt_state and self.fail:
+            self.log.append(('failed promotion', self.name))
+            raise RuntimeError("copy of %s failed" % self.name)
+        self.log.append(('promote' if lt_state else 'demote', self.name))
+
+    def check_removable(self):
+        pass
+
+    def get_removal_stages(self):
+        return [], []
+
+
+class LongTermCopierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.incremental_path = os.path.join(self.work_dir, 'incrementals')
+        self.long_term_path = os.path.join(self.work_dir, 'long_term')
+        os.mkdir(self.incremental_path)
+        os.mkdir(self.long_term_path)
+        self.config = make_config(self.work_dir, incremental_path=self.incremental_path,
+                                  long_term_backup_path=self.long_term_path, long_term_storage='filesystem',
+                                  long_term_copy_verify=True, long_term_copy_streams=2, retention_io_threads=2,
+                                  deletion_retries=0)
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+        LongTermStorage.configure(self.config)
+        LongTermCopier.backup_logger = self.config.get_logger('long_term')
+        LongTermCopier.config = self.config
+
+    def tearDown(self):
+        LongTermCopier.drain()
+        LongTermStorage.storage = None
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, directory, file_name, content):
+        file_name_full_path = os.path.join(directory, file_name)
+        with open(file_name_full_path, 'w') as file_pointer:
+            file_pointer.write(content)
+        return file_name_full_path
+
+    def test_promotion_removes_demoted_copies_once_landed(self):
+        src = self.write_file(self.incremental_path, 'db.2.sql', 'new dump')
+        old = self.write_file(self.long_term_path, 'db.1.sql', 'old dump')
+        dst = os.path.join(self.long_term_path, 'db.2.sql')
+        LongTermCopier.promote('db', src, dst, [old], 1)
+        with open(dst) as copy_pointer:
+            self.assertEqual(copy_pointer.read(), 'new dump')
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(src))
+        self.assertEqual(os.listdir(self.long_term_path), ['db.2.sql'])
+        self.assertEqual(RunMetrics.get_values('db').get('long_term_removals'), 1)
+
+    def test_failed_copy_keeps_older_long_term_copies(self):
+        src = os.path.join(self.incremental_path, 'missing.sql')
+        old = self.write_file(self.long_term_path, 'db.1.sql', 'old dump')
+        LongTermCopier.promote('db', src, os.path.join(self.long_term_path, 'db.2.sql'), [old], 1)
+        # Neither the demoted copy nor a partial copy of the new one
+        self.assertEqual(os.listdir(self.long_term_path), ['db.1.sql'])
+        self.assertEqual(RunMetrics.get_values('db').get('long_term_copy_failures'), 1)
+        self.assertNotIn('long_term_removals', RunMetrics.get_values('db'))
+
+    def test_temporary_source_is_removed_either_way(self):
+        src = self.write_file(self.incremental_path, 'db.2.sql.tmp', 'decompressed')
+        LongTermCopier.promote('db', src, os.path.join(self.long_term_path, 'db.2.sql'), [], 0, remove_src=True)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(os.listdir(self.long_term_path), ['db.2.sql'])
+
+    def test_queued_promotions_are_done_by_drain(self):
+        LongTermCopier.start(self.config)
+        self.assertTrue(LongTermCopier.is_started())
+        for i in range(5):
+            src = self.write_file(self.incremental_path, 'db%d.sql' % i, 'dump %d' % i)
+            LongTermCopier.submit('db%d' % i, src, os.path.join(self.long_term_path, 'db%d.sql' % i), [], 0)
+        LongTermCopier.drain()
+        self.assertFalse(LongTermCopier.is_started())
+        self.assertEqual(sorted(os.listdir(self.long_term_path)), ['db%d.sql' % i for i in range(5)])
+
+    def apply(self, instances):
+        """instances: dict of key -> (action, instance)"""
+        columns = RetentionColumns()
+        actions = list()
+        for key in sorted(instances):
+            columns.add('db', key, 0, False)
+            actions.append(instances[key][0])
+        plan = RetentionPlan(columns, actions, [''] * len(actions))
+        RetentionExecutor(self.config).apply(plan, 'db', dict((key, instance) for key, (_, instance)
+                                                              in instances.items()))
+
+    def test_promotions_finish_before_demotions_start(self):
+        log = list()
+        self.apply({
+            'a': (DEMOTE, FakeInstance('a', log)),
+            'b': (PROMOTE, FakeInstance('b', log)),
+            'c': (DEMOTE, FakeInstance('c', log)),
+            'd': (KEEP, FakeInstance('d', log)),
+        })
+        self.assertEqual(log[0], ('promote', 'b'))
+        self.assertEqual(sorted(log[1:]), [('demote', 'a'), ('demote', 'c')])
+
+    def test_failed_promotion_demotes_nothing(self):
+        log = list()
+        self.apply({
+            'a': (DEMOTE, FakeInstance('a', log)),
+            'b': (PROMOTE, FakeInstance('b', log, fail=True)),
+        })
+        self.assertEqual(log, [('failed promotion', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
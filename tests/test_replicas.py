@@ -0,0 +1,130 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# First, as a run does: the replicas and the package's main module import each other
+import mysql_backup.mysql_backup
+from mysql_backup.mysql_backup_replicas import BackupReplicas, Replica
+from run_cache import run_cache_manager
+from tests.helpers import make_config, stop_config
+
+
+class PlaceTest(unittest.TestCase):
+
+    def test_heaviest_first_onto_the_lightest_host(self):
+        placement = BackupReplicas.place({'a': 50, 'b': 40, 'c': 30, 'd': 20, 'e': 10}, ['db1', 'db2', 'db3'])
+        self.assertEqual(placement, {'db1': ['a'], 'db2': ['b', 'e'], 'db3': ['c', 'd']})
+
+    def test_databases_only_needing_retention_stay_with_the_first(self):
+        placement = BackupReplicas.place({'a': 10, 'b': 0, 'c': 0, 'd': 5}, ['db1', 'db2'])
+        self.assertEqual(placement, {'db1': ['a', 'b', 'c'], 'db2': ['d']})
+
+    def test_ties_are_deterministic(self):
+        weights = dict(('db%02d' % i, 1) for i in range(6))
+        placement = BackupReplicas.place(weights, ['db1', 'db2', 'db3'])
+        self.assertEqual(placement, {'db1': ['db00', 'db03'], 'db2': ['db01', 'db04'], 'db3': ['db02', 'db05']})
+        self.assertEqual(BackupReplicas.place(weights, ['db1', 'db2', 'db3']), placement)
+
+    def test_every_database_placed_once_within_the_greedy_bound(self):
+        randomizer = random.Random(49)
+        for _ in range(200):
+            hosts = ['db%d' % i for i in range(randomizer.randint(1, 5))]
+            weights = dict(('d%d' % i, randomizer.choice([0, 0, randomizer.randint(1, 10 ** 9)]))
+                           for i in range(randomizer.randint(0, 30)))
+            placement = BackupReplicas.place(weights, hosts)
+            self.assertEqual(sorted(db for db_names in placement.values() for db in db_names), sorted(weights))
+            loads = [sum(weights[db] for db in placement[host]) for host in hosts]
+            # Longest processing time first: no host exceeds the average by more than one database
+            if weights:
+                self.assertLessEqual(max(loads), sum(loads) / float(len(hosts)) + max(weights.values()))
+
+    def test_single_host(self):
+        self.assertEqual(BackupReplicas.place({'a': 1, 'b': 0}, ['db1']), {'db1': ['a', 'b']})
+
+
+class HostTest(unittest.TestCase):
+
+    def test_split_host(self):
+        self.assertEqual(BackupReplicas.split_host('db1'), ('db1', None))
+        self.assertEqual(BackupReplicas.split_host('db1:3307'), ('db1', 3307))
+        # An IPv6 address is left whole
+        self.assertEqual(BackupReplicas.split_host('::1'), ('::1', None))
+
+    def test_dump_options_follow_the_current_replica(self):
+        self.assertEqual(BackupReplicas.get_dump_options(), [])
+        with BackupReplicas.using('db2:3307'):
+            self.assertEqual(BackupReplicas.get_dump_options(), ['-h', 'db2', '-P', '3307'])
+            with BackupReplicas.using('db3'):
+                self.assertEqual(BackupReplicas.get_dump_options(), ['-h', 'db3'])
+            self.assertEqual(BackupReplicas.current, 'db2:3307')
+        self.assertIsNone(BackupReplicas.current)
+
+
+class FakeRunningCacheManager(object):
+
+    running_count = 1
+
+    def __init__(self, config):
+        pass
+
+    def get_current_running_count(self):
+        return FakeRunningCacheManager.running_count
+
+
+class ReleaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.config = make_config(self.work_dir, mysql_hosts=('db1', 'db2', 'db3'), mysql_host='db1',
+                                  running_cache_file=os.path.join(self.work_dir, 'running'))
+        BackupReplicas.configure(self.config)
+        self.started = list()
+        self.set_running = Replica.set_running
+        self.running_cache_manager = run_cache_manager.RunningCacheManager
+        started = self.started
+        Replica.set_running = lambda replica, running_state: started.append((replica.host, running_state))
+        run_cache_manager.RunningCacheManager = FakeRunningCacheManager
+        FakeRunningCacheManager.running_count = 1
+
+    def tearDown(self):
+        Replica.set_running = self.set_running
+        run_cache_manager.RunningCacheManager = self.running_cache_manager
+        BackupReplicas.hosts = ()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def read_remaining(self):
+        with open(BackupReplicas.remaining_file) as remaining_pointer:
+            return json.load(remaining_pointer)
+
+    def test_slave_started_after_its_last_database(self):
+        BackupReplicas.write_remaining({'db1': ['a'], 'db2': ['b', 'c'], 'db3': []})
+        self.assertEqual(self.read_remaining(), {'db2': ['b', 'c']})
+        BackupReplicas.release(self.config, 'db2', 'b')
+        self.assertEqual(self.read_remaining(), {'db2': ['c']})
+        self.assertEqual(self.started, [])
+        # Not on the replica's list
+        BackupReplicas.release(self.config, 'db2', 'b')
+        BackupReplicas.release(self.config, 'db1', 'a')
+        self.assertEqual(self.started, [])
+        BackupReplicas.release(self.config, 'db2', 'c')
+        self.assertEqual(self.read_remaining(), {})
+        self.assertEqual(self.started, [('db2', True)])
+
+    def test_slave_left_stopped_while_another_backup_runs(self):
+        FakeRunningCacheManager.running_count = 2
+        BackupReplicas.write_remaining({'db2': ['b']})
+        BackupReplicas.release(self.config, 'db2', 'b')
+        self.assertEqual(self.started, [])
+
+    def test_release_without_fan_out(self):
+        BackupReplicas.remove_remaining()
+        BackupReplicas.release(self.config, 'db2', 'b')
+        self.assertEqual(self.started, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
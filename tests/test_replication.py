@@ -0,0 +1,128 @@
+import unittest
+
+from mysql_backup.mysql_backup_replication import ReplicationPosition, UNKNOWN
+
+
+def event(pos, event_type, info='', end_log_pos=None):
+    return {'Pos': pos, 'Event_type': event_type, 'Info': info,
+            'End_log_pos': end_log_pos if end_log_pos is not None else pos + 10}
+
+
+class BinlogCursor(object):
+    """Answers SHOW BINARY LOGS and SHOW BINLOG EVENTS from logs, a
+    dict of log file -> events, as a DictCursor would"""
+
+    def __init__(self, logs, master_status=None):
+        self.logs = logs
+        self.master_status = master_status
+        self.rows = None
+
+    def execute(self, statement, args=None):
+        if statement.startswith("SHOW BINARY LOGS"):
+            self.rows = [{'Log_name': log_file} for log_file in sorted(self.logs)]
+        elif statement.startswith("SHOW MASTER STATUS"):
+            self.rows = [self.master_status] if self.master_status else []
+        elif statement.startswith("SHOW BINLOG EVENTS"):
+            log_file, position, limit = args
+            events = [e for e in self.logs[log_file] if e['Pos'] >= position]
+            self.rows = events[:limit]
+        else:
+            raise AssertionError("unexpected statement %s" % statement)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class EventDatabaseTest(unittest.TestCase):
+
+    def test_table_map_names_the_database(self):
+        self.assertEqual(ReplicationPosition.get_event_database(
+            event(4, 'Table_map', 'table_id: 108 (shop.orders)')), 'shop')
+        self.assertEqual(ReplicationPosition.get_event_database(
+            event(4, 'Table_map', 'table_id: 108 (`shop`.`orders`)')), 'shop')
+        self.assertIs(ReplicationPosition.get_event_database(event(4, 'Table_map', 'garbled')), UNKNOWN)
+
+    def test_events_that_change_nothing_by_themselves(self):
+        for event_type in ('Gtid', 'Xid', 'Rotate', 'Write_rows', 'Update_rows', 'Delete_rows', 'Format_desc'):
+            self.assertIsNone(ReplicationPosition.get_event_database(event(4, event_type)), event_type)
+        for info in ('BEGIN', 'COMMIT', '  rollback', 'COMMIT WORK', 'XA START', 'XA END X\'a\'', 'SAVEPOINT a',
+                     'RELEASE SAVEPOINT a', 'ROLLBACK TO `a`'):
+            self.assertIsNone(ReplicationPosition.get_event_database(event(4, 'Query', info)), info)
+
+    def test_statements_can_not_be_told(self):
+        for info in ('use `shop`; UPDATE orders SET paid = 1', 'CREATE TABLE shop.t (id int)',
+                     'BEGIN NOT ATOMIC INSERT INTO shop.t VALUES (1); END', 'COMMITTED_ORDERS'):
+            self.assertIs(ReplicationPosition.get_event_database(event(4, 'Query', info)), UNKNOWN, info)
+        self.assertIs(ReplicationPosition.get_event_database(event(4, 'Some_future_event')), UNKNOWN)
+
+
+class TouchedDatabasesTest(unittest.TestCase):
+
+    def test_row_events_across_binlogs(self):
+        cursor = BinlogCursor({
+            'slave-bin.000001': [event(4, 'Format_desc'), event(100, 'Table_map', 'table_id: 1 (before.t)'),
+                                 event(200, 'Gtid'), event(210, 'Query', 'BEGIN'),
+                                 event(220, 'Table_map', 'table_id: 2 (shop.orders)'), event(230, 'Write_rows'),
+                                 event(240, 'Xid'), event(250, 'Rotate')],
+            'slave-bin.000002': [event(4, 'Format_desc'), event(120, 'Table_map', 'table_id: 3 (crm.leads)'),
+                                 event(130, 'Update_rows'), event(500, 'Table_map', 'table_id: 4 (after.t)')],
+        })
+        self.assertEqual(ReplicationPosition.get_touched_databases(cursor, ('slave-bin.000001', 200),
+                                                                   ('slave-bin.000002', 500), 100),
+                         set(['shop', 'crm']))
+
+    def test_pages_through_long_binlogs(self):
+        events = [event(4 + 10 * i, 'Table_map', 'table_id: %d (db%d.t)' % (i, i % 3)) for i in range(25)]
+        cursor = BinlogCursor({'slave-bin.000001': events})
+        self.assertEqual(ReplicationPosition.get_touched_databases(cursor, ('slave-bin.000001', 4),
+                                                                   ('slave-bin.000001', 1000), 100, page_size=4),
+                         set(['db0', 'db1', 'db2']))
+
+    def test_can_not_tell(self):
+        logs = {'slave-bin.000002': [event(4, 'Query', 'use `shop`; DELETE FROM orders'),
+                                     event(20, 'Table_map', 'table_id: 1 (shop.orders)')]}
+        # A statement was logged
+        self.assertIsNone(ReplicationPosition.get_touched_databases(BinlogCursor(logs), ('slave-bin.000002', 4),
+                                                                    ('slave-bin.000002', 100), 100))
+        # The start was purged
+        self.assertIsNone(ReplicationPosition.get_touched_databases(BinlogCursor(logs), ('slave-bin.000001', 4),
+                                                                    ('slave-bin.000002', 100), 100))
+        # Too many events to read
+        logs = {'slave-bin.000002': [event(4 + 10 * i, 'Table_map', 'table_id: 1 (shop.t)') for i in range(10)]}
+        self.assertIsNone(ReplicationPosition.get_touched_databases(BinlogCursor(logs), ('slave-bin.000002', 4),
+                                                                    ('slave-bin.000002', 1000), 5))
+
+    def test_nothing_applied(self):
+        cursor = BinlogCursor({'slave-bin.000001': [event(4, 'Format_desc'), event(300, 'Table_map',
+                                                                                  'table_id: 1 (shop.t)')]})
+        self.assertEqual(ReplicationPosition.get_touched_databases(cursor, ('slave-bin.000001', 300),
+                                                                   ('slave-bin.000001', 300), 100), set())
+
+
+class PositionTest(unittest.TestCase):
+
+    def test_slave_position_ignores_gtid_whitespace(self):
+        status = {'Executed_Gtid_Set': 'uuid:1-10,\nother:1-5', 'Relay_Master_Log_File': 'bin.000003',
+                  'Exec_Master_Log_Pos': '120'}
+        self.assertEqual(ReplicationPosition.get_slave_position(status), ('uuid:1-10,other:1-5', 'bin.000003', 120))
+        self.assertEqual(ReplicationPosition.get_slave_position({}), ('', None, 0))
+
+    def test_compare_master_positions(self):
+        compare = ReplicationPosition.compare_master_positions
+        self.assertEqual(compare(('bin.000002', 500), ('bin.000010', 4)), -1)
+        self.assertEqual(compare(('bin.000010', 4), ('bin.000002', 500)), 1)
+        self.assertEqual(compare(('bin.000002', 500), ('bin.000002', 500)), 0)
+        self.assertIsNone(compare(('bin.000002', 500), ('other.000002', 500)))
+        self.assertIsNone(compare((None, 0), ('bin.000002', 500)))
+
+    def test_binlog_position(self):
+        self.assertEqual(ReplicationPosition.get_binlog_position(
+            BinlogCursor({}, {'File': 'slave-bin.000004', 'Position': '154'})), ('slave-bin.000004', 154))
+        self.assertIsNone(ReplicationPosition.get_binlog_position(BinlogCursor({})))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import random
+import unittest
+
+from mysql_backup.mysql_retention_planner import RetentionColumns, RetentionPlanner, KEEP, DELETE, PROMOTE, \
+    DEMOTE
+
+NOW = 1000000000
+HOUR = 3600
+DAY = 86400
+
+
+def baseline_outcome(rows, now, incremental_max_copies=None, incremental_max_lifespan_seconds=None,
+                     long_term_backup_max_copies=None, long_term_backup_min_frequency_seconds=None,
+                     long_term_max_lifespan_seconds=None):
+    """The short and long term loops of MysqlDbInstance before the
+    planner, on (key, timestamp, long term) rows.
+    return: dict of key -> 'deleted', 'long term' or 'incremental'"""
+    outcome = dict()
+    remaining = list()
+    st_counter = 0
+    for key, timestamp, long_term in sorted(rows, key=lambda row: now - row[1]):
+        destroy_this = False
+        if incremental_max_copies is not None and st_counter >= incremental_max_copies:
+            destroy_this = True
+        if incremental_max_lifespan_seconds is not None and now - timestamp > incremental_max_lifespan_seconds:
+            destroy_this = True
+        if destroy_this:
+            outcome[key] = 'deleted'
+        else:
+            st_counter += 1
+            remaining.append([key, timestamp, long_term])
+
+    if remaining:
+        if long_term_backup_max_copies is None or long_term_backup_max_copies != 0:
+            youngest = remaining[0]
+            if not youngest[2]:
+                most_recent_lt_age = None
+                for key, timestamp, long_term in remaining:
+                    if long_term:
+                        most_recent_lt_age = now - timestamp
+                        break
+                # None compared below anything in Python 2
+                if most_recent_lt_age is None or long_term_backup_min_frequency_seconds is None or \
+                        long_term_backup_min_frequency_seconds < most_recent_lt_age - (now - youngest[1]):
+                    youngest[2] = True
+            lt_instance_count = 0
+            for instance in remaining:
+                if not instance[2]:
+                    continue
+                keep_instance = True
+                if long_term_backup_max_copies is not None and lt_instance_count >= long_term_backup_max_copies:
+                    keep_instance = False
+                if long_term_max_lifespan_seconds is not None and now - instance[1] > long_term_max_lifespan_seconds:
+                    keep_instance = False
+                if keep_instance:
+                    lt_instance_count += 1
+                else:
+                    instance[2] = False
+        else:
+            for instance in remaining:
+                instance[2] = False
+
+    for key, timestamp, long_term in remaining:
+        outcome[key] = 'long term' if long_term else 'incremental'
+    return outcome
+
+
+def plan_outcome(rows, now, **settings):
+    columns = RetentionColumns()
+    for key, timestamp, long_term in rows:
+        columns.add('db', key, timestamp, long_term)
+    actions = RetentionPlanner(**settings).plan(columns, now).get_actions('db')
+    outcome = dict()
+    for key, timestamp, long_term in rows:
+        action = actions[key]
+        if action == DELETE:
+            outcome[key] = 'deleted'
+        elif action == PROMOTE or (action == KEEP and long_term):
+            outcome[key] = 'long term'
+        else:
+            outcome[key] = 'incremental'
+    return outcome
+
+
+def make_rows(timestamps, long_term=()):
+    return [('b%02d' % i, timestamp, i in long_term) for i, timestamp in enumerate(timestamps)]
+
+
+class RetentionPlannerTest(unittest.TestCase):
+
+    def test_keeps_closely_spaced_incrementals(self):
+        # Spacing was never enforced on existing backups
+        rows = make_rows([NOW - 60 * i for i in range(5)])
+        outcome = plan_outcome(rows, NOW, incremental_max_copies=10, long_term_backup_max_copies=0)
+        self.assertEqual(sorted(outcome.values()), ['incremental'] * 5)
+
+    def test_keeps_closely_spaced_long_term_copies(self):
+        rows = make_rows([NOW - 60 * i for i in range(3)], long_term=(0, 1, 2))
+        outcome = plan_outcome(rows, NOW, long_term_backup_max_copies=5,
+                               long_term_backup_min_frequency_seconds=DAY)
+        self.assertEqual(sorted(outcome.values()), ['long term'] * 3)
+
+    def test_deletes_beyond_max_copies_oldest_first(self):
+        rows = make_rows([NOW - HOUR * i for i in range(4)])
+        outcome = plan_outcome(rows, NOW, incremental_max_copies=2, long_term_backup_max_copies=0)
+        self.assertEqual([outcome[key] for key, _, _ in rows], ['incremental', 'incremental', 'deleted', 'deleted'])
+
+    def test_deletes_older_than_lifespan(self):
+        rows = make_rows([NOW - HOUR, NOW - 3 * DAY])
+        outcome = plan_outcome(rows, NOW, incremental_max_lifespan_seconds=2 * DAY, long_term_backup_max_copies=0)
+        self.assertEqual(outcome, {'b00': 'incremental', 'b01': 'deleted'})
+
+    def test_promotes_youngest_once_enough_time_passed(self):
+        rows = make_rows([NOW - HOUR, NOW - 3 * HOUR], long_term=(1,))
+        self.assertEqual(plan_outcome(rows, NOW, long_term_backup_min_frequency_seconds=HOUR)['b00'], 'long term')
+        self.assertEqual(plan_outcome(rows, NOW, long_term_backup_min_frequency_seconds=3 * HOUR)['b00'],
+                         'incremental')
+
+    def test_max_long_term_copies_zero_demotes_all(self):
+        columns = RetentionColumns()
+        for key, timestamp, long_term in make_rows([NOW - HOUR, NOW - DAY], long_term=(0, 1)):
+            columns.add('db', key, timestamp, long_term)
+        plan = RetentionPlanner(long_term_backup_max_copies=0).plan(columns, NOW)
+        self.assertEqual(plan.get_actions('db'), {'b00': DEMOTE, 'b01': DEMOTE})
+
+    def test_plans_databases_independently(self):
+        columns = RetentionColumns()
+        columns.add('a', 'a1', NOW - HOUR, False)
+        columns.add('b', 'b1', NOW - HOUR, False)
+        columns.add('a', 'a2', NOW - 2 * HOUR, False)
+        plan = RetentionPlanner(incremental_max_copies=1, long_term_backup_max_copies=0).plan(columns, NOW)
+        self.assertEqual(plan.get_actions('a'), {'a1': KEEP, 'a2': DELETE})
+        self.assertEqual(plan.get_actions('b'), {'b1': KEEP})
+        self.assertEqual(plan.get_actions('c'), {})
+
+    def test_matches_baseline_decisions(self):
+        randomizer = random.Random(20)
+        choices = {
+            'incremental_max_copies': (None, 0, 1, 3, 8),
+            'incremental_max_lifespan_seconds': (None, HOUR, DAY, 7 * DAY),
+            'long_term_backup_max_copies': (None, 0, 1, 2, 5),
+            'long_term_backup_min_frequency_seconds': (None, 0, HOUR, DAY),
+            'long_term_max_lifespan_seconds': (None, DAY, 30 * DAY),
+        }
+        for _ in range(2000):
+            settings = dict((name, randomizer.choice(values)) for name, values in choices.items())
+            timestamps = randomizer.sample(xrange(NOW - 40 * DAY, NOW), randomizer.randint(1, 12))
+            long_term = set(i for i in range(len(timestamps)) if randomizer.random() < 0.3)
+            rows = make_rows(timestamps, long_term)
+            self.assertEqual(plan_outcome(rows, NOW, **settings), baseline_outcome(rows, NOW, **settings),
+                             (settings, rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
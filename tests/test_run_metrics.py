@@ -0,0 +1,109 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mysql_backup.mysql_backup
+from run_metrics.run_metrics import RunMetrics
+from run_metrics.run_trace import RunTrace
+from tests.helpers import make_config, stop_config
+
+
+class FakeDbInstance(object):
+
+    def __init__(self, config, db_name):
+        self.config = config
+        self.db_name = db_name
+        self.replica = None
+
+
+class TakeSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        RunMetrics.reset()
+
+    def tearDown(self):
+        RunMetrics.reset()
+
+    def test_values_added_meanwhile_are_kept_once(self):
+        stop = threading.Event()
+        added = list()
+
+        def add():
+            count = 0
+            while not stop.is_set():
+                RunMetrics.add('long_term_promotions', 1, db_name='db')
+                count += 1
+            added.append(count)
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        taken = 0
+        for _ in range(2000):
+            taken += RunMetrics.take_snapshot()['databases'].get('db', {}).get('long_term_promotions', 0)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        taken += RunMetrics.take_snapshot()['databases'].get('db', {}).get('long_term_promotions', 0)
+        self.assertEqual(taken, sum(added))
+        self.assertEqual(RunMetrics.get_snapshot(), {'run': {}, 'databases': {}})
+
+
+class ForkDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.config = make_config(self.work_dir, job_retries=0, job_retry_delay_seconds=0)
+        self.execute_db = mysql_backup.mysql_backup.execute_db
+        self.enabled = RunTrace.enabled
+        RunTrace.enabled = True
+        RunMetrics.reset()
+        RunTrace.reset()
+
+    def tearDown(self):
+        mysql_backup.mysql_backup.execute_db = self.execute_db
+        RunTrace.enabled = self.enabled
+        RunMetrics.reset()
+        RunTrace.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def test_in_process_job_keeps_the_callers_collection(self):
+        def execute_db(db_instance_obj, run_started):
+            RunMetrics.add('dump_bytes', 100, db_name=db_instance_obj.db_name)
+            # As the caller's long term copier would while the job runs
+            RunMetrics.add('long_term_promotions', 1, db_name='other')
+            with RunTrace.span('dump'):
+                pass
+        mysql_backup.mysql_backup.execute_db = execute_db
+        RunMetrics.add('long_term_promotions', 2, db_name='other')
+        with RunTrace.span('before'):
+            pass
+
+        result = mysql_backup.mysql_backup.fork_db(FakeDbInstance(self.config, 'db'))
+        self.assertIsNone(result['failure'])
+        self.assertEqual(result['metrics']['databases'], {'db': {'dump_bytes': 100}, 'other':
+                                                          {'long_term_promotions': 1}})
+        self.assertIn('dump', [event['name'] for event in result['trace']])
+        self.assertEqual(RunMetrics.get_values('other'), {'long_term_promotions': 2})
+        self.assertEqual([event['name'] for event in RunTrace.get_events()], ['before'])
+
+        # Merged as the run does, each counted once
+        RunMetrics.merge(result['metrics'])
+        self.assertEqual(RunMetrics.get_values('other'), {'long_term_promotions': 3})
+        self.assertEqual(RunMetrics.get_values('db'), {'dump_bytes': 100})
+
+    def test_failed_job_is_returned(self):
+        def execute_db(db_instance_obj, run_started):
+            RunMetrics.add('dump_bytes', 100, db_name=db_instance_obj.db_name)
+            raise RuntimeError("compress failed")
+        mysql_backup.mysql_backup.execute_db = execute_db
+
+        result = mysql_backup.mysql_backup.fork_db(FakeDbInstance(self.config, 'db'))
+        self.assertEqual(result['failure']['db_name'], 'db')
+        self.assertEqual(result['metrics']['databases']['db']['dump_bytes'], 100)
+        self.assertEqual(RunMetrics.get_values('db').get('dump_bytes'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mysql_backup.mysql_backup_s3_storage import S3Storage
+from run_metrics.run_metrics import RunMetrics
+from tests.helpers import make_config, stop_config
+
+# Only run where moto is installed, as boto3 is only required for s3
+try:
+    import boto3
+    import moto
+    from botocore.exceptions import ClientError
+    mock_s3 = getattr(moto, 'mock_aws', None) or moto.mock_s3
+except ImportError:
+    moto = None
+
+MB = 1024 * 1024
+
+
+class S3StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        if moto is None:
+            self.skipTest("moto is not installed")
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.mock = mock_s3()
+        self.mock.start()
+        self.config = make_config(self.work_dir, s3_bucket='backups', s3_prefix='/mysql/', s3_region='us-east-1',
+                                  s3_access_key_id='testing', s3_secret_access_key='testing',
+                                  s3_part_size=5 * MB, s3_upload_threads=2, checksum_buffer_size=MB)
+        self.storage = S3Storage(self.config)
+        self.client = self.storage.get_client()
+        self.client.create_bucket(Bucket='backups')
+        self.max_parts = S3Storage.max_parts
+        RunMetrics.reset()
+
+    def tearDown(self):
+        S3Storage.max_parts = self.max_parts
+        RunMetrics.reset()
+        self.mock.stop()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def write_source(self, size):
+        src = os.path.join(self.work_dir, 'db__2020-01-01_00-00-00.sql.bz2')
+        with open(src, 'wb') as src_pointer:
+            src_pointer.write(os.urandom(size))
+        return src
+
+    def upload_ids(self):
+        return [upload['UploadId'] for upload in self.client.list_multipart_uploads(Bucket='backups')
+                .get('Uploads', ())]
+
+    def test_put_is_a_multipart_upload(self):
+        src = self.write_source(11 * MB)
+        self.storage.put(src, self.storage.get_full_name('db__2020-01-01_00-00-00.sql.bz2'))
+        head = self.client.head_object(Bucket='backups', Key='mysql/db__2020-01-01_00-00-00.sql.bz2')
+        with open(src, 'rb') as src_pointer:
+            parts = [src_pointer.read(5 * MB) for _ in range(3)]
+        etag = '%s-3' % hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+        self.assertEqual(head['ETag'].strip('"'), etag)
+        self.assertEqual(head['ContentLength'], 11 * MB)
+        self.assertEqual(RunMetrics.get_values().get('long_term_upload_parts'), 3)
+        self.assertEqual(RunMetrics.get_values().get('long_term_upload_bytes'), 11 * MB)
+
+    def test_part_size_grows_to_stay_within_max_parts(self):
+        self.assertEqual(self.storage.get_part_size(0), 5 * MB)
+        self.assertEqual(self.storage.get_part_size(100 * 1024 * MB), 100 * 1024 * MB / 10000 + 1)
+        S3Storage.max_parts = 2
+        src = self.write_source(11 * MB)
+        self.storage.put(src, self.storage.get_full_name('db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertEqual(RunMetrics.get_values().get('long_term_upload_parts'), 2)
+        head = self.client.head_object(Bucket='backups', Key='mysql/db__2020-01-01_00-00-00.sql.bz2')
+        self.assertTrue(head['ETag'].strip('"').endswith('-2'))
+
+    def test_failed_part_aborts_the_upload(self):
+        upload_part = self.client.upload_part
+
+        def fails(**kwargs):
+            if kwargs['PartNumber'] == 2:
+                raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'We encountered an internal '
+                                                                                 'error'}}, 'UploadPart')
+            return upload_part(**kwargs)
+        self.client.upload_part = fails
+        src = self.write_source(11 * MB)
+        self.assertRaises(RuntimeError, self.storage.put, src,
+                          self.storage.get_full_name('db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertEqual(self.upload_ids(), [])
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket='backups'))
+
+    def test_verify_mismatch_removes_the_object(self):
+        complete_multipart_upload = self.client.complete_multipart_upload
+
+        def bad_etag(**kwargs):
+            response = complete_multipart_upload(**kwargs)
+            response['ETag'] = '"%s-1"' % ('0' * 32)
+            return response
+        self.client.complete_multipart_upload = bad_etag
+        src = self.write_source(MB)
+        file_name = self.storage.get_full_name('db__2020-01-01_00-00-00.sql.bz2')
+        try:
+            self.storage.put(src, file_name)
+        except RuntimeError as e:
+            self.assertIn("Verification", str(e))
+        else:
+            self.fail("put did not fail")
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket='backups'))
+        # Not checked without verify
+        self.storage.put(src, file_name, verify=False)
+        self.assertEqual(len(self.client.list_objects_v2(Bucket='backups')['Contents']), 1)
+
+    def test_list_exists_and_remove(self):
+        self.client.put_object(Bucket='backups', Key='mysql/db__2020-01-01_00-00-00.sql.bz2', Body=b'12345')
+        self.client.put_object(Bucket='backups', Key='mysql/nested/db__2020-01-01_00-00-00.sql.bz2', Body=b'1')
+        self.client.put_object(Bucket='backups', Key='other/db__2020-01-01_00-00-00.sql.bz2', Body=b'1')
+        file_name = 's3://backups/mysql/db__2020-01-01_00-00-00.sql.bz2'
+        self.assertEqual(self.storage.list_files(), [file_name])
+        self.assertTrue(self.storage.exists(file_name))
+        self.assertEqual(self.storage.get_size(file_name), 5)
+        self.assertFalse(self.storage.exists('s3://backups/mysql/db__2020-01-02_00-00-00.sql.bz2'))
+        self.storage.remove(file_name)
+        self.assertFalse(self.storage.exists(file_name))
+        # Listed once per run
+        self.assertEqual(RunMetrics.get_values().get('directory_scans'), 1)
+        self.storage.reset()
+        self.assertEqual(self.storage.list_files(), [])
+
+    def test_owns_only_objects_directly_under_prefix(self):
+        self.assertEqual(str(self.storage), 's3://backups/mysql/')
+        self.assertTrue(self.storage.owns('s3://backups/mysql/db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertFalse(self.storage.owns('s3://backups/mysql/nested/db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertFalse(self.storage.owns('s3://backups/other/db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertFalse(self.storage.owns('s3://backups/mysqlx/db__2020-01-01_00-00-00.sql.bz2'))
+        self.assertFalse(self.storage.owns('/long_term/db__2020-01-01_00-00-00.sql.bz2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
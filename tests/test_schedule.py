@@ -0,0 +1,108 @@
+import shutil
+import tempfile
+import unittest
+
+from mysql_backup.mysql_backup_schedule import BackupSchedule
+from tests.helpers import make_config, stop_config
+
+NOW = 1000000000
+HOUR = 3600
+DAY = 86400
+
+
+class BackupScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.configure()
+
+    def tearDown(self):
+        BackupSchedule.stats = dict()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def configure(self, **settings):
+        values = dict(adaptive_frequency=True, adaptive_min_backup_frequency_seconds=HOUR,
+                      adaptive_max_backup_frequency_seconds=DAY, incremental_min_backup_frequency_seconds=6 * HOUR)
+        values.update(settings)
+        self.config = make_config(self.work_dir, **values)
+        BackupSchedule.configure(self.config)
+
+    def test_interval_follows_the_change_ratio_within_bounds(self):
+        get = BackupSchedule.get_learned_interval
+        self.assertEqual(get({'change_ratio': 1.0, 'size_bytes': 0}), HOUR)
+        self.assertEqual(get({'change_ratio': 0.0, 'size_bytes': 0}), DAY)
+        self.assertEqual(get({'change_ratio': 0.5, 'size_bytes': 0}), (HOUR + DAY) // 2)
+        # Out of range ratios stay within the bounds
+        self.assertEqual(get({'change_ratio': 1.5, 'size_bytes': 0}), HOUR)
+        self.assertEqual(get({'change_ratio': -0.5, 'size_bytes': 0}), DAY)
+
+    def test_bytes_per_day_floor(self):
+        self.configure(adaptive_max_dump_bytes_per_day=10 * 1024 ** 3)
+        get = BackupSchedule.get_learned_interval
+        # 5 GB dumps at most twice a day
+        self.assertEqual(get({'change_ratio': 1.0, 'size_bytes': 5 * 1024 ** 3}), DAY // 2)
+        self.assertEqual(get({'change_ratio': 1.0, 'size_bytes': 1024 ** 2}), HOUR)
+        # Never beyond the upper bound
+        self.assertEqual(get({'change_ratio': 1.0, 'size_bytes': 100 * 1024 ** 3}), DAY)
+
+    def test_no_bounds(self):
+        self.configure(adaptive_frequency=False, adaptive_min_backup_frequency_seconds=None)
+        self.assertIsNone(BackupSchedule.get_learned_interval({'change_ratio': 1.0, 'size_bytes': 0}))
+        self.assertEqual(BackupSchedule.get_interval('db'), 6 * HOUR)
+
+    def test_bounds_are_checked(self):
+        self.assertRaises(ValueError, self.configure, adaptive_min_backup_frequency_seconds=DAY,
+                          adaptive_max_backup_frequency_seconds=HOUR)
+        self.assertRaises(ValueError, self.configure, adaptive_max_backup_frequency_seconds=None)
+
+    def test_record_smooths_the_outcomes(self):
+        BackupSchedule.record('db', True, 1000, now=NOW)
+        self.assertEqual(BackupSchedule.get_stats()['db'], {'change_ratio': 1.0, 'size_bytes': 1000, 'attempts': 1,
+                                                            'last_attempt': NOW, 'interval_seconds': HOUR})
+        BackupSchedule.record('db', False, 2000, now=NOW + HOUR)
+        entry = BackupSchedule.get_stats()['db']
+        self.assertAlmostEqual(entry['change_ratio'], 0.7)
+        self.assertEqual(entry['size_bytes'], 1300)
+        self.assertEqual((entry['attempts'], entry['last_attempt']), (2, NOW + HOUR))
+        self.assertEqual(entry['interval_seconds'], BackupSchedule.get_learned_interval(entry))
+        # An attempt without a dump leaves the size alone
+        BackupSchedule.record('db', False, None, now=NOW + 2 * HOUR)
+        self.assertEqual(BackupSchedule.get_stats()['db']['size_bytes'], 1300)
+
+    def test_unchanged_databases_back_off(self):
+        intervals = list()
+        for attempt in range(10):
+            BackupSchedule.record('db', attempt == 0, 1000, now=NOW + attempt * HOUR)
+            intervals.append(BackupSchedule.get_interval('db'))
+        self.assertEqual(intervals[0], HOUR)
+        self.assertTrue(all(shorter < longer for shorter, longer in zip(intervals, intervals[1:])))
+        self.assertTrue(intervals[-1] < DAY)
+        self.assertEqual(BackupSchedule.get_interval('new'), HOUR)
+
+    def test_record_run_counts_only_attempts(self):
+        BackupSchedule.record_run({'a': {'dump_attempts': 1, 'dumps_changed': 1, 'dump_bytes': 10},
+                                   'b': {'dump_attempts': 1, 'dump_bytes': 20},
+                                   'c': {'files_pruned': 3}}, now=NOW)
+        stats = BackupSchedule.get_stats()
+        self.assertEqual(sorted(stats), ['a', 'b'])
+        self.assertEqual((stats['a']['change_ratio'], stats['b']['change_ratio']), (1.0, 0.0))
+
+    def test_prune_forgets_databases_not_attempted(self):
+        BackupSchedule.record('old', True, 10, now=NOW - 10 * DAY)
+        BackupSchedule.record('recent', True, 10, now=NOW - DAY)
+        BackupSchedule.load(dict(BackupSchedule.get_stats(), legacy={'change_ratio': 1.0, 'size_bytes': 0,
+                                                                      'attempts': 1}))
+        BackupSchedule.prune(None, now=NOW)
+        self.assertEqual(len(BackupSchedule.get_stats()), 3)
+        BackupSchedule.prune(7 * DAY, now=NOW)
+        # An entry without last_attempt is kept
+        self.assertEqual(sorted(BackupSchedule.get_stats()), ['legacy', 'recent'])
+        BackupSchedule.prune(DAY, now=NOW)
+        self.assertEqual(sorted(BackupSchedule.get_stats()), ['legacy', 'recent'])
+        BackupSchedule.prune(DAY - 1, now=NOW)
+        self.assertEqual(sorted(BackupSchedule.get_stats()), ['legacy'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import errno
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+# First, as a run does: the segments and the package's main module import each other
+import mysql_backup.mysql_backup
+from mysql_backup.mysql_backup_directory_snapshot import BackupDirectorySnapshot
+from mysql_backup.mysql_backup_page_cache import PageCache
+from mysql_backup.mysql_backup_schedule import BackupSchedule
+from mysql_backup.mysql_backup_segments import SegmentReferences, TableSegments, MANIFEST_VERSION, \
+    SWEEP_MIN_AGE_SECONDS
+from mysql_backup.mysql_backup_throttle import MysqlBackupThrottle
+from mysql_backup.mysql_db_instance import MysqlDbInstance
+from run_metrics.run_metrics import RunMetrics
+from tests.helpers import make_config, stop_config
+
+
+class FakeInstance(object):
+    """A backup instance whose manifest refers to segment_files"""
+
+    def __init__(self, segment_files):
+        self.segment_files = segment_files
+
+    def get_segment_files(self):
+        return list(self.segment_files)
+
+
+class SegmentReferencesTest(unittest.TestCase):
+
+    def test_shared_segment_outlives_one_manifest(self):
+        references = SegmentReferences()
+        references.add(['1.a.sql', '1.b.sql'])
+        references.add(['1.a.sql', '2.b.sql'])
+        self.assertEqual(references.get('1.a.sql'), 2)
+        self.assertEqual(references.release(['1.a.sql', '1.b.sql']), ['1.b.sql'])
+        self.assertEqual(references.get('1.a.sql'), 1)
+        self.assertEqual(references.get('1.b.sql'), 0)
+        self.assertEqual(references.release(['1.a.sql', '2.b.sql']), ['1.a.sql', '2.b.sql'])
+        self.assertEqual(references.counts, {})
+
+    def test_release_of_unknown_segment(self):
+        references = SegmentReferences()
+        self.assertEqual(references.release(['1.a.sql']), ['1.a.sql'])
+        self.assertEqual(references.get('1.a.sql', None), None)
+
+
+class TableSegmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.config = make_config(self.work_dir, incremental_path=self.work_dir, table_level_incremental=True,
+                                  retention_io_threads=1, deletion_retries=0)
+        self.directory = TableSegments.get_directory(self.config, 'db')
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+        BackupSchedule.configure(self.config)
+        self.db_instance = MysqlDbInstance(self.config, 'db')
+
+    def tearDown(self):
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def write_segments(self, segment_files, age_seconds=0):
+        when = time.time() - age_seconds
+        for segment_file in segment_files:
+            segment_path = os.path.join(self.directory, segment_file)
+            with open(segment_path, 'w') as segment_pointer:
+                segment_pointer.write(segment_file)
+            os.utime(segment_path, (when, when))
+
+    def test_removes_only_segments_no_other_manifest_refers_to(self):
+        self.write_segments(['1.a.sql', '1.b.sql', '2.b.sql'])
+        old = FakeInstance(['1.a.sql', '1.b.sql'])
+        new = FakeInstance(['1.a.sql', '2.b.sql'])
+        segment_files = MysqlDbInstance.get_segment_files_by_instance([old, new])
+        self.db_instance.remove_unreferenced_segments(segment_files, [old])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['1.a.sql', '2.b.sql'])
+        self.db_instance.remove_unreferenced_segments(MysqlDbInstance.get_segment_files_by_instance([new]), [new])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_removing_every_sharing_manifest_at_once(self):
+        self.write_segments(['1.a.sql', '2.a.sql', '3.a.sql'])
+        first = FakeInstance(['1.a.sql'])
+        second = FakeInstance(['1.a.sql', '2.a.sql'])
+        third = FakeInstance(['1.a.sql', '3.a.sql'])
+        segment_files = MysqlDbInstance.get_segment_files_by_instance([first, second, third])
+        self.db_instance.remove_unreferenced_segments(segment_files, [first, second])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['1.a.sql', '3.a.sql'])
+
+    def test_sweep_removes_old_unreferenced_segments(self):
+        self.write_segments(['1.a.sql', '1.b.sql'], age_seconds=SWEEP_MIN_AGE_SECONDS + 60)
+        # Perhaps of a backup being written
+        self.write_segments(['2.b.sql'])
+        self.db_instance.mysql_backup_instances = [FakeInstance(['1.a.sql'])]
+        self.db_instance.sweep_segments()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['1.a.sql', '2.b.sql'])
+
+    def test_instance_checksum_follows_segment_content_only(self):
+        segments = [{'table': 'b', 'checksum': '2'}, {'table': None, 'checksum': '0'}, {'table': 'a', 'checksum': '1'}]
+        checksum = TableSegments.get_instance_checksum(self.config, segments)
+        self.assertEqual(TableSegments.get_instance_checksum(self.config, list(reversed(segments))), checksum)
+        changed = [dict(segment) for segment in segments]
+        changed[0]['checksum'] = '3'
+        self.assertNotEqual(TableSegments.get_instance_checksum(self.config, changed), checksum)
+
+    def test_manifest_round_trip_and_version(self):
+        manifest_name = os.path.join(self.work_dir, 'db.manifest')
+        manifest = {'version': MANIFEST_VERSION, 'segments': [{'table': 'a', 'file': '1.a.sql', 'checksum': '1'}]}
+        TableSegments.write_manifest(manifest, manifest_name)
+        self.assertEqual(TableSegments.read_manifest(manifest_name), manifest)
+        self.assertFalse(os.path.exists(manifest_name + '.tmp'))
+        TableSegments.write_manifest({'version': MANIFEST_VERSION + 1}, manifest_name)
+        self.assertRaises(ValueError, TableSegments.read_manifest, manifest_name)
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.segment_path = os.path.join(self.work_dir, '1.a.sql')
+        with open(self.segment_path, 'w') as segment_pointer:
+            segment_pointer.write('INSERT INTO a VALUES (1);\n' * 10000)
+        self.failing_compressor = os.path.join(self.work_dir, 'failing_gzip')
+        with open(self.failing_compressor, 'w') as compressor_pointer:
+            compressor_pointer.write('#!/bin/sh\necho "gzip: write error: I/O or other error, bailing out" >&2\n'
+                                     'exit 2\n')
+        os.chmod(self.failing_compressor, 0o755)
+        self.stream = MysqlBackupThrottle.stream
+        self.drop = PageCache.drop
+        PageCache.drop = False
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+
+    def tearDown(self):
+        MysqlBackupThrottle.stream = staticmethod(self.stream)
+        PageCache.drop = self.drop
+        BackupDirectorySnapshot.reset()
+        RunMetrics.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def compress(self, compress_command):
+        self.config = make_config(self.work_dir, compress_command=compress_command, compressed_file_extension='gz',
+                                  checksum_buffer_size=4096)
+        # Listed, so the snapshot is asked about what is left
+        BackupDirectorySnapshot.get_entries(self.work_dir)
+        return TableSegments.compress(self.config, 'db', self.segment_path)
+
+    def test_compresses_and_removes_the_segment(self):
+        self.assertEqual(self.compress('gzip'), '1.a.sql.gz')
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['1.a.sql.gz', 'failing_gzip'])
+        self.assertTrue(BackupDirectorySnapshot.exists(self.segment_path + '.gz'))
+        self.assertEqual(RunMetrics.get_values('db').get('compressed_bytes'),
+                         os.path.getsize(self.segment_path + '.gz'))
+
+    def test_failed_compressor_names_its_error(self):
+        try:
+            self.compress(self.failing_compressor)
+        except RuntimeError as e:
+            self.assertIn("bailing out", str(e))
+        else:
+            self.fail("compress did not fail")
+        self.assertEqual(os.listdir(self.work_dir), ['failing_gzip'])
+        self.assertFalse(BackupDirectorySnapshot.exists(self.segment_path + '.gz'))
+
+    def test_failed_write_kills_the_compressor(self):
+        processes = list()
+        popen = subprocess.Popen
+
+        class Popen(popen):
+            def __init__(self, *args, **kwargs):
+                popen.__init__(self, *args, **kwargs)
+                processes.append(self)
+
+        def stream(stage, src_pointer, dst_pointer, buffer_size, hash_obj=None):
+            dst_pointer.write(src_pointer.read(1024))
+            raise IOError(errno.ENOSPC, "No space left on device")
+        MysqlBackupThrottle.stream = staticmethod(stream)
+        subprocess.Popen = Popen
+        self.addCleanup(setattr, subprocess, 'Popen', popen)
+        try:
+            self.compress('gzip')
+        except IOError as e:
+            self.assertEqual(e.errno, errno.ENOSPC)
+        else:
+            self.fail("compress did not fail")
+        # Reaped, not left blocked on its pipe
+        self.assertEqual(len(processes), 1)
+        self.assertIsNotNone(processes[0].returncode)
+        self.assertEqual(os.listdir(self.work_dir), ['failing_gzip'])
+        self.assertFalse(BackupDirectorySnapshot.exists(self.segment_path + '.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
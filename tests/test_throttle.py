@@ -0,0 +1,127 @@
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mysql_backup import mysql_backup_throttle
+from mysql_backup.mysql_backup_throttle import MysqlBackupThrottle, TokenBucket
+from run_metrics.run_metrics import RunMetrics
+from tests.helpers import make_config, stop_config
+
+
+class FakeTime(object):
+    """Stands in for the time module, sleeping moves the clock on"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = list()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        mysql_backup_throttle.time = self.clock
+        self.addCleanup(setattr, mysql_backup_throttle, 'time', time)
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(100)
+        self.assertEqual(bucket.consume(60), 0)
+        self.assertEqual(bucket.consume(40), 0)
+        # Into debt, waited off by the writer
+        self.assertEqual(bucket.consume(50), 0.5)
+        self.assertEqual(self.clock.now, 1000.5)
+        self.assertEqual(bucket.consume(100), 1.0)
+
+    def test_refills_up_to_burst(self):
+        bucket = TokenBucket(100, burst=200)
+        self.assertEqual(bucket.consume(200), 0)
+        self.clock.now += 1
+        self.assertEqual(bucket.consume(100), 0)
+        # Idle for long, still no more than burst
+        self.clock.now += 60
+        self.assertEqual(bucket.consume(200), 0)
+        self.assertEqual(bucket.consume(50), 0.5)
+
+    def test_factor_scales_the_rate(self):
+        bucket = TokenBucket(100)
+        bucket.consume(100)
+        self.assertEqual(bucket.consume(50, 0.5), 1.0)
+        self.assertEqual(self.clock.slept, [1.0])
+
+
+class AdaptiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='mysql_backup_test_')
+        self.config = make_config(self.work_dir)
+        MysqlBackupThrottle.backup_logger = self.config.get_logger('throttle')
+        MysqlBackupThrottle.factor = multiprocessing.Value('d', 1.0, lock=False)
+        MysqlBackupThrottle.adaptive = True
+        MysqlBackupThrottle.adaptive_max_lag_seconds = 60
+        MysqlBackupThrottle.adaptive_min_fraction = 0.1
+        MysqlBackupThrottle.adaptive_check_interval_seconds = 3600
+        MysqlBackupThrottle.rates = {'compress': 100}
+        RunMetrics.reset()
+
+    def tearDown(self):
+        MysqlBackupThrottle.stop_adaptive()
+        MysqlBackupThrottle.factor = None
+        MysqlBackupThrottle.adaptive = False
+        MysqlBackupThrottle.rates = dict()
+        RunMetrics.reset()
+        stop_config(self.config)
+        shutil.rmtree(self.work_dir)
+
+    def adjust(self, lag):
+        MysqlBackupThrottle.adjust(lag)
+        return MysqlBackupThrottle.get_factor()
+
+    def test_halved_while_behind_down_to_the_minimum(self):
+        self.assertEqual([self.adjust(lag) for lag in (61, 120, 61, 61, 61)], [0.5, 0.25, 0.125, 0.1, 0.1])
+        self.assertEqual(RunMetrics.get_values().get('throttle_backoffs'), 4)
+
+    def test_doubled_once_under_half_the_lag(self):
+        MysqlBackupThrottle.factor.value = 0.1
+        # Between half and the maximum nothing changes
+        self.assertEqual([self.adjust(lag) for lag in (60, 31, 30, 0, 0, 0, 0)], [0.1, 0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+        self.assertIsNone(RunMetrics.get_values().get('throttle_backoffs'))
+
+    def test_unknown_lag_changes_nothing(self):
+        MysqlBackupThrottle.factor.value = 0.25
+        self.assertEqual(self.adjust(None), 0.25)
+        MysqlBackupThrottle.factor = None
+        MysqlBackupThrottle.adjust(120)
+        self.assertEqual(MysqlBackupThrottle.get_factor(), 1.0)
+
+    def test_monitor_samples_at_once_and_restores_the_rates(self):
+        sampled = threading.Event()
+
+        def get_lag():
+            sampled.set()
+            return 120
+        MysqlBackupThrottle.start_adaptive(get_lag)
+        # Long before adaptive_check_interval_seconds
+        self.assertTrue(sampled.wait(10))
+        MysqlBackupThrottle.stop_adaptive()
+        self.assertEqual(RunMetrics.get_values().get('throttle_backoffs'), 1)
+        self.assertEqual(MysqlBackupThrottle.get_factor(), 1.0)
+        self.assertIsNone(MysqlBackupThrottle.monitor)
+
+    def test_monitor_only_with_rates(self):
+        MysqlBackupThrottle.rates = dict()
+        MysqlBackupThrottle.start_adaptive(lambda: 120)
+        self.assertIsNone(MysqlBackupThrottle.monitor)
+
+
+if __name__ == '__main__':
+    unittest.main()